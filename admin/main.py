@@ -7,6 +7,7 @@ from starlette.middleware.sessions import SessionMiddleware
 from starlette.templating import Jinja2Templates
 from slowapi import Limiter
 from slowapi.util import get_remote_address
+import asyncio
 import os
 import logging
 import secrets
@@ -22,7 +23,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 from app.logging_config import setup_logging, _SecretMaskingFilter
 from app.settings import settings
-from app.infra.sqlite_utils import open_connection
+from app.infra.sqlite_utils import connection_pool_stats, open_connection
+from app.infra.sqlite_writer import sqlite_writer_stats
 from dotenv import load_dotenv
 
 
@@ -294,6 +296,41 @@ from fastapi import HTTPException
 app.add_exception_handler(Exception, global_exception_handler)
 
 
+@app.on_event("startup")
+async def start_warmup() -> None:
+    """Фоновый прогрев кэшей после старта: индекс токенов, соединения с панелями, payload'ы подписок"""
+    from bot.services.startup_warmup import ADMIN_WARMUP_STEPS, startup_warmup
+
+    startup_warmup.start(ADMIN_WARMUP_STEPS)
+
+
+@app.on_event("shutdown")
+async def close_panel_clients() -> None:
+    """Закрыть общий пул соединений к панелям V2Ray при остановке админки"""
+    from vpn_protocols import close_v2ray_clients
+
+    await close_v2ray_clients()
+
+
+@app.on_event("shutdown")
+async def flush_write_behind() -> None:
+    """Записать накопленные отложенные записи (last_updated_at подписок и т.п.)"""
+    from app.infra.write_behind import flush_write_behind_buffers
+
+    await flush_write_behind_buffers()
+
+
+@app.on_event("shutdown")
+async def close_sqlite_pools() -> None:
+    """Дописать очередь писателя и закрыть пулы соединений SQLite (sqlite3 и aiosqlite)"""
+    from app.infra.sqlite_utils import close_async_connection_pools, close_connection_pools
+    from app.infra.sqlite_writer import close_sqlite_writers
+
+    await asyncio.to_thread(close_sqlite_writers)
+    await close_async_connection_pools()
+    close_connection_pools()
+
+
 @app.get("/healthz", tags=["health"])
 async def health_check():
     """
@@ -325,7 +362,9 @@ async def health_check():
         db_time = (time.time() - db_start) * 1000  # в миллисекундах
         health_status["checks"]["database"] = {
             "status": "ok",
-            "response_time_ms": round(db_time, 2)
+            "response_time_ms": round(db_time, 2),
+            "pools": connection_pool_stats(),
+            "writers": sqlite_writer_stats(),
         }
     except Exception as exc:
         logging.exception("Database health check failed: %s", exc)
@@ -397,6 +436,11 @@ async def health_check():
             "note": "Non-critical check"
         }
     
+    # Прогрев после старта (не влияет на статус: пока он идёт, запросы обслуживаются обычным путём)
+    from bot.services.startup_warmup import startup_warmup
+
+    health_status["checks"]["warmup"] = startup_warmup.status()
+
     # Метрики производительности
     total_time = (time.time() - start_time) * 1000
     health_status["metrics"] = {
@@ -410,6 +454,39 @@ async def health_check():
         return JSONResponse(health_status, status_code=503)
     
     return JSONResponse(health_status)
+
+
+@app.get("/metrics", tags=["health"])
+async def panel_metrics_endpoint(request: Request):
+    """
+    Метрики запросов к панелям V2Ray в текстовом формате Prometheus.
+
+    Доступ: заголовок Authorization: Bearer <VEILBOT_METRICS_TOKEN> или сессия администратора.
+    Включает серии процесса админки и последние снимки бота (panel_metrics_snapshots).
+    """
+    from fastapi.responses import PlainTextResponse
+    from app.infra.panel_health import panel_key
+    from app.infra.panel_metrics import panel_metrics, render_prometheus
+    from app.repositories.server_repository import ServerRepository
+
+    token = os.getenv("VEILBOT_METRICS_TOKEN", "")
+    auth_header = request.headers.get("Authorization", "")
+    token_ok = bool(token) and secrets.compare_digest(auth_header, f"Bearer {token}")
+    if not token_ok and not request.session.get("admin_logged_in"):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    server_ids = {}
+    try:
+        for row in ServerRepository().list_servers():
+            server_ids.setdefault(panel_key(row[2]), row[0])
+    except Exception as exc:
+        logging.debug("Panel metrics: failed to map servers: %s", exc)
+    return PlainTextResponse(
+        render_prometheus(panel_metrics.collect(), server_ids),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 app.add_exception_handler(HTTPException, http_exception_handler)
 app.add_exception_handler(RequestValidationError, validation_exception_handler)
 
@@ -18,8 +18,9 @@ from typing import Any, Dict, Optional
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from app.repositories.key_repository import KeyRepository
 from vpn_protocols import ProtocolFactory
-from vpn_protocols import V2RayProtocol
+from vpn_protocols import get_v2ray_client
 import aiohttp
+from app.infra.search_index import key_search_condition
 from app.infra.sqlite_utils import open_connection
 from app.settings import settings
 
@@ -409,19 +410,9 @@ def _compute_filtered_key_stats(
                 where.append("k.server_id = ?")
                 params.append(server_id)
             if search_query:
-                search_pattern = f"%{search_query}%"
-                search_conditions = [
-                    "CAST(k.id AS TEXT) LIKE ?",
-                    "k.email LIKE ?",
-                    "IFNULL(s.name,'') LIKE ?",
-                    "IFNULL(t.name,'') LIKE ?",
-                    "CAST(k.user_id AS TEXT) LIKE ?",
-                    "k.v2ray_uuid LIKE ?",
-                    "(k.id || '_v2ray') LIKE ?",
-                    "CAST(k.subscription_id AS TEXT) LIKE ?",
-                ]
-                where.append("(" + " OR ".join(search_conditions) + ")")
-                params.extend([search_pattern] * len(search_conditions))
+                search_condition, search_params = key_search_condition(c, search_query)
+                where.append(search_condition)
+                params.extend(search_params)
             where_sql = (" WHERE " + " AND ".join(where)) if where else ""
             return base_sql + where_sql, params
         
@@ -498,7 +489,7 @@ async def _delete_key_internal(request: Request, key_id: int | str, key_repo: Ke
                 if server and server[0] and server[1]:
                     try:
                         log_admin_action(request, "V2RAY_DELETE_ATTEMPT", f"Attempting to delete user {v2ray_uuid} from server {server[0]}")
-                        protocol_client = V2RayProtocol(server[0], server[1])
+                        protocol_client = get_v2ray_client(server[0], server[1])
                         result = await protocol_client.delete_user(v2ray_uuid)
                         if result:
                             log_admin_action(request, "V2RAY_DELETE_SUCCESS", f"Successfully deleted user {v2ray_uuid} from server")
@@ -2,7 +2,7 @@
 Маршруты для управления серверами
 """
 from fastapi import APIRouter, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from starlette.status import HTTP_303_SEE_OTHER
 import sys
 import os
@@ -15,7 +15,9 @@ from app.repositories.server_repository import ServerRepository
 from app.settings import settings
 from app.infra.sqlite_utils import open_connection
 from app.infra.foreign_keys import safe_foreign_keys_off
-from vpn_protocols import V2RayProtocol
+from app.infra.panel_health import STATE_HALF_OPEN, STATE_OPEN, panel_health, panel_key
+from app.infra.panel_metrics import panel_metrics, summarize_by_panel
+from vpn_protocols import get_v2ray_client
 
 from ..middleware.audit import log_admin_action
 from ..dependencies.csrf import get_csrf_token, validate_csrf_token
@@ -42,6 +44,46 @@ def _normalize_v2ray_api_url(api_url: str) -> str:
     return urlunparse(normalized).rstrip('/')
 
 
+def _panel_health_view(
+    api_url: str | None, persisted: dict[str, dict], metrics: dict[str, dict] | None = None
+) -> dict:
+    """Состояние breaker'а панели для шаблона: своё (процесс админки) или снимок бота из БД."""
+    state = panel_health.get_state(api_url)
+    if not state.get("known"):
+        state = persisted.get(panel_key(api_url), state)
+
+    if not state.get("known"):
+        badge_class, label = "badge-neutral", "Нет данных"
+    elif state["state"] == STATE_OPEN:
+        badge_class, label = "badge-error", "Недоступна"
+    elif state["state"] == STATE_HALF_OPEN:
+        badge_class, label = "badge-warning", "Проверка"
+    else:
+        badge_class, label = "badge-success", "OK"
+
+    details = []
+    if state.get("error_rate") is not None:
+        details.append(f"ошибок {state['error_rate'] * 100:.0f}%")
+    if state.get("latency_ewma_ms") is not None:
+        details.append(f"{state['latency_ewma_ms']:.0f} мс")
+    if state.get("last_error") and state["state"] != "closed":
+        details.append(str(state["last_error"]))
+    summary = (metrics or {}).get(panel_key(api_url))
+    if summary:
+        if summary.get("p95_ms") is not None:
+            details.append(f"p95 {summary['p95_ms']:.0f} мс")
+        details.append(f"запросов {summary['requests']}, ошибок {summary['errors']}")
+        if summary.get("slowest_endpoint"):
+            details.append(f"медленнее всего {summary['slowest_endpoint']}")
+    return {
+        "state": state["state"],
+        "badge_class": badge_class,
+        "label": label,
+        "title": ", ".join(details) or label,
+        "latency_ms": state.get("latency_ewma_ms"),
+    }
+
+
 def _prepare_servers_context(repo: ServerRepository, search_query: str | None = None) -> tuple[list[dict], int]:
     """Build a list of server dicts ready for template rendering."""
     raw_servers = repo.list_servers(search_query=search_query)
@@ -50,6 +92,8 @@ def _prepare_servers_context(repo: ServerRepository, search_query: str | None =
 
     server_ids = [row[0] for row in raw_servers]
     v2ray_key_counts = repo.v2ray_key_counts(server_ids)
+    persisted_health = panel_health.load_persisted()
+    metrics_summary = summarize_by_panel(panel_metrics.collect())
 
     servers_for_template: list[dict] = []
     for row in raw_servers:
@@ -101,6 +145,7 @@ def _prepare_servers_context(repo: ServerRepository, search_query: str | None =
                 "display_host": display_host,
                 "subscription_group_id": (subscription_group_id or "").strip(),
                 "subscription_group_display": group_display,
+                "panel_health": _panel_health_view(api_url, persisted_health, metrics_summary),
             }
         )
 
@@ -215,6 +260,9 @@ async def add_server(
                         loop = asyncio.new_event_loop()
                         asyncio.set_event_loop(loop)
                         loop.run_until_complete(create_keys_for_new_server(server_id))
+                        # Сессия пула привязана к этому loop — закрываем до loop.close()
+                        from vpn_protocols import close_v2ray_clients
+                        loop.run_until_complete(close_v2ray_clients())
                         loop.close()
                     except Exception as e:
                         logging.error(f"Error in background task for server {server_id}: {e}", exc_info=True)
@@ -263,6 +311,33 @@ async def add_server(
         })
 
 
+@router.get("/api/servers/panel-metrics")
+async def panel_metrics_api(request: Request):
+    """Метрики запросов к панелям по серверам: сводка (p50/p95, ошибки) и серии по эндпоинтам."""
+    if not request.session.get("admin_logged_in"):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    series = panel_metrics.collect()
+    summary = summarize_by_panel(series)
+    repo = ServerRepository(DATABASE_PATH)
+    servers = []
+    for row in repo.list_servers():
+        server_id, name, api_url = row[0], row[1], row[2]
+        key = panel_key(api_url)
+        servers.append({
+            "id": server_id,
+            "name": name,
+            "panel": key,
+            "summary": summary.get(key),
+            "endpoints": [
+                {k: v for k, v in item.items() if k != "panel"}
+                for item in series
+                if item["panel"] == key
+            ],
+        })
+    return JSONResponse({"servers": servers})
+
+
 @router.get("/delete_server/{server_id}", response_class=HTMLResponse)
 async def delete_server(request: Request, server_id: int):
     """Удаление сервера"""
@@ -514,7 +589,7 @@ async def _delete_all_keys_from_server(
                 if v2ray_keys and api_url and api_key:
                     protocol_client = None
                     try:
-                        protocol_client = V2RayProtocol(api_url, api_key)
+                        protocol_client = get_v2ray_client(api_url, api_key)
                         for key_id, v2ray_uuid, user_id in v2ray_keys:
                             if v2ray_uuid:
                                 try:
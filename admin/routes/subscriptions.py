@@ -2,7 +2,7 @@
 API маршруты для подписок V2Ray
 """
 from fastapi import APIRouter, Request, HTTPException, Form, Body
-from fastapi.responses import PlainTextResponse, RedirectResponse, JSONResponse, HTMLResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse, JSONResponse, HTMLResponse, Response
 from pydantic import BaseModel
 from slowapi import Limiter
 from slowapi.util import get_remote_address
@@ -17,13 +17,16 @@ from typing import Optional, Dict, Any
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from bot.services.subscription_service import SubscriptionService, validate_subscription_token
-from app.repositories.subscription_repository import SubscriptionRepository
+from bot.services.subscription_payloads import etag_matches, rebuild_subscription_payload, subscription_payloads
+from bot.services.startup_warmup import startup_warmup
+from bot.services.subscription_token_index import subscription_tokens
+from app.repositories.subscription_repository import SubscriptionRepository, subscription_last_seen_buffer
 from app.repositories.user_repository import UserRepository
 from app.repositories.server_repository import ServerRepository
 from app.settings import settings
 from app.infra.sqlite_utils import open_connection
 from app.infra.foreign_keys import safe_foreign_keys_off
-from vpn_protocols import V2RayProtocol
+from vpn_protocols import get_v2ray_client
 from ..middleware.audit import log_admin_action
 from ..dependencies.csrf import get_csrf_token
 from ..dependencies.templates import templates
@@ -696,7 +699,7 @@ async def _delete_subscription_internal(request: Request, subscription_id: int)
                         "V2RAY_DELETE_ATTEMPT",
                         f"Attempting to delete key {key_id} from server {api_url} for subscription {subscription_id}"
                     )
-                    protocol_client = V2RayProtocol(api_url, api_key_or_cert)
+                    protocol_client = get_v2ray_client(api_url, api_key_or_cert)
                     result = await protocol_client.delete_user(key_id)
                     if result:
                         deleted_v2ray_count += 1
@@ -849,11 +852,80 @@ def _safe_header_value(value: str | None) -> str | None:
         return safe_value or None
 
 
+def _subscription_response_headers(metadata: Dict[str, Any], etag: Optional[str]) -> Dict[str, str]:
+    """Заголовки ответа подписки: Subscription-Userinfo, Profile-Title, ETag и запрет кэширования."""
+    userinfo_header = None
+    title_header = None
+    if metadata:
+        usage_bytes = metadata.get("traffic_usage_bytes") or 0
+        limit_bytes = metadata.get("traffic_limit_bytes") or 0
+        expires_ts = metadata.get("expires_at") or 0
+        # Формат заголовка Subscription-Userinfo согласно спецификации v2ray
+        # Стандартный формат: upload=<bytes>; download=<bytes>; total=<bytes>; expire=<timestamp>
+        # Примечание: В приложении v2raytun отображение использованного трафика не работает (показывает 0),
+        # хотя лимит трафика (total) отображается правильно. Это похоже на проблему/ограничение самого v2raytun.
+        # В других приложениях (например, v2rayNG) все работает корректно.
+        # Формат корректен по спецификации v2ray и оставлен как стандартный.
+        userinfo_header = f"upload=0; download={usage_bytes}; total={limit_bytes}; expire={expires_ts}"
+        # Устанавливаем Profile-Title с названием "Vee VPN", чтобы избежать использования названия сервера
+        subscription_title = metadata.get("subscription_title") or "Vee VPN"
+        # URL-кодируем название для безопасного использования в заголовке
+        from urllib.parse import quote
+        title_header = quote(subscription_title, safe='')
+
+    # no-cache (а не no-store): клиент может хранить ответ, но обязан перепроверить его по ETag
+    response_headers = {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Cache-Control": "no-cache, must-revalidate",
+        "Pragma": "no-cache",
+        "Expires": "0",
+    }
+    if etag:
+        response_headers["ETag"] = etag
+    if userinfo_header:
+        response_headers["Subscription-Userinfo"] = userinfo_header
+    if title_header:
+        # Устанавливаем Profile-Title, чтобы приложение использовало его вместо названия сервера
+        response_headers["Profile-Title"] = title_header
+    return response_headers
+
+
+def _log_subscription_servers(token: str, content: str) -> None:
+    """Отладочный вывод названий первых серверов собранной подписки"""
+    import base64
+    from urllib.parse import unquote
+    try:
+        decoded = base64.b64decode(content).decode('utf-8')
+        lines = decoded.split('\n')
+        for line in lines[:2]:  # Проверяем первые 2 сервера
+            if '#' in line:
+                fragment = line.split('#')[-1]
+                decoded_name = unquote(fragment)
+                logger.info(f"Subscription {token[:8]}... contains server: {decoded_name}")
+            else:
+                logger.warning(f"Subscription {token[:8]}... server URL missing fragment!")
+    except Exception as e:
+        logger.error(f"Error checking subscription content: {e}")
+
+
+def _mark_subscription_served(state) -> None:
+    """Отметить выдачу подписки (200 или 304) в last_updated_at через write-behind буфер"""
+    if state is None:
+        return
+    try:
+        subscription_last_seen_buffer(subscription_payloads.db_path).touch(state.subscription_id)
+    except Exception as e:
+        logger.warning(f"Failed to touch last_updated_at for subscription {state.subscription_id}: {e}")
+
+
 @router.get("/api/subscription/{token}", response_class=PlainTextResponse)
 @limiter.limit("60/minute")
 async def get_subscription(request: Request, token: str):
     """
     Получить подписку V2Ray по токену
+
+    Ответ берётся из материализованного payload (subscription_payloads), пока не изменились
+    входные данные подписки; If-None-Match с актуальным ETag даёт 304 без тела.
     
     Returns:
         Base64-кодированная строка с VLESS URL или ошибка
@@ -864,75 +936,68 @@ async def get_subscription(request: Request, token: str):
             logger.warning(f"Invalid subscription token format: {token[:8]}...")
             raise HTTPException(status_code=400, detail="Invalid token format")
 
-        # Инвалидируем кэш перед генерацией, чтобы всегда получать свежие данные
-        # Это гарантирует, что названия серверов будут актуальными
-        from bot.services.subscription_service import invalidate_subscription_cache, _subscription_cache
-        invalidate_subscription_cache(token)
-        # Также очищаем внутренний кэш для гарантии
-        cache_key = f"subscription:{token}"
-        _subscription_cache.delete(cache_key)
-
-        # Генерация подписки
-        service = SubscriptionService()
-        package = await service.generate_subscription_package(token)
-        content = package["content"] if package else None
-        
-        # Логируем для отладки
-        if content:
-            import base64
-            from urllib.parse import unquote
-            try:
-                decoded = base64.b64decode(content).decode('utf-8')
-                lines = decoded.split('\n')
-                for line in lines[:2]:  # Проверяем первые 2 сервера
-                    if '#' in line:
-                        fragment = line.split('#')[-1]
-                        decoded_name = unquote(fragment)
-                        logger.info(f"Subscription {token[:8]}... contains server: {decoded_name}")
-                    else:
-                        logger.warning(f"Subscription {token[:8]}... server URL missing fragment!")
-            except Exception as e:
-                logger.error(f"Error checking subscription content: {e}")
+        # Неизвестные токены (сканеры, ссылки удалённых подписок) отсекаются без обращения к БД
+        if not await subscription_tokens.might_exist(token):
+            raise HTTPException(status_code=404, detail="Subscription not found or expired")
+
+        if_none_match = request.headers.get("if-none-match")
+        state = None
+        payload = None
+        try:
+            state = await subscription_payloads.load_state(token)
+        except Exception as e:
+            logger.warning(f"[SUBSCRIPTION_PAYLOAD] Failed to load payload state for {token[:8]}...: {e}")
+        else:
+            if state is None:
+                subscription_tokens.mark_missing(token)
+                logger.warning(f"Subscription not found for token {token[:8]}...")
+                raise HTTPException(status_code=404, detail="Subscription not found or expired")
 
-        if content is None:
+        if state is not None and not state.servable:
             logger.warning(f"Subscription not found or expired for token {token[:8]}...")
             raise HTTPException(status_code=404, detail="Subscription not found or expired")
 
-        metadata = (package or {}).get("metadata", {}) if package else {}
-        userinfo_header = None
-        title_header = None
-        if metadata:
-            usage_bytes = metadata.get("traffic_usage_bytes") or 0
-            limit_bytes = metadata.get("traffic_limit_bytes") or 0
-            expires_ts = metadata.get("expires_at") or 0
-            # Формат заголовка Subscription-Userinfo согласно спецификации v2ray
-            # Стандартный формат: upload=<bytes>; download=<bytes>; total=<bytes>; expire=<timestamp>
-            # Примечание: В приложении v2raytun отображение использованного трафика не работает (показывает 0),
-            # хотя лимит трафика (total) отображается правильно. Это похоже на проблему/ограничение самого v2raytun.
-            # В других приложениях (например, v2rayNG) все работает корректно.
-            # Формат корректен по спецификации v2ray и оставлен как стандартный.
-            userinfo_header = f"upload=0; download={usage_bytes}; total={limit_bytes}; expire={expires_ts}"
-            # Устанавливаем Profile-Title с названием "Vee VPN", чтобы избежать использования названия сервера
-            subscription_title = metadata.get("subscription_title") or "Vee VPN"
-            # URL-кодируем название для безопасного использования в заголовке
-            from urllib.parse import quote
-            title_header = quote(subscription_title, safe='')
-
-        response_headers = {
-            "Content-Type": "text/plain; charset=utf-8",
-            "Cache-Control": "no-cache, no-store, must-revalidate",
-            "Pragma": "no-cache",
-            "Expires": "0",
-        }
-        if userinfo_header:
-            response_headers["Subscription-Userinfo"] = userinfo_header
-        if title_header:
-            # Устанавливаем Profile-Title, чтобы приложение использовало его вместо названия сервера
-            response_headers["Profile-Title"] = title_header
-
+        if state is not None and state.is_fresh:
+            if etag_matches(if_none_match, state.stored_etag):
+                _mark_subscription_served(state)
+                return Response(status_code=304, headers=_subscription_response_headers({}, state.stored_etag))
+            try:
+                payload = await subscription_payloads.get(state.subscription_id)
+            except Exception as e:
+                logger.warning(f"[SUBSCRIPTION_PAYLOAD] Failed to read payload for {token[:8]}...: {e}")
+        elif state is not None and state.stored_etag and startup_warmup.payloads_warming:
+            # Идёт прогрев после рестарта: отдаём сохранённый payload, пересобираем его в фоне
+            try:
+                stale = await subscription_payloads.get(state.subscription_id)
+            except Exception as e:
+                logger.warning(f"[SUBSCRIPTION_PAYLOAD] Failed to read payload for {token[:8]}...: {e}")
+                stale = None
+            if stale is not None and startup_warmup.serves_stale(stale.built_at):
+                startup_warmup.refresh_in_background(token, state)
+                if etag_matches(if_none_match, stale.etag):
+                    _mark_subscription_served(state)
+                    return Response(status_code=304, headers=_subscription_response_headers({}, stale.etag))
+                payload = stale
+
+        if payload is None:
+            # Входные данные изменились (или payload ещё не собран) — генерируем заново
+            payload = await rebuild_subscription_payload(token, state)
+            if payload is None:
+                logger.warning(f"Subscription not found or expired for token {token[:8]}...")
+                raise HTTPException(status_code=404, detail="Subscription not found or expired")
+
+            # Логируем для отладки
+            _log_subscription_servers(token, payload.content)
+
+            # Пересборка могла дать то же содержимое — клиенту с этим ETag тело не нужно
+            if etag_matches(if_none_match, payload.etag):
+                _mark_subscription_served(state)
+                return Response(status_code=304, headers=_subscription_response_headers({}, payload.etag))
+
+        _mark_subscription_served(state)
         return PlainTextResponse(
-            content=content,
-            headers=response_headers,
+            content=payload.content,
+            headers=_subscription_response_headers(payload.metadata, payload.etag),
         )
 
     except HTTPException:
@@ -0,0 +1,336 @@
+"""
+Межпроцессная инвалидация in-memory кэшей через SQLite.
+
+Бот и админка — разные процессы, у каждого свои SimpleCache. Инвалидация публикуется строкой
+в таблицу cache_invalidations (namespace + ключ; без ключа — весь namespace), локальные
+подписчики получают её сразу, остальные процессы — при следующем poll(). Чтение кэша только
+планирует poll() в фоновом потоке (poll_soon), не чаще раза в
+VEILBOT_CACHE_INVALIDATION_POLL_INTERVAL секунд (по умолчанию 1), и не ждёт его: get() остаётся
+чтением из памяти, в том числе на потоке event loop. Опрос стоит одной выборки по rowid.
+
+Строки старше VEILBOT_CACHE_INVALIDATION_RETENTION секунд (по умолчанию 3600) удаляются;
+процесс, который не опрашивал таблицу дольше этого срока, очищает все подписанные namespace
+целиком — пропущенные события уже могли быть удалены.
+
+Из event loop publish() не пишет в БД сам: события копятся до конца текущего шага цикла и
+уходят одной пачкой через писателя SQLite (app.infra.sqlite_writer) — вызывающий может ещё
+держать свою транзакцию, а ждать её на потоке цикла нельзя.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from app.infra.cache import SimpleCache
+from app.infra.sqlite_utils import apply_pragmas_sync
+from app.infra.sqlite_writer import get_sqlite_writer
+
+logger = logging.getLogger(__name__)
+
+InvalidationHandler = Callable[[Optional[str]], None]
+
+_PRUNE_INTERVAL_SEC = 600
+_POLL_BATCH = 1000
+_ERROR_BACKOFF_SEC = 30
+
+_INSERT_SQL = "INSERT INTO cache_invalidations (namespace, key, origin, created_at) VALUES (?, ?, ?, ?)"
+_PRUNE_SQL = "DELETE FROM cache_invalidations WHERE created_at < ?"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def _resolve_db_path(db_path: Optional[str]) -> str:
+    if db_path is not None:
+        return db_path
+    path = os.getenv("DATABASE_PATH")
+    if not path:
+        from app.settings import settings
+        path = settings.DATABASE_PATH
+    return path
+
+
+class CacheInvalidationBus:
+    """Канал инвалидации кэшей между процессами поверх таблицы cache_invalidations."""
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        *,
+        poll_interval_sec: Optional[float] = None,
+        retention_sec: Optional[float] = None,
+        enabled: Optional[bool] = None,
+    ):
+        self.db_path = db_path
+        self.poll_interval_sec = (
+            poll_interval_sec if poll_interval_sec is not None
+            else _env_float("VEILBOT_CACHE_INVALIDATION_POLL_INTERVAL", 1.0)
+        )
+        self.retention_sec = (
+            retention_sec if retention_sec is not None
+            else _env_float("VEILBOT_CACHE_INVALIDATION_RETENTION", 3600)
+        )
+        if enabled is None:
+            enabled = os.getenv("VEILBOT_CACHE_INVALIDATION", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = enabled
+        process = os.getenv("VEILBOT_PROCESS_NAME") or os.path.basename(sys.argv[0] or "") or "python"
+        # Уникален для экземпляра: свои события при poll() пропускаются, они уже применены
+        self.origin = f"{process}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handlers: Dict[str, List[InvalidationHandler]] = {}
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_path: Optional[str] = None
+        self._last_id: Optional[int] = None
+        self._next_poll = 0.0
+        self._last_poll_wall = time.time()
+        self._next_prune = 0.0
+        self._stats = {"published": 0, "received": 0, "polls": 0, "resyncs": 0, "errors": 0}
+        # Публикации из event loop, ещё не переданные писателю
+        self._pending: List[tuple] = []
+        self._flush_scheduled = False
+        self._flushes: Set[asyncio.Task] = set()
+        # Фоновый опрос для poll_soon(): свой lock, чтобы не ждать _lock, который poll() держит на время выборки
+        self._poll_lock = threading.Lock()
+        self._poll_executor: Optional[ThreadPoolExecutor] = None
+        self._poll_future: Optional[Future] = None
+
+    def subscribe(self, namespace: str, handler: InvalidationHandler) -> None:
+        """handler(key) вызывается на каждую инвалидацию namespace; key=None — сбросить всё."""
+        with self._lock:
+            self._handlers.setdefault(namespace, []).append(handler)
+
+    def publish(self, namespace: str, key: Optional[str] = None) -> None:
+        """Инвалидировать ключ (или весь namespace) в этом и во всех остальных процессах."""
+        self.publish_many(namespace, [key])
+
+    def publish_many(self, namespace: str, keys: Iterable[Optional[str]]) -> None:
+        """Инвалидировать несколько ключей одной записью в БД."""
+        keys = list(keys)
+        for key in keys:
+            self._dispatch(namespace, key)
+        if not self.enabled or not keys:
+            return
+        now = int(time.time())
+        rows = [(namespace, key, self.origin, now) for key in keys]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            with self._lock:
+                self._pending.extend(rows)
+                if self._flush_scheduled:
+                    return
+                self._flush_scheduled = True
+            loop.call_soon(self._flush_pending)
+            return
+        try:
+            with self._lock:
+                conn = self._connection()
+                for sql, params, many in self._statements(rows):
+                    if many:
+                        conn.executemany(sql, params)
+                    else:
+                        conn.execute(sql, params)
+                conn.commit()
+                self._stats["published"] += len(rows)
+        except sqlite3.Error as e:
+            self._on_error("publish", e)
+
+    def _statements(self, rows: List[tuple]) -> List[tuple]:
+        statements = [(_INSERT_SQL, rows, True)]
+        now = time.time()
+        with self._lock:
+            if now >= self._next_prune:
+                self._next_prune = now + _PRUNE_INTERVAL_SEC
+                statements.append((_PRUNE_SQL, (int(now - self.retention_sec),), False))
+        return statements
+
+    def _flush_pending(self) -> None:
+        # Шаг цикла, опубликовавший события, уже отдал управление — пишем их пачкой вне потока цикла
+        with self._lock:
+            rows, self._pending = self._pending, []
+            self._flush_scheduled = False
+        if not rows:
+            return
+        task = asyncio.get_running_loop().create_task(self._write_async(rows))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write_async(self, rows: List[tuple]) -> None:
+        try:
+            await get_sqlite_writer(_resolve_db_path(self.db_path)).write_async(self._statements(rows))
+        except (sqlite3.Error, RuntimeError) as e:
+            self._on_error("publish", e)
+            return
+        with self._lock:
+            self._stats["published"] += len(rows)
+
+    def poll(self, force: bool = False) -> int:
+        """Применить чужие инвалидации, появившиеся с прошлого опроса. Возвращает их число."""
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return 0
+        events: List[tuple] = []
+        resync = False
+        try:
+            with self._lock:
+                if not force and now < self._next_poll:
+                    return 0
+                self._next_poll = now + self.poll_interval_sec
+                conn = self._connection()
+                self._stats["polls"] += 1
+                wall = time.time()
+                stale = wall - self._last_poll_wall > self.retention_sec
+                self._last_poll_wall = wall
+                if self._last_id is None or stale:
+                    # Первый опрос (кэши ещё пусты) или пропущенные события могли быть удалены
+                    row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()
+                    resync = self._last_id is not None
+                    self._last_id = int(row[0])
+                else:
+                    events = conn.execute(
+                        """
+                        SELECT id, namespace, key, origin FROM cache_invalidations
+                        WHERE id > ? ORDER BY id LIMIT ?
+                        """,
+                        (self._last_id, _POLL_BATCH),
+                    ).fetchall()
+                    if events:
+                        self._last_id = int(events[-1][0])
+                        if len(events) == _POLL_BATCH:
+                            # Отстали на целую пачку — дочитаем на следующем вызове
+                            self._next_poll = 0.0
+                if resync:
+                    self._stats["resyncs"] += 1
+        except sqlite3.Error as e:
+            self._on_error("poll", e)
+            return 0
+
+        if resync:
+            for namespace in list(self._handlers):
+                self._dispatch(namespace, None)
+            return 0
+        received = 0
+        for _, namespace, key, origin in events:
+            if origin == self.origin:
+                continue
+            received += 1
+            self._dispatch(namespace, key)
+        if received:
+            with self._lock:
+                self._stats["received"] += received
+        return received
+
+    def poll_soon(self) -> Optional[Future]:
+        """Запустить poll() в фоновом потоке, если подошёл срок; вызывающий БД не ждёт."""
+        if not self.enabled or time.monotonic() < self._next_poll:
+            return None
+        with self._poll_lock:
+            if self._poll_future is not None and not self._poll_future.done():
+                return self._poll_future
+            if self._poll_executor is None:
+                self._poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-invalidation")
+            self._poll_future = self._poll_executor.submit(self.poll)
+            return self._poll_future
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                self._stats, last_id=self._last_id, pending=len(self._pending), namespaces=sorted(self._handlers)
+            )
+
+    def close(self) -> None:
+        with self._poll_lock:
+            if self._poll_executor is not None:
+                self._poll_executor.shutdown(wait=False)
+            self._poll_executor = None
+            self._poll_future = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._conn_path = None
+            self._last_id = None
+
+    def _dispatch(self, namespace: str, key: Optional[str]) -> None:
+        with self._lock:
+            handlers = list(self._handlers.get(namespace, ()))
+        for handler in handlers:
+            try:
+                handler(key)
+            except Exception as e:
+                logger.warning(f"[CACHE_INVALIDATION] Handler for {namespace} failed: {e}")
+
+    def _connection(self) -> sqlite3.Connection:
+        path = _resolve_db_path(self.db_path)
+        if self._conn is None or self._conn_path != path:
+            if self._conn is not None:
+                self._conn.close()
+                self._last_id = None
+            self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            apply_pragmas_sync(self._conn)
+            self._conn_path = path
+        return self._conn
+
+    def _on_error(self, operation: str, error: Exception) -> None:
+        # Канал недоступен (нет таблицы, БД занята) — кэши продолжают жить по своему TTL
+        with self._lock:
+            self._stats["errors"] += 1
+            self._next_poll = time.monotonic() + max(self.poll_interval_sec, _ERROR_BACKOFF_SEC)
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._conn_path = None
+        logger.warning(f"[CACHE_INVALIDATION] {operation} failed: {error}")
+
+
+class SharedCache(SimpleCache):
+    """SimpleCache, чьи инвалидации расходятся по всем процессам через CacheInvalidationBus.
+
+    delete()/clear() по-прежнему локальные; межпроцессные — invalidate()/invalidate_all().
+    """
+
+    def __init__(self, namespace: str, bus: Optional[CacheInvalidationBus] = None):
+        super().__init__()
+        self.namespace = namespace
+        self._bus = bus if bus is not None else cache_invalidation_bus
+        self._bus.subscribe(namespace, self._on_invalidation)
+
+    def get(self, key: str) -> Optional[Any]:
+        # Чужие инвалидации подтягиваются в фоне; чтение — только из памяти
+        self._bus.poll_soon()
+        return super().get(key)
+
+    def invalidate(self, key: str) -> None:
+        self._bus.publish(self.namespace, key)
+
+    def invalidate_many(self, keys: Iterable[str]) -> None:
+        self._bus.publish_many(self.namespace, keys)
+
+    def invalidate_all(self) -> None:
+        self._bus.publish(self.namespace)
+
+    def _on_invalidation(self, key: Optional[str]) -> None:
+        if key is None:
+            super().clear()
+        else:
+            super().delete(key)
+
+
+# Global cache invalidation bus instance
+cache_invalidation_bus = CacheInvalidationBus()
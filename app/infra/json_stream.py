@@ -0,0 +1,121 @@
+"""
+Потоковый разбор JSON-массивов из ответа HTTP.
+
+Большие списки ключей панели (`GET /keys`, десятки тысяч записей) разбираются по элементам
+по мере поступления тела ответа, без загрузки всего документа в память. Поддерживаются
+оба формата ответа панели: массив на верхнем уровне и объект с массивом в поле (`{"keys": [...]}`).
+Каждый элемент декодируется стандартным json (C-декодер), в памяти одновременно — только
+непрочитанный хвост буфера.
+"""
+from __future__ import annotations
+
+import codecs
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Optional
+
+_WHITESPACE = " \t\n\r"
+# Символы, которыми может закончиться число или литерал (true/false/null) внутри документа
+_DELIMITERS = _WHITESPACE + ",]}:"
+_decoder = json.JSONDecoder()
+
+
+class _Buffer:
+    """Текстовый буфер с позицией чтения; догружается из асинхронного источника байтов."""
+
+    def __init__(self, chunks: AsyncIterable[bytes]):
+        self._chunks = chunks.__aiter__()
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    async def fill(self) -> bool:
+        """Дочитать следующий кусок; False — источник исчерпан."""
+        if self.eof:
+            return False
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self.eof = True
+            self.text = self.text[self.pos:] + self._decoder.decode(b"", final=True)
+            self.pos = 0
+            return False
+        # Отбрасываем уже прочитанное, чтобы буфер не рос вместе с документом
+        self.text = self.text[self.pos:] + self._decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    async def peek(self) -> Optional[str]:
+        """Следующий значимый символ (пробелы пропускаются) или None в конце данных."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not await self.fill():
+                return None
+
+    async def expect(self, char: str) -> None:
+        if await self.peek() != char:
+            raise ValueError(f"Invalid JSON stream: expected {char!r} at offset {self.pos}")
+        self.pos += 1
+
+    async def value(self) -> Any:
+        """Декодировать следующее JSON-значение целиком, догружая данные при необходимости."""
+        await self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if await self.fill():
+                    continue
+                raise ValueError(f"Invalid JSON stream: truncated value at offset {self.pos}")
+            # Число или литерал заканчивается только разделителем: кусок мог разрезать «1.5» после
+            # «1.», «-2e3» после «-2e» — тогда префикс декодируется, и нужно дочитать данные
+            if self.text[self.pos] not in '{["' and not self.eof and (
+                end >= len(self.text) or self.text[end] not in _DELIMITERS
+            ):
+                await self.fill()
+                continue
+            self.pos = end
+            return value
+
+
+async def iter_json_array(chunks: AsyncIterable[bytes], field: Optional[str] = None) -> AsyncIterator[Any]:
+    """Элементы JSON-массива из потока байтов.
+
+    Args:
+        chunks: тело ответа кусками (например, response.content.iter_chunked()).
+        field: если документ — объект, имя поля с массивом; массив на верхнем уровне
+            разбирается в любом случае. Остальные поля объекта пропускаются.
+    """
+    buffer = _Buffer(chunks)
+    first = await buffer.peek()
+    if first == "{" and field is not None:
+        buffer.pos += 1
+        if await buffer.peek() == "}":
+            return
+        while True:
+            name = await buffer.value()
+            await buffer.expect(":")
+            if name == field and await buffer.peek() == "[":
+                break
+            await buffer.value()
+            if await buffer.peek() == ",":
+                buffer.pos += 1
+                continue
+            await buffer.expect("}")
+            return
+    elif first != "[":
+        raise ValueError("Invalid JSON stream: expected an array")
+
+    buffer.pos += 1
+    if await buffer.peek() == "]":
+        return
+    while True:
+        yield await buffer.value()
+        if await buffer.peek() == ",":
+            buffer.pos += 1
+            continue
+        await buffer.expect("]")
+        return
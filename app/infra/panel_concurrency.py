@@ -0,0 +1,287 @@
+"""
+Адаптивные лимиты параллелизма запросов к панелям V2Ray.
+
+У каждой панели (host:port) свой лимит одновременных запросов, который подстраивается по
+правилу AIMD: +1 слот за «раунд» успешных запросов без роста задержки, ×0.5 при ошибке/таймауте
+и ×0.8 при задержке заметно выше базовой (минимальной наблюдаемой). Поверх — общий лимит на процесс.
+Быстрая панель быстро набирает слоты, а медленная или перегруженная сужается и не занимает
+очередь остальных.
+
+Слоты берут методы V2RayProtocol (создание/удаление ключей, трафик, конфиги); обратная связь
+приходит из TraceConfig общих сессий app.infra.panel_http.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, FrozenSet, Optional, Set
+
+import aiohttp
+
+from app.infra.panel_health import is_failure_status, panel_key
+from app.infra.panel_http import timed_trace_config
+
+logger = logging.getLogger(__name__)
+
+# Панели, слот которых уже держит текущая задача (вложенные вызовы, например create_user → get_user_config)
+_held_panels: contextvars.ContextVar[FrozenSet[str]] = contextvars.ContextVar(
+    "veilbot_panel_slots_held", default=frozenset()
+)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def _resolve_waiter(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+class _Gate:
+    """Счётчик слотов с изменяемым лимитом, безопасный для нескольких event loop/потоков.
+
+    Ожидающие — futures своих loop'ов; освобождение будит их через call_soon_threadsafe.
+    """
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._granted: Set[asyncio.Future] = set()
+        self._lock = threading.Lock()
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < max(1, int(self.limit))
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._has_capacity():
+                self.in_flight += 1
+                return
+            fut = loop.create_future()
+            self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = fut in self._granted
+                self._granted.discard(fut)
+                if not granted and fut in self._waiters:
+                    self._waiters.remove(fut)
+            if granted:
+                # Слот уже выдан, но задача отменена — возвращаем его
+                self.release()
+            raise
+        with self._lock:
+            self._granted.discard(fut)
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._wake_locked()
+
+    def set_limit(self, limit: float) -> None:
+        with self._lock:
+            self.limit = limit
+            self._wake_locked()
+
+    def _wake_locked(self) -> None:
+        while self._waiters and self._has_capacity():
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            try:
+                fut.get_loop().call_soon_threadsafe(_resolve_waiter, fut)
+            except RuntimeError:
+                # loop ожидающего уже закрыт
+                continue
+            self._granted.add(fut)
+            self.in_flight += 1
+
+    @property
+    def waiting(self) -> int:
+        with self._lock:
+            return sum(1 for fut in self._waiters if not fut.done())
+
+
+class _PanelLimit:
+    """AIMD-состояние одной панели (изменяется под блокировкой контроллера)."""
+
+    def __init__(self, key: str, initial: int):
+        self.key = key
+        self.gate = _Gate(initial)
+        self.baseline_ms: Optional[float] = None
+        self.latency_ewma_ms: Optional[float] = None
+        self.last_decrease_at = 0.0
+        self.decreases = 0
+
+
+class PanelConcurrencyController:
+    """Per-panel adaptive concurrency limits with a process-wide cap.
+
+    Настройки: VEILBOT_PANEL_CONCURRENCY_INITIAL (стартовый лимит панели), VEILBOT_PANEL_CONCURRENCY_MIN,
+    VEILBOT_PANEL_CONCURRENCY_MAX, VEILBOT_PANEL_CONCURRENCY_GLOBAL (общий лимит процесса).
+    """
+
+    def __init__(
+        self,
+        *,
+        initial_limit: Optional[int] = None,
+        min_limit: Optional[int] = None,
+        max_limit: Optional[int] = None,
+        global_limit: Optional[int] = None,
+        latency_tolerance: float = 2.0,
+        decrease_cooldown_sec: float = 1.0,
+        ewma_alpha: float = 0.2,
+    ):
+        self.min_limit = min_limit if min_limit is not None else _env_int("VEILBOT_PANEL_CONCURRENCY_MIN", 1)
+        self.max_limit = max(
+            self.min_limit,
+            max_limit if max_limit is not None else _env_int("VEILBOT_PANEL_CONCURRENCY_MAX", 32),
+        )
+        initial = initial_limit if initial_limit is not None else _env_int("VEILBOT_PANEL_CONCURRENCY_INITIAL", 8)
+        self.initial_limit = min(self.max_limit, max(self.min_limit, initial))
+        self.global_limit = (
+            global_limit if global_limit is not None else _env_int("VEILBOT_PANEL_CONCURRENCY_GLOBAL", 64)
+        )
+        self.latency_tolerance = latency_tolerance
+        self.decrease_cooldown_sec = decrease_cooldown_sec
+        self.ewma_alpha = ewma_alpha
+        self._global = _Gate(self.global_limit)
+        self._panels: Dict[str, _PanelLimit] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> _PanelLimit:
+        with self._lock:
+            panel = self._panels.get(key)
+            if panel is None:
+                panel = _PanelLimit(key, self.initial_limit)
+                self._panels[key] = panel
+            return panel
+
+    @asynccontextmanager
+    async def slot(self, api_url: Optional[str]) -> AsyncIterator[None]:
+        """Занять слот панели и общий слот на время запроса(ов) к панели.
+
+        Повторный вход той же задачи для той же панели слот не занимает. Не держите слот
+        через yield асинхронного генератора: потребитель унаследует его как «свой».
+        """
+        key = panel_key(api_url)
+        held = _held_panels.get()
+        if not key or key in held:
+            yield
+            return
+
+        panel = self._get(key)
+        # Сначала слот панели, затем общий: ожидающие медленной панели не держат общие слоты
+        await panel.gate.acquire()
+        try:
+            await self._global.acquire()
+        except BaseException:
+            panel.gate.release()
+            raise
+        token = _held_panels.set(held | {key})
+        try:
+            yield
+        finally:
+            # Сначала слоты: reset() бросает ValueError, если выход идёт в другом контексте
+            self._global.release()
+            panel.gate.release()
+            try:
+                _held_panels.reset(token)
+            except ValueError:
+                pass
+
+    def on_result(self, url: Any, ok: bool, latency_ms: Optional[float] = None) -> None:
+        """Обратная связь AIMD по исходу одного HTTP-запроса к панели."""
+        key = panel_key(str(url))
+        if not key:
+            return
+        panel = self._get(key)
+        now = time.monotonic()
+        with self._lock:
+            limit = panel.gate.limit
+            congested = not ok
+            if ok and latency_ms is not None:
+                if panel.latency_ewma_ms is None:
+                    panel.latency_ewma_ms = latency_ms
+                else:
+                    panel.latency_ewma_ms += self.ewma_alpha * (latency_ms - panel.latency_ewma_ms)
+                if panel.baseline_ms is None or latency_ms < panel.baseline_ms:
+                    panel.baseline_ms = latency_ms
+                else:
+                    # Базовая задержка медленно «всплывает», чтобы не залипнуть на случайном минимуме
+                    panel.baseline_ms += 0.01 * (latency_ms - panel.baseline_ms)
+                congested = panel.latency_ewma_ms > panel.baseline_ms * self.latency_tolerance
+
+            if congested:
+                if now - panel.last_decrease_at < self.decrease_cooldown_sec:
+                    return
+                factor = 0.5 if not ok else 0.8
+                new_limit = max(float(self.min_limit), limit * factor)
+                panel.last_decrease_at = now
+                panel.decreases += 1
+            else:
+                # Аддитивный рост только когда лимит реально используется
+                if panel.gate.in_flight + 1 < int(limit):
+                    return
+                new_limit = min(float(self.max_limit), limit + 1.0 / max(1.0, limit))
+
+        if int(new_limit) != int(limit):
+            logger.debug(
+                "[PANEL_CONCURRENCY] %s: limit %s -> %s (ok=%s, latency=%s ms)",
+                key, int(limit), int(new_limit), ok, latency_ms,
+            )
+        panel.gate.set_limit(new_limit)
+
+    def limit_for(self, api_url: Optional[str]) -> int:
+        key = panel_key(api_url)
+        if not key:
+            return self.initial_limit
+        return max(1, int(self._get(key).gate.limit))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Текущие лимиты и загрузка по панелям (для админки/метрик)."""
+        with self._lock:
+            panels = list(self._panels.values())
+        return {
+            panel.key: {
+                "limit": max(1, int(panel.gate.limit)),
+                "in_flight": panel.gate.in_flight,
+                "waiting": panel.gate.waiting,
+                "latency_ewma_ms": round(panel.latency_ewma_ms, 1) if panel.latency_ewma_ms is not None else None,
+                "baseline_ms": round(panel.baseline_ms, 1) if panel.baseline_ms is not None else None,
+                "decreases": panel.decreases,
+            }
+            for panel in panels
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._panels.clear()
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """TraceConfig для aiohttp-сессий панелей: передаёт исход и задержку запросов в on_result()."""
+
+        def on_end(params, elapsed_ms: Optional[float]) -> None:
+            self.on_result(params.url, not is_failure_status(params.response.status), elapsed_ms)
+
+        def on_exception(params, elapsed_ms: Optional[float]) -> None:
+            self.on_result(params.url, False, elapsed_ms)
+
+        return timed_trace_config(on_end, on_exception)
+
+
+# Global controller instance
+panel_concurrency = PanelConcurrencyController()
@@ -0,0 +1,396 @@
+"""
+Здоровье панелей V2Ray и circuit breaker, общий для всех вызывающих.
+
+Для каждой панели (host:port из api_url) хранится скользящее окно исходов запросов,
+EWMA задержки и состояние breaker'а closed → open → half-open. Исходы записываются
+TraceConfig'ом сессий из app.infra.panel_http, поэтому учитываются все запросы к панели
+(монитор трафика, синхронизация ключей, покупка, генерация подписок). Пока breaker открыт,
+V2RayProtocol сразу получает PanelCircuitOpenError вместо ожидания PANEL_TIMEOUT.
+
+Решения breaker'а принимаются в памяти процесса; снимки состояния пишутся в таблицу
+panel_health_state (при смене состояния и не чаще VEILBOT_PANEL_HEALTH_PERSIST_INTERVAL),
+чтобы страница серверов админки видела состояние, накопленное ботом. Из event loop снимки
+пишутся в отдельном потоке по порядку: trace-колбэки запросов не ждут блокировку БД.
+"""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+
+from app.infra.panel_http import timed_trace_config
+from app.infra.sqlite_utils import get_db_cursor
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+class PanelCircuitOpenError(aiohttp.ClientConnectionError):
+    """Панель помечена недоступной: запрос не отправляется до окончания cooldown."""
+
+    def __init__(self, panel: str, retry_in: float):
+        self.panel = panel
+        self.retry_in = retry_in
+        super().__init__(f"Panel {panel} circuit is open, retry in {retry_in:.0f}s")
+
+
+def is_failure_status(status: int) -> bool:
+    """5xx и 429 — панель перегружена/сломана; прочие 4xx — панель жива, ошибка в запросе."""
+    return status >= 500 or status == 429
+
+
+def panel_key(api_url: Optional[str]) -> str:
+    """Ключ панели: host:port из api_url (схема по умолчанию https, как в V2RayProtocol)."""
+    raw = (api_url or "").strip()
+    if not raw:
+        return ""
+    if "://" not in raw:
+        raw = f"https://{raw}"
+    parsed = urlparse(raw)
+    host = (parsed.hostname or "").lower()
+    if not host:
+        return ""
+    port = parsed.port or (80 if parsed.scheme == "http" else 443)
+    return f"{host}:{port}"
+
+
+class PanelHealth:
+    """Состояние одной панели. Не потокобезопасен сам по себе — защищается реестром."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.state = STATE_CLOSED
+        self.outcomes: Deque[Tuple[float, bool]] = deque()
+        self.consecutive_failures = 0
+        self.latency_ewma_ms: Optional[float] = None
+        self.opened_at: Optional[float] = None
+        self.probe_started_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_success_at: Optional[float] = None
+        self.last_failure_at: Optional[float] = None
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def prune(self, now: float, window_sec: float, window_size: int) -> None:
+        while self.outcomes and (now - self.outcomes[0][0] > window_sec or len(self.outcomes) > window_size):
+            self.outcomes.popleft()
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+
+class PanelHealthRegistry:
+    """Thread-safe registry of PanelHealth keyed by panel host:port.
+
+    Breaker открывается после VEILBOT_PANEL_BREAKER_FAILURES ошибок подряд или при доле ошибок
+    >= VEILBOT_PANEL_BREAKER_ERROR_RATE в окне (минимум VEILBOT_PANEL_BREAKER_MIN_REQUESTS исходов
+    за VEILBOT_PANEL_BREAKER_WINDOW секунд). Через VEILBOT_PANEL_BREAKER_COOLDOWN секунд пропускается
+    один пробный запрос (half-open): успех закрывает breaker, ошибка открывает снова.
+    """
+
+    def __init__(
+        self,
+        *,
+        failure_threshold: Optional[int] = None,
+        error_rate_threshold: Optional[float] = None,
+        min_requests: Optional[int] = None,
+        window_sec: Optional[float] = None,
+        window_size: int = 50,
+        cooldown_sec: Optional[float] = None,
+        probe_timeout_sec: float = 130.0,
+        ewma_alpha: float = 0.2,
+        persist_interval_sec: Optional[float] = None,
+    ):
+        self.failure_threshold = (
+            failure_threshold if failure_threshold is not None
+            else int(_env_float("VEILBOT_PANEL_BREAKER_FAILURES", 5)) or 1
+        )
+        self.error_rate_threshold = (
+            error_rate_threshold if error_rate_threshold is not None
+            else _env_float("VEILBOT_PANEL_BREAKER_ERROR_RATE", 0.5)
+        )
+        self.min_requests = (
+            min_requests if min_requests is not None
+            else int(_env_float("VEILBOT_PANEL_BREAKER_MIN_REQUESTS", 10)) or 1
+        )
+        self.window_sec = window_sec if window_sec is not None else _env_float("VEILBOT_PANEL_BREAKER_WINDOW", 120)
+        self.window_size = window_size
+        self.cooldown_sec = (
+            cooldown_sec if cooldown_sec is not None else _env_float("VEILBOT_PANEL_BREAKER_COOLDOWN", 30)
+        )
+        # Пробный запрос, не вернувший исход (отменён/завис), не блокирует half-open навсегда
+        self.probe_timeout_sec = probe_timeout_sec
+        self.ewma_alpha = ewma_alpha
+        self.persist_interval_sec = (
+            persist_interval_sec if persist_interval_sec is not None
+            else _env_float("VEILBOT_PANEL_HEALTH_PERSIST_INTERVAL", 60)
+        )
+        self._last_persisted: Dict[str, float] = {}
+        self._persist_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._panels: Dict[str, PanelHealth] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> PanelHealth:
+        health = self._panels.get(key)
+        if health is None:
+            health = PanelHealth(key)
+            self._panels[key] = health
+        return health
+
+    def _refresh_state(self, health: PanelHealth, now: float) -> None:
+        """open → half_open по истечении cooldown (caller holds the lock)."""
+        if health.state == STATE_OPEN and health.opened_at is not None:
+            if now - health.opened_at >= self.cooldown_sec:
+                health.state = STATE_HALF_OPEN
+                health.probe_started_at = None
+                logger.info("[PANEL_HEALTH] %s: half-open, next request is a probe", health.key)
+
+    def _open(self, health: PanelHealth, now: float, reason: str) -> None:
+        if health.state != STATE_OPEN:
+            logger.warning(
+                "[PANEL_HEALTH] %s: circuit opened (%s, error_rate=%.0f%%, consecutive=%s)",
+                health.key,
+                reason,
+                health.error_rate() * 100,
+                health.consecutive_failures,
+            )
+        health.state = STATE_OPEN
+        health.opened_at = now
+        health.probe_started_at = None
+
+    def is_available(self, api_url: Optional[str]) -> bool:
+        """Можно ли обращаться к панели (без резервирования пробного запроса)."""
+        key = panel_key(api_url)
+        if not key:
+            return True
+        with self._lock:
+            health = self._panels.get(key)
+            if health is None:
+                return True
+            self._refresh_state(health, time.monotonic())
+            return health.state != STATE_OPEN
+
+    def check(self, api_url: Optional[str]) -> None:
+        """Пропустить запрос или бросить PanelCircuitOpenError.
+
+        В half-open пропускается один пробный запрос; остальные отклоняются до его исхода.
+        """
+        key = panel_key(api_url)
+        if not key:
+            return
+        now = time.monotonic()
+        with self._lock:
+            health = self._panels.get(key)
+            if health is None:
+                return
+            self._refresh_state(health, now)
+            if health.state == STATE_CLOSED:
+                return
+            if health.state == STATE_HALF_OPEN:
+                probe_started = health.probe_started_at
+                if probe_started is None or now - probe_started >= self.probe_timeout_sec:
+                    health.probe_started_at = now
+                    return
+                raise PanelCircuitOpenError(key, self.cooldown_sec)
+            retry_in = max(0.0, self.cooldown_sec - (now - (health.opened_at or now)))
+            raise PanelCircuitOpenError(key, retry_in)
+
+    def record(self, url: Any, ok: bool, latency_ms: Optional[float] = None, error: Optional[str] = None) -> None:
+        """Записать исход запроса к панели (url — str или yarl.URL)."""
+        key = panel_key(str(url))
+        if not key:
+            return
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(key)
+            previous_state = health.state
+            self._record_locked(health, now, ok, latency_ms, error)
+            persist = health.state != previous_state or (
+                self.persist_interval_sec > 0
+                and now - self._last_persisted.get(key, float("-inf")) >= self.persist_interval_sec
+            )
+            if persist:
+                self._last_persisted[key] = now
+        if persist:
+            self._persist_off_loop(self.get_state(key))
+
+    def _record_locked(
+        self, health: PanelHealth, now: float, ok: bool, latency_ms: Optional[float], error: Optional[str]
+    ) -> None:
+        key = health.key
+        health.total_requests += 1
+        if latency_ms is not None:
+            if health.latency_ewma_ms is None:
+                health.latency_ewma_ms = latency_ms
+            else:
+                health.latency_ewma_ms += self.ewma_alpha * (latency_ms - health.latency_ewma_ms)
+        health.outcomes.append((now, ok))
+        health.prune(now, self.window_sec, self.window_size)
+
+        if ok:
+            health.consecutive_failures = 0
+            health.last_success_at = time.time()
+            if health.state != STATE_CLOSED:
+                logger.info("[PANEL_HEALTH] %s: circuit closed after successful probe", key)
+                health.state = STATE_CLOSED
+                health.opened_at = None
+                health.probe_started_at = None
+                health.outcomes.clear()
+            return
+
+        health.total_failures += 1
+        health.consecutive_failures += 1
+        health.last_failure_at = time.time()
+        health.last_error = error
+        if health.state == STATE_HALF_OPEN:
+            self._open(health, now, "probe failed")
+        elif health.consecutive_failures >= self.failure_threshold:
+            self._open(health, now, "consecutive failures")
+        elif len(health.outcomes) >= self.min_requests and health.error_rate() >= self.error_rate_threshold:
+            self._open(health, now, "error rate")
+
+    def get_state(self, api_url: Optional[str]) -> Dict[str, Any]:
+        """Снимок состояния панели для админки (панель без запросов — closed, unknown)."""
+        key = panel_key(api_url)
+        with self._lock:
+            health = self._panels.get(key) if key else None
+            if health is None:
+                return {"panel": key, "state": STATE_CLOSED, "known": False}
+            now = time.monotonic()
+            self._refresh_state(health, now)
+            health.prune(now, self.window_sec, self.window_size)
+            return {
+                "panel": key,
+                "state": health.state,
+                "known": True,
+                "error_rate": round(health.error_rate(), 3),
+                "window_requests": len(health.outcomes),
+                "consecutive_failures": health.consecutive_failures,
+                "latency_ewma_ms": round(health.latency_ewma_ms, 1) if health.latency_ewma_ms is not None else None,
+                "retry_in": (
+                    round(max(0.0, self.cooldown_sec - (now - health.opened_at)), 1)
+                    if health.state == STATE_OPEN and health.opened_at is not None
+                    else None
+                ),
+                "last_error": health.last_error,
+                "last_success_at": int(health.last_success_at) if health.last_success_at else None,
+                "last_failure_at": int(health.last_failure_at) if health.last_failure_at else None,
+                "total_requests": health.total_requests,
+                "total_failures": health.total_failures,
+            }
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            keys = list(self._panels)
+        return {key: self.get_state(key) for key in keys}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._panels.clear()
+            self._last_persisted.clear()
+
+    def _persist_off_loop(self, state: Dict[str, Any]) -> None:
+        """Записать снимок; на потоке event loop — в фоновом потоке (один поток сохраняет порядок)."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._persist(state)
+            return
+        with self._lock:
+            if self._persist_executor is None:
+                self._persist_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="panel-health-persist"
+                )
+            executor = self._persist_executor
+        executor.submit(self._persist, state)
+
+    def _persist(self, state: Dict[str, Any]) -> None:
+        """Сохранить снимок панели в panel_health_state (best-effort, ошибки БД не мешают запросам)."""
+        try:
+            with get_db_cursor(commit=True) as cursor:
+                cursor.execute(
+                    """
+                    INSERT OR REPLACE INTO panel_health_state
+                    (panel, state, error_rate, latency_ewma_ms, consecutive_failures, last_error, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        state["panel"],
+                        state["state"],
+                        state.get("error_rate"),
+                        state.get("latency_ewma_ms"),
+                        state.get("consecutive_failures"),
+                        state.get("last_error"),
+                        int(time.time()),
+                    ),
+                )
+        except Exception as e:
+            logger.debug("[PANEL_HEALTH] Failed to persist state for %s: %s", state.get("panel"), e)
+
+    def load_persisted(self) -> Dict[str, Dict[str, Any]]:
+        """Снимки из panel_health_state по ключу панели (для админки в отдельном процессе)."""
+        try:
+            with get_db_cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT panel, state, error_rate, latency_ewma_ms, consecutive_failures, last_error, updated_at
+                    FROM panel_health_state
+                    """
+                )
+                rows = cursor.fetchall()
+        except Exception as e:
+            logger.debug("[PANEL_HEALTH] Failed to load persisted states: %s", e)
+            return {}
+        return {
+            row[0]: {
+                "panel": row[0],
+                "state": row[1],
+                "known": True,
+                "error_rate": row[2],
+                "latency_ewma_ms": row[3],
+                "consecutive_failures": row[4],
+                "last_error": row[5],
+                "updated_at": row[6],
+            }
+            for row in rows
+        }
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """TraceConfig для aiohttp-сессий панелей: записывает исход и задержку каждого запроса."""
+
+        def on_end(params, elapsed_ms: Optional[float]) -> None:
+            status = params.response.status
+            ok = not is_failure_status(status)
+            self.record(params.url, ok, elapsed_ms, None if ok else f"HTTP {status}")
+
+        def on_exception(params, elapsed_ms: Optional[float]) -> None:
+            exc = params.exception
+            if isinstance(exc, PanelCircuitOpenError):
+                return
+            self.record(params.url, False, elapsed_ms, f"{type(exc).__name__}: {exc}"[:200])
+
+        return timed_trace_config(on_end, on_exception)
+
+
+# Global registry instance
+panel_health = PanelHealthRegistry()
@@ -0,0 +1,183 @@
+"""
+Общий пул HTTP-сессий для API панелей V2Ray.
+
+Один aiohttp.ClientSession (и один TCPConnector) на event loop: keep-alive,
+кэш DNS и лимиты соединений на хост разделяются всеми клиентами панелей,
+вместо отдельного TLS-рукопожатия на каждый ProtocolFactory.create_protocol().
+
+Здоровье, конкурентность и метрики панелей подключаются к сессиям TraceConfig'ами,
+собранными через timed_trace_config().
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import ssl
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(0, int(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+# Медленные/перегруженные панели: больше connect (TLS), total и sock_read для крупных ответов
+PANEL_TIMEOUT = aiohttp.ClientTimeout(total=120, connect=20, sock_connect=20, sock_read=100)
+
+
+# (params трассировки aiohttp, длительность запроса в мс или None)
+TraceHandler = Callable[[Any, Optional[float]], None]
+
+
+def timed_trace_config(on_end: TraceHandler, on_exception: TraceHandler) -> aiohttp.TraceConfig:
+    """TraceConfig, который замеряет длительность запроса и передаёт её обработчикам.
+
+    on_end получает params с ответом, on_exception — params с исключением; отменённые
+    запросы (CancelledError) не передаются. Длительность None, если начало не зафиксировано.
+    """
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params) -> None:
+        ctx.started_at = asyncio.get_running_loop().time()
+
+    def _elapsed_ms(ctx) -> Optional[float]:
+        started_at = getattr(ctx, "started_at", None)
+        if started_at is None:
+            return None
+        return (asyncio.get_running_loop().time() - started_at) * 1000
+
+    async def on_request_end(session, ctx, params) -> None:
+        on_end(params, _elapsed_ms(ctx))
+
+    async def on_request_exception(session, ctx, params) -> None:
+        if isinstance(params.exception, asyncio.CancelledError):
+            return
+        on_exception(params, _elapsed_ms(ctx))
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class PanelSessionPool:
+    """Thread-safe registry of shared aiohttp sessions, one per running event loop.
+
+    Сессия aiohttp привязана к loop, а в одном процессе их бывает несколько
+    (например, фоновый поток админки с asyncio.new_event_loop()), поэтому
+    сессии хранятся по loop и создаются лениво при первом запросе.
+    """
+
+    def __init__(
+        self,
+        *,
+        limit: int | None = None,
+        limit_per_host: int | None = None,
+        dns_cache_ttl: int | None = None,
+        keepalive_timeout: float | None = None,
+    ):
+        self.limit = limit if limit is not None else _env_int("VEILBOT_PANEL_POOL_LIMIT", 100)
+        self.limit_per_host = (
+            limit_per_host if limit_per_host is not None else _env_int("VEILBOT_PANEL_POOL_LIMIT_PER_HOST", 20)
+        )
+        self.dns_cache_ttl = dns_cache_ttl if dns_cache_ttl is not None else _env_int("VEILBOT_PANEL_DNS_TTL", 300)
+        self.keepalive_timeout = (
+            keepalive_timeout if keepalive_timeout is not None else float(_env_int("VEILBOT_PANEL_KEEPALIVE", 60))
+        )
+        self._sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        self._lock = threading.Lock()
+        self._ssl_context = self._build_ssl_context()
+
+    @staticmethod
+    def _build_ssl_context() -> ssl.SSLContext:
+        # Панели используют самоподписанные сертификаты
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def create_session(self) -> aiohttp.ClientSession:
+        # Реестры сами импортируют timed_trace_config отсюда
+        from app.infra.panel_concurrency import panel_concurrency
+        from app.infra.panel_health import panel_health
+        from app.infra.panel_metrics import panel_metrics
+
+        connector = aiohttp.TCPConnector(
+            ssl=self._ssl_context,
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl or None,
+            keepalive_timeout=self.keepalive_timeout,
+            force_close=False,
+            enable_cleanup_closed=True,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=PANEL_TIMEOUT,
+            trace_configs=[
+                panel_health.trace_config(),
+                panel_concurrency.trace_config(),
+                panel_metrics.trace_config(),
+            ],
+        )
+
+    def _prune_dead_loops(self) -> None:
+        """Drop sessions whose event loop is already closed (caller holds the lock)."""
+        for loop in [loop for loop in self._sessions if loop.is_closed()]:
+            self._sessions.pop(loop, None)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Вернуть общую сессию для текущего event loop (создаётся при первом обращении)."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._prune_dead_loops()
+            session = self._sessions.get(loop)
+            if session is None or session.closed:
+                session = self.create_session()
+                self._sessions[loop] = session
+                logger.debug(
+                    "[PANEL_HTTP] Created shared session (limit=%s, per_host=%s, dns_ttl=%s)",
+                    self.limit,
+                    self.limit_per_host,
+                    self.dns_cache_ttl,
+                )
+            return session
+
+    async def close(self) -> None:
+        """Закрыть сессию текущего event loop (shutdown-хук процесса)."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._prune_dead_loops()
+            session = self._sessions.pop(loop, None)
+        if session is not None and not session.closed:
+            await session.close()
+            logger.info("[PANEL_HTTP] Closed shared panel session")
+
+    def stats(self) -> Dict[str, int]:
+        """Краткая статистика пула (для health/админки)."""
+        with self._lock:
+            sessions = [s for s in self._sessions.values() if not s.closed]
+            open_connections = 0
+            for session in sessions:
+                connector = session.connector
+                if connector is not None:
+                    open_connections += sum(len(v) for v in getattr(connector, "_conns", {}).values())
+            return {
+                "sessions": len(sessions),
+                "idle_connections": open_connections,
+                "limit": self.limit,
+                "limit_per_host": self.limit_per_host,
+            }
+
+
+# Global pool instance
+panel_session_pool = PanelSessionPool()
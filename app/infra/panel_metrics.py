@@ -0,0 +1,314 @@
+"""
+Метрики запросов к панелям V2Ray: гистограммы задержек и счётчики ошибок.
+
+Каждый HTTP-запрос общих сессий app.infra.panel_http попадает в серию
+(панель host:port, шаблон эндпоинта вида «GET /keys/{id}/traffic», класс статуса 2xx/4xx/5xx/
+timeout/error) с гистограммой длительности по фиксированным корзинам. Реестр живёт в памяти
+процесса; снимки пишутся в panel_metrics_snapshots (не чаще VEILBOT_PANEL_METRICS_PERSIST_INTERVAL
+секунд), чтобы админка — отдельный процесс — показывала и отдавала в /metrics метрики бота.
+Из event loop снимок пишется в отдельном потоке, а не в trace-колбэке запроса.
+"""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+
+from app.infra.panel_health import panel_key
+from app.infra.panel_http import timed_trace_config
+from app.infra.sqlite_utils import get_db_cursor
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин, мс (+Inf — последняя корзина)
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+STATUS_TIMEOUT = "timeout"
+STATUS_ERROR = "error"
+
+_ID_SEGMENT = re.compile(r"^(\d+|[0-9a-fA-F-]{16,}|\d{4}-\d{2}-\d{2})$")
+# Сегмент после этих коллекций — всегда идентификатор (key_id, UUID или имя ключа, дата)
+_ID_COLLECTIONS = frozenset({"keys", "daily"})
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def endpoint_template(method: str, url: Any) -> str:
+    """«GET /keys/{id}/traffic»: путь после /api, идентификаторы/UUID/даты заменены на {id}."""
+    path = urlparse(str(url)).path or "/"
+    segments = [segment for segment in path.split("/") if segment]
+    if "api" in segments:
+        segments = segments[segments.index("api") + 1:]
+    normalized = [
+        "{id}" if _ID_SEGMENT.match(segment) or (i and segments[i - 1] in _ID_COLLECTIONS) else segment
+        for i, segment in enumerate(segments)
+    ]
+    return f"{(method or 'GET').upper()} /{'/'.join(normalized)}"
+
+
+def status_class(status: Optional[int] = None, exception: Optional[BaseException] = None) -> str:
+    if exception is not None:
+        if isinstance(exception, (asyncio.TimeoutError, aiohttp.ServerTimeoutError)):
+            return STATUS_TIMEOUT
+        return STATUS_ERROR
+    if status is None:
+        return STATUS_ERROR
+    return f"{status // 100}xx"
+
+
+def is_error_class(status: str) -> bool:
+    return status in ("5xx", STATUS_TIMEOUT, STATUS_ERROR)
+
+
+def _process_name() -> str:
+    return os.getenv("VEILBOT_PROCESS_NAME") or os.path.basename(sys.argv[0] or "") or "python"
+
+
+class _Series:
+    __slots__ = ("buckets", "count", "sum_ms")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+
+    def observe(self, duration_ms: float) -> None:
+        index = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if duration_ms <= bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum_ms += duration_ms
+
+
+def quantile_ms(buckets: List[int], q: float) -> Optional[float]:
+    """Оценка квантиля по гистограмме (линейная интерполяция внутри корзины)."""
+    total = sum(buckets)
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for i, count in enumerate(buckets):
+        upper = LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else LATENCY_BUCKETS_MS[-1]
+        if count and seen + count >= rank:
+            return lower + (upper - lower) * ((rank - seen) / count)
+        seen += count
+        lower = upper
+    return LATENCY_BUCKETS_MS[-1]
+
+
+def merge_series(snapshots: Iterable[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Сложить серии нескольких снимков (свой процесс + снимки других процессов из БД)."""
+    merged: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for series in snapshot:
+            key = (series["panel"], series["endpoint"], series["status"])
+            target = merged.get(key)
+            if target is None:
+                merged[key] = {**series, "buckets": list(series["buckets"])}
+                continue
+            target["buckets"] = [a + b for a, b in zip(target["buckets"], series["buckets"])]
+            target["count"] += series["count"]
+            target["sum_ms"] += series["sum_ms"]
+    return sorted(merged.values(), key=lambda s: (s["panel"], s["endpoint"], s["status"]))
+
+
+def summarize_by_panel(series_list: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Сводка по панели: запросы, ошибки, p50/p95 и самый медленный эндпоинт (по p95)."""
+    panels: Dict[str, Dict[str, Any]] = {}
+    endpoints: Dict[Tuple[str, str], List[int]] = {}
+    for series in series_list:
+        panel = panels.setdefault(
+            series["panel"],
+            {"requests": 0, "errors": 0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)},
+        )
+        panel["requests"] += series["count"]
+        if is_error_class(series["status"]):
+            panel["errors"] += series["count"]
+        panel["buckets"] = [a + b for a, b in zip(panel["buckets"], series["buckets"])]
+        key = (series["panel"], series["endpoint"])
+        endpoints[key] = [a + b for a, b in zip(endpoints.get(key, [0] * len(series["buckets"])), series["buckets"])]
+
+    summary: Dict[str, Dict[str, Any]] = {}
+    for name, panel in panels.items():
+        slowest = max(
+            ((endpoint, quantile_ms(buckets, 0.95) or 0.0) for (p, endpoint), buckets in endpoints.items() if p == name),
+            key=lambda item: item[1],
+            default=(None, None),
+        )
+        summary[name] = {
+            "requests": panel["requests"],
+            "errors": panel["errors"],
+            "error_rate": panel["errors"] / panel["requests"] if panel["requests"] else 0.0,
+            "p50_ms": quantile_ms(panel["buckets"], 0.5),
+            "p95_ms": quantile_ms(panel["buckets"], 0.95),
+            "slowest_endpoint": slowest[0],
+            "slowest_p95_ms": slowest[1],
+        }
+    return summary
+
+
+class PanelMetricsRegistry:
+    """Thread-safe registry of per-panel, per-endpoint latency histograms."""
+
+    def __init__(self, *, persist_interval_sec: Optional[float] = None, process_name: Optional[str] = None):
+        self.persist_interval_sec = (
+            persist_interval_sec if persist_interval_sec is not None
+            else _env_float("VEILBOT_PANEL_METRICS_PERSIST_INTERVAL", 60)
+        )
+        self.process_name = process_name or _process_name()
+        self._series: Dict[Tuple[str, str, str], _Series] = {}
+        self._lock = threading.Lock()
+        self._last_persisted = time.monotonic()
+        self._persist_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def observe(self, url: Any, method: str, status: str, duration_ms: float) -> None:
+        key = (panel_key(str(url)), endpoint_template(method, url), status)
+        if not key[0]:
+            return
+        now = time.monotonic()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.observe(max(0.0, duration_ms))
+            persist = self.persist_interval_sec > 0 and now - self._last_persisted >= self.persist_interval_sec
+            if persist:
+                self._last_persisted = now
+        if persist:
+            self._persist_off_loop()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "panel": panel,
+                    "endpoint": endpoint,
+                    "status": status,
+                    "buckets": list(series.buckets),
+                    "count": series.count,
+                    "sum_ms": round(series.sum_ms, 3),
+                }
+                for (panel, endpoint, status), series in sorted(self._series.items())
+            ]
+
+    def collect(self) -> List[Dict[str, Any]]:
+        """Серии своего процесса плюс последние снимки остальных процессов из БД."""
+        return merge_series([self.snapshot(), *self.load_persisted().values()])
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def _persist_off_loop(self) -> None:
+        """Записать снимок; на потоке event loop — в фоновом потоке (один поток сохраняет порядок)."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._persist()
+            return
+        with self._lock:
+            if self._persist_executor is None:
+                self._persist_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="panel-metrics-persist"
+                )
+            executor = self._persist_executor
+        executor.submit(self._persist)
+
+    def _persist(self) -> None:
+        """Сохранить снимок процесса в panel_metrics_snapshots (best-effort)."""
+        try:
+            payload = json.dumps(self.snapshot(), separators=(",", ":"))
+            with get_db_cursor(commit=True) as cursor:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO panel_metrics_snapshots (process, snapshot, updated_at) VALUES (?, ?, ?)",
+                    (self.process_name, payload, int(time.time())),
+                )
+        except Exception as e:
+            logger.debug("[PANEL_METRICS] Failed to persist snapshot: %s", e)
+
+    def load_persisted(self, max_age_sec: float = 3600) -> Dict[str, List[Dict[str, Any]]]:
+        """Снимки других процессов (не старше max_age_sec)."""
+        try:
+            with get_db_cursor() as cursor:
+                cursor.execute(
+                    "SELECT process, snapshot FROM panel_metrics_snapshots WHERE process != ? AND updated_at >= ?",
+                    (self.process_name, int(time.time() - max_age_sec)),
+                )
+                rows = cursor.fetchall()
+        except Exception as e:
+            logger.debug("[PANEL_METRICS] Failed to load snapshots: %s", e)
+            return {}
+        snapshots: Dict[str, List[Dict[str, Any]]] = {}
+        for process, payload in rows:
+            try:
+                snapshots[process] = json.loads(payload)
+            except (TypeError, ValueError):
+                continue
+        return snapshots
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """TraceConfig для aiohttp-сессий панелей: длительность и класс статуса каждого запроса."""
+
+        def on_end(params, elapsed_ms: Optional[float]) -> None:
+            self.observe(params.url, params.method, status_class(params.response.status), elapsed_ms or 0.0)
+
+        def on_exception(params, elapsed_ms: Optional[float]) -> None:
+            self.observe(params.url, params.method, status_class(exception=params.exception), elapsed_ms or 0.0)
+
+        return timed_trace_config(on_end, on_exception)
+
+
+def _label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(series_list: List[Dict[str, Any]], server_ids: Optional[Dict[str, Any]] = None) -> str:
+    """Текстовый формат Prometheus: veilbot_panel_request_duration_ms (histogram) и veilbot_panel_requests_total."""
+    server_ids = server_ids or {}
+    lines = [
+        "# HELP veilbot_panel_request_duration_ms V2Ray panel request duration in milliseconds.",
+        "# TYPE veilbot_panel_request_duration_ms histogram",
+    ]
+    totals: List[str] = []
+    for series in series_list:
+        labels = (
+            f'server_id="{_label(server_ids.get(series["panel"], ""))}",panel="{_label(series["panel"])}",'
+            f'endpoint="{_label(series["endpoint"])}",status="{_label(series["status"])}"'
+        )
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, series["buckets"]):
+            cumulative += count
+            lines.append(f'veilbot_panel_request_duration_ms_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+        lines.append(f'veilbot_panel_request_duration_ms_bucket{{{labels},le="+Inf"}} {series["count"]}')
+        lines.append(f"veilbot_panel_request_duration_ms_sum{{{labels}}} {series['sum_ms']}")
+        lines.append(f"veilbot_panel_request_duration_ms_count{{{labels}}} {series['count']}")
+        totals.append(f"veilbot_panel_requests_total{{{labels}}} {series['count']}")
+    lines += [
+        "# HELP veilbot_panel_requests_total V2Ray panel requests by endpoint and status class.",
+        "# TYPE veilbot_panel_requests_total counter",
+        *totals,
+    ]
+    return "\n".join(lines) + "\n"
+
+
+# Global registry instance
+panel_metrics = PanelMetricsRegistry()
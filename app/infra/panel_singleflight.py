@@ -0,0 +1,133 @@
+"""
+Single-flight для идемпотентных GET-запросов к панелям V2Ray.
+
+Одинаковые запросы (одна панель, один API-ключ, один ресурс), которые оказались в полёте
+одновременно — скан «сиротских» ключей, страница /keys админки, трафик ключа, ручные скрипты, —
+выполняются одним upstream-запросом; остальные вызывающие ждут и получают копию результата.
+Опционально успешный результат хранится короткий TTL (VEILBOT_PANEL_GET_CACHE_TTL, секунды;
+по умолчанию 0 — только объединение запросов в полёте), чтобы гасить всплески.
+
+Изменяющие запросы (создание/удаление ключа, сброс трафика) сбрасывают TTL-кэш своей панели
+через invalidate().
+"""
+from __future__ import annotations
+
+import asyncio
+import copy
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+class PanelSingleFlight:
+    """Объединение одинаковых GET-запросов в полёте плюс необязательный TTL-кэш результатов.
+
+    Задачи привязаны к event loop, поэтому запросы в полёте хранятся по (loop, key);
+    TTL-кэш общий для процесса (в нём только готовые данные).
+    """
+
+    def __init__(self, *, ttl_sec: Optional[float] = None, enabled: Optional[bool] = None):
+        self.ttl_sec = ttl_sec if ttl_sec is not None else _env_float("VEILBOT_PANEL_GET_CACHE_TTL", 0.0)
+        if enabled is None:
+            enabled = os.getenv("VEILBOT_PANEL_SINGLEFLIGHT", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = enabled
+        self._inflight: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+        self._cache: Dict[Hashable, Tuple[float, Any]] = {}
+        # Поколение панели: растёт при invalidate(), ответ, начатый до записи, в кэш не попадает
+        self._generations: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "coalesced": 0, "cache_hits": 0}
+
+    async def do(
+        self,
+        key: Tuple[Hashable, ...],
+        fn: Callable[[], Awaitable[Any]],
+        *,
+        cache_if: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """Выполнить fn() один раз для всех одновременных вызовов с тем же key.
+
+        key[0] — панель (для invalidate). cache_if решает, можно ли положить результат
+        в TTL-кэш (по умолчанию — любой непустой результат).
+        """
+        if not self.enabled:
+            return await fn()
+
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[0] > now:
+                    self._stats["cache_hits"] += 1
+                    return copy.deepcopy(cached[1])
+                del self._cache[key]
+            task = self._inflight.get((loop, key))
+            leader = task is None
+            if leader:
+                self._stats["requests"] += 1
+                generation = self._generations.get(key[0], 0)
+                task = loop.create_task(self._run(loop, key, fn, cache_if, generation))
+                self._inflight[(loop, key)] = task
+            else:
+                self._stats["coalesced"] += 1
+
+        # shield: отмена одного из ожидающих не отменяет общий запрос для остальных
+        result = await asyncio.shield(task)
+        return result if leader else copy.deepcopy(result)
+
+    async def _run(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        key: Tuple[Hashable, ...],
+        fn: Callable[[], Awaitable[Any]],
+        cache_if: Optional[Callable[[Any], bool]],
+        generation: int,
+    ) -> Any:
+        try:
+            result = await fn()
+            if self.ttl_sec > 0 and (cache_if(result) if cache_if is not None else bool(result)):
+                snapshot = copy.deepcopy(result)
+                with self._lock:
+                    if self._generations.get(key[0], 0) == generation:
+                        self._cache[key] = (time.monotonic() + self.ttl_sec, snapshot)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop((loop, key), None)
+
+    def invalidate(self, panel: Optional[Hashable] = None) -> None:
+        """Сбросить TTL-кэш панели (или весь кэш). Запросы в полёте не затрагиваются."""
+        with self._lock:
+            if panel is None:
+                self._cache.clear()
+                for known in list(self._generations):
+                    self._generations[known] += 1
+                return
+            self._generations[panel] = self._generations.get(panel, 0) + 1
+            for key in [key for key in self._cache if key[0] == panel]:
+                del self._cache[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, inflight=len(self._inflight), cached=len(self._cache))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._stats = {key: 0 for key in self._stats}
+
+
+# Global single-flight instance
+panel_singleflight = PanelSingleFlight()
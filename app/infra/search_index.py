@@ -0,0 +1,261 @@
+"""
+Индекс поиска админки на FTS5.
+
+Поиск в списках пользователей, подписок и ключей — подстрока в id, username, email, токенах,
+UUID и id платежей (LIKE '%q%'). Раньше он шёл по CAST(id AS TEXT), токенам и коррелированным
+EXISTS по v2ray_keys.email и payments.email, то есть полным проходом нескольких таблиц — дважды
+на страницу (список и счётчики). Теперь эти значения лежат в FTS5-таблице search_index с
+токенизатором trigram, который ускоряет тот же LIKE '%q%' (без учёта регистра, как LIKE в SQLite):
+страницы сначала находят id подходящих сущностей в индексе, затем выбирают строки по id.
+
+Одна строка индекса — одно значение: rowid = id сущности * _SLOTS + слот поля, поэтому триггеры
+удаляют строки сущности диапазоном rowid без прохода по таблице. Индекс поддерживается триггерами
+на users, subscriptions, v2ray_keys и payments (UPDATE — только на индексируемые столбцы).
+Названия тарифов и серверов (маленькие таблицы) сопоставляются отдельным запросом.
+
+Если FTS5 недоступен или VEILBOT_ADMIN_SEARCH_INDEX=0, условия поиска строятся прежним LIKE.
+"""
+from __future__ import annotations
+
+import os
+from typing import Any, List, NamedTuple, Sequence, Tuple
+
+SEARCH_INDEX_ENABLED = os.getenv("VEILBOT_ADMIN_SEARCH_INDEX", "1").strip().lower() not in ("0", "false", "no")
+
+SEARCH_INDEX_TABLE = "search_index"
+
+# Служебные email, которые бот подставляет пользователям без почты
+PLACEHOLDER_EMAIL_LIKE = "user_%@veilbot.com"
+
+_SLOTS = 16
+
+
+class _Source(NamedTuple):
+    kind: str
+    table: str
+    id_column: str
+    # Столбцы, изменение которых перестраивает строки сущности
+    columns: Tuple[str, ...]
+    # (слот, поле, выражение значения; {row} — префикс строки: "" или "new.")
+    fields: Tuple[Tuple[int, str, str], ...]
+
+
+_SOURCES = (
+    _Source("user", "users", "user_id", ("user_id", "username", "first_name", "last_name"), (
+        (0, "user_id", "CAST({row}user_id AS TEXT)"),
+        (1, "username", "{row}username"),
+        (2, "first_name", "{row}first_name"),
+        (3, "last_name", "{row}last_name"),
+    )),
+    _Source("subscription", "subscriptions", "id", ("id", "user_id", "subscription_token"), (
+        (4, "id", "CAST({row}id AS TEXT)"),
+        (5, "user_id", "CAST({row}user_id AS TEXT)"),
+        (6, "token", "{row}subscription_token"),
+    )),
+    _Source("key", "v2ray_keys", "id", ("id", "user_id", "email", "v2ray_uuid", "subscription_id"), (
+        # "206_v2ray" покрывает и поиск по числовому id
+        (7, "id", "{row}id || '_v2ray'"),
+        (8, "email", "{row}email"),
+        (9, "uuid", "{row}v2ray_uuid"),
+        (10, "user_id", "CAST({row}user_id AS TEXT)"),
+        (11, "subscription_id", "CAST({row}subscription_id AS TEXT)"),
+    )),
+    _Source("payment", "payments", "id", ("id", "user_id", "payment_id", "email"), (
+        (12, "payment_id", "{row}payment_id"),
+        (13, "email", "{row}email"),
+    )),
+)
+
+_INSERT_COLUMNS = "rowid, kind, field, entity_id, user_id, value"
+
+
+def _slot_range(source: _Source) -> Tuple[int, int]:
+    slots = [slot for slot, _, _ in source.fields]
+    return min(slots), max(slots)
+
+
+def _trigger_statements(source: _Source) -> List[str]:
+    first, last = _slot_range(source)
+    fields = "\n                UNION ALL ".join(
+        f"SELECT {slot} AS slot, '{field}' AS field, {expr.format(row='new.')} AS value"
+        for slot, field, expr in source.fields
+    )
+    insert = f"""
+            INSERT INTO {SEARCH_INDEX_TABLE} ({_INSERT_COLUMNS})
+            SELECT new.{source.id_column} * {_SLOTS} + slot, '{source.kind}', field,
+                   new.{source.id_column}, new.user_id, value
+            FROM (
+                {fields}
+            )
+            WHERE value != '';"""
+    delete = f"""
+            DELETE FROM {SEARCH_INDEX_TABLE}
+            WHERE rowid BETWEEN old.{source.id_column} * {_SLOTS} + {first} AND old.{source.id_column} * {_SLOTS} + {last};"""
+    name = f"{SEARCH_INDEX_TABLE}_{source.table}"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON {source.table} BEGIN{insert}\n        END",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_au AFTER UPDATE OF {', '.join(source.columns)} ON {source.table} "
+        f"BEGIN{delete}{insert}\n        END",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON {source.table} BEGIN{delete}\n        END",
+    ]
+
+
+def search_index_exists(conn: Any) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_INDEX_TABLE,)
+    ).fetchone()
+    return row is not None
+
+
+def search_index_available(conn: Any) -> bool:
+    """Можно ли искать через индекс (включён и таблица создана)."""
+    return SEARCH_INDEX_ENABLED and search_index_exists(conn)
+
+
+def rebuild_search_index(conn: Any) -> int:
+    """Перезаполнить индекс из таблиц; возвращает число строк индекса. Коммит — за вызывающим."""
+    conn.execute(f"DELETE FROM {SEARCH_INDEX_TABLE}")
+    for source in _SOURCES:
+        for slot, field, expr in source.fields:
+            conn.execute(
+                f"""
+                INSERT INTO {SEARCH_INDEX_TABLE} ({_INSERT_COLUMNS})
+                SELECT entity_id * {_SLOTS} + {slot}, '{source.kind}', '{field}', entity_id, user_id, value
+                FROM (
+                    SELECT {source.id_column} AS entity_id, user_id, {expr.format(row='')} AS value
+                    FROM {source.table}
+                )
+                WHERE value != ''
+                """
+            )
+    return conn.execute(f"SELECT COUNT(*) FROM {SEARCH_INDEX_TABLE}").fetchone()[0]
+
+
+def create_search_index(conn: Any) -> bool:
+    """Создать таблицу индекса и триггеры; новую таблицу сразу заполнить.
+
+    Возвращает True, если таблица создана сейчас. Без FTS5 — sqlite3.OperationalError.
+    """
+    created = not search_index_exists(conn)
+    conn.execute(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_INDEX_TABLE} USING fts5(
+            kind UNINDEXED, field UNINDEXED, entity_id UNINDEXED, user_id UNINDEXED, value,
+            tokenize = 'trigram'
+        )
+        """
+    )
+    for source in _SOURCES:
+        for statement in _trigger_statements(source):
+            conn.execute(statement)
+    if created:
+        rebuild_search_index(conn)
+    return created
+
+
+def _matching_ids(conn: Any, table: str, like: str) -> List[int]:
+    """id строк маленькой таблицы (тарифы, серверы), название которых подходит под запрос."""
+    return [row[0] for row in conn.execute(f"SELECT id FROM {table} WHERE IFNULL(name, '') LIKE ?", (like,)).fetchall()]
+
+
+def _in_clause(column: str, ids: Sequence[int]) -> Tuple[str, List[Any]]:
+    return f"{column} IN ({', '.join('?' * len(ids))})", list(ids)
+
+
+def _email_owners_sql() -> str:
+    """user_id владельцев email (ключи и платежи), без служебных адресов."""
+    return (
+        f"SELECT user_id FROM {SEARCH_INDEX_TABLE} "
+        f"WHERE value LIKE ? AND field = 'email' AND kind IN ('key', 'payment') "
+        f"AND value NOT LIKE '{PLACEHOLDER_EMAIL_LIKE}'"
+    )
+
+
+def _legacy_email_exists(owner: str, table: str, alias: str) -> str:
+    return (
+        f"EXISTS (SELECT 1 FROM {table} {alias} WHERE {alias}.user_id = {owner} "
+        f"AND {alias}.email LIKE ? AND {alias}.email IS NOT NULL AND {alias}.email != '' "
+        f"AND {alias}.email NOT LIKE '{PLACEHOLDER_EMAIL_LIKE}')"
+    )
+
+
+def user_search_condition(conn: Any, query: str, alias: str = "u") -> Tuple[str, List[Any]]:
+    """Условие поиска пользователей: user_id, username, имя, email ключей и платежей, id платежей."""
+    like = f"%{query.strip()}%"
+    if search_index_available(conn):
+        sql = (
+            f"{alias}.user_id IN ("
+            f"SELECT user_id FROM {SEARCH_INDEX_TABLE} "
+            f"WHERE value LIKE ? AND (kind = 'user' OR (kind = 'payment' AND field = 'payment_id')) "
+            f"UNION ALL {_email_owners_sql()})"
+        )
+        return sql, [like, like]
+    conditions = [
+        f"CAST({alias}.user_id AS TEXT) LIKE ?",
+        f"IFNULL({alias}.username, '') LIKE ?",
+        f"IFNULL({alias}.first_name, '') LIKE ?",
+        f"IFNULL({alias}.last_name, '') LIKE ?",
+        _legacy_email_exists(f"{alias}.user_id", "v2ray_keys", "sk"),
+        _legacy_email_exists(f"{alias}.user_id", "payments", "sp"),
+    ]
+    return "(" + " OR ".join(conditions) + ")", [like] * len(conditions)
+
+
+def subscription_search_condition(
+    conn: Any, query: str, alias: str = "s", tariff_alias: str = "t"
+) -> Tuple[str, List[Any]]:
+    """Условие поиска подписок: id, user_id, токен, тариф, email владельца, id платежей подписки."""
+    like = f"%{query.strip()}%"
+    if search_index_available(conn):
+        conditions = [
+            f"{alias}.id IN ("
+            f"SELECT entity_id FROM {SEARCH_INDEX_TABLE} WHERE value LIKE ? AND kind = 'subscription' "
+            f"UNION ALL SELECT sp.subscription_id FROM payments sp WHERE sp.id IN ("
+            f"SELECT entity_id FROM {SEARCH_INDEX_TABLE} WHERE value LIKE ? AND kind = 'payment' AND field = 'payment_id'"
+            f"))",
+            f"{alias}.user_id IN ({_email_owners_sql()})",
+        ]
+        params: List[Any] = [like, like, like]
+        tariff_ids = _matching_ids(conn, "tariffs", like)
+        if tariff_ids:
+            clause, ids = _in_clause(f"{alias}.tariff_id", tariff_ids)
+            conditions.append(clause)
+            params.extend(ids)
+        return "(" + " OR ".join(conditions) + ")", params
+    conditions = [
+        f"CAST({alias}.id AS TEXT) LIKE ?",
+        f"CAST({alias}.user_id AS TEXT) LIKE ?",
+        f"{alias}.subscription_token LIKE ?",
+        f"{tariff_alias}.name LIKE ?",
+        _legacy_email_exists(f"{alias}.user_id", "v2ray_keys", "sk"),
+        _legacy_email_exists(f"{alias}.user_id", "payments", "sp"),
+    ]
+    return "(" + " OR ".join(conditions) + ")", [like] * len(conditions)
+
+
+def key_search_condition(
+    conn: Any, query: str, alias: str = "k", server_alias: str = "s", tariff_alias: str = "t"
+) -> Tuple[str, List[Any]]:
+    """Условие поиска ключей: id ("206_v2ray"), email, UUID, user_id, подписка, сервер, тариф."""
+    like = f"%{query}%"
+    if search_index_available(conn):
+        conditions = [f"{alias}.id IN (SELECT entity_id FROM {SEARCH_INDEX_TABLE} WHERE value LIKE ? AND kind = 'key')"]
+        params: List[Any] = [like]
+        for column, table in ((f"{alias}.server_id", "servers"), (f"{alias}.tariff_id", "tariffs")):
+            ids = _matching_ids(conn, table, like)
+            if ids:
+                clause, values = _in_clause(column, ids)
+                conditions.append(clause)
+                params.extend(values)
+        return "(" + " OR ".join(conditions) + ")", params
+    conditions = [
+        f"CAST({alias}.id AS TEXT) LIKE ?",
+        f"{alias}.email LIKE ?",
+        f"{alias}.v2ray_uuid LIKE ?",
+        f"IFNULL({server_alias}.name,'') LIKE ?",
+        f"IFNULL({tariff_alias}.name,'') LIKE ?",
+        f"CAST({alias}.user_id AS TEXT) LIKE ?",
+        f"({alias}.id || '_v2ray') LIKE ?",
+        f"CAST({alias}.subscription_id AS TEXT) LIKE ?",
+    ]
+    return "(" + " OR ".join(conditions) + ")", [like] * len(conditions)
@@ -2,11 +2,14 @@ from __future__ import annotations
 
 import os
 import sqlite3
+import threading
 import time
 import asyncio
 import logging
+from collections import deque
 from contextlib import asynccontextmanager, contextmanager
-from typing import Optional, Callable, TypeVar, Any, Coroutine, Dict
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Iterator, List, Optional, Callable, TypeVar, Any, Coroutine, Dict, Tuple
 
 import aiosqlite
 
@@ -15,6 +18,35 @@ logger = logging.getLogger(__name__)
 T = TypeVar('T')
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(0, int(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+# Пул синхронных соединений (pooled_connection / get_db_cursor)
+SQLITE_POOL_ENABLED = os.getenv("VEILBOT_SQLITE_POOL", "1").strip().lower() not in ("0", "false", "no")
+SQLITE_POOL_SIZE = max(1, _env_int("VEILBOT_SQLITE_POOL_SIZE", 8))
+SQLITE_POOL_TIMEOUT = _env_float("VEILBOT_SQLITE_POOL_TIMEOUT", 2.0)
+SQLITE_CACHED_STATEMENTS = _env_int("VEILBOT_SQLITE_CACHED_STATEMENTS", 512)
+# Пул aiosqlite-соединений (open_async_connection): читатели и писатели
+SQLITE_ASYNC_POOL_ENABLED = os.getenv("VEILBOT_SQLITE_ASYNC_POOL", "1").strip().lower() not in ("0", "false", "no")
+SQLITE_ASYNC_POOL_READERS = max(1, _env_int("VEILBOT_SQLITE_ASYNC_POOL_READERS", 4))
+SQLITE_ASYNC_POOL_WRITERS = max(1, _env_int("VEILBOT_SQLITE_ASYNC_POOL_WRITERS", 1))
+SQLITE_ASYNC_POOL_TIMEOUT = _env_float("VEILBOT_SQLITE_ASYNC_POOL_TIMEOUT", 2.0)
+# Соединение, простоявшее дольше, перед выдачей проверяется SELECT 1; старше — пересоздаётся
+_POOL_HEALTHCHECK_IDLE_SEC = 30.0
+_POOL_MAX_LIFETIME_SEC = 3600.0
+
+
 def apply_pragmas_sync(conn: sqlite3.Connection) -> None:
     """Apply recommended SQLite PRAGMAs for this project.
 
@@ -42,20 +74,261 @@ def apply_pragmas_sync(conn: sqlite3.Connection) -> None:
         pass
 
 
-def open_connection(db_path: Optional[str]) -> sqlite3.Connection:
+def _resolve_db_path(db_path: Optional[str]) -> str:
     if db_path is not None:
-        path = db_path
-    else:
-        path = os.getenv("DATABASE_PATH")
-        if not path:
-            from app.settings import settings
-            path = settings.DATABASE_PATH
+        return db_path
+    path = os.getenv("DATABASE_PATH")
+    if not path:
+        from app.settings import settings
+        path = settings.DATABASE_PATH
+    return path
+
+
+def open_connection(db_path: Optional[str]) -> sqlite3.Connection:
+    path = _resolve_db_path(db_path)
     # Короткий timeout (5s) — при конкуренции бот/админка не блокируем надолго
     conn = sqlite3.connect(path, timeout=5)
     apply_pragmas_sync(conn)
     return conn
 
 
+def _on_event_loop_thread() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class _PoolEntry:
+    __slots__ = ("conn", "pooled", "created_at", "last_used")
+
+    def __init__(self, conn: sqlite3.Connection, pooled: bool):
+        self.conn = conn
+        self.pooled = pooled
+        self.created_at = self.last_used = time.monotonic()
+
+
+class SQLiteConnectionPool:
+    """
+    Пул долгоживущих sqlite3-соединений к одному файлу БД.
+
+    Соединение выдаётся одному потоку на время использования (check_same_thread=False нужен
+    только для возврата в пул из другого потока). PRAGMA применяются один раз при создании,
+    кэш подготовленных выражений — cached_statements. При возврате незавершённая транзакция
+    откатывается, row_factory/isolation_level и foreign_keys возвращаются к значениям по
+    умолчанию. Если все max_size соединений заняты дольше timeout, выдаётся временное
+    соединение вне пула (закрывается после использования) — вложенные вызовы не блокируются.
+    В потоке с работающим event loop пул не ждёт вовсе: временное соединение выдаётся сразу.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        max_size: int = SQLITE_POOL_SIZE,
+        timeout: float = SQLITE_POOL_TIMEOUT,
+        cached_statements: int = SQLITE_CACHED_STATEMENTS,
+    ):
+        self.path = path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle: Deque[_PoolEntry] = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "created": 0, "reused": 0, "waits": 0, "overflow": 0, "loop_overflow": 0,
+            "discarded": 0, "healthcheck_failures": 0,
+        }
+
+    def acquire(self) -> _PoolEntry:
+        # В потоке event loop ждать нельзя: держатели соединений — корутины этого же loop,
+        # пока мы ждём, они не вернут соединение. Сразу выдаём временное.
+        on_loop = _on_event_loop_thread()
+        deadline = time.monotonic() + (0.0 if on_loop else self.timeout)
+        entry: Optional[_PoolEntry] = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    break
+                if self._idle:
+                    # LIFO: самое «тёплое» соединение (кэш страниц и выражений)
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["overflow"] += 1
+                    if on_loop:
+                        self._stats["loop_overflow"] += 1
+                        logger.debug(f"[SQLITE_POOL] Pool for {self.path} busy on event loop thread, using a temporary connection")
+                    else:
+                        logger.warning(f"[SQLITE_POOL] Pool for {self.path} exhausted ({self.max_size}), using a temporary connection")
+                    return self._connect(pooled=False)
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+        if self._closed and entry is None:
+            return self._connect(pooled=False)
+        if entry is not None:
+            if self._healthy(entry):
+                with self._cond:
+                    self._stats["reused"] += 1
+                return entry
+            self._close_entry(entry)
+        try:
+            return self._connect(pooled=True)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, entry: _PoolEntry, discard: bool = False) -> None:
+        if not entry.pooled:
+            self._close_entry(entry)
+            return
+        conn = entry.conn
+        if not discard:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.row_factory = None
+                if conn.isolation_level != "":
+                    conn.isolation_level = ""
+                conn.execute("PRAGMA foreign_keys=ON")
+            except Exception as e:
+                logger.warning(f"[SQLITE_POOL] Discarding connection to {self.path}: {e}")
+                discard = True
+        now = time.monotonic()
+        with self._cond:
+            if discard or self._closed or now - entry.created_at > _POOL_MAX_LIFETIME_SEC:
+                self._size -= 1
+                if discard:
+                    self._stats["discarded"] += 1
+                self._cond.notify()
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+                self._cond.notify()
+                return
+        self._close_entry(entry)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close_entry(entry)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return dict(self._stats, size=self._size, idle=len(self._idle), max_size=self.max_size)
+
+    def _connect(self, pooled: bool) -> _PoolEntry:
+        conn = sqlite3.connect(
+            self.path, timeout=5, check_same_thread=False, cached_statements=self.cached_statements
+        )
+        apply_pragmas_sync(conn)
+        if pooled:
+            with self._cond:
+                self._stats["created"] += 1
+        return _PoolEntry(conn, pooled)
+
+    def _healthy(self, entry: _PoolEntry) -> bool:
+        now = time.monotonic()
+        if now - entry.created_at > _POOL_MAX_LIFETIME_SEC:
+            return False
+        if now - entry.last_used <= _POOL_HEALTHCHECK_IDLE_SEC:
+            return True
+        try:
+            entry.conn.execute("SELECT 1").fetchone()
+            return True
+        except Exception as e:
+            logger.warning(f"[SQLITE_POOL] Health check failed for {self.path}: {e}")
+            with self._cond:
+                self._stats["healthcheck_failures"] += 1
+            return False
+
+    @staticmethod
+    def _close_entry(entry: _PoolEntry) -> None:
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+
+_pools: Dict[Tuple[int, str], SQLiteConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(db_path: Optional[str] = None) -> SQLiteConnectionPool:
+    """Пул для файла БД (после fork процесс получает свой пул)."""
+    path = os.path.abspath(_resolve_db_path(db_path))
+    key = (os.getpid(), path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = SQLiteConnectionPool(path)
+    return pool
+
+
+def close_connection_pools() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+@contextmanager
+def _leased_connection(db_path: Optional[str]) -> Iterator[sqlite3.Connection]:
+    """Соединение из пула без автокоммита: незакоммиченное откатывается при возврате."""
+    if not SQLITE_POOL_ENABLED:
+        conn = open_connection(db_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+    pool = get_connection_pool(db_path)
+    entry = pool.acquire()
+    discard = False
+    try:
+        yield entry.conn
+    except sqlite3.Error as e:
+        # Ошибки данных и блокировок соединение не портят; прочие (закрыто, повреждено) — в утиль
+        discard = not isinstance(e, (sqlite3.IntegrityError, sqlite3.OperationalError))
+        raise
+    finally:
+        pool.release(entry, discard)
+
+
+@contextmanager
+def pooled_connection(db_path: Optional[str] = None) -> Iterator[sqlite3.Connection]:
+    """
+    Соединение из пула на время with-блока; та же семантика, что у `with sqlite3.connect(...)`:
+    commit при выходе без исключения, rollback при исключении. После блока соединение
+    возвращается в пул — использовать его вне блока нельзя.
+    """
+    with _leased_connection(db_path) as conn:
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        if conn.in_transaction:
+            conn.commit()
+
+
 async def apply_pragmas_async(conn: aiosqlite.Connection) -> None:
     try:
         await conn.execute("PRAGMA journal_mode=WAL")
@@ -75,22 +348,347 @@ async def apply_pragmas_async(conn: aiosqlite.Connection) -> None:
         pass
 
 
+class _AsyncPoolEntry:
+    __slots__ = ("conn", "lane", "pooled", "created_at", "last_used")
+
+    def __init__(self, conn: aiosqlite.Connection, lane: str, pooled: bool):
+        self.conn = conn
+        self.lane = lane
+        self.pooled = pooled
+        self.created_at = self.last_used = time.monotonic()
+
+
+class _AsyncLane:
+    __slots__ = ("max_size", "size", "idle", "waiters")
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self.size = 0
+        self.idle: Deque[_AsyncPoolEntry] = deque()
+        self.waiters: Deque[asyncio.Future] = deque()
+
+
+# Полосы пула, которые текущая задача уже держит: вложенный запрос соединения в той же
+# задаче не ждёт сам себя, а сразу получает временное соединение (как до пула)
+_held_async_lanes: ContextVar[frozenset] = ContextVar("veilbot_held_async_lanes", default=frozenset())
+
+
+class AsyncSQLiteConnectionPool:
+    """
+    Пул постоянных aiosqlite-соединений к одному файлу БД: читатели и писатель.
+
+    Каждое aiosqlite-соединение — отдельный поток, поэтому пул убирает создание потока и
+    PRAGMA с каждого вызова. Читающие соединения (readonly=True) открыты с query_only и
+    выдаются параллельно (до `readers`), пишущих — `writers` (по умолчанию одно): запись в
+    SQLite всё равно сериализуется блокировкой файла, а очередь в процессе дешевле, чем
+    busy_timeout. Соединения не привязаны к event loop, ожидающие будятся через
+    call_soon_threadsafe — один пул обслуживает все loop'ы процесса.
+
+    Если соединение не освободилось за timeout, выдаётся временное соединение вне пула.
+    При возврате незавершённая транзакция откатывается, row_factory сбрасывается,
+    foreign_keys снова включается (если не удалось — соединение закрывается).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        readers: int = SQLITE_ASYNC_POOL_READERS,
+        writers: int = SQLITE_ASYNC_POOL_WRITERS,
+        timeout: float = SQLITE_ASYNC_POOL_TIMEOUT,
+        cached_statements: int = SQLITE_CACHED_STATEMENTS,
+    ):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._lanes = {"read": _AsyncLane(readers), "write": _AsyncLane(writers)}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {
+            lane: {
+                "checkouts": 0, "created": 0, "waits": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+                "timeouts": 0, "nested": 0, "discarded": 0,
+            }
+            for lane in self._lanes
+        }
+
+    async def acquire(self, readonly: bool = False) -> _AsyncPoolEntry:
+        name = "read" if readonly else "write"
+        lane = self._lanes[name]
+        stats = self._stats[name]
+        entry: Optional[_AsyncPoolEntry] = None
+        waiter: Optional[asyncio.Future] = None
+        create = False
+        with self._lock:
+            stats["checkouts"] += 1
+            if self._closed:
+                pass
+            elif lane.idle:
+                entry = lane.idle.pop()
+            elif lane.size < lane.max_size:
+                lane.size += 1
+                create = True
+            elif (id(self), name) in _held_async_lanes.get():
+                stats["nested"] += 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                lane.waiters.append(waiter)
+                stats["waits"] += 1
+        if self._closed and entry is None and not create:
+            return await self._connect(name, pooled=False)
+
+        if waiter is not None:
+            started = time.monotonic()
+            try:
+                entry = await asyncio.wait_for(waiter, self.timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    stats["timeouts"] += 1
+                logger.warning(
+                    f"[SQLITE_POOL] No {name} connection to {self.path} within {self.timeout}s, using a temporary one"
+                )
+                return await self._connect(name, pooled=False)
+            finally:
+                waited_ms = (time.monotonic() - started) * 1000
+                with self._lock:
+                    if not waiter.done() or waiter.cancelled():
+                        try:
+                            lane.waiters.remove(waiter)
+                        except ValueError:
+                            pass
+                    stats["wait_ms_total"] += waited_ms
+                    stats["wait_ms_max"] = max(stats["wait_ms_max"], waited_ms)
+        elif entry is None and not create:
+            # Вложенный запрос той же полосы из задачи, которая её уже держит
+            return await self._connect(name, pooled=False)
+
+        if entry is not None:
+            if await self._healthy(entry):
+                return entry
+            await self._close_entry(entry)
+            create = True
+        try:
+            return await self._connect(name, pooled=True)
+        except BaseException:
+            self._forget(name)
+            raise
+
+    async def release(self, entry: _AsyncPoolEntry, discard: bool = False) -> None:
+        if not entry.pooled:
+            await self._close_entry(entry)
+            return
+        conn = entry.conn
+        if not discard:
+            try:
+                if conn.in_transaction:
+                    await conn.rollback()
+                conn.row_factory = None
+                # PRAGMA внутри транзакции не действует: вызывающий мог не вернуть foreign_keys=ON
+                await conn.execute("PRAGMA foreign_keys=ON")
+            except Exception as e:
+                logger.warning(f"[SQLITE_POOL] Discarding async connection to {self.path}: {e}")
+                discard = True
+        now = time.monotonic()
+        if discard or self._closed or now - entry.created_at > _POOL_MAX_LIFETIME_SEC:
+            if discard:
+                with self._lock:
+                    self._stats[entry.lane]["discarded"] += 1
+            self._forget(entry.lane)
+            await self._close_entry(entry)
+            return
+        entry.last_used = now
+        self._hand_over(entry)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            idle: List[_AsyncPoolEntry] = []
+            for lane in self._lanes.values():
+                idle.extend(lane.idle)
+                lane.size -= len(lane.idle)
+                lane.idle.clear()
+        for entry in idle:
+            await self._close_entry(entry)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for name, lane in self._lanes.items():
+                stats = dict(self._stats[name])
+                stats["wait_ms_total"] = round(stats["wait_ms_total"], 1)
+                stats["wait_ms_max"] = round(stats["wait_ms_max"], 1)
+                stats.update(
+                    size=lane.size, idle=len(lane.idle), in_use=lane.size - len(lane.idle),
+                    waiting=len(lane.waiters), max_size=lane.max_size,
+                )
+                result[name] = stats
+            return result
+
+    def _hand_over(self, entry: _AsyncPoolEntry) -> None:
+        """Отдать соединение первому живому ожидающему (в его loop) или вернуть в пул."""
+        lane = self._lanes[entry.lane]
+        with self._lock:
+            while lane.waiters:
+                waiter = lane.waiters.popleft()
+                if waiter.done():
+                    continue
+                try:
+                    waiter.get_loop().call_soon_threadsafe(self._deliver, waiter, entry)
+                    return
+                except RuntimeError:
+                    # loop ожидающего уже закрыт
+                    continue
+            lane.idle.append(entry)
+
+    def _deliver(self, waiter: asyncio.Future, entry: _AsyncPoolEntry) -> None:
+        if waiter.done():
+            # Ожидающий успел отвалиться по таймауту — соединение следующему
+            self._hand_over(entry)
+        else:
+            waiter.set_result(entry)
+
+    def _forget(self, name: str) -> None:
+        """Соединение полосы закрыто: освободить место и разбудить ожидающего."""
+        lane = self._lanes[name]
+        with self._lock:
+            lane.size -= 1
+            waiter = None
+            while lane.waiters and waiter is None:
+                candidate = lane.waiters.popleft()
+                if not candidate.done():
+                    waiter = candidate
+            if waiter is not None:
+                lane.size += 1
+        if waiter is not None:
+            try:
+                waiter.get_loop().call_soon_threadsafe(self._spawn_for, waiter, name)
+            except RuntimeError:
+                self._forget(name)
+
+    def _spawn_for(self, waiter: asyncio.Future, name: str) -> None:
+        async def spawn() -> None:
+            try:
+                entry = await self._connect(name, pooled=True)
+            except Exception as e:
+                self._forget(name)
+                if not waiter.done():
+                    waiter.set_exception(e)
+                return
+            self._deliver(waiter, entry)
+
+        asyncio.ensure_future(spawn())
+
+    async def _connect(self, name: str, pooled: bool) -> _AsyncPoolEntry:
+        # IMPORTANT: Increase SQLite connect timeout to reduce "database is locked" errors under concurrent writers.
+        conn = aiosqlite.connect(self.path, timeout=5, cached_statements=self.cached_statements)
+        # Поток соединения из пула живёт до конца процесса и не должен держать выход
+        conn.daemon = True
+        await conn
+        try:
+            await apply_pragmas_async(conn)
+            if name == "read":
+                await conn.execute("PRAGMA query_only=ON")
+        except BaseException:
+            await conn.close()
+            raise
+        if pooled:
+            with self._lock:
+                self._stats[name]["created"] += 1
+        return _AsyncPoolEntry(conn, name, pooled)
+
+    async def _healthy(self, entry: _AsyncPoolEntry) -> bool:
+        now = time.monotonic()
+        if now - entry.created_at > _POOL_MAX_LIFETIME_SEC:
+            return False
+        if now - entry.last_used <= _POOL_HEALTHCHECK_IDLE_SEC:
+            return True
+        try:
+            async with entry.conn.execute("SELECT 1") as cursor:
+                await cursor.fetchone()
+            return True
+        except Exception as e:
+            logger.warning(f"[SQLITE_POOL] Health check failed for {self.path}: {e}")
+            return False
+
+    @staticmethod
+    async def _close_entry(entry: _AsyncPoolEntry) -> None:
+        try:
+            await entry.conn.close()
+        except Exception:
+            pass
+
+
+_async_pools: Dict[Tuple[int, str], AsyncSQLiteConnectionPool] = {}
+
+
+def get_async_connection_pool(db_path: Optional[str] = None) -> AsyncSQLiteConnectionPool:
+    """Асинхронный пул для файла БД (общий для всех event loop процесса)."""
+    path = os.path.abspath(_resolve_db_path(db_path))
+    key = (os.getpid(), path)
+    pool = _async_pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _async_pools.get(key)
+            if pool is None:
+                pool = _async_pools[key] = AsyncSQLiteConnectionPool(path)
+    return pool
+
+
+async def close_async_connection_pools() -> None:
+    with _pools_lock:
+        pools = list(_async_pools.values())
+        _async_pools.clear()
+    for pool in pools:
+        await pool.close()
+
+
+def connection_pool_stats() -> Dict[str, Any]:
+    """Метрики синхронных и асинхронных пулов процесса (для /healthz)."""
+    pid = os.getpid()
+    with _pools_lock:
+        sync_pools = {path: pool for (owner, path), pool in _pools.items() if owner == pid}
+        async_pools = {path: pool for (owner, path), pool in _async_pools.items() if owner == pid}
+    return {
+        "sync": {path: pool.stats() for path, pool in sync_pools.items()},
+        "async": {path: pool.stats() for path, pool in async_pools.items()},
+    }
+
+
 @asynccontextmanager
-async def open_async_connection(db_path: Optional[str]) -> aiosqlite.Connection:
-    if db_path is not None:
-        path = db_path
-    else:
-        path = os.getenv("DATABASE_PATH")
-        if not path:
-            from app.settings import settings
-            path = settings.DATABASE_PATH
-    # IMPORTANT: Increase SQLite connect timeout to reduce "database is locked" errors under concurrent writers.
-    conn = await aiosqlite.connect(path, timeout=5)
-    await apply_pragmas_async(conn)
+async def open_async_connection(db_path: Optional[str], *, readonly: bool = False) -> AsyncIterator[aiosqlite.Connection]:
+    """
+    aiosqlite-соединение из пула на время блока (см. AsyncSQLiteConnectionPool).
+
+    readonly=True — соединение читателя (query_only): только для блоков без записи.
+    Незакоммиченное при выходе откатывается, как и при закрытии отдельного соединения.
+    """
+    if not SQLITE_ASYNC_POOL_ENABLED:
+        path = _resolve_db_path(db_path)
+        # IMPORTANT: Increase SQLite connect timeout to reduce "database is locked" errors under concurrent writers.
+        conn = await aiosqlite.connect(path, timeout=5)
+        await apply_pragmas_async(conn)
+        try:
+            yield conn
+        finally:
+            await conn.close()
+        return
+    pool = get_async_connection_pool(db_path)
+    entry = await pool.acquire(readonly)
+    marker = (id(pool), entry.lane)
+    token = _held_async_lanes.set(_held_async_lanes.get() | {marker})
+    discard = False
     try:
-        yield conn
+        yield entry.conn
+    except sqlite3.Error as e:
+        discard = not isinstance(e, (sqlite3.IntegrityError, sqlite3.OperationalError))
+        raise
+    except ValueError as e:
+        # aiosqlite сообщает о закрытом соединении через ValueError
+        discard = str(e) in ("Connection closed", "no active connection")
+        raise
     finally:
-        await conn.close()
+        _held_async_lanes.reset(token)
+        await pool.release(entry, discard)
 
 
 @contextmanager
@@ -98,8 +696,8 @@ def get_db_cursor(commit: bool = False, db_path: Optional[str] = None):
     """
     Context manager для получения курсора БД (совместимость с utils.py).
     
-    Это упрощенная версия без connection pool для постепенной миграции.
-    Для новых файлов рекомендуется использовать open_connection() напрямую.
+    Соединение берётся из пула (см. SQLiteConnectionPool). Без commit=True изменения
+    не сохраняются: незакоммиченная транзакция откатывается при возврате соединения.
     
     Args:
         commit: Автоматически коммитить изменения при выходе
@@ -108,19 +706,18 @@ def get_db_cursor(commit: bool = False, db_path: Optional[str] = None):
     Yields:
         sqlite3.Cursor: Курсор для работы с БД
     """
-    conn = open_connection(db_path)
-    conn.row_factory = sqlite3.Row  # Для совместимости с utils.py
-    cursor = conn.cursor()
-    try:
-        yield cursor
-        if commit:
-            conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        cursor.close()
-        conn.close()
+    with _leased_connection(db_path) as conn:
+        conn.row_factory = sqlite3.Row  # Для совместимости с utils.py
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            if commit:
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
 
 def retry_db_operation(
@@ -0,0 +1,330 @@
+"""
+Единый писатель SQLite процесса с групповым коммитом.
+
+Бот, фоновые задачи и админка пишут в один файл БД из многих потоков и процессов; каждая
+запись — своя транзакция, которая ждёт блокировку в busy_timeout, а при неудаче повторяется
+через retry_db_operation. Писатель — отдельный поток с собственным соединением: вызывающие
+отдают ему пачки выражений (WriteBatch), он забирает из очереди всё накопившееся (до
+VEILBOT_SQLITE_WRITER_MAX_GROUP пачек) и выполняет одной транзакцией BEGIN IMMEDIATE …
+COMMIT. Каждая пачка идёт в своём SAVEPOINT: ошибка одной пачки откатывает только её.
+
+Блокировка между процессами берётся BEGIN IMMEDIATE с коротким busy_timeout и повторами
+со случайной паузой (процессы не синхронизируются в повторах), общее ожидание ограничено
+VEILBOT_SQLITE_WRITER_LOCK_WAIT секундами — после этого пачки группы получают
+OperationalError. Пока ждём блокировку, новые пачки копятся и уходят той же группой.
+
+Использование:
+    writer = get_sqlite_writer(db_path)
+    writer.executemany("UPDATE t SET x = ? WHERE id = ?", rows)            # из потока
+    await writer.executemany_async("UPDATE t SET x = ? WHERE id = ?", rows)  # из event loop
+
+Отключается VEILBOT_SQLITE_WRITER=0 — пачки выполняются в вызывающем потоке на соединении
+из пула, как раньше.
+"""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.infra.sqlite_utils import _resolve_db_path, apply_pragmas_sync, pooled_connection
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(0, int(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+SQLITE_WRITER_ENABLED = os.getenv("VEILBOT_SQLITE_WRITER", "1").strip().lower() not in ("0", "false", "no")
+
+# Один квант ожидания блокировки внутри SQLite между нашими повторами BEGIN IMMEDIATE
+_BUSY_SLICE_MS = 50
+_STOP = object()
+
+# (sql, параметры, executemany?)
+WriteStatement = Tuple[str, Any, bool]
+
+
+class WriteBatch:
+    """Выражения, которые применяются атомарно; результат — суммарный rowcount."""
+
+    __slots__ = ("statements", "future")
+
+    def __init__(self, statements: Sequence[WriteStatement]):
+        self.statements = list(statements)
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+def _is_locked(error: BaseException) -> bool:
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+class SQLiteWriter:
+    """Поток-писатель для одного файла БД (см. модуль)."""
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        max_group: Optional[int] = None,
+        lock_wait_sec: Optional[float] = None,
+    ):
+        self.path = path
+        self.max_group = max(1, max_group if max_group is not None else _env_int("VEILBOT_SQLITE_WRITER_MAX_GROUP", 256))
+        self.lock_wait_sec = (
+            lock_wait_sec if lock_wait_sec is not None else _env_float("VEILBOT_SQLITE_WRITER_LOCK_WAIT", 10.0)
+        )
+        self._queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "batches": 0, "groups": 0, "statements": 0, "rows": 0, "max_group": 0,
+            "failed_batches": 0, "lock_waits": 0, "lock_wait_ms": 0.0, "lock_timeouts": 0,
+        }
+
+    # --- API вызывающих ---
+
+    def submit(self, statements: Sequence[WriteStatement]) -> concurrent.futures.Future:
+        """Поставить пачку в очередь писателя; Future завершится после COMMIT группы."""
+        batch = WriteBatch(statements)
+        if self._closed:
+            batch.future.set_exception(RuntimeError(f"SQLite writer for {self.path} is closed"))
+            return batch.future
+        self._ensure_thread()
+        self._queue.put(batch)
+        return batch.future
+
+    def write(self, statements: Sequence[WriteStatement]) -> int:
+        if not SQLITE_WRITER_ENABLED:
+            return self._write_inline(statements)
+        return self.submit(statements).result()
+
+    async def write_async(self, statements: Sequence[WriteStatement]) -> int:
+        if not SQLITE_WRITER_ENABLED:
+            return await asyncio.to_thread(self._write_inline, statements)
+        return await asyncio.wrap_future(self.submit(statements))
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return self.write([(sql, params, False)])
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        return self.write([(sql, list(seq_of_params), True)])
+
+    async def execute_async(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return await self.write_async([(sql, params, False)])
+
+    async def executemany_async(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        return await self.write_async([(sql, list(seq_of_params), True)])
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Дописать очередь и остановить поток."""
+        with self._thread_lock:
+            self._closed = True
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["lock_wait_ms"] = round(stats["lock_wait_ms"], 1)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    # --- поток писателя ---
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f"sqlite-writer:{os.path.basename(self.path)}", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            group: List[WriteBatch] = [item]
+            stop = False
+            while len(group) < self.max_group:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                group.append(item)
+            self._commit_group(group)
+            if stop:
+                break
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=_BUSY_SLICE_MS / 1000, isolation_level=None)
+            apply_pragmas_sync(conn)
+            conn.execute(f"PRAGMA busy_timeout={_BUSY_SLICE_MS}")
+            self._conn = conn
+        return self._conn
+
+    def _begin(self, conn: sqlite3.Connection) -> None:
+        """BEGIN IMMEDIATE с ограниченным ожиданием блокировки других процессов."""
+        started = time.monotonic()
+        deadline = started + self.lock_wait_sec
+        delay = 0.005
+        waited = False
+        try:
+            while True:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    return
+                except sqlite3.OperationalError as e:
+                    if not _is_locked(e):
+                        raise
+                    if not waited:
+                        waited = True
+                        with self._stats_lock:
+                            self._stats["lock_waits"] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        with self._stats_lock:
+                            self._stats["lock_timeouts"] += 1
+                        raise
+                    time.sleep(min(remaining, random.uniform(0, delay)))
+                    delay = min(delay * 2, 0.2)
+        finally:
+            if waited:
+                with self._stats_lock:
+                    self._stats["lock_wait_ms"] += (time.monotonic() - started) * 1000
+
+    def _commit_group(self, group: List[WriteBatch]) -> None:
+        results: List[Tuple[WriteBatch, Optional[int], Optional[BaseException]]] = []
+        statements = rows = 0
+        try:
+            conn = self._connection()
+            self._begin(conn)
+            try:
+                for batch in group:
+                    conn.execute("SAVEPOINT writer_batch")
+                    try:
+                        rowcount = 0
+                        for sql, params, many in batch.statements:
+                            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+                            rowcount += max(cursor.rowcount, 0)
+                        conn.execute("RELEASE writer_batch")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO writer_batch")
+                        conn.execute("RELEASE writer_batch")
+                        results.append((batch, None, e))
+                        continue
+                    statements += len(batch.statements)
+                    rows += rowcount
+                    results.append((batch, rowcount, None))
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+        except Exception as e:
+            if not isinstance(e, (sqlite3.IntegrityError, sqlite3.OperationalError)) and self._conn is not None:
+                # Соединение в неизвестном состоянии — откроем новое для следующей группы
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+            logger.warning(f"[SQLITE_WRITER] Group of {len(group)} batches failed for {self.path}: {e}")
+            results = [(batch, None, e) for batch in group]
+            statements = rows = 0
+
+        failed = 0
+        for batch, rowcount, error in results:
+            if error is not None:
+                failed += 1
+                batch.future.set_exception(error)
+            else:
+                batch.future.set_result(rowcount)
+        with self._stats_lock:
+            self._stats["groups"] += 1
+            self._stats["batches"] += len(group)
+            self._stats["statements"] += statements
+            self._stats["rows"] += rows
+            self._stats["failed_batches"] += failed
+            self._stats["max_group"] = max(self._stats["max_group"], len(group))
+
+    def _write_inline(self, statements: Sequence[WriteStatement]) -> int:
+        with pooled_connection(self.path) as conn:
+            rowcount = 0
+            for sql, params, many in statements:
+                cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+                rowcount += max(cursor.rowcount, 0)
+            return rowcount
+
+
+_writers: Dict[Tuple[int, str], SQLiteWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_sqlite_writer(db_path: Optional[str] = None) -> SQLiteWriter:
+    """Писатель для файла БД (по одному на процесс и файл)."""
+    path = os.path.abspath(_resolve_db_path(db_path))
+    key = (os.getpid(), path)
+    writer = _writers.get(key)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(key)
+            if writer is None:
+                writer = _writers[key] = SQLiteWriter(path)
+    return writer
+
+
+def close_sqlite_writers() -> None:
+    """Дописать очереди и остановить писателей (остановка бота/админки, atexit)."""
+    with _writers_lock:
+        writers = [writer for (pid, _), writer in _writers.items() if pid == os.getpid()]
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+def sqlite_writer_stats() -> Dict[str, Dict[str, Any]]:
+    with _writers_lock:
+        writers = {path: writer for (pid, path), writer in _writers.items() if pid == os.getpid()}
+    return {path: writer.stats() for path, writer in writers.items()}
+
+
+atexit.register(close_sqlite_writers)
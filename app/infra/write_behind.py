@@ -0,0 +1,204 @@
+"""
+Write-behind буфер для частых «touch»-записей в SQLite.
+
+Запись вида «обновить отметку времени у строки» (last_updated_at подписки и т.п.) на каждый
+запрос — это отдельная транзакция у единственного писателя SQLite, которая конкурирует
+с платежами и монитором трафика. Буфер копит значения в памяти по ключу (повторные касания
+одного ключа схлопываются, по умолчанию остаётся максимум) и сбрасывает их одной пачкой
+executemany через писателя процесса (app/infra/sqlite_writer.py): не позже чем через
+VEILBOT_WRITE_BEHIND_INTERVAL секунд после первого несброшенного касания (по умолчанию 5),
+сразу при переполнении и при остановке процесса.
+
+Буферы создаются через get_write_behind_buffer() — по одному на (имя, БД), чтобы
+flush_write_behind_buffers() при остановке сбросил все.
+"""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from app.infra.sqlite_writer import get_sqlite_writer
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+class WriteBehindBuffer:
+    """Схлопывание касаний по ключу и пакетная запись `sql` с параметрами params(key, value).
+
+    По умолчанию параметры — (value, key), т.е. sql вида `UPDATE t SET col = ? WHERE id = ?`.
+    При ошибке записи пачка возвращается в буфер и будет записана со следующим сбросом.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sql: str,
+        *,
+        db_path: Optional[str] = None,
+        interval_sec: Optional[float] = None,
+        max_pending: int = 5000,
+        merge: Callable[[Any, Any], Any] = max,
+        params: Callable[[Hashable, Any], Tuple] = lambda key, value: (value, key),
+    ):
+        self.name = name
+        self.sql = sql
+        self.db_path = db_path
+        self.interval_sec = (
+            interval_sec if interval_sec is not None else _env_float("VEILBOT_WRITE_BEHIND_INTERVAL", 5.0)
+        )
+        self.max_pending = max_pending
+        self._merge = merge
+        self._params = params
+        self._pending: Dict[Hashable, Any] = {}
+        self._first_pending_at: Optional[float] = None
+        self._armed = False
+        self._lock = threading.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {"touches": 0, "flushes": 0, "rows": 0, "errors": 0}
+
+    def touch(self, key: Hashable, value: Any = None) -> None:
+        """Запомнить значение для ключа (value=None — текущее время, int)."""
+        if value is None:
+            value = int(time.time())
+        with self._lock:
+            current = self._pending.get(key)
+            self._pending[key] = value if current is None else self._merge(current, value)
+            self._stats["touches"] += 1
+            if self._first_pending_at is None:
+                self._first_pending_at = time.monotonic()
+            overflow = len(self._pending) >= self.max_pending
+            due = time.monotonic() - self._first_pending_at >= self.interval_sec
+            arm = not self._armed
+            self._armed = True
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Синхронный контекст: таймер не поставить, пишем сами, когда подошёл срок
+            if overflow or due:
+                self.flush_sync()
+            return
+        if overflow or due:
+            self._spawn(loop)
+        elif arm:
+            loop.call_later(self.interval_sec, self._spawn, loop)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    async def flush(self) -> int:
+        """Записать накопленное одной транзакцией. Возвращает число записанных строк."""
+        batch = self._take()
+        if not batch:
+            return 0
+        try:
+            await get_sqlite_writer(self.db_path).executemany_async(
+                self.sql, [self._params(key, value) for key, value in batch.items()]
+            )
+        except Exception as e:
+            self._restore(batch, e)
+            # Повторим по таймеру, даже если новых касаний не будет
+            with self._lock:
+                arm = not self._armed
+                self._armed = True
+            if arm:
+                loop = asyncio.get_running_loop()
+                loop.call_later(self.interval_sec, self._spawn, loop)
+            return 0
+        return self._done(batch)
+
+    def flush_sync(self) -> int:
+        """Синхронный вариант flush() — для atexit и кода без event loop."""
+        batch = self._take()
+        if not batch:
+            return 0
+        try:
+            get_sqlite_writer(self.db_path).executemany(
+                self.sql, [self._params(key, value) for key, value in batch.items()]
+            )
+        except Exception as e:
+            self._restore(batch, e)
+            return 0
+        return self._done(batch)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
+
+    def _spawn(self, loop: asyncio.AbstractEventLoop) -> None:
+        if loop.is_closed():
+            return
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take(self) -> Dict[Hashable, Any]:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._first_pending_at = None
+            self._armed = False
+            return batch
+
+    def _restore(self, batch: Dict[Hashable, Any], error: Exception) -> None:
+        with self._lock:
+            for key, value in batch.items():
+                current = self._pending.get(key)
+                self._pending[key] = value if current is None else self._merge(current, value)
+            if self._first_pending_at is None:
+                self._first_pending_at = time.monotonic()
+            self._stats["errors"] += 1
+        logger.warning(f"[WRITE_BEHIND] {self.name}: failed to flush {len(batch)} rows, will retry: {error}")
+
+    def _done(self, batch: Dict[Hashable, Any]) -> int:
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["rows"] += len(batch)
+        logger.debug(f"[WRITE_BEHIND] {self.name}: flushed {len(batch)} rows")
+        return len(batch)
+
+
+_buffers: Dict[Tuple[str, Optional[str]], WriteBehindBuffer] = {}
+_buffers_lock = threading.Lock()
+
+
+def get_write_behind_buffer(name: str, sql: str, *, db_path: Optional[str] = None, **kwargs: Any) -> WriteBehindBuffer:
+    """Буфер для (name, db_path); создаётся при первом обращении и сбрасывается при остановке."""
+    with _buffers_lock:
+        buffer = _buffers.get((name, db_path))
+        if buffer is None:
+            buffer = WriteBehindBuffer(name, sql, db_path=db_path, **kwargs)
+            _buffers[(name, db_path)] = buffer
+        return buffer
+
+
+async def flush_write_behind_buffers() -> int:
+    """Сбросить все буферы (вызывается при остановке бота и админки)."""
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+    written = 0
+    for buffer in buffers:
+        written += await buffer.flush()
+    return written
+
+
+def _flush_at_exit() -> None:
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+    for buffer in buffers:
+        buffer.flush_sync()
+
+
+atexit.register(_flush_at_exit)
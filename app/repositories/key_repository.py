@@ -2,7 +2,8 @@ from __future__ import annotations
 
 from typing import List, Tuple
 from app.settings import settings
-from app.infra.sqlite_utils import open_connection
+from app.infra.search_index import key_search_condition
+from app.infra.sqlite_utils import pooled_connection
 from app.infra.foreign_keys import safe_foreign_keys_off
 
 
@@ -11,7 +12,7 @@ class KeyRepository:
         self.db_path = db_path or settings.DATABASE_PATH
 
     def list_v2ray_keys_with_server(self) -> List[Tuple]:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -30,14 +31,14 @@ class KeyRepository:
 
     def get_v2ray_key_brief(self, key_pk: int) -> Tuple | None:
         """Return (user_id, v2ray_uuid, server_id) for v2ray key id or None."""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("SELECT user_id, v2ray_uuid, server_id FROM v2ray_keys WHERE id = ?", (key_pk,))
             return c.fetchone()
 
     def get_key_unified_by_id(self, key_pk: int) -> Tuple | None:
         """Единая строка ключа V2Ray для админки."""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -59,7 +60,7 @@ class KeyRepository:
             return c.fetchone()
 
     def delete_v2ray_key_by_id(self, key_pk: int) -> None:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # Используем контекстный менеджер для безопасного отключения foreign keys
             with safe_foreign_keys_off(c):
@@ -68,7 +69,7 @@ class KeyRepository:
 
     def get_expired_v2ray_keys(self, now_ts: int) -> List[Tuple]:
         """Получить истекшие V2Ray ключи (срок берется из subscriptions)"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT k.id, k.v2ray_uuid, k.server_id 
@@ -79,7 +80,7 @@ class KeyRepository:
             return c.fetchall()
 
     def v2ray_key_exists(self, key_pk: int) -> bool:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("SELECT 1 FROM v2ray_keys WHERE id = ?", (key_pk,))
             return c.fetchone() is not None
@@ -92,7 +93,7 @@ class KeyRepository:
         Для обновления срока нужно обновить подписку через SubscriptionRepository.extend_subscription()
         ВАЖНО: traffic_limit_mb не используется на уровне ключей, вся информация берется из подписки
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # Получаем subscription_id ключа
             c.execute("SELECT subscription_id FROM v2ray_keys WHERE id = ?", (key_pk,))
@@ -131,7 +132,7 @@ class KeyRepository:
         expiry_at параметр оставлен для обратной совместимости, но не сохраняется в БД.
         Срок действия ключа определяется подпиской (subscription_id).
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # ИСПРАВЛЕНИЕ: Колонки traffic_over_limit_at и traffic_over_limit_notified удалены из таблицы v2ray_keys
             # expiry_at также удален - срок берется из subscriptions
@@ -170,7 +171,7 @@ class KeyRepository:
         search_query: str | None = None,
     ) -> int:
         total = 0
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             def apply_common_conditions(base_sql: str, params: list) -> tuple[str, list]:
                 needs_join = search_query is not None
@@ -191,19 +192,9 @@ class KeyRepository:
                     where.append("k.server_id = ?")
                     params.append(server_id)
                 if search_query:
-                    search_pattern = f"%{search_query}%"
-                    search_conditions = [
-                        "CAST(k.id AS TEXT) LIKE ?",
-                        "k.email LIKE ?",
-                        "IFNULL(s.name,'') LIKE ?",
-                        "IFNULL(t.name,'') LIKE ?",
-                        "CAST(k.user_id AS TEXT) LIKE ?",
-                        "k.v2ray_uuid LIKE ?",
-                        "(k.id || '_v2ray') LIKE ?",
-                        "CAST(k.subscription_id AS TEXT) LIKE ?",
-                    ]
-                    where.append("(" + " OR ".join(search_conditions) + ")")
-                    params.extend([search_pattern] * len(search_conditions))
+                    search_condition, search_params = key_search_condition(c, search_query)
+                    where.append(search_condition)
+                    params.extend(search_params)
                 where_sql = (" WHERE " + " AND ".join(where)) if where else ""
                 return base_sql + where_sql, params
 
@@ -241,7 +232,7 @@ class KeyRepository:
         sort_map.get(sort_by.lower(), 3)
         order_dir = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
 
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             parts = []
             params: list = []
@@ -281,22 +272,10 @@ class KeyRepository:
                 if server_id is not None:
                     where.append("k.server_id = ?"); params.append(server_id)
                 if search_query:
-                    search_pattern = f"%{search_query}%"
-                    # Поиск по всем столбцам: id, email, v2ray_uuid, server_name, tariff_name, user_id, subscription_id
-                    search_conditions = [
-                        "CAST(k.id AS TEXT) LIKE ?",  # Поиск по числовому ID
-                        "k.email LIKE ?",
-                        "k.v2ray_uuid LIKE ?",
-                        "IFNULL(s.name,'') LIKE ?",
-                        "IFNULL(t.name,'') LIKE ?",
-                        "CAST(k.user_id AS TEXT) LIKE ?",  # Поиск по user_id
-                        # Поиск по полному ID с протоколом (например, "206_v2ray")
-                        "(k.id || '_v2ray') LIKE ?",
-                        # Поиск по subscription_id для V2Ray ключей
-                        "CAST(k.subscription_id AS TEXT) LIKE ?",
-                    ]
-                    where.append("(" + " OR ".join(search_conditions) + ")")
-                    params.extend([search_pattern] * len(search_conditions))
+                    # id, email, v2ray_uuid, сервер, тариф, user_id, subscription_id (см. key_search_condition)
+                    search_condition, search_params = key_search_condition(c, search_query)
+                    where.append(search_condition)
+                    params.extend(search_params)
                 # ИСПРАВЛЕНИЕ: Не применяем keyset_where здесь, т.к. он использует алиас "k" который может вызвать проблемы
                 # keyset_where будет применен к обернутому запросу после UNION
                 if where:
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from typing import Dict, List, Tuple
-from app.infra.sqlite_utils import open_connection
+from app.infra.sqlite_utils import pooled_connection
 from app.infra.foreign_keys import safe_foreign_keys_off
 from app.settings import settings
 
@@ -11,7 +11,7 @@ class ServerRepository:
         self.db_path = db_path or settings.DATABASE_PATH
 
     def list_servers(self, search_query: str | None = None) -> List[Tuple]:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             if search_query:
                 search_pattern = f"%{search_query}%"
@@ -53,7 +53,7 @@ class ServerRepository:
         access_level: str = "all",
         subscription_group_id: str | None = None,
     ) -> int:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             gid = (subscription_group_id or "").strip() or None
             c.execute(
@@ -67,7 +67,7 @@ class ServerRepository:
             return c.lastrowid
 
     def get_server(self, server_id: int) -> Tuple | None:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """SELECT id, name, api_url, cert_sha256, max_keys, active, country, protocol, domain, api_key, v2ray_path,
@@ -94,7 +94,7 @@ class ServerRepository:
         access_level: str = "all",
         subscription_group_id: str | None = None,
     ) -> None:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             gid = (subscription_group_id or "").strip() or None
             c.execute(
@@ -135,7 +135,7 @@ class ServerRepository:
         }
         affected_subscriptions: set[int] = set()
 
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
 
             # Сохраняем затронутые подписки до удаления ключей
@@ -160,7 +160,7 @@ class ServerRepository:
         if not server_ids:
             return {}
         q_marks = ",".join(["?"] * len(server_ids))
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(f"SELECT server_id, COUNT(*) FROM v2ray_keys GROUP BY server_id HAVING server_id IN ({q_marks})", server_ids)
             return dict(c.fetchall())
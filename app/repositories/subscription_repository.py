@@ -5,9 +5,34 @@
 from __future__ import annotations
 
 import time
-from typing import List, Tuple, Optional
+from typing import List, NamedTuple, Tuple, Optional
 from app.settings import settings
-from app.infra.sqlite_utils import open_connection, open_async_connection
+from app.infra.sqlite_utils import pooled_connection, open_async_connection
+from app.infra.search_index import subscription_search_condition
+from app.infra.sqlite_writer import get_sqlite_writer
+from app.infra.write_behind import WriteBehindBuffer, get_write_behind_buffer
+
+
+def subscription_last_seen_buffer(db_path: Optional[str]) -> WriteBehindBuffer:
+    """Write-behind буфер subscriptions.last_updated_at (время последней выдачи подписки)"""
+    # MAX: отметка, записанная напрямую (например, при продлении), не откатывается назад
+    return get_write_behind_buffer(
+        "subscriptions.last_updated_at",
+        "UPDATE subscriptions SET last_updated_at = MAX(COALESCE(last_updated_at, 0), ?) WHERE id = ?",
+        db_path=db_path,
+    )
+
+
+class SubscriptionGenerationData(NamedTuple):
+    """Всё, что нужно для генерации содержимого подписки (см. load_subscription_generation_data_async)"""
+
+    subscription: Tuple
+    is_vip: bool
+    tariff_name: Optional[str]
+    traffic_usage_bytes: int
+    traffic_limit_bytes: int
+    traffic_over_limit_at: Optional[int]
+    keys: List[Tuple]
 
 
 class SubscriptionRepository:
@@ -22,7 +47,7 @@ class SubscriptionRepository:
         tariff_id: Optional[int] = None,
     ) -> int:
         """Создать новую подписку"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             c.execute(
@@ -37,7 +62,7 @@ class SubscriptionRepository:
 
     def get_subscription_by_token(self, token: str) -> Optional[Tuple]:
         """Получить подписку по токену"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -51,7 +76,7 @@ class SubscriptionRepository:
 
     def get_active_subscription(self, user_id: int) -> Optional[Tuple]:
         """Получить активную подписку пользователя"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             c.execute(
@@ -68,7 +93,7 @@ class SubscriptionRepository:
 
     def update_subscription_last_updated(self, subscription_id: int) -> None:
         """Обновить last_updated_at для подписки"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             c.execute(
@@ -85,7 +110,7 @@ class SubscriptionRepository:
         Перед вызовом этого метода необходимо удалить все ключи подписки с серверов через V2Ray API!
         Используйте get_subscription_keys_for_deletion() для получения списка ключей.
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 "UPDATE subscriptions SET is_active = 0 WHERE id = ?",
@@ -101,7 +126,7 @@ class SubscriptionRepository:
             new_expires_at: Новый срок действия (timestamp)
             tariff_id: Опционально - обновить tariff_id подписки. Если None, сохраняется текущее значение.
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             
@@ -139,7 +164,7 @@ class SubscriptionRepository:
         Returns:
             Новое значение expires_at после продления
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             
@@ -207,7 +232,7 @@ class SubscriptionRepository:
 
     def get_expired_subscriptions(self, grace_threshold: int) -> List[Tuple]:
         """Получить истекшие подписки (для grace period) - включая деактивированные"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # Ищем все подписки, которые истекли более 24 часов назад
             # Включаем деактивированные, так как они тоже должны быть удалены
@@ -223,7 +248,7 @@ class SubscriptionRepository:
 
     def get_expiring_subscriptions(self, now: int) -> List[Tuple]:
         """Получить активные подписки для проверки уведомлений"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -237,7 +262,7 @@ class SubscriptionRepository:
 
     def update_subscription_notified(self, subscription_id: int, notified: int) -> None:
         """Обновить флаги уведомлений для подписки"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 "UPDATE subscriptions SET notified = ? WHERE id = ?",
@@ -245,9 +270,22 @@ class SubscriptionRepository:
             )
             conn.commit()
 
+    async def update_subscriptions_notified_async(self, updates: List[Tuple[int, int]]) -> None:
+        """Обновить флаги уведомлений пачкой через писателя процесса
+
+        Args:
+            updates: список кортежей (subscription_id, notified)
+        """
+        if not updates:
+            return
+        await get_sqlite_writer(self.db_path).executemany_async(
+            "UPDATE subscriptions SET notified = ? WHERE id = ?",
+            [(notified, subscription_id) for subscription_id, notified in updates],
+        )
+
     def mark_purchase_notification_sent(self, subscription_id: int) -> None:
         """Пометить уведомление о покупке как отправленное"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 "UPDATE subscriptions SET purchase_notification_sent = 1 WHERE id = ?",
@@ -260,7 +298,7 @@ class SubscriptionRepository:
         
         Включает как новые подписки (по created_at), так и продленные (по last_updated_at)
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             max_age_seconds = max_age_days * 86400
@@ -287,7 +325,7 @@ class SubscriptionRepository:
         Примечание: Лимиты трафика и времени контролируются на уровне подписки,
         а не отдельных ключей. Срок действия берется из subscriptions.expires_at.
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -309,7 +347,7 @@ class SubscriptionRepository:
         """Получить все ключи подписки для удаления (V2Ray).
         Returns: List of tuples: (key_id, api_url, api_key, protocol)"""
         result = []
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -327,7 +365,7 @@ class SubscriptionRepository:
     def get_subscription_keys_with_server_info(self, subscription_id: int) -> List[Tuple]:
         """Получить все ключи подписки с информацией о серверах для получения трафика из API
         Returns: List of (key_id, v2ray_uuid, server_id, api_url, api_key) tuples"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -343,7 +381,7 @@ class SubscriptionRepository:
     def delete_subscription_keys(self, subscription_id: int) -> int:
         """Удалить все ключи подписки из БД (V2Ray)."""
         from app.infra.foreign_keys import safe_foreign_keys_off
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             with safe_foreign_keys_off(c):
                 c.execute(
@@ -413,7 +451,7 @@ class SubscriptionRepository:
 
     async def get_subscription_by_token_async(self, token: str) -> Optional[Tuple]:
         """Получить подписку по токену (асинхронная версия)"""
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT id, user_id, subscription_token, created_at, expires_at, tariff_id, is_active, last_updated_at, notified
@@ -425,9 +463,108 @@ class SubscriptionRepository:
                 row = await cursor.fetchone()
                 return row
 
+    async def load_subscription_generation_data_async(
+        self, token: str, now: int
+    ) -> Optional[SubscriptionGenerationData]:
+        """Загрузить данные для генерации подписки по токену одним соединением (асинхронная версия)
+
+        Подписка, VIP-статус, имя тарифа, трафик (та же формула, что в get_subscription_traffic_sum),
+        эффективный лимит (та же логика, что в get_subscription_traffic_limit), traffic_over_limit_at
+        и активные ключи (строки как у get_subscription_keys_async).
+        """
+        async with open_async_connection(self.db_path, readonly=True) as conn:
+            async with conn.execute(
+                """
+                SELECT s.id, s.user_id, s.subscription_token, s.created_at, s.expires_at, s.tariff_id,
+                       s.is_active, s.last_updated_at, s.notified,
+                       COALESCE(u.is_vip, 0),
+                       t.name,
+                       s.traffic_limit_mb,
+                       COALESCE(t.traffic_limit_mb, 0),
+                       (SELECT CASE WHEN COUNT(DISTINCT vk.traffic_limit_mb) = 1 THEN MAX(vk.traffic_limit_mb) END
+                        FROM v2ray_keys vk
+                        WHERE vk.subscription_id = s.id
+                          AND vk.traffic_limit_mb IS NOT NULL
+                          AND vk.traffic_limit_mb > 0),
+                       (SELECT COALESCE(SUM(COALESCE(vk.panel_total_bytes_observed, 0)), 0)
+                        FROM v2ray_keys vk
+                        WHERE vk.subscription_id = s.id),
+                       COALESCE(s.traffic_baseline_bytes, 0),
+                       s.traffic_over_limit_at
+                FROM subscriptions s
+                LEFT JOIN users u ON u.user_id = s.user_id
+                LEFT JOIN tariffs t ON t.id = s.tariff_id
+                WHERE s.subscription_token = ?
+                """,
+                (token,),
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+
+            subscription = tuple(row[:9])
+            (
+                is_vip,
+                tariff_name,
+                subscription_limit_mb,
+                tariff_limit_mb,
+                key_limit_mb,
+                observed_bytes,
+                baseline_bytes,
+                over_limit_at,
+            ) = row[9:]
+            # Лимит: индивидуальный (даже 0 = безлимит) -> тариф -> единый лимит ключей -> безлимит
+            if subscription_limit_mb is not None:
+                limit_mb = int(subscription_limit_mb)
+            elif tariff_limit_mb:
+                limit_mb = int(tariff_limit_mb)
+            else:
+                limit_mb = int(key_limit_mb or 0)
+
+            async with conn.execute(
+                """
+                SELECT k.v2ray_uuid, k.client_config, s.domain, s.api_url, s.api_key, s.country, s.name as server_name
+                FROM v2ray_keys k
+                JOIN servers s ON k.server_id = s.id
+                JOIN subscriptions sub ON k.subscription_id = sub.id
+                WHERE k.subscription_id = ?
+                  AND k.user_id = ?
+                  AND sub.expires_at > ?
+                  AND s.active = 1
+                ORDER BY s.country, s.name
+                """,
+                (subscription[0], subscription[1], now),
+            ) as cursor:
+                keys = list(await cursor.fetchall())
+
+        return SubscriptionGenerationData(
+            subscription=subscription,
+            is_vip=bool(is_vip),
+            tariff_name=tariff_name,
+            traffic_usage_bytes=max(0, int(observed_bytes or 0) - int(baseline_bytes or 0)),
+            traffic_limit_bytes=limit_mb * 1024 * 1024,
+            traffic_over_limit_at=over_limit_at,
+            keys=keys,
+        )
+
+    async def update_keys_client_config_async(self, updates: List[Tuple[str, str]]) -> None:
+        """Сохранить client_config ключей одной транзакцией (асинхронная версия)
+
+        Args:
+            updates: пары (client_config, v2ray_uuid)
+        """
+        if not updates:
+            return
+        async with open_async_connection(self.db_path) as conn:
+            await conn.executemany(
+                "UPDATE v2ray_keys SET client_config = ? WHERE v2ray_uuid = ?",
+                updates,
+            )
+            await conn.commit()
+
     async def get_active_subscription_async(self, user_id: int) -> Optional[Tuple]:
         """Получить активную подписку пользователя (асинхронная версия)"""
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             now = int(time.time())
             async with conn.execute(
                 """
@@ -452,6 +589,10 @@ class SubscriptionRepository:
             )
             await conn.commit()
 
+    def touch_subscription_last_updated(self, subscription_id: int) -> None:
+        """Отметить выдачу подписки: last_updated_at пишется пачкой через write-behind буфер"""
+        subscription_last_seen_buffer(self.db_path).touch(subscription_id)
+
     async def deactivate_subscription_async(self, subscription_id: int) -> None:
         """
         Деактивировать подписку (асинхронная версия)
@@ -578,7 +719,7 @@ class SubscriptionRepository:
 
     async def get_expired_subscriptions_async(self, grace_threshold: int) -> List[Tuple]:
         """Получить истекшие подписки (для grace period) (асинхронная версия)"""
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT id, user_id, subscription_token
@@ -592,7 +733,7 @@ class SubscriptionRepository:
 
     async def get_expiring_subscriptions_async(self, now: int) -> List[Tuple]:
         """Получить активные подписки для проверки уведомлений (асинхронная версия)"""
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT id, user_id, subscription_token, expires_at, created_at, COALESCE(notified, 0) as notified
@@ -628,7 +769,7 @@ class SubscriptionRepository:
         Примечание: Лимиты трафика и времени контролируются на уровне подписки,
         а не отдельных ключей. Поэтому проверка лимита на уровне ключа не выполняется.
         """
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT k.v2ray_uuid, k.client_config, s.domain, s.api_url, s.api_key, s.country, s.name as server_name
@@ -650,7 +791,7 @@ class SubscriptionRepository:
         """Получить все ключи подписки для удаления (асинхронная версия, V2Ray).
         Returns: List of tuples: (key_id, api_url, api_key, protocol)"""
         result = []
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT k.v2ray_uuid, s.api_url, s.api_key, 'v2ray' as protocol
@@ -677,6 +818,9 @@ class SubscriptionRepository:
                 await conn.commit()
                 return deleted_count
             finally:
+                # Внутри незавершённой транзакции PRAGMA не действует — сначала откат
+                if conn.in_transaction:
+                    await conn.rollback()
                 await conn.execute("PRAGMA foreign_keys=ON")
 
     def list_subscriptions(
@@ -696,7 +840,7 @@ class SubscriptionRepository:
             paid_only: Если True, показывать только платные подписки (price_rub > 0, не VIP)
             include_inactive: Если True, включать подписки с is_active = 0 (по умолчанию только активные).
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
 
             # Базовое условие для платных подписок
@@ -710,7 +854,7 @@ class SubscriptionRepository:
             active_condition = "" if include_inactive else "AND s.is_active = 1"
 
             if query:
-                like = f"%{query.strip()}%"
+                search_condition, search_params = subscription_search_condition(c, query)
                 sql = """
                 SELECT 
                     s.id,
@@ -723,43 +867,21 @@ class SubscriptionRepository:
                     s.last_updated_at,
                     s.notified,
                     t.name as tariff_name,
-                    COALESCE(vk.v2ray_count, 0) as keys_count,
+                    (SELECT COUNT(*) FROM v2ray_keys vk WHERE vk.subscription_id = s.id) as keys_count,
                     s.traffic_limit_mb
                 FROM subscriptions s
                 LEFT JOIN tariffs t ON s.tariff_id = t.id
                 LEFT JOIN users u ON s.user_id = u.user_id
-                LEFT JOIN (
-                    SELECT subscription_id, COUNT(*) as v2ray_count
-                    FROM v2ray_keys
-                    GROUP BY subscription_id
-                ) vk ON vk.subscription_id = s.id
                 WHERE s.is_active = 1
                   {paid_condition}
-                  AND (CAST(s.id AS TEXT) LIKE ?
-                    OR CAST(s.user_id AS TEXT) LIKE ?
-                    OR s.subscription_token LIKE ?
-                    OR t.name LIKE ?
-                    OR EXISTS (
-                        SELECT 1 FROM v2ray_keys k 
-                        WHERE k.user_id = s.user_id 
-                          AND k.email LIKE ? 
-                          AND k.email IS NOT NULL 
-                          AND k.email != '' 
-                          AND k.email NOT LIKE 'user_%@veilbot.com'
-                    )
-                    OR EXISTS (
-                        SELECT 1 FROM payments p 
-                        WHERE p.user_id = s.user_id 
-                          AND p.email LIKE ? 
-                          AND p.email IS NOT NULL 
-                          AND p.email != '' 
-                          AND p.email NOT LIKE 'user_%@veilbot.com'
-                    ))
+                  AND {search_condition}
                 ORDER BY s.created_at DESC
                 LIMIT ? OFFSET ?
                 """
-                sql = sql.format(active_condition=active_condition, paid_condition=paid_condition)
-                c.execute(sql, (like, like, like, like, like, like, limit, offset))
+                sql = sql.format(
+                    active_condition=active_condition, paid_condition=paid_condition, search_condition=search_condition
+                )
+                c.execute(sql, (*search_params, limit, offset))
             else:
                 sql = """
                 SELECT 
@@ -773,16 +895,11 @@ class SubscriptionRepository:
                     s.last_updated_at,
                     s.notified,
                     t.name as tariff_name,
-                    COALESCE(vk.v2ray_count, 0) as keys_count,
+                    (SELECT COUNT(*) FROM v2ray_keys vk WHERE vk.subscription_id = s.id) as keys_count,
                     s.traffic_limit_mb
                 FROM subscriptions s
                 LEFT JOIN tariffs t ON s.tariff_id = t.id
                 LEFT JOIN users u ON s.user_id = u.user_id
-                LEFT JOIN (
-                    SELECT subscription_id, COUNT(*) as v2ray_count
-                    FROM v2ray_keys
-                    GROUP BY subscription_id
-                ) vk ON vk.subscription_id = s.id
                 WHERE 1=1
                   {active_condition}
                   {paid_condition}
@@ -806,7 +923,7 @@ class SubscriptionRepository:
             paid_only: Если True, считать только платные подписки (price_rub > 0, не VIP)
             include_inactive: Если True, учитывать подписки с is_active = 0.
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
 
             paid_condition = ""
@@ -818,38 +935,20 @@ class SubscriptionRepository:
             active_condition = "" if include_inactive else "AND s.is_active = 1"
 
             if query:
-                like = f"%{query.strip()}%"
+                search_condition, search_params = subscription_search_condition(c, query)
                 sql = """
                 SELECT COUNT(*)
                 FROM subscriptions s
                 LEFT JOIN tariffs t ON s.tariff_id = t.id
                 LEFT JOIN users u ON s.user_id = u.user_id
-                WHERE ((CAST(s.id AS TEXT) LIKE ?
-                    OR CAST(s.user_id AS TEXT) LIKE ?
-                    OR s.subscription_token LIKE ?
-                    OR t.name LIKE ?
-                    OR EXISTS (
-                        SELECT 1 FROM v2ray_keys k 
-                        WHERE k.user_id = s.user_id 
-                          AND k.email LIKE ? 
-                          AND k.email IS NOT NULL 
-                          AND k.email != '' 
-                          AND k.email NOT LIKE 'user_%@veilbot.com'
-                    )
-                    OR EXISTS (
-                        SELECT 1 FROM payments p 
-                        WHERE p.user_id = s.user_id 
-                          AND p.email LIKE ? 
-                          AND p.email IS NOT NULL 
-                          AND p.email != '' 
-                          AND p.email NOT LIKE 'user_%@veilbot.com'
-                    ))
-                  )
+                WHERE {search_condition}
                   {active_condition}
                   {paid_condition}
                 """
-                sql = sql.format(active_condition=active_condition, paid_condition=paid_condition)
-                c.execute(sql, (like, like, like, like, like, like))
+                sql = sql.format(
+                    active_condition=active_condition, paid_condition=paid_condition, search_condition=search_condition
+                )
+                c.execute(sql, search_params)
             else:
                 if paid_only:
                     sql = """
@@ -889,18 +988,12 @@ class SubscriptionRepository:
         if include_inactive:
             extra_active = " AND s.is_active = 1 AND s.expires_at > ?"
 
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             if query:
-                like = f"%{query.strip()}%"
-                base_where = """((CAST(s.id AS TEXT) LIKE ?
-                    OR CAST(s.user_id AS TEXT) LIKE ?
-                    OR s.subscription_token LIKE ?
-                    OR t.name LIKE ?
-                    OR EXISTS (SELECT 1 FROM v2ray_keys k WHERE k.user_id = s.user_id AND k.email LIKE ? AND k.email IS NOT NULL AND k.email != '' AND k.email NOT LIKE 'user_%@veilbot.com')
-                    OR EXISTS (SELECT 1 FROM payments p2 WHERE p2.user_id = s.user_id AND p2.email LIKE ? AND p2.email IS NOT NULL AND p2.email != '' AND p2.email NOT LIKE 'user_%@veilbot.com'))
-                )""" + active_condition + paid_condition
-                params = (like, like, like, like, like, like)
+                search_condition, search_params = subscription_search_condition(c, query)
+                base_where = " " + search_condition + active_condition + paid_condition
+                params = tuple(search_params)
                 c.execute(
                     "SELECT COUNT(*) FROM subscriptions s LEFT JOIN tariffs t ON s.tariff_id = t.id LEFT JOIN users u ON s.user_id = u.user_id WHERE "
                     + base_where + extra_active,
@@ -953,7 +1046,7 @@ class SubscriptionRepository:
 
     def get_subscription_by_id(self, subscription_id: int) -> Optional[Tuple]:
         """Получить подписку по ID с информацией о тарифе и количестве ключей"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -968,15 +1061,10 @@ class SubscriptionRepository:
                     s.last_updated_at,
                     s.notified,
                     t.name as tariff_name,
-                    COALESCE(vk.v2ray_count, 0) as keys_count,
+                    (SELECT COUNT(*) FROM v2ray_keys vk WHERE vk.subscription_id = s.id) as keys_count,
                     s.traffic_limit_mb
                 FROM subscriptions s
                 LEFT JOIN tariffs t ON s.tariff_id = t.id
-                LEFT JOIN (
-                    SELECT subscription_id, COUNT(*) as v2ray_count
-                    FROM v2ray_keys
-                    GROUP BY subscription_id
-                ) vk ON vk.subscription_id = s.id
                 WHERE s.id = ?
                 """,
                 (subscription_id,),
@@ -985,7 +1073,7 @@ class SubscriptionRepository:
 
     async def get_subscription_by_id_async(self, subscription_id: int) -> Optional[Tuple]:
         """Асинхронная версия get_subscription_by_id; те же поля 0–11 + purchase_notification_sent (12)."""
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT
@@ -999,16 +1087,11 @@ class SubscriptionRepository:
                     s.last_updated_at,
                     s.notified,
                     t.name AS tariff_name,
-                    COALESCE(vk.v2ray_count, 0) AS keys_count,
+                    (SELECT COUNT(*) FROM v2ray_keys vk WHERE vk.subscription_id = s.id) AS keys_count,
                     s.traffic_limit_mb,
                     s.purchase_notification_sent
                 FROM subscriptions s
                 LEFT JOIN tariffs t ON s.tariff_id = t.id
-                LEFT JOIN (
-                    SELECT subscription_id, COUNT(*) AS v2ray_count
-                    FROM v2ray_keys
-                    GROUP BY subscription_id
-                ) vk ON vk.subscription_id = s.id
                 WHERE s.id = ?
                 """,
                 (subscription_id,),
@@ -1017,7 +1100,7 @@ class SubscriptionRepository:
 
     def get_subscription_keys_list(self, subscription_id: int) -> List[Tuple]:
         """Получить список всех ключей подписки с информацией о серверах"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -1047,7 +1130,7 @@ class SubscriptionRepository:
         Израсходовано по подписке за текущий период: max(0, S - B), где
         S = сумма panel_total_bytes_observed по ключам, B = subscriptions.traffic_baseline_bytes.
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -1076,7 +1159,7 @@ class SubscriptionRepository:
         if not subscription_ids:
             return {}
         
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # Используем IN для получения всех сумм одним запросом
             placeholders = ','.join('?' * len(subscription_ids))
@@ -1109,7 +1192,7 @@ class SubscriptionRepository:
         Returns: dict[subscription_id, limit_bytes]"""
         if not subscription_ids:
             return {}
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             placeholders = ','.join('?' * len(subscription_ids))
             c.execute(f"""
@@ -1126,7 +1209,7 @@ class SubscriptionRepository:
         - Если traffic_limit_mb установлен (не NULL), используется он (0 = безлимит)
         - Если traffic_limit_mb NULL, используется лимит из тарифа
         - Если и там 0/NULL, пробуем взять единый лимит из ключей подписки (fallback)"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # Сначала проверяем индивидуальный лимит подписки
             c.execute("""
@@ -1168,7 +1251,7 @@ class SubscriptionRepository:
     
     def update_subscription_traffic(self, subscription_id: int, usage_bytes: int) -> None:
         """Обновить трафик подписки"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             c.execute("""
@@ -1179,6 +1262,18 @@ class SubscriptionRepository:
             """, (usage_bytes, now, subscription_id))
             conn.commit()
     
+    _TRAFFIC_UPDATE_SQL = """
+        UPDATE subscriptions
+        SET traffic_usage_bytes = ?,
+            last_updated_at = ?
+        WHERE id = ?
+    """
+
+    @staticmethod
+    def _traffic_update_rows(traffic_updates: list[tuple[int, int]]) -> list[tuple[int, int, int]]:
+        now = int(time.time())
+        return [(usage_bytes, now, sub_id) for sub_id, usage_bytes in traffic_updates]
+    
     def batch_update_subscriptions_traffic(self, traffic_updates: list[tuple[int, int]]) -> None:
         """Batch-обновление трафика для нескольких подписок
         
@@ -1187,20 +1282,18 @@ class SubscriptionRepository:
         """
         if not traffic_updates:
             return
-        
-        with open_connection(self.db_path) as conn:
-            c = conn.cursor()
-            now = int(time.time())
-            # Подготавливаем данные с добавлением timestamp
-            updates_with_time = [(usage_bytes, now, sub_id) for sub_id, usage_bytes in traffic_updates]
-            c.executemany("""
-                UPDATE subscriptions
-                SET traffic_usage_bytes = ?,
-                    last_updated_at = ?
-                WHERE id = ?
-            """, updates_with_time)
-            conn.commit()
-    
+        get_sqlite_writer(self.db_path).executemany(
+            self._TRAFFIC_UPDATE_SQL, self._traffic_update_rows(traffic_updates)
+        )
+
+    async def batch_update_subscriptions_traffic_async(self, traffic_updates: list[tuple[int, int]]) -> None:
+        """Асинхронная версия batch_update_subscriptions_traffic (запись через писателя процесса)"""
+        if not traffic_updates:
+            return
+        await get_sqlite_writer(self.db_path).executemany_async(
+            self._TRAFFIC_UPDATE_SQL, self._traffic_update_rows(traffic_updates)
+        )
+
     def update_subscription_traffic_limit(self, subscription_id: int, traffic_limit_mb: int | None) -> None:
         """Обновить лимит трафика подписки (в МБ)
         Если traffic_limit_mb = None, поле не обновляется
@@ -1213,7 +1306,7 @@ class SubscriptionRepository:
             logger.info(f"Skipping traffic_limit_mb update for subscription {subscription_id} (None value)")
             return
         
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             # Сохраняем значение как есть, даже если 0 (0 означает использовать лимит из тарифа)
@@ -1269,7 +1362,7 @@ class SubscriptionRepository:
         - Если traffic_limit_mb NULL, используется лимит из тарифа
         Возвращает только подписки с лимитом > 0 (безлимитные не включаются)
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT 
@@ -1302,7 +1395,7 @@ class SubscriptionRepository:
         Returns:
             Количество ключей в подписке (для обратной совместимости)
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             # Подсчитываем количество ключей в подписке
             c.execute("SELECT COUNT(*) FROM v2ray_keys WHERE subscription_id = ?", (subscription_id,))
@@ -1318,7 +1411,7 @@ class SubscriptionRepository:
         """
         import logging
         logger = logging.getLogger(__name__)
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             logger.info(f"Updating traffic_limit_mb for all keys in subscription {subscription_id}: {traffic_limit_mb} MB")
             c.execute(
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from typing import List, Tuple
-from app.infra.sqlite_utils import open_connection
+from app.infra.sqlite_utils import pooled_connection
 from app.settings import settings
 
 
@@ -10,7 +10,7 @@ class TariffRepository:
         self.db_path = db_path or settings.DATABASE_PATH
 
     def list_tariffs(self, search_query: str | None = None, include_archived: bool = True) -> List[Tuple]:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             where_clauses = []
             params = []
@@ -47,7 +47,7 @@ class TariffRepository:
             return c.fetchall()
 
     def get_tariff(self, tariff_id: int) -> Tuple | None:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -81,7 +81,7 @@ class TariffRepository:
         enable_cryptobot: int = 1,
         is_archived: int = 0,
     ) -> int:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
@@ -114,7 +114,7 @@ class TariffRepository:
             return c.lastrowid
 
     def delete_tariff(self, tariff_id: int) -> None:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("DELETE FROM tariffs WHERE id = ?", (tariff_id,))
             conn.commit()
@@ -132,7 +132,7 @@ class TariffRepository:
         enable_cryptobot: int | None = None,
         is_archived: int | None = None,
     ) -> None:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             fields = [
                 ("name", name),
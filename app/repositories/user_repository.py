@@ -2,7 +2,8 @@ from __future__ import annotations
 
 from typing import List, Tuple, Optional
 
-from app.infra.sqlite_utils import open_connection
+from app.infra.search_index import user_search_condition
+from app.infra.sqlite_utils import pooled_connection
 from app.settings import settings
 
 
@@ -34,7 +35,7 @@ class UserRepository:
             query: Поисковый запрос
             vip_filter: Фильтр по VIP статусу ('vip', 'non_vip', None для всех)
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             
             # Базовое условие для VIP фильтра
@@ -45,39 +46,9 @@ class UserRepository:
                 vip_condition = "AND COALESCE(u.is_vip, 0) = 0"
             
             if query:
-                like = f"%{query.strip()}%"
-                sql = f"""
-                SELECT COUNT(DISTINCT u.user_id)
-                FROM users u
-                LEFT JOIN (
-                    SELECT referrer_id, COUNT(*) as referral_count
-                    FROM referrals
-                    GROUP BY referrer_id
-                ) r ON r.referrer_id = u.user_id
-                WHERE (CAST(u.user_id AS TEXT) LIKE ?
-                   OR IFNULL(u.username, '') LIKE ?
-                   OR IFNULL(u.first_name, '') LIKE ?
-                   OR IFNULL(u.last_name, '') LIKE ?
-                   OR CAST(IFNULL(r.referral_count, 0) AS TEXT) LIKE ?
-                   OR EXISTS (
-                       SELECT 1 FROM v2ray_keys k 
-                       WHERE k.user_id = u.user_id 
-                         AND k.email LIKE ? 
-                         AND k.email IS NOT NULL 
-                         AND k.email != '' 
-                         AND k.email NOT LIKE 'user_%@veilbot.com'
-                   )
-                   OR EXISTS (
-                       SELECT 1 FROM payments p 
-                       WHERE p.user_id = u.user_id 
-                         AND p.email LIKE ? 
-                         AND p.email IS NOT NULL 
-                         AND p.email != '' 
-                         AND p.email NOT LIKE 'user_%@veilbot.com'
-                   ))
-                   {vip_condition}
-                """
-                c.execute(sql, (like, like, like, like, like, like, like))
+                search_condition, search_params = user_search_condition(c, query)
+                sql = f"SELECT COUNT(*) FROM users u WHERE {search_condition} {vip_condition}"
+                c.execute(sql, search_params)
             else:
                 sql = f"SELECT COUNT(*) FROM users u WHERE 1=1 {vip_condition}"
                 c.execute(sql)
@@ -87,7 +58,8 @@ class UserRepository:
     def list_users(self, query: Optional[str] = None, limit: int = 50, offset: int = 0, vip_filter: Optional[str] = None) -> List[Tuple[int, int, int]]:
         """
         Возвращает список (user_id, referral_count, is_vip) с пагинацией и поиском.
-        Поиск работает по: user_id, username, first_name, last_name, email, referral_count
+        Поиск работает по: user_id, username, first_name, last_name, email ключей и платежей, id платежа
+        (индекс search_index, см. app/infra/search_index.py)
         Источник пользователей — таблица users (все пользователи, которые когда-либо нажали /start).
         
         Args:
@@ -96,7 +68,7 @@ class UserRepository:
             offset: Смещение для пагинации
             vip_filter: Фильтр по VIP статусу ('vip', 'non_vip', None для всех)
         """
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
 
             # Базовое условие для VIP фильтра
@@ -107,42 +79,16 @@ class UserRepository:
                 vip_condition = "AND COALESCE(u.is_vip, 0) = 0"
 
             if query:
-                like = f"%{query.strip()}%"
+                search_condition, search_params = user_search_condition(c, query)
                 sql = (
-                    f"SELECT DISTINCT u.user_id, "
+                    f"SELECT u.user_id, "
                     f"       (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = u.user_id) AS referral_count, "
                     f"       COALESCE(u.is_vip, 0) as is_vip "
                     f"FROM users u "
-                    f"LEFT JOIN ("
-                    f"    SELECT referrer_id, COUNT(*) as referral_count "
-                    f"    FROM referrals "
-                    f"    GROUP BY referrer_id"
-                    f") r ON r.referrer_id = u.user_id "
-                    f"WHERE (CAST(u.user_id AS TEXT) LIKE ? "
-                    f"   OR IFNULL(u.username, '') LIKE ? "
-                    f"   OR IFNULL(u.first_name, '') LIKE ? "
-                    f"   OR IFNULL(u.last_name, '') LIKE ? "
-                    f"   OR CAST(IFNULL(r.referral_count, 0) AS TEXT) LIKE ? "
-                    f"   OR EXISTS ("
-                    f"       SELECT 1 FROM v2ray_keys k "
-                    f"       WHERE k.user_id = u.user_id "
-                    f"         AND k.email LIKE ? "
-                    f"         AND k.email IS NOT NULL "
-                    f"         AND k.email != '' "
-                    f"         AND k.email NOT LIKE 'user_%@veilbot.com'"
-                    f"   ) "
-                    f"   OR EXISTS ("
-                    f"       SELECT 1 FROM payments p "
-                    f"       WHERE p.user_id = u.user_id "
-                    f"         AND p.email LIKE ? "
-                    f"         AND p.email IS NOT NULL "
-                    f"         AND p.email != '' "
-                    f"         AND p.email NOT LIKE 'user_%@veilbot.com'"
-                    f"   )) "
-                    f"   {vip_condition} "
+                    f"WHERE {search_condition} {vip_condition} "
                     f"ORDER BY u.user_id LIMIT ? OFFSET ?"
                 )
-                c.execute(sql, (like, like, like, like, like, like, like, limit, offset))
+                c.execute(sql, (*search_params, limit, offset))
             else:
                 sql = (
                     f"SELECT u.user_id, "
@@ -158,7 +104,7 @@ class UserRepository:
 
     def get_user_overview(self, user_id: int) -> dict:
         """Return basic info about user: counts, last activity, email if any."""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("SELECT COUNT(*), MAX(created_at) FROM v2ray_keys WHERE user_id = ?", (user_id,))
             v2ray_row = c.fetchone() or (0, None)
@@ -186,7 +132,7 @@ class UserRepository:
 
     def count_total_referrals(self) -> int:
         """Подсчет общего количества рефералов для всех пользователей"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("SELECT COUNT(*) FROM referrals")
             row = c.fetchone()
@@ -194,7 +140,7 @@ class UserRepository:
 
     def is_user_vip(self, user_id: int) -> bool:
         """Проверить, является ли пользователь VIP"""
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute("SELECT COALESCE(is_vip, 0) FROM users WHERE user_id = ?", (user_id,))
             row = c.fetchone()
@@ -205,7 +151,7 @@ class UserRepository:
         import logging
         logger = logging.getLogger(__name__)
         
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             vip_value = 1 if is_vip else 0
             c.execute("UPDATE users SET is_vip = ? WHERE user_id = ?", (vip_value, user_id))
@@ -227,7 +173,7 @@ class UserRepository:
     def count_active_users(self) -> int:
         """Подсчет активных пользователей (с активными подписками)"""
         import time
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             now = int(time.time())
             c.execute("""
@@ -242,7 +188,7 @@ class UserRepository:
             return int(row[0] if row and row[0] is not None else 0)
 
     def list_referrals(self, referrer_id: int) -> list[dict]:
-        with open_connection(self.db_path) as conn:
+        with pooled_connection(self.db_path) as conn:
             c = conn.cursor()
             c.execute(
                 """
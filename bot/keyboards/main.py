@@ -6,17 +6,17 @@ from typing import Optional
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from app.infra.sqlite_utils import get_db_cursor
 from config import PROTOCOLS, FREE_V2RAY_TARIFF_ID
-from app.infra.cache import SimpleCache
+from app.infra.cache_invalidation import SharedCache
 
-# Кэш для меню
-_menu_cache = SimpleCache()
+# Кэш для меню; инвалидация из админки доходит до процесса бота через cache_invalidations,
+# поэтому меню можно держать долго
+_menu_cache = SharedCache("menu")
+MENU_CACHE_TTL = 3600
 
 def invalidate_menu_cache():
     """Инвалидировать кэш меню (вызывать при изменении тарифов/серверов)"""
-    _menu_cache.delete("protocol_selection_menu")
-    # Удаляем все кэшированные меню тарифов
-    # Так как ключи могут быть разные, очищаем весь кэш меню
-    _menu_cache.clear()
+    # Ключи меню тарифов зависят от параметров фильтрации, поэтому сбрасываем весь namespace
+    _menu_cache.invalidate_all()
 
 def get_main_menu(user_id: Optional[int] = None) -> ReplyKeyboardMarkup:
     """
@@ -69,12 +69,11 @@ def get_protocol_selection_menu() -> ReplyKeyboardMarkup:
     # Добавляем кнопку "Назад"
     menu.add(KeyboardButton("🔙 Назад"))
     
-    # Кэшируем на 5 минут
-    _menu_cache.set(cache_key, menu, ttl=300)
+    _menu_cache.set(cache_key, menu, ttl=MENU_CACHE_TTL)
     
     return menu
 
-def get_tariff_menu(paid_only: bool = False, payment_method: str = None) -> ReplyKeyboardMarkup:
+def get_tariff_menu(paid_only: bool = False, payment_method: Optional[str] = None) -> ReplyKeyboardMarkup:
     """
     Получить меню тарифов с ценами в зависимости от способа оплаты
     
@@ -157,8 +156,8 @@ def get_tariff_menu(paid_only: bool = False, payment_method: str = None) -> Repl
     
     menu.add(KeyboardButton("🔙 Назад"))
     
-    # Кэшируем на 5 минут (тарифы меняются редко)
-    _menu_cache.set(cache_key, menu, ttl=300)
+    # Тарифы меняются редко, изменения из админки сбрасывают кэш через invalidate_menu_cache
+    _menu_cache.set(cache_key, menu, ttl=MENU_CACHE_TTL)
     
     return menu
 
@@ -259,7 +258,7 @@ async def get_protocol_selection_menu_async() -> ReplyKeyboardMarkup:
     return await asyncio.to_thread(get_protocol_selection_menu)
 
 
-async def get_tariff_menu_async(paid_only: bool = False, payment_method: str = None) -> ReplyKeyboardMarkup:
+async def get_tariff_menu_async(paid_only: bool = False, payment_method: Optional[str] = None) -> ReplyKeyboardMarkup:
     """Асинхронная обёртка: выполнение в executor."""
     return await asyncio.to_thread(get_tariff_menu, paid_only, payment_method)
 
@@ -163,8 +163,10 @@ def start_background_tasks(loop):
         cleanup_expired_payments,
         fix_payments_without_subscription_id,
     )
+    from bot.services.startup_warmup import BOT_WARMUP_STEPS, startup_warmup
     
     background_tasks = [
+        startup_warmup.run(BOT_WARMUP_STEPS),
         process_pending_paid_payments(),
         check_key_availability(),
         auto_delete_expired_subscriptions(),
@@ -184,6 +186,20 @@ def start_background_tasks(loop):
             logging.error(f"Ошибка при запуске фоновой задачи {task.__name__}: {e}")
 
 
+async def on_shutdown(dp: Dispatcher) -> None:
+    """Освобождение общих ресурсов при остановке бота"""
+    from vpn_protocols import close_v2ray_clients
+    from app.infra.write_behind import flush_write_behind_buffers
+    from app.infra.sqlite_utils import close_async_connection_pools, close_connection_pools
+    from app.infra.sqlite_writer import close_sqlite_writers
+
+    await flush_write_behind_buffers()
+    await close_v2ray_clients()
+    await asyncio.to_thread(close_sqlite_writers)
+    await close_async_connection_pools()
+    close_connection_pools()
+
+
 def main():
     """Главная функция запуска бота"""
     # Настройка логирования с маскированием секретов
@@ -240,7 +256,7 @@ def main():
         logger.info("Обработчик ошибок настроен")
         
         # Запуск бота с обработкой ошибок
-        executor.start_polling(dp, skip_updates=True, loop=loop)
+        executor.start_polling(dp, skip_updates=True, loop=loop, on_shutdown=on_shutdown)
         
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
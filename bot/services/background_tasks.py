@@ -10,8 +10,10 @@ import sqlite3
 from collections import defaultdict
 from typing import Optional, Callable, Awaitable, Dict, Any, List, Tuple, Set
 
+from app.infra.panel_health import panel_health
 from app.infra.sqlite_utils import get_db_cursor, retry_db_operation
-from vpn_protocols import format_duration, ProtocolFactory
+from app.infra.sqlite_writer import get_sqlite_writer
+from vpn_protocols import canonical_vless_config, format_duration, panel_key_id_from_user_data, ProtocolFactory
 from bot.utils import format_key_message_unified, safe_send_message
 from bot.keyboards import get_main_menu
 from bot.core import get_bot_instance
@@ -273,23 +275,15 @@ async def auto_delete_expired_keys() -> None:
             v2ray_deleted = 0
             for _, v2ray_uuid, api_url, api_key in expired_v2ray_keys:
                 if v2ray_uuid and api_url and api_key:
-                    protocol_client = None
                     try:
-                        from vpn_protocols import V2RayProtocol
-
-                        protocol_client = V2RayProtocol(api_url, api_key)
+                        protocol_client = ProtocolFactory.create_protocol(
+                            "v2ray", {"api_url": api_url, "api_key": api_key}
+                        )
                         await protocol_client.delete_user(v2ray_uuid)
                     except Exception as exc:  # noqa: BLE001
                         logging.warning(
                             "Failed to delete V2Ray key %s from server: %s", v2ray_uuid, exc
                         )
-                    finally:
-                        if protocol_client:
-                            try:
-                                await protocol_client.close()
-                            except Exception:
-                                # Best-effort close; не ломаем периодическую задачу из-за ошибки закрытия
-                                pass
 
             try:
                 with safe_foreign_keys_off(cursor):
@@ -327,6 +321,37 @@ async def auto_delete_expired_keys() -> None:
     )
 
 
+def _traffic_bulk_enabled() -> bool:
+    """Bulk-режим монитора трафика: один GET /traffic на сервер вместо запросов по ключам."""
+    return os.getenv("VEILBOT_TRAFFIC_BULK_MODE", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def _split_keys_by_bulk_traffic(
+    active_keys: List[tuple],
+    bulk_by_server: Dict[int, Optional[Dict[str, int]]],
+) -> Tuple[Dict[int, int], List[tuple]]:
+    """Сопоставить строки v2ray_keys с bulk-ответами серверов по UUID.
+
+    Args:
+        active_keys: строки (key_id, v2ray_uuid, server_id, ...) из monitor_subscription_traffic_limits
+        bulk_by_server: {server_id: {uuid: total_bytes}}; None — bulk-запрос к серверу не удался
+
+    Returns:
+        (usage_map {key_id: total_bytes}, ключи для поштучного запроса)
+    """
+    usage_map: Dict[int, int] = {}
+    fallback_keys: List[tuple] = []
+    for key_row in active_keys:
+        key_id, v2ray_uuid, server_id = key_row[0], key_row[1], key_row[2]
+        totals = bulk_by_server.get(server_id)
+        uuid_key = (v2ray_uuid or "").strip()
+        if totals is not None and uuid_key and uuid_key in totals:
+            usage_map[key_id] = totals[uuid_key]
+        else:
+            fallback_keys.append(key_row)
+    return usage_map, fallback_keys
+
+
 def _format_bytes_short(num_bytes: Optional[float]) -> str:
     if not num_bytes or num_bytes <= 0:
         return "0 Б"
@@ -440,7 +465,7 @@ async def process_pending_paid_payments() -> None:
                         SELECT k.user_id FROM v2ray_keys k
                         JOIN subscriptions s ON k.subscription_id = s.id
                         WHERE s.expires_at > ?
-                        UNION
+                        UNION ALL
                         SELECT user_id FROM subscriptions WHERE expires_at > ? AND is_active = 1
                     )
                 ''',
@@ -837,7 +862,9 @@ async def monitor_subscription_traffic_limits() -> None:
     """Контроль превышения трафиковых лимитов для подписок V2Ray.
 
     Каждые 30 минут:
-    1. Запрашивает с панели total_bytes по ключам (где есть API).
+    1. Запрашивает с панели total_bytes по ключам (где есть API): один GET /traffic на сервер
+       (VEILBOT_TRAFFIC_BULK_MODE), поштучно — только ключи, отсутствующие в bulk-ответе
+       (по сохранённому v2ray_keys.panel_key_id, без резолва UUID → key_id).
     2. Обновляет v2ray_keys.panel_total_bytes_observed монотонно (max(stored, api); при ошибке GET не трогаем).
     3. Израсходовано по подписке: max(0, S - B), S = сумма observed по ключам, B = subscriptions.traffic_baseline_bytes.
     4. Проверяет превышение лимитов и шлёт уведомления.
@@ -852,42 +879,62 @@ async def monitor_subscription_traffic_limits() -> None:
         server_id: int,
         api_url: str,
         api_key: str,
-        fetch_sem: asyncio.Semaphore,
-    ) -> Optional[int]:
-        """Получить total_bytes с панели (см. V2RayProtocol.get_v2ray_key_traffic_resolved)."""
-        async with fetch_sem:
-            try:
-                config = {"api_url": api_url, "api_key": api_key}
-                protocol = ProtocolFactory.create_protocol("v2ray", config)
+        panel_key_id: Optional[str] = None,
+    ) -> Tuple[Optional[int], Optional[str]]:
+        """Получить total_bytes с панели (см. V2RayProtocol.get_v2ray_key_traffic_resolved).
 
-                try:
-                    _api_ident, stats = await protocol.get_v2ray_key_traffic_resolved(v2ray_uuid)
-                    if not stats:
-                        logging.warning(
-                            "[TRAFFIC] Cannot resolve traffic for UUID %s (db key_id=%s, server_id=%s)",
-                            v2ray_uuid,
-                            key_id,
-                            server_id,
-                        )
-                        return None
+        Параллелизм ограничивает panel_concurrency: адаптивный лимит на каждую панель и общий лимит.
 
-                    total_bytes = stats.get("total_bytes")
-                    if isinstance(total_bytes, (int, float)) and total_bytes >= 0:
-                        return int(total_bytes)
+        Returns:
+            (total_bytes, key_id панели) — key_id для ленивого заполнения v2ray_keys.panel_key_id
+        """
+        try:
+            # Общий клиент из реестра: keep-alive соединения к панели переиспользуются между ключами
+            config = {"api_url": api_url, "api_key": api_key}
+            protocol = ProtocolFactory.create_protocol("v2ray", config)
 
-                    return None
-                finally:
-                    await protocol.close()
-            except Exception as e:
-                logging.error(
-                    "[TRAFFIC] Error fetching traffic for key %s (UUID: %s): %s",
-                    key_id,
+            api_ident, stats = await protocol.get_v2ray_key_traffic_resolved(
+                v2ray_uuid, panel_key_id=panel_key_id
+            )
+            if not stats:
+                logging.warning(
+                    "[TRAFFIC] Cannot resolve traffic for UUID %s (db key_id=%s, server_id=%s)",
                     v2ray_uuid,
-                    e,
-                    exc_info=True,
+                    key_id,
+                    server_id,
                 )
-                return None
+                return None, None
+
+            total_bytes = stats.get("total_bytes")
+            if isinstance(total_bytes, (int, float)) and total_bytes >= 0:
+                return int(total_bytes), api_ident
+
+            return None, api_ident
+        except Exception as e:
+            logging.error(
+                "[TRAFFIC] Error fetching traffic for key %s (UUID: %s): %s",
+                key_id,
+                v2ray_uuid,
+                e,
+                exc_info=True,
+            )
+            return None, None
     
+    async def _fetch_server_traffic_totals(
+        server_id: int,
+        api_url: str,
+        api_key: str,
+    ) -> Optional[Dict[str, int]]:
+        """Получить {uuid: total_bytes} по всему серверу одним запросом GET /traffic."""
+        protocol = ProtocolFactory.create_protocol("v2ray", {"api_url": api_url, "api_key": api_key})
+        totals = await protocol.get_traffic_totals_by_uuid()
+        if totals is None:
+            logging.warning(
+                "[TRAFFIC] Bulk traffic unavailable for server %s, falling back to per-key requests",
+                server_id,
+            )
+        return totals
+
     async def _delete_subscription_due_to_traffic(
         *,
         cursor: sqlite3.Cursor,
@@ -923,7 +970,8 @@ async def monitor_subscription_traffic_limits() -> None:
                         k.subscription_id,
                         IFNULL(s.api_url, '') AS api_url,
                         IFNULL(s.api_key, '') AS api_key,
-                        IFNULL(k.panel_total_bytes_observed, 0) AS panel_total_bytes_observed
+                        IFNULL(k.panel_total_bytes_observed, 0) AS panel_total_bytes_observed,
+                        k.panel_key_id
                     FROM v2ray_keys k
                     JOIN servers s ON k.server_id = s.id
                     JOIN subscriptions sub ON k.subscription_id = sub.id
@@ -950,26 +998,75 @@ async def monitor_subscription_traffic_limits() -> None:
         subscriptions = await asyncio.to_thread(repo.get_subscriptions_with_traffic_limits, now)
         
         # Шаг 2: Выполняем долгие операции с API (БД уже закрыта, блокировок нет)
-        # Ограничение параллелизма снижает Connection timeout на перегруженных панелях (все ключи сразу).
-        fetch_sem = asyncio.Semaphore(max(1, int(os.getenv("VEILBOT_TRAFFIC_FETCH_CONCURRENCY", "15"))))
-
-        # Запросить трафик для каждого ключа (семафор + traffic-first в протоколе)
-        tasks_with_keys: list[tuple[int, asyncio.Task]] = []
+        # Параллелизм по каждой панели ограничивает panel_concurrency (AIMD по задержке и ошибкам):
+        # медленная панель сужает свой лимит и не занимает слоты быстрых.
 
+        keys_with_api = []
+        unavailable_servers: Set[int] = set()
         for key_row in active_keys:
-            key_id, v2ray_uuid, server_id, subscription_id, api_url, api_key, _panel_observed = key_row
-            if not api_url or not api_key:
+            if not key_row[4] or not key_row[5]:
                 logging.warning(
                     "[TRAFFIC] Missing API credentials for server %s, skipping key %s",
-                    server_id, v2ray_uuid
+                    key_row[2], key_row[1]
                 )
                 continue
-            
-            task = _fetch_traffic_for_key(key_id, v2ray_uuid, server_id, api_url, api_key, fetch_sem)
+            if not panel_health.is_available(key_row[4]):
+                # Breaker открыт: observed не трогаем, ключи обновятся в следующем цикле
+                unavailable_servers.add(key_row[2])
+                continue
+            keys_with_api.append(key_row)
+        if unavailable_servers:
+            logging.warning(
+                "[TRAFFIC] Skipping servers with open panel circuit: %s",
+                sorted(unavailable_servers),
+            )
+
+        # Bulk: один GET /traffic на сервер, ключи сопоставляются по UUID.
+        # Число запросов к панелям растёт с числом серверов, а не ключей.
+        bulk_by_server: Dict[int, Optional[Dict[str, int]]] = {}
+        if _traffic_bulk_enabled() and keys_with_api:
+            server_credentials: Dict[int, Tuple[str, str]] = {}
+            for key_row in keys_with_api:
+                server_credentials.setdefault(key_row[2], (key_row[4], key_row[5]))
+            bulk_results = await asyncio.gather(
+                *(
+                    _fetch_server_traffic_totals(server_id, api_url, api_key)
+                    for server_id, (api_url, api_key) in server_credentials.items()
+                ),
+                return_exceptions=True,
+            )
+            for server_id, bulk_result in zip(server_credentials, bulk_results):
+                if isinstance(bulk_result, Exception):
+                    logging.error("[TRAFFIC] Bulk traffic error for server %s: %s", server_id, bulk_result)
+                    bulk_result = None
+                bulk_by_server[server_id] = bulk_result
+
+        usage_map: Dict[int, Optional[int]] = {}
+        bulk_usage, fallback_keys = _split_keys_by_bulk_traffic(keys_with_api, bulk_by_server)
+        usage_map.update(bulk_usage)
+        if bulk_by_server:
+            logging.info(
+                "[TRAFFIC] Bulk traffic: %s keys resolved via %s server requests, %s keys need per-key requests",
+                len(bulk_usage),
+                len(bulk_by_server),
+                len(fallback_keys),
+            )
+
+        # Поштучно — только ключи, которых нет в bulk-ответе (или сервер без bulk)
+        tasks_with_keys: list[tuple[int, asyncio.Task]] = []
+        stored_panel_ids: Dict[int, Optional[str]] = {}
+
+        for key_row in fallback_keys:
+            key_id, v2ray_uuid, server_id, subscription_id, api_url, api_key, _panel_observed = key_row[:7]
+            panel_key_id = key_row[7] if len(key_row) > 7 else None
+            stored_panel_ids[key_id] = panel_key_id
+            task = _fetch_traffic_for_key(
+                key_id, v2ray_uuid, server_id, api_url, api_key, panel_key_id=panel_key_id
+            )
             tasks_with_keys.append((key_id, task))
         
         # Выполняем все запросы параллельно
-        usage_map: Dict[int, Optional[int]] = {}
+        panel_id_updates: list[tuple[str, int]] = []  # (panel_key_id, key_id)
         if tasks_with_keys:
             logging.info(f"[TRAFFIC] Fetching traffic for {len(tasks_with_keys)} keys in parallel")
             tasks = [task for _, task in tasks_with_keys]
@@ -980,8 +1077,19 @@ async def monitor_subscription_traffic_limits() -> None:
                 if isinstance(result, Exception):
                     logging.error(f"[TRAFFIC] Error fetching traffic for key {key_id}: {result}", exc_info=True)
                     continue
-                if result is not None:
-                    usage_map[key_id] = result
+                total_bytes, resolved_panel_id = result
+                if total_bytes is not None:
+                    usage_map[key_id] = total_bytes
+                if resolved_panel_id and resolved_panel_id != stored_panel_ids.get(key_id):
+                    panel_id_updates.append((resolved_panel_id, key_id))
+
+        # Ленивое заполнение panel_key_id: в следующий цикл трафик запрашивается без резолва по UUID
+        if panel_id_updates:
+            await get_sqlite_writer().executemany_async(
+                "UPDATE v2ray_keys SET panel_key_id = ? WHERE id = ?",
+                panel_id_updates,
+            )
+            logging.info(f"[TRAFFIC] Stored panel key_id for {len(panel_id_updates)} keys")
         
         # Шаг 3: монотонное обновление panel_total_bytes_observed по ключам
         key_updates: list[tuple[int, int]] = []  # (new_observed, key_id)
@@ -997,14 +1105,10 @@ async def monitor_subscription_traffic_limits() -> None:
 
         logging.info(f"[TRAFFIC] Updating panel_total_bytes_observed for {len(key_updates)} keys")
         if key_updates:
-            def update_keys_observed():
-                with get_db_cursor(commit=True) as cursor:
-                    cursor.executemany(
-                        "UPDATE v2ray_keys SET panel_total_bytes_observed = ? WHERE id = ?",
-                        key_updates,
-                    )
-
-            await asyncio.to_thread(retry_db_operation, update_keys_observed, 3)
+            await get_sqlite_writer().executemany_async(
+                "UPDATE v2ray_keys SET panel_total_bytes_observed = ? WHERE id = ?",
+                key_updates,
+            )
             logging.info(f"[TRAFFIC] Updated panel_total_bytes_observed for {len(key_updates)} keys")
 
         
@@ -1119,26 +1223,18 @@ async def monitor_subscription_traffic_limits() -> None:
                 subscription_id
             ))
         
-        # Batch-обновление трафика всех подписок (sync DB — в executor)
+        # Batch-обновление трафика и флагов подписок — через писателя процесса
         if traffic_updates:
-            def update_subscriptions_traffic():
-                repo.batch_update_subscriptions_traffic(traffic_updates)
-            
-            await asyncio.to_thread(retry_db_operation, update_subscriptions_traffic, 3)
+            await repo.batch_update_subscriptions_traffic_async(traffic_updates)
             logging.info(f"[TRAFFIC] Batch-updated traffic for {len(traffic_updates)} subscriptions")
         
-        # Batch-обновление флагов подписок (sync DB — в executor)
         if updates:
-            def update_subscriptions_flags():
-                with get_db_cursor(commit=True) as cursor:
-                    cursor.executemany("""
-                        UPDATE subscriptions
-                        SET traffic_over_limit_at = ?,
-                            traffic_over_limit_notified = ?
-                        WHERE id = ?
-                    """, updates)
-            
-            await asyncio.to_thread(retry_db_operation, update_subscriptions_flags, 3)
+            await get_sqlite_writer().executemany_async("""
+                UPDATE subscriptions
+                SET traffic_over_limit_at = ?,
+                    traffic_over_limit_notified = ?
+                WHERE id = ?
+            """, updates)
         
         # Отправить уведомления
         bot = get_bot_instance()
@@ -1261,10 +1357,7 @@ async def notify_expiring_subscriptions() -> None:
         
         # Обновление БД
         if updates:
-            def _apply_updates() -> None:
-                for sub_id, notified in updates:
-                    repo.update_subscription_notified(sub_id, notified)
-            retry_db_operation(_apply_updates, max_attempts=5, initial_delay=0.2)
+            await repo.update_subscriptions_notified_async(updates)
             logging.info("Updated %s subscriptions with expiry notifications", len(updates))
     
     await _run_periodic(
@@ -1412,7 +1505,7 @@ async def fix_payments_without_subscription_id() -> None:
             # Используем прямой SQL запрос для эффективности
             from app.infra.sqlite_utils import open_async_connection
             
-            async with open_async_connection(app_settings.DATABASE_PATH) as conn:
+            async with open_async_connection(app_settings.DATABASE_PATH, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT p.id, p.payment_id, p.user_id, p.tariff_id, p.created_at, p.updated_at
@@ -1450,7 +1543,7 @@ async def fix_payments_without_subscription_id() -> None:
                     grace_period = 24 * 3600  # 24 часа
                     grace_threshold = payment_created_at - grace_period
                     
-                    async with open_async_connection(app_settings.DATABASE_PATH) as conn:
+                    async with open_async_connection(app_settings.DATABASE_PATH, readonly=True) as conn:
                         async with conn.execute(
                             """
                             SELECT id, created_at, expires_at
@@ -1647,22 +1740,19 @@ async def create_keys_for_new_server(server_id: int) -> None:
                     v2ray_uuid = user_data['uuid']
                     
                     # Получить client_config
-                    client_config = await protocol_client.get_user_config(
-                        v2ray_uuid,
-                        {
-                            'domain': domain or 'veil-bot.ru',
-                            'port': 443,
-                            'email': key_email,
-                        }
-                    )
+                    client_config = user_data.get('client_config')
+                    if not client_config:
+                        client_config = await protocol_client.get_user_config(
+                            v2ray_uuid,
+                            {
+                                'domain': domain or 'veil-bot.ru',
+                                'port': 443,
+                                'email': key_email,
+                            }
+                        )
                     
-                    # Извлекаем VLESS URL из конфигурации
-                    if 'vless://' in client_config:
-                        lines = client_config.split('\n')
-                        for line in lines:
-                            if line.strip().startswith('vless://'):
-                                client_config = line.strip()
-                                break
+                    # Ключ подписки хранится в канонической форме: строка vless:// без фрагмента
+                    client_config = canonical_vless_config(client_config)
                     
                     # Перепроверяем в БД перед созданием (мог появиться конкурентно)
                     with get_db_cursor() as check_cursor:
@@ -1691,8 +1781,9 @@ async def create_keys_for_new_server(server_id: int) -> None:
                         try:
                             cursor.execute("""
                                 INSERT INTO v2ray_keys 
-                                (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, subscription_id)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config,
+                                 subscription_id, panel_key_id)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                             """, (
                                 server_id,
                                 user_id,
@@ -1702,6 +1793,7 @@ async def create_keys_for_new_server(server_id: int) -> None:
                                 tariff_id,
                                 client_config,
                                 subscription_id,
+                                panel_key_id_from_user_data(user_data),
                             ))
                         except sqlite3.IntegrityError as e:
                             # Если все же произошла ошибка уникальности (например, по v2ray_uuid)
@@ -1775,42 +1867,40 @@ async def _check_key_exists_on_server(
     api_url: str,
     api_key: str,
     domain: str,
-    api_semaphore: asyncio.Semaphore,
     protocol: str = "v2ray",
 ) -> bool:
     """Проверить, существует ли ключ V2Ray на сервере."""
-    async with api_semaphore:
+    try:
+        if protocol != "v2ray":
+            return True
+        server_config = {
+            "api_url": api_url,
+            "api_key": api_key,
+            "domain": domain,
+        }
+        protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
         try:
-            if protocol != "v2ray":
-                return True
-            server_config = {
-                "api_url": api_url,
-                "api_key": api_key,
-                "domain": domain,
-            }
-            protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
-            try:
-                await protocol_client.get_user_config(
-                    v2ray_uuid,
-                    {
-                        "domain": domain or "veil-bot.ru",
-                        "port": 443,
-                        "email": "user@veilbot.com",
-                    },
-                )
-                return True
-            except Exception as e:
-                error_str = str(e).lower()
-                if "404" in error_str or "not found" in error_str:
-                    return False
-                logger.warning(f"Error checking key {v2ray_uuid[:8]}... on server: {e}")
-                return True
-            finally:
-                if hasattr(protocol_client, "close"):
-                    await protocol_client.close()
+            await protocol_client.get_user_config(
+                v2ray_uuid,
+                {
+                    "domain": domain or "veil-bot.ru",
+                    "port": 443,
+                    "email": "user@veilbot.com",
+                },
+            )
+            return True
         except Exception as e:
-            logger.error(f"Failed to check key existence: {e}", exc_info=True)
+            error_str = str(e).lower()
+            if "404" in error_str or "not found" in error_str:
+                return False
+            logger.warning(f"Error checking key {v2ray_uuid[:8]}... on server: {e}")
             return True
+        finally:
+            if hasattr(protocol_client, "close"):
+                await protocol_client.close()
+    except Exception as e:
+        logger.error(f"Failed to check key existence: {e}", exc_info=True)
+        return True
 
 
 async def _create_subscription_key_on_server(
@@ -1821,7 +1911,6 @@ async def _create_subscription_key_on_server(
     expires_at: int,
     tariff_id: Optional[int],
     now: int,
-    api_semaphore: asyncio.Semaphore,
     protocol: str = 'v2ray',
 ) -> Tuple[bool, Optional[str]]:
     """
@@ -1835,7 +1924,6 @@ async def _create_subscription_key_on_server(
         expires_at: Timestamp истечения подписки
         tariff_id: ID тарифа
         now: Текущий timestamp
-        api_semaphore: Семафор для ограничения параллелизма
         protocol: Протокол ('v2ray')
     
     Returns:
@@ -1845,24 +1933,25 @@ async def _create_subscription_key_on_server(
         return False, f"Unsupported protocol: {protocol}"
     server_id_db, name, api_url, api_key, domain, v2ray_path = server_info[:6]
 
-    async with api_semaphore:  # Ограничиваем параллелизм API-запросов
-        try:
-            key_email = f"{user_id}_subscription_{subscription_id}@veilbot.com"
+    try:
+        key_email = f"{user_id}_subscription_{subscription_id}@veilbot.com"
 
-            server_config = {
-                "api_url": api_url,
-                "api_key": api_key,
-                "domain": domain,
-            }
-            protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
-            try:
-                user_data = await protocol_client.create_user(key_email, name=name)
+        server_config = {
+            "api_url": api_url,
+            "api_key": api_key,
+            "domain": domain,
+        }
+        protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
+        try:
+            user_data = await protocol_client.create_user(key_email, name=name)
 
-                if not user_data or not user_data.get("uuid"):
-                    return False, "Failed to create user on V2Ray server"
+            if not user_data or not user_data.get("uuid"):
+                return False, "Failed to create user on V2Ray server"
 
-                v2ray_uuid = user_data["uuid"]
+            v2ray_uuid = user_data["uuid"]
 
+            client_config = user_data.get("client_config")
+            if not client_config:
                 client_config = await protocol_client.get_user_config(
                     v2ray_uuid,
                     {
@@ -1872,56 +1961,58 @@ async def _create_subscription_key_on_server(
                     },
                 )
 
-                if "vless://" in client_config:
-                    lines = client_config.split("\n")
-                    for line in lines:
-                        if line.strip().startswith("vless://"):
-                            client_config = line.strip()
-                            break
+            if "vless://" in client_config:
+                lines = client_config.split("\n")
+                for line in lines:
+                    if line.strip().startswith("vless://"):
+                        client_config = line.strip()
+                        break
 
-                with get_db_cursor(commit=True) as cursor:
-                    cursor.connection.execute("PRAGMA foreign_keys = OFF")
-                    try:
-                        cursor.execute(
-                            """
-                                INSERT OR IGNORE INTO v2ray_keys
-                                (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, subscription_id)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            (
-                                server_id,
-                                user_id,
-                                v2ray_uuid,
-                                key_email,
-                                now,
-                                tariff_id,
-                                client_config,
-                                subscription_id,
-                            ),
-                        )
-                        if cursor.rowcount == 0:
-                            await protocol_client.delete_user(v2ray_uuid)
-                            return False, "Key already exists (race condition)"
-                    finally:
-                        cursor.connection.execute("PRAGMA foreign_keys = ON")
+            with get_db_cursor(commit=True) as cursor:
+                cursor.connection.execute("PRAGMA foreign_keys = OFF")
+                try:
+                    cursor.execute(
+                        """
+                            INSERT OR IGNORE INTO v2ray_keys
+                            (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config,
+                             subscription_id, panel_key_id)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (
+                            server_id,
+                            user_id,
+                            v2ray_uuid,
+                            key_email,
+                            now,
+                            tariff_id,
+                            client_config,
+                            subscription_id,
+                            panel_key_id_from_user_data(user_data),
+                        ),
+                    )
+                    if cursor.rowcount == 0:
+                        await protocol_client.delete_user(v2ray_uuid)
+                        return False, "Key already exists (race condition)"
+                finally:
+                    cursor.connection.execute("PRAGMA foreign_keys = ON")
 
-                return True, None
-            finally:
-                if hasattr(protocol_client, "close"):
-                    await protocol_client.close()
-        except sqlite3.IntegrityError as e:
-            logger.warning(
-                f"Sync: Integrity error when inserting key for subscription {subscription_id} "
-                f"on server {server_id}: {e}. Key may have been created concurrently."
-            )
-            return False, f"Integrity error: {e}"
-        except Exception as e:
-            logger.error(
-                f"Sync: Failed to create key for subscription {subscription_id} "
-                f"on server {server_id}: {e}",
-                exc_info=True
-            )
-            return False, str(e)
+            return True, None
+        finally:
+            if hasattr(protocol_client, "close"):
+                await protocol_client.close()
+    except sqlite3.IntegrityError as e:
+        logger.warning(
+            f"Sync: Integrity error when inserting key for subscription {subscription_id} "
+            f"on server {server_id}: {e}. Key may have been created concurrently."
+        )
+        return False, f"Integrity error: {e}"
+    except Exception as e:
+        logger.error(
+            f"Sync: Failed to create key for subscription {subscription_id} "
+            f"on server {server_id}: {e}",
+            exc_info=True
+        )
+        return False, str(e)
 
 
 async def _delete_subscription_key_from_server(
@@ -1931,71 +2022,69 @@ async def _delete_subscription_key_from_server(
     v2ray_uuid: Optional[str],
     api_url: Optional[str],
     api_key: Optional[str],
-    api_semaphore: asyncio.Semaphore,
     protocol: str = "v2ray",
 ) -> Tuple[bool, Optional[str]]:
     """Удалить ключ V2Ray подписки с сервера и из БД."""
-    async with api_semaphore:
-        try:
-            if protocol != "v2ray":
-                return False, f"Unsupported protocol: {protocol}"
-            deleted_from_server = False
-
-            if api_url and api_key and v2ray_uuid:
-                server_config = {
-                    "api_url": api_url,
-                    "api_key": api_key,
-                    "domain": "",
-                }
-                protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
-                try:
-                    deleted_from_server = await protocol_client.delete_user(v2ray_uuid)
-                    if deleted_from_server:
-                        logger.debug(
-                            f"Sync: Deleted key {v2ray_uuid[:8]}... "
-                            f"from server {server_id} via API"
-                        )
-                    else:
-                        logger.warning(
-                            f"Sync: Failed to delete key {v2ray_uuid[:8]}... "
-                            f"from server {server_id} via API (returned False)"
-                        )
-                except Exception as api_error:
+    try:
+        if protocol != "v2ray":
+            return False, f"Unsupported protocol: {protocol}"
+        deleted_from_server = False
+
+        if api_url and api_key and v2ray_uuid:
+            server_config = {
+                "api_url": api_url,
+                "api_key": api_key,
+                "domain": "",
+            }
+            protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
+            try:
+                deleted_from_server = await protocol_client.delete_user(v2ray_uuid)
+                if deleted_from_server:
+                    logger.debug(
+                        f"Sync: Deleted key {v2ray_uuid[:8]}... "
+                        f"from server {server_id} via API"
+                    )
+                else:
                     logger.warning(
                         f"Sync: Failed to delete key {v2ray_uuid[:8]}... "
-                        f"from server {server_id} via API: {api_error}"
+                        f"from server {server_id} via API (returned False)"
                     )
-                    deleted_from_server = False
-                finally:
-                    if hasattr(protocol_client, "close"):
-                        await protocol_client.close()
-            else:
-                logger.debug(
-                    f"Sync: Key {key_id} has no server info, will delete from DB only"
+            except Exception as api_error:
+                logger.warning(
+                    f"Sync: Failed to delete key {v2ray_uuid[:8]}... "
+                    f"from server {server_id} via API: {api_error}"
                 )
-                deleted_from_server = True
+                deleted_from_server = False
+            finally:
+                if hasattr(protocol_client, "close"):
+                    await protocol_client.close()
+        else:
+            logger.debug(
+                f"Sync: Key {key_id} has no server info, will delete from DB only"
+            )
+            deleted_from_server = True
 
-            if deleted_from_server:
-                with get_db_cursor(commit=True) as cursor:
-                    with safe_foreign_keys_off(cursor):
-                        cursor.execute(
-                            "DELETE FROM v2ray_keys WHERE id = ?",
-                            (key_id,),
+        if deleted_from_server:
+            with get_db_cursor(commit=True) as cursor:
+                with safe_foreign_keys_off(cursor):
+                    cursor.execute(
+                        "DELETE FROM v2ray_keys WHERE id = ?",
+                        (key_id,),
+                    )
+                    if cursor.rowcount == 0:
+                        logger.warning(
+                            f"Sync: Key {key_id} not found in DB (may have been deleted already)"
                         )
-                        if cursor.rowcount == 0:
-                            logger.warning(
-                                f"Sync: Key {key_id} not found in DB (may have been deleted already)"
-                            )
-                            return False, "Key not found in DB"
-                return True, None
-            return False, "Failed to delete from server"
+                        return False, "Key not found in DB"
+            return True, None
+        return False, "Failed to delete from server"
 
-        except Exception as e:
-            logger.error(
-                f"Sync: Failed to delete key {key_id} for subscription {subscription_id}: {e}",
-                exc_info=True,
-            )
-            return False, str(e)
+    except Exception as e:
+        logger.error(
+            f"Sync: Failed to delete key {key_id} for subscription {subscription_id}: {e}",
+            exc_info=True,
+        )
+        return False, str(e)
 
 
 def _user_has_access_to_server(
@@ -2021,7 +2110,6 @@ async def _process_subscription_sync(
     v2ray_keys_by_subscription: Dict[int, list],
     v2ray_servers: list,
     now: int,
-    api_semaphore: asyncio.Semaphore,
     key_counts_global: Dict[int, int],
 ) -> Dict[str, Any]:
     """
@@ -2046,6 +2134,7 @@ async def _process_subscription_sync(
         'deleted': 0,
         'failed_create': 0,
         'failed_delete': 0,
+        'skipped_unavailable': 0,
         'tokens_to_invalidate': set(),
     }
     
@@ -2077,7 +2166,6 @@ async def _process_subscription_sync(
                 v2ray_allowed_dict,
                 "v2ray",
                 now,
-                api_semaphore,
                 result,
                 key_counts_global,
                 is_vip=is_vip,
@@ -2108,7 +2196,6 @@ async def _process_protocol_sync(
     active_servers_dict: Dict[int, tuple],
     protocol: str,
     now: int,
-    api_semaphore: asyncio.Semaphore,
     result: Dict[str, Any],
     key_counts_global: Dict[int, int],
     *,
@@ -2139,7 +2226,6 @@ async def _process_protocol_sync(
                     api_url_from_dict or api_url,
                     api_key_from_dict or api_key,
                     domain or "",
-                    api_semaphore,
                     protocol="v2ray",
                 )
 
@@ -2269,10 +2355,14 @@ async def _process_protocol_sync(
         if server_id not in active_servers_dict:
             continue
         server_info = active_servers_dict[server_id]
+        if not panel_health.is_available(server_info[2]):
+            # Breaker панели открыт: ключ создастся в следующем цикле, не держим батч на таймаутах
+            result['skipped_unavailable'] += 1
+            continue
         create_tasks.append(
             _create_subscription_key_on_server(
                 subscription_id, user_id, server_id, server_info,
-                expires_at, tariff_id, now, api_semaphore, protocol=protocol
+                expires_at, tariff_id, now, protocol=protocol
             )
         )
 
@@ -2301,7 +2391,7 @@ async def _process_protocol_sync(
         delete_tasks.append(
             _delete_subscription_key_from_server(
                 key_id, subscription_id, server_id, v2ray_uuid,
-                api_url, api_key, api_semaphore, protocol="v2ray"
+                api_url, api_key, protocol="v2ray"
             )
         )
 
@@ -2340,7 +2430,6 @@ async def _delete_orphaned_keys_from_server(
     api_url: str,
     api_key: Optional[str] = None,
     cert_sha256: Optional[str] = None,
-    api_semaphore: asyncio.Semaphore = None,
 ) -> Tuple[int, int]:
     """
     Удалить orphaned ключи с V2Ray сервера (которых нет в БД).
@@ -2350,8 +2439,6 @@ async def _delete_orphaned_keys_from_server(
     """
     if protocol != "v2ray":
         return 0, 0
-    if api_semaphore is None:
-        api_semaphore = asyncio.Semaphore(10)
 
     deleted_count = 0
     error_count = 0
@@ -2379,13 +2466,40 @@ async def _delete_orphaned_keys_from_server(
         }
         protocol_client = ProtocolFactory.create_protocol("v2ray", server_config)
 
+        # Ключи панели разбираются потоково и сразу сверяются с БД: в памяти только
+        # множества из БД и список кандидатов на удаление, а не весь ответ /keys
+        keys_to_delete = []
         try:
-            remote_keys = await protocol_client.get_all_keys()
-            if not remote_keys:
-                if hasattr(protocol_client, "close"):
-                    await protocol_client.close()
-                return 0, 0
+            async for remote_entry in protocol_client.iter_all_keys():
+                remote_uuid = _extract_v2ray_uuid(remote_entry)
+                if not remote_uuid or remote_uuid in db_uuids:
+                    continue
+
+                remote_name = (remote_entry.get("name") or "").lower().strip()
+                remote_email = (remote_entry.get("email") or "").lower().strip()
+
+                key_info = remote_entry.get("key") if isinstance(remote_entry.get("key"), dict) else None
+                if isinstance(key_info, dict):
+                    remote_name = remote_name or (key_info.get("name") or "").lower().strip()
+                    remote_email = remote_email or (key_info.get("email") or "").lower().strip()
+
+                if remote_name in db_emails or remote_email in db_emails:
+                    continue
+
+                key_identifier = (
+                    remote_entry.get("id")
+                    or remote_entry.get("key_id")
+                    or (key_info.get("id") if isinstance(key_info, dict) else None)
+                    or (key_info.get("key_id") if isinstance(key_info, dict) else None)
+                    or remote_uuid
+                )
+
+                keys_to_delete.append({
+                    "uuid": remote_uuid,
+                    "id": key_identifier,
+                })
         except Exception as e:
+            # Неполный список — ничего не удаляем
             logger.warning(
                 f"Sync: Failed to get keys from v2ray server {server_id} ({server_name}): {e}"
             )
@@ -2393,48 +2507,17 @@ async def _delete_orphaned_keys_from_server(
                 await protocol_client.close()
             return 0, 1
 
-        keys_to_delete = []
-        for remote_entry in remote_keys:
-            remote_uuid = _extract_v2ray_uuid(remote_entry)
-            if not remote_uuid or remote_uuid in db_uuids:
-                continue
-
-            remote_name = (remote_entry.get("name") or "").lower().strip()
-            remote_email = (remote_entry.get("email") or "").lower().strip()
-
-            key_info = remote_entry.get("key") if isinstance(remote_entry.get("key"), dict) else None
-            if isinstance(key_info, dict):
-                remote_name = remote_name or (key_info.get("name") or "").lower().strip()
-                remote_email = remote_email or (key_info.get("email") or "").lower().strip()
-
-            if remote_name in db_emails or remote_email in db_emails:
-                continue
-
-            key_identifier = (
-                remote_entry.get("id")
-                or remote_entry.get("key_id")
-                or (key_info.get("id") if isinstance(key_info, dict) else None)
-                or (key_info.get("key_id") if isinstance(key_info, dict) else None)
-                or remote_uuid
-            )
-
-            keys_to_delete.append({
-                "uuid": remote_uuid,
-                "id": key_identifier,
-            })
-
         if keys_to_delete:
             logger.info(
                 f"Sync: Found {len(keys_to_delete)} orphaned v2ray keys on server {server_id} ({server_name})"
             )
 
             async def delete_orphan_key(key_info: Dict[str, Any]) -> bool:
-                async with api_semaphore:
-                    try:
-                        return await protocol_client.delete_user(str(key_info["id"]))
-                    except Exception as e:
-                        logger.warning(f"Sync: Failed to delete orphaned v2ray key: {e}")
-                        return False
+                try:
+                    return await protocol_client.delete_user(str(key_info["id"]))
+                except Exception as e:
+                    logger.warning(f"Sync: Failed to delete orphaned v2ray key: {e}")
+                    return False
 
             delete_tasks = [delete_orphan_key(key_info) for key_info in keys_to_delete]
             delete_results = await asyncio.gather(*delete_tasks, return_exceptions=True)
@@ -2530,14 +2613,15 @@ async def sync_subscription_keys_with_active_servers() -> None:
                 f"{len(all_servers)} total servers for orphaned check"
             )
             
-            # ОПТИМИЗАЦИЯ 2: Rate limiting для API-запросов (макс 10 параллельных запросов к серверам)
-            api_semaphore = asyncio.Semaphore(10)
-            
+            # ОПТИМИЗАЦИЯ 2: Rate limiting API-запросов — адаптивный лимит на каждую панель
+            # (app.infra.panel_concurrency) вместо общего семафора: медленная панель не занимает слоты быстрых
+
             # Синхронизация подписок (если есть активные подписки)
             total_created = 0
             total_deleted = 0
             total_failed_create = 0
             total_failed_delete = 0
+            total_skipped_unavailable = 0
             tokens_to_invalidate = set()
             
             if active_subscriptions:
@@ -2583,7 +2667,6 @@ async def sync_subscription_keys_with_active_servers() -> None:
                         v2ray_keys_by_subscription,
                         v2ray_servers,
                         now,
-                        api_semaphore,
                         key_counts_global,
                     )
                     for subscription in batch
@@ -2602,6 +2685,7 @@ async def sync_subscription_keys_with_active_servers() -> None:
                     total_deleted += result['deleted']
                     total_failed_create += result['failed_create']
                     total_failed_delete += result['failed_delete']
+                    total_skipped_unavailable += result.get('skipped_unavailable', 0)
                     tokens_to_invalidate.update(result.get('tokens_to_invalidate', set()))
             
             # ОПТИМИЗАЦИЯ 4: Батчинг инвалидации кэша (один раз для всех измененных подписок)
@@ -2618,11 +2702,14 @@ async def sync_subscription_keys_with_active_servers() -> None:
                 orphaned_tasks = []
                 for server_row in all_servers:
                     server_id, server_name, protocol, api_url, api_key, cert_sha256 = server_row
+                    if not panel_health.is_available(api_url):
+                        logger.info(f"Sync: Skipping orphaned check on server {server_id}: panel circuit is open")
+                        continue
                     if protocol == 'v2ray':
                         orphaned_tasks.append(
                             _delete_orphaned_keys_from_server(
                                 server_id, server_name, 'v2ray', api_url, api_key,
-                                None, api_semaphore
+                                None,
                             )
                         )
                 
@@ -2640,6 +2727,7 @@ async def sync_subscription_keys_with_active_servers() -> None:
             logger.info(
                 f"Sync completed: {total_created} created, {total_deleted} deleted, "
                 f"{total_failed_create} failed to create, {total_failed_delete} failed to delete, "
+                f"{total_skipped_unavailable} skipped (panel circuit open), "
                 f"{total_orphaned_deleted} orphaned keys deleted, {total_orphaned_errors} orphaned errors, "
                 f"{len(tokens_to_invalidate)} subscriptions cache invalidated"
             )
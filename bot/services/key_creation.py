@@ -283,11 +283,11 @@ async def create_new_key_flow_with_protocol(
 
         if success:
             # Получаем обновленную информацию о ключе
-            cursor.execute("SELECT k.v2ray_uuid, s.domain, s.v2ray_path, s.api_url, s.api_key, k.email FROM v2ray_keys k JOIN servers s ON k.server_id = s.id WHERE k.id = ?", (existing_key[0],))
+            cursor.execute("SELECT k.v2ray_uuid, s.domain, s.v2ray_path, s.api_url, s.api_key, k.email, k.panel_key_id FROM v2ray_keys k JOIN servers s ON k.server_id = s.id WHERE k.id = ?", (existing_key[0],))
             updated_key = cursor.fetchone()
 
             if updated_key:
-                v2ray_uuid, domain, path, api_url, api_key, key_email = updated_key
+                v2ray_uuid, domain, path, api_url, api_key, key_email, panel_key_id = updated_key
                 # Получаем реальную конфигурацию с сервера (как в "мои ключи")
                 config = None
                 protocol_client = None
@@ -303,7 +303,15 @@ async def create_new_key_flow_with_protocol(
                         })
                         if for_renewal:
                             try:
-                                await protocol_client.reset_key_usage(v2ray_uuid)
+                                # Сброс по сохранённому key_id панели; резолв по UUID — только если его нет или он устарел
+                                resolved_id, _ = await protocol_client.reset_v2ray_key_traffic_resolved(
+                                    v2ray_uuid, panel_key_id=panel_key_id
+                                )
+                                if resolved_id and resolved_id != panel_key_id:
+                                    cursor.execute(
+                                        "UPDATE v2ray_keys SET panel_key_id = ? WHERE id = ?",
+                                        (resolved_id, existing_key[0]),
+                                    )
                             except Exception as reset_error:
                                 logging.error(f"Error resetting V2Ray usage for {v2ray_uuid}: {reset_error}")
                     else:
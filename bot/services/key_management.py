@@ -11,7 +11,7 @@ from aiogram import types
 
 from app.infra.sqlite_utils import get_db_cursor
 from bot.services.subscription_server_groups import user_has_active_paid_subscription
-from vpn_protocols import ProtocolFactory
+from vpn_protocols import ProtocolFactory, panel_key_id_from_user_data
 from bot.utils import format_key_message_unified
 from bot.keyboards import get_main_menu
 from bot.core import get_bot_instance
@@ -428,8 +428,8 @@ async def extend_existing_key_with_fallback(
             return False
         
         try:
-            from vpn_protocols import V2RayProtocol
-            v2ray_client = V2RayProtocol(alt_api_url, alt_api_key)
+            from vpn_protocols import get_v2ray_client
+            v2ray_client = get_v2ray_client(alt_api_url, alt_api_key)
             user_data = await v2ray_client.create_user(email or f"user_{existing_key[0]}@veilbot.com")
             
             if not user_data or not user_data.get('uuid'):
@@ -439,6 +439,7 @@ async def extend_existing_key_with_fallback(
             update_parts = [
                 ("server_id = ?", alt_server_id),
                 ("v2ray_uuid = ?", user_data['uuid']),
+                ("panel_key_id = ?", panel_key_id_from_user_data(user_data)),
                 ("email = ?", email or ''),
                 ("tariff_id = ?", tariff_id or 0),
             ]
@@ -485,8 +486,8 @@ async def extend_existing_key_with_fallback(
             return False
         
         try:
-            from vpn_protocols import V2RayProtocol
-            v2ray_client = V2RayProtocol(alt_api_url, alt_api_key)
+            from vpn_protocols import get_v2ray_client
+            v2ray_client = get_v2ray_client(alt_api_url, alt_api_key)
             user_data = await v2ray_client.create_user(email or f"user_{existing_key[0]}@veilbot.com")
             
             if not user_data or not user_data.get('uuid'):
@@ -495,9 +496,16 @@ async def extend_existing_key_with_fallback(
             
             cursor.execute("""
                 UPDATE v2ray_keys 
-                SET server_id = ?, v2ray_uuid = ?, email = ?, tariff_id = ?
+                SET server_id = ?, v2ray_uuid = ?, panel_key_id = ?, email = ?, tariff_id = ?
                 WHERE id = ?
-            """, (alt_server_id, user_data['uuid'], email or '', tariff_id or 0, existing_key[0]))
+            """, (
+                alt_server_id,
+                user_data['uuid'],
+                panel_key_id_from_user_data(user_data),
+                email or '',
+                tariff_id or 0,
+                existing_key[0],
+            ))
             
             logging.info(f"V2Ray key {existing_key[0]} moved to alternative server {alt_server_id} ({alt_name})")
             return True
@@ -849,8 +857,8 @@ async def reissue_specific_key(
             with safe_foreign_keys_off(cursor):
                 cursor.execute(
                     "INSERT INTO v2ray_keys (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, "
-                    "traffic_usage_bytes, subscription_id) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    "traffic_usage_bytes, subscription_id, panel_key_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                     (
                         new_server_id,
                         user_id,
@@ -861,6 +869,7 @@ async def reissue_specific_key(
                         config,
                         usage_bytes_new,
                         subscription_id,
+                        panel_key_id_from_user_data(user_data),
                     ),
                 )
 
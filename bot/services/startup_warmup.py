@@ -0,0 +1,278 @@
+"""
+Прогрев кэшей после старта процесса.
+
+После рестарта админки все кэши холодные: индекс токенов, соединения с панелями, пересобираемые
+payload'ы подписок. Клиенты обновляют подписки по расписанию, поэтому первая волна запросов
+синхронна и вся идёт медленным путём. Прогрев выполняется в фоне с ограниченным параллелизмом:
+
+- token_index — загрузка индекса токенов подписок;
+- panels — общие клиенты активных панелей и по одному лёгкому запросу (DNS, TCP/TLS, keep-alive);
+- payloads — подписки, которые обновлялись недавно (по last_updated_at), проверяются и при
+  устаревшем отпечатке пересобираются (не больше VEILBOT_STARTUP_WARMUP_SUBSCRIPTIONS штук);
+- menus — меню протоколов и тарифов бота.
+
+Пока прогрев payload'ов не закончен, эндпоинт подписки может отдать сохранённый payload с
+устаревшим отпечатком (не старше VEILBOT_STARTUP_WARMUP_MAX_STALE секунд) и пересобрать его в фоне
+вместо синхронной генерации — см. payloads_warming, serves_stale() и refresh_in_background().
+
+Настройки: VEILBOT_STARTUP_WARMUP (0 — выключить), VEILBOT_STARTUP_WARMUP_CONCURRENCY (4),
+VEILBOT_STARTUP_WARMUP_SUBSCRIPTIONS (2000), VEILBOT_STARTUP_WARMUP_MAX_STALE (86400).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Sequence, Set, Tuple
+
+from app.infra.sqlite_utils import open_async_connection
+
+logger = logging.getLogger(__name__)
+
+ADMIN_WARMUP_STEPS = ("token_index", "panels", "payloads")
+BOT_WARMUP_STEPS = ("panels", "menus")
+
+_PANEL_WARMUP_TIMEOUT_SEC = 10.0
+_MENU_PAYMENT_METHODS: Tuple[Optional[str], ...] = (None, "yookassa", "platega", "cryptobot")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(0, int(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+class StartupWarmup:
+    """Фоновый прогрев кэшей процесса и статус готовности."""
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        *,
+        enabled: Optional[bool] = None,
+        concurrency: Optional[int] = None,
+        subscription_limit: Optional[int] = None,
+        max_stale_sec: Optional[int] = None,
+    ):
+        self.db_path = db_path
+        if enabled is None:
+            enabled = os.getenv("VEILBOT_STARTUP_WARMUP", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = enabled
+        self.concurrency = max(1, concurrency if concurrency is not None else _env_int("VEILBOT_STARTUP_WARMUP_CONCURRENCY", 4))
+        self.subscription_limit = (
+            subscription_limit if subscription_limit is not None
+            else _env_int("VEILBOT_STARTUP_WARMUP_SUBSCRIPTIONS", 2000)
+        )
+        self.max_stale_sec = (
+            max_stale_sec if max_stale_sec is not None
+            else _env_int("VEILBOT_STARTUP_WARMUP_MAX_STALE", 86400)
+        )
+        self._steps: Dict[str, str] = {}
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+        self._payloads_pending = False
+        self._refreshing: Set[str] = set()
+        # Фоновые задачи прогрева (ссылки держим, чтобы задачи не собрал GC)
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._stats = {
+            "subscriptions_checked": 0, "payloads_rebuilt": 0, "payloads_failed": 0,
+            "panels_warmed": 0, "panels_failed": 0, "stale_served": 0,
+        }
+
+    @property
+    def ready(self) -> bool:
+        """Прогрев завершён (или не запускался)."""
+        return self._started_at is None or self._finished_at is not None
+
+    def start(self, steps: Sequence[str] = ADMIN_WARMUP_STEPS) -> Optional[asyncio.Task]:
+        """Запустить прогрев фоновой задачей в текущем event loop."""
+        if not self.enabled:
+            return None
+        self._mark_started(steps)
+        return self._spawn(self.run(steps))
+
+    async def run(self, steps: Sequence[str] = ADMIN_WARMUP_STEPS) -> None:
+        """Выполнить шаги прогрева по порядку; ошибка шага не останавливает остальные."""
+        if not self.enabled:
+            return
+        if self._started_at is None or self._finished_at is not None:
+            self._mark_started(steps)
+        started = time.monotonic()
+        try:
+            for step in steps:
+                self._steps[step] = "running"
+                step_started = time.monotonic()
+                try:
+                    await getattr(self, f"_warm_{step}")()
+                    self._steps[step] = "done"
+                except Exception as e:
+                    self._steps[step] = "failed"
+                    logger.warning(f"[WARMUP] Step {step} failed: {e}")
+                finally:
+                    if step == "payloads":
+                        self._payloads_pending = False
+                logger.info(f"[WARMUP] Step {step}: {self._steps[step]} in {time.monotonic() - step_started:.1f}s")
+        finally:
+            self._payloads_pending = False
+            self._finished_at = time.monotonic()
+        logger.info(f"[WARMUP] Completed in {time.monotonic() - started:.1f}s: {self._stats}")
+
+    @property
+    def payloads_warming(self) -> bool:
+        """Прогрев payload'ов ещё не закончен."""
+        return self._payloads_pending
+
+    def serves_stale(self, built_at: Optional[int], now: Optional[int] = None) -> bool:
+        """Можно ли отдать payload с устаревшим отпечатком, пока идёт прогрев payload'ов."""
+        if not self._payloads_pending or not built_at:
+            return False
+        now = int(now if now is not None else time.time())
+        return now - int(built_at) <= self.max_stale_sec
+
+    def refresh_in_background(self, token: str, state: Any) -> None:
+        """Отдан устаревший payload: пересобрать его в фоне (один раз на токен)."""
+        self._stats["stale_served"] += 1
+        if token in self._refreshing:
+            return
+        self._refreshing.add(token)
+        task = self._spawn(self._refresh_payload(token, state))
+        task.add_done_callback(lambda _: self._refreshing.discard(token))
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        elapsed = None
+        if self._started_at is not None:
+            elapsed = round((self._finished_at or now) - self._started_at, 1)
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "steps": dict(self._steps),
+            "elapsed_sec": elapsed,
+            **self._stats,
+        }
+
+    def reset(self) -> None:
+        self._steps = {}
+        self._started_at = None
+        self._finished_at = None
+        self._payloads_pending = False
+        self._refreshing.clear()
+        self._semaphore = None
+        for name in self._stats:
+            self._stats[name] = 0
+
+    def _mark_started(self, steps: Sequence[str]) -> None:
+        self._steps = {step: "pending" for step in steps}
+        self._started_at = time.monotonic()
+        self._finished_at = None
+        self._payloads_pending = "payloads" in steps
+
+    def _spawn(self, coro: Any) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _limit(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def _warm_token_index(self) -> None:
+        from bot.services.subscription_token_index import subscription_tokens
+
+        await subscription_tokens.warm()
+
+    async def _warm_panels(self) -> None:
+        from vpn_protocols import ProtocolFactory, V2RayProtocol
+
+        async with open_async_connection(self.db_path, readonly=True) as conn:
+            async with conn.execute(
+                """
+                SELECT api_url, api_key, domain FROM servers
+                WHERE active = 1 AND protocol = 'v2ray' AND api_url IS NOT NULL AND api_url != ''
+                """
+            ) as cursor:
+                servers = await cursor.fetchall()
+
+        async def warm(api_url: str, api_key: Optional[str], domain: Optional[str]) -> None:
+            async with self._limit():
+                try:
+                    client = ProtocolFactory.create_protocol(
+                        'v2ray', {'api_url': api_url, 'api_key': api_key, 'domain': domain}
+                    )
+                    # Статус отдаёт только API панели V2Ray (у Outline такого метода нет)
+                    status = (
+                        await asyncio.wait_for(client.get_api_status(), _PANEL_WARMUP_TIMEOUT_SEC)
+                        if isinstance(client, V2RayProtocol) else None
+                    )
+                except Exception as e:
+                    logger.debug(f"[WARMUP] Panel {api_url} warm-up failed: {e}")
+                    status = None
+                self._stats["panels_warmed" if status else "panels_failed"] += 1
+
+        await asyncio.gather(*(warm(*server) for server in servers))
+
+    async def _warm_payloads(self) -> None:
+        from bot.services.subscription_payloads import subscription_payloads
+
+        if not subscription_payloads.enabled or not self.subscription_limit:
+            return
+        now = int(time.time())
+        async with open_async_connection(self.db_path, readonly=True) as conn:
+            async with conn.execute(
+                """
+                SELECT s.subscription_token
+                FROM subscriptions s
+                LEFT JOIN users u ON u.user_id = s.user_id
+                WHERE s.is_active = 1 AND (s.expires_at > ? OR COALESCE(u.is_vip, 0) = 1)
+                ORDER BY COALESCE(s.last_updated_at, 0) DESC, s.id DESC
+                LIMIT ?
+                """,
+                (now, self.subscription_limit),
+            ) as cursor:
+                tokens = [row[0] for row in await cursor.fetchall() if row[0]]
+
+        async def warm(token: str) -> None:
+            async with self._limit():
+                try:
+                    state = await subscription_payloads.load_state(token)
+                except Exception as e:
+                    logger.debug(f"[WARMUP] Failed to load payload state for {token[:8]}...: {e}")
+                    self._stats["payloads_failed"] += 1
+                    return
+                self._stats["subscriptions_checked"] += 1
+                if state is None or not state.servable or state.is_fresh:
+                    return
+                await self._rebuild(token, state)
+
+        await asyncio.gather(*(warm(token) for token in tokens))
+
+    async def _refresh_payload(self, token: str, state: Any) -> None:
+        async with self._limit():
+            await self._rebuild(token, state)
+
+    async def _rebuild(self, token: str, state: Any) -> None:
+        from bot.services.subscription_payloads import rebuild_subscription_payload
+
+        try:
+            payload = await rebuild_subscription_payload(token, state)
+        except Exception as e:
+            logger.warning(f"[WARMUP] Failed to rebuild payload for {token[:8]}...: {e}")
+            payload = None
+        self._stats["payloads_rebuilt" if payload is not None else "payloads_failed"] += 1
+
+    async def _warm_menus(self) -> None:
+        from bot.keyboards import get_protocol_selection_menu_async, get_tariff_menu_async
+
+        await get_protocol_selection_menu_async()
+        for paid_only in (False, True):
+            for payment_method in _MENU_PAYMENT_METHODS:
+                await get_tariff_menu_async(paid_only=paid_only, payment_method=payment_method)
+
+
+# Global startup warm-up instance
+startup_warmup = StartupWarmup()
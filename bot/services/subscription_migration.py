@@ -7,7 +7,7 @@ from typing import Optional, Dict, Any, Tuple
 from app.infra.sqlite_utils import get_db_cursor
 from app.repositories.subscription_repository import SubscriptionRepository
 from bot.services.subscription_service import SubscriptionService
-from vpn_protocols import V2RayProtocol
+from vpn_protocols import get_v2ray_client
 from app.infra.foreign_keys import safe_foreign_keys_off
 
 logger = logging.getLogger(__name__)
@@ -84,7 +84,7 @@ async def delete_user_standalone_keys(user_id: int) -> Dict[str, int]:
         if v2ray_uuid and api_url and api_key:
             try:
                 logger.info(f"Удаление V2Ray ключа {v2ray_uuid} с сервера {api_url}")
-                protocol_client = V2RayProtocol(api_url, api_key)
+                protocol_client = get_v2ray_client(api_url, api_key)
                 result = await protocol_client.delete_user(v2ray_uuid)
                 if result:
                     results['v2ray_deleted'] += 1
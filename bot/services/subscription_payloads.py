@@ -0,0 +1,291 @@
+"""
+Материализованные ответы /api/subscription/{token}.
+
+Готовый payload подписки (base64-содержимое + метаданные для заголовков) хранится в таблице
+subscription_payloads вместе с отпечатком входных данных, из которых он собран: строка подписки,
+тариф, VIP-статус, ключи и их серверы, корзина израсходованного трафика и корзина времени
+(строки «Remaining»/«Lifetime» в заголовке). Пока отпечаток совпадает, эндпоинт отдаёт
+сохранённый payload (или 304 по If-None-Match) без generate_subscription_package: две выборки
+по одному соединению вместо полного конвейера генерации и записи в БД.
+
+Настройки:
+- VEILBOT_SUBSCRIPTION_PAYLOAD_STORE=0 — отключить (каждый запрос генерирует подписку заново);
+- VEILBOT_SUBSCRIPTION_TRAFFIC_BUCKET_MB — шаг корзины трафика (по умолчанию 50 МБ);
+- VEILBOT_SUBSCRIPTION_PAYLOAD_MAX_AGE — шаг корзины времени, секунды (по умолчанию 3600).
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+from app.infra.sqlite_utils import open_async_connection
+
+logger = logging.getLogger(__name__)
+
+# Меняется вместе с форматом содержимого подписки — старые payload'ы пересобираются
+PAYLOAD_FORMAT_VERSION = 1
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(0, int(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+class PayloadState(NamedTuple):
+    """Текущий отпечаток входных данных подписки и то, что о ней уже сохранено.
+
+    servable — подписку можно выдавать: активна, не истекла и не заблокирована по трафику.
+    """
+
+    subscription_id: int
+    servable: bool
+    inputs_hash: str
+    stored_hash: Optional[str]
+    stored_etag: Optional[str]
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.stored_hash is not None and self.stored_hash == self.inputs_hash
+
+
+class StoredPayload(NamedTuple):
+    etag: str
+    version: int
+    content: str
+    metadata: Dict[str, Any]
+    built_at: int
+
+
+def compute_etag(content: str) -> str:
+    """Сильный ETag содержимого (в кавычках, как в заголовке)."""
+    return '"' + hashlib.sha256(content.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Сравнение If-None-Match с ETag (слабое сравнение, как требует RFC 9110 для GET)."""
+    if not if_none_match or not etag:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class SubscriptionPayloadStore:
+    """Хранилище собранных payload'ов подписок с отпечатком входных данных."""
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        *,
+        enabled: Optional[bool] = None,
+        traffic_bucket_mb: Optional[int] = None,
+        max_age_sec: Optional[int] = None,
+    ):
+        self.db_path = db_path
+        if enabled is None:
+            enabled = os.getenv("VEILBOT_SUBSCRIPTION_PAYLOAD_STORE", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = enabled
+        self.traffic_bucket_bytes = (
+            traffic_bucket_mb if traffic_bucket_mb is not None
+            else _env_int("VEILBOT_SUBSCRIPTION_TRAFFIC_BUCKET_MB", 50)
+        ) * 1024 * 1024
+        self.max_age_sec = (
+            max_age_sec if max_age_sec is not None
+            else _env_int("VEILBOT_SUBSCRIPTION_PAYLOAD_MAX_AGE", 3600)
+        )
+
+    async def load_state(self, token: str, now: Optional[int] = None) -> Optional[PayloadState]:
+        """Собрать отпечаток входных данных подписки; None — подписки с таким токеном нет."""
+        now = int(now if now is not None else time.time())
+        async with open_async_connection(self.db_path, readonly=True) as conn:
+            async with conn.execute(
+                """
+                SELECT s.id, s.user_id, s.created_at, s.expires_at, s.tariff_id, s.is_active,
+                       s.traffic_limit_mb, s.traffic_over_limit_at, COALESCE(s.traffic_baseline_bytes, 0),
+                       t.name, t.traffic_limit_mb, COALESCE(u.is_vip, 0),
+                       (SELECT COALESCE(SUM(COALESCE(vk.panel_total_bytes_observed, 0)), 0)
+                        FROM v2ray_keys vk WHERE vk.subscription_id = s.id),
+                       (SELECT CASE WHEN COUNT(DISTINCT vk.traffic_limit_mb) = 1 THEN MAX(vk.traffic_limit_mb) END
+                        FROM v2ray_keys vk
+                        WHERE vk.subscription_id = s.id
+                          AND vk.traffic_limit_mb IS NOT NULL
+                          AND vk.traffic_limit_mb > 0),
+                       p.inputs_hash, p.etag
+                FROM subscriptions s
+                LEFT JOIN tariffs t ON t.id = s.tariff_id
+                LEFT JOIN users u ON u.user_id = s.user_id
+                LEFT JOIN subscription_payloads p ON p.subscription_id = s.id
+                WHERE s.subscription_token = ?
+                """,
+                (token,),
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            (
+                subscription_id, user_id, created_at, expires_at, tariff_id, is_active,
+                sub_limit_mb, over_limit_at, baseline_bytes,
+                tariff_name, tariff_limit_mb, is_vip,
+                observed_bytes, key_limit_mb, stored_hash, stored_etag,
+            ) = row
+            # Тот же набор, что читает get_subscription_keys_async, плюс лимиты ключей (fallback лимита)
+            async with conn.execute(
+                """
+                SELECT k.v2ray_uuid, k.client_config, k.traffic_limit_mb,
+                       s.domain, s.api_url, s.api_key, s.country, s.name
+                FROM v2ray_keys k
+                JOIN servers s ON k.server_id = s.id
+                WHERE k.subscription_id = ? AND k.user_id = ? AND s.active = 1
+                ORDER BY s.country, s.name, k.v2ray_uuid
+                """,
+                (subscription_id, user_id),
+            ) as cursor:
+                keys = await cursor.fetchall()
+
+        expires_at = int(expires_at or 0)
+        usage_bytes = max(0, int(observed_bytes or 0) - int(baseline_bytes or 0))
+        grace_expired = bool(over_limit_at) and now > int(over_limit_at) + 86400
+        # Лимит и блокировка по трафику — как в _generate_subscription_package (VIP без проверок)
+        if sub_limit_mb is not None:
+            limit_mb = int(sub_limit_mb)
+        elif tariff_limit_mb:
+            limit_mb = int(tariff_limit_mb)
+        else:
+            limit_mb = int(key_limit_mb or 0)
+        over_traffic_limit = bool(limit_mb) and usage_bytes > limit_mb * 1024 * 1024 and grace_expired
+        servable = bool(is_active) and (bool(is_vip) or (expires_at > now and not over_traffic_limit))
+
+        from bot.services.subscription_service import SUBSCRIPTION_DISPLAY_NAME
+        from config import SUPPORT_USERNAME
+
+        inputs = [
+            PAYLOAD_FORMAT_VERSION,
+            [subscription_id, user_id, created_at, expires_at, tariff_id, bool(is_active), bool(is_vip)],
+            [sub_limit_mb, tariff_name, tariff_limit_mb, over_limit_at, grace_expired],
+            usage_bytes // self.traffic_bucket_bytes if self.traffic_bucket_bytes else usage_bytes,
+            # Фаза корзины своя у каждой подписки: payload'ы не устаревают все разом на границе часа
+            (now + subscription_id * 2654435761 % self.max_age_sec) // self.max_age_sec if self.max_age_sec else now,
+            [list(key) for key in keys],
+            [SUBSCRIPTION_DISPLAY_NAME, SUPPORT_USERNAME],
+        ]
+        inputs_hash = hashlib.sha256(
+            json.dumps(inputs, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
+        return PayloadState(
+            subscription_id=int(subscription_id),
+            servable=servable,
+            inputs_hash=inputs_hash,
+            stored_hash=stored_hash if self.enabled else None,
+            stored_etag=stored_etag if self.enabled else None,
+        )
+
+    async def get(self, subscription_id: int) -> Optional[StoredPayload]:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
+            async with conn.execute(
+                """
+                SELECT etag, version, content, metadata, built_at
+                FROM subscription_payloads
+                WHERE subscription_id = ?
+                """,
+                (subscription_id,),
+            ) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return None
+        try:
+            metadata = json.loads(row[3]) if row[3] else {}
+        except (TypeError, ValueError):
+            metadata = {}
+        return StoredPayload(etag=row[0], version=int(row[1]), content=row[2], metadata=metadata, built_at=int(row[4]))
+
+    async def save(self, state: PayloadState, package: Dict[str, Any]) -> StoredPayload:
+        """Сохранить собранный payload под отпечатком state.
+
+        Версия растёт, только когда меняется содержимое: одновременные пересборки с тем же
+        отпечатком и тем же результатом строку не трогают.
+        """
+        content = package["content"]
+        metadata = package.get("metadata") or {}
+        etag = compute_etag(content)
+        built_at = int(time.time())
+        version = 1
+        if not self.enabled:
+            return StoredPayload(etag=etag, version=version, content=content, metadata=metadata, built_at=built_at)
+        try:
+            async with open_async_connection(self.db_path) as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO subscription_payloads
+                        (subscription_id, inputs_hash, etag, version, content, metadata, built_at)
+                    VALUES (?, ?, ?, 1, ?, ?, ?)
+                    ON CONFLICT(subscription_id) DO UPDATE SET
+                        inputs_hash = excluded.inputs_hash,
+                        etag = excluded.etag,
+                        version = subscription_payloads.version
+                            + (subscription_payloads.etag != excluded.etag),
+                        content = excluded.content,
+                        metadata = excluded.metadata,
+                        built_at = excluded.built_at
+                    WHERE subscription_payloads.inputs_hash != excluded.inputs_hash
+                       OR subscription_payloads.etag != excluded.etag
+                    """,
+                    (
+                        state.subscription_id,
+                        state.inputs_hash,
+                        etag,
+                        content,
+                        json.dumps(metadata, ensure_ascii=False, default=str),
+                        built_at,
+                    ),
+                )
+                async with conn.execute(
+                    "SELECT version FROM subscription_payloads WHERE subscription_id = ?",
+                    (state.subscription_id,),
+                ) as cursor:
+                    row = await cursor.fetchone()
+                await conn.commit()
+            version = int(row[0]) if row else version
+        except Exception as e:
+            # Не удалось сохранить — ответ всё равно отдаём, в следующий раз соберём заново
+            logger.warning(f"[SUBSCRIPTION_PAYLOAD] Failed to store payload for subscription {state.subscription_id}: {e}")
+        return StoredPayload(etag=etag, version=version, content=content, metadata=metadata, built_at=built_at)
+
+
+# Global subscription payload store instance
+subscription_payloads = SubscriptionPayloadStore()
+
+
+async def rebuild_subscription_payload(token: str, state: Optional[PayloadState]) -> Optional[StoredPayload]:
+    """Сгенерировать подписку заново и сохранить payload под отпечатком state.
+
+    None — подписку выдать нельзя (истекла, нет ключей и т.п.). Без state payload не сохраняется.
+    """
+    from bot.services.subscription_service import SubscriptionService, _subscription_cache
+
+    # Пакет в локальном кэше мог быть собран из прежних данных (например, до изменения трафика),
+    # поэтому сбрасываем его только в этом процессе, без события другим
+    _subscription_cache.delete(f"subscription:{token}")
+    package = await SubscriptionService().generate_subscription_package(token)
+    if not package or package.get("content") is None:
+        return None
+    if state is not None:
+        return await subscription_payloads.save(state, package)
+    return StoredPayload(
+        etag=compute_etag(package["content"]),
+        version=0,
+        content=package["content"],
+        metadata=package.get("metadata") or {},
+        built_at=int(time.time()),
+    )
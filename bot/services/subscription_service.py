@@ -2,20 +2,27 @@
 Сервис для работы с подписками V2Ray
 """
 import asyncio
+import copy
+import functools
+import os
 import uuid
 import base64
 import time
 import logging
 from datetime import datetime
-from typing import Optional, Dict, Any, NamedTuple
+from typing import Optional, Dict, Any, List, NamedTuple, Set, Tuple
 
 from app.repositories.subscription_repository import SubscriptionRepository
-from app.infra.cache import SimpleCache
+from app.infra.cache_invalidation import SharedCache
 from vpn_protocols import (
     ProtocolFactory,
+    canonical_vless_config,
     normalize_vless_host,
-    add_server_name_to_vless,
+    panel_key_id_from_user_data,
     remove_fragment_from_vless,
+    render_vless_link,
+    vless_fragment,
+    vless_host_override,
 )
 from app.infra.sqlite_utils import get_db_cursor, retry_db_operation
 from bot.services.subscription_server_groups import (
@@ -66,8 +73,52 @@ def _is_retryable_key_error(exc: BaseException) -> bool:
         pass
     return False
 
-# Кэш для подписок (TTL 5 минут)
-_subscription_cache = SimpleCache()
+# Дедлайн параллельного получения недостающих client_config при генерации подписки (секунды)
+try:
+    CONFIG_FETCH_DEADLINE = max(0.1, float(os.getenv("VEILBOT_SUBSCRIPTION_CONFIG_FETCH_DEADLINE", "5")))
+except ValueError:
+    CONFIG_FETCH_DEADLINE = 5.0
+
+# Фоновые дозапросы client_config (ссылки держим, чтобы задачи не собрал GC)
+_config_backfills: Set[asyncio.Future] = set()
+# Запросы client_config в полёте: {(loop, v2ray_uuid): задача} — одновременные генерации
+# подписки одного пользователя не дублируют вызовы панели
+_config_fetches: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Future] = {}
+
+
+def _forget_config_fetch(key: Tuple[asyncio.AbstractEventLoop, str], task: asyncio.Future) -> None:
+    if _config_fetches.get(key) is task:
+        del _config_fetches[key]
+
+
+def _collect_fetched_configs(done: Set[asyncio.Future], tasks: Dict[asyncio.Future, str]) -> Dict[str, str]:
+    configs = {}
+    for task in done:
+        if not task.cancelled() and task.exception() is None and task.result():
+            configs[tasks[task]] = task.result()
+    return configs
+
+
+# Single-flight генерации подписки по токену: {(loop, db_path, token): задача генерации}
+_generation_inflight: Dict[Tuple[asyncio.AbstractEventLoop, str, str], asyncio.Task] = {}
+GENERATION_SINGLEFLIGHT = os.getenv("VEILBOT_SUBSCRIPTION_SINGLEFLIGHT", "1").strip().lower() not in ("0", "false", "no")
+try:
+    GENERATION_WAIT_TIMEOUT = max(0.1, float(os.getenv("VEILBOT_SUBSCRIPTION_SINGLEFLIGHT_WAIT", "10")))
+except ValueError:
+    GENERATION_WAIT_TIMEOUT = 10.0
+
+
+
+def _forget_generation(key: Tuple[asyncio.AbstractEventLoop, str, str], task: asyncio.Task) -> None:
+    if _generation_inflight.get(key) is task:
+        del _generation_inflight[key]
+    # Ошибку получит лидер; если его отменили, а ожидающих нет — не оставляем её «unretrieved»
+    if not task.cancelled():
+        task.exception()
+
+
+# Кэш для подписок (TTL 5 минут); инвалидации расходятся между ботом и админкой
+_subscription_cache = SharedCache("subscription")
 CACHE_TTL = 300  # 5 минут
 
 
@@ -85,9 +136,9 @@ def validate_subscription_token(token: str) -> bool:
 
 
 def invalidate_subscription_cache(token: str) -> None:
-    """Инвалидировать кэш подписки"""
+    """Инвалидировать кэш подписки (во всех процессах)"""
     cache_key = f"subscription:{token}"
-    _subscription_cache.delete(cache_key)
+    _subscription_cache.invalidate(cache_key)
 
 
 def invalidate_subscriptions_cache_for_server(server_id: int) -> None:
@@ -109,15 +160,12 @@ def invalidate_subscriptions_cache_for_server(server_id: int) -> None:
                 WHERE k.server_id = ? AND s.is_active = 1
             """, (server_id,))
             
-            tokens = cursor.fetchall()
-            invalidated_count = 0
-            
-            for (token,) in tokens:
-                invalidate_subscription_cache(token)
-                invalidated_count += 1
-            
-            if invalidated_count > 0:
-                logger.info(f"Invalidated cache for {invalidated_count} subscriptions containing keys from server {server_id}")
+            tokens = [token for (token,) in cursor.fetchall()]
+
+        if tokens:
+            # Все токены сервера — одной пачкой INSERT в одной транзакции
+            _subscription_cache.invalidate_many(f"subscription:{token}" for token in tokens)
+            logger.info(f"Invalidated cache for {len(tokens)} subscriptions containing keys from server {server_id}")
     except Exception as e:
         logger.error(f"Error invalidating subscription cache for server {server_id}: {e}", exc_info=True)
 
@@ -127,28 +175,9 @@ def invalidate_all_active_subscriptions_cache() -> None:
     Инвалидировать кэш всех активных подписок
     Используется при глобальных изменениях
     """
-    try:
-        from app.infra.sqlite_utils import get_db_cursor
-        
-        with get_db_cursor() as cursor:
-            now = int(time.time())
-            cursor.execute("""
-                SELECT subscription_token
-                FROM subscriptions
-                WHERE is_active = 1 AND expires_at > ?
-            """, (now,))
-            
-            tokens = cursor.fetchall()
-            invalidated_count = 0
-            
-            for (token,) in tokens:
-                invalidate_subscription_cache(token)
-                invalidated_count += 1
-            
-            if invalidated_count > 0:
-                logger.info(f"Invalidated cache for {invalidated_count} active subscriptions")
-    except Exception as e:
-        logger.error(f"Error invalidating all subscriptions cache: {e}", exc_info=True)
+    # Одно событие на весь namespace вместо строки на каждый токен
+    _subscription_cache.invalidate_all()
+    logger.info("Invalidated cache for all subscriptions")
 
 
 def update_subscription_configs_remove_fragments() -> None:
@@ -301,6 +330,7 @@ def _fetch_servers_for_new_subscription(user_id: int, subscription_id: int) -> l
 def _insert_v2ray_key_for_subscription(
     server_id: int, user_id: int, v2ray_uuid: str, key_email: str, now: int,
     tariff_id: int, client_config: Optional[str], subscription_id: int,
+    panel_key_id: Optional[str] = None,
 ) -> None:
     """Вставляет одну запись в v2ray_keys. Вызывается через retry_db_operation при database is locked."""
     with get_db_cursor(commit=True) as cursor:
@@ -309,10 +339,14 @@ def _insert_v2ray_key_for_subscription(
             cursor.execute(
                 """
                 INSERT INTO v2ray_keys
-                (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, subscription_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, subscription_id,
+                 panel_key_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (server_id, user_id, v2ray_uuid, key_email, now, tariff_id, client_config, subscription_id),
+                (
+                    server_id, user_id, v2ray_uuid, key_email, now, tariff_id, client_config, subscription_id,
+                    panel_key_id,
+                ),
             )
         finally:
             cursor.connection.execute("PRAGMA foreign_keys = ON")
@@ -361,6 +395,11 @@ class SubscriptionService:
     async def generate_subscription_package(self, token: str) -> Optional[Dict[str, Any]]:
         """
         Сгенерировать содержимое подписки (base64-кодированный список VLESS URL)
+
+        Одновременные запросы одного токена (телефон, планшет и роутер пользователя, массовое
+        обновление после деплоя) ждут одну генерацию и получают копию её результата. Ожидание
+        ограничено GENERATION_WAIT_TIMEOUT секундами; если общая генерация не успела или упала,
+        ожидающий генерирует подписку сам.
         
         Args:
             token: Токен подписки
@@ -368,6 +407,36 @@ class SubscriptionService:
         Returns:
             Base64-кодированная строка с VLESS URL или None при ошибке
         """
+        if not GENERATION_SINGLEFLIGHT:
+            return await self._generate_subscription_package(token)
+
+        loop = asyncio.get_running_loop()
+        key = (loop, self.repository.db_path, token)
+        task = _generation_inflight.get(key)
+        if task is None:
+            task = loop.create_task(self._generate_subscription_package(token))
+            _generation_inflight[key] = task
+            task.add_done_callback(functools.partial(_forget_generation, key))
+            # shield: если отменят запрос-лидер, генерация продолжится для остальных
+            return await asyncio.shield(task)
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), timeout=GENERATION_WAIT_TIMEOUT)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            logger.warning(f"Shared subscription generation for {token[:8]}... was cancelled, generating separately")
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Shared subscription generation for {token[:8]}... exceeded {GENERATION_WAIT_TIMEOUT}s, generating separately"
+            )
+        except Exception as e:
+            logger.warning(f"Shared subscription generation for {token[:8]}... failed ({e}), generating separately")
+        else:
+            return copy.deepcopy(result)
+        return await self._generate_subscription_package(token)
+
+    async def _generate_subscription_package(self, token: str) -> Optional[Dict[str, Any]]:
         cache_key = f"subscription:{token}"
         cached = _subscription_cache.get(cache_key)
         if cached:
@@ -379,9 +448,10 @@ class SubscriptionService:
             logger.warning(f"Invalid subscription token format: {token[:8]}...")
             return None
 
-        # Получение подписки из БД
-        subscription = await self.repository.get_subscription_by_token_async(token)
-        if not subscription:
+        # Все данные для генерации — одним асинхронным соединением, без блокирующих вызовов в event loop
+        now = int(time.time())
+        data = await self.repository.load_subscription_generation_data_async(token, now)
+        if not data:
             logger.warning(f"Subscription not found for token {token[:8]}...")
             return None
 
@@ -395,65 +465,35 @@ class SubscriptionService:
             is_active,
             last_updated_at,
             notified,
-        ) = subscription
+        ) = data.subscription
 
         # Проверка активности и срока действия
-        now = int(time.time())
         if not is_active:
             logger.warning(f"Subscription {subscription_id} is not active")
             return None
 
-        # Проверяем VIP статус пользователя
-        from app.repositories.user_repository import UserRepository
-        user_repo = UserRepository()
-        is_vip = user_repo.is_user_vip(user_id)
+        is_vip = data.is_vip
         
         # Для VIP подписок пропускаем проверку срока действия
         if not is_vip and expires_at <= now:
             logger.warning(f"Subscription {subscription_id} has expired")
             return None
         
-        # Проверка лимита трафика подписки
-        tariff_name: Optional[str] = None
+        # Проверка лимита трафика подписки; тариф нужен только для отображения имени в метаданных
+        tariff_name: Optional[str] = data.tariff_name
         traffic_limit_bytes: Optional[int] = None
         traffic_usage_bytes: int = 0
 
         # Для VIP подписок пропускаем проверку трафика
         if not is_vip:
-            # Вычисляем использованный трафик динамически, суммируя трафик всех ключей подписки
-            traffic_usage_bytes = self.repository.get_subscription_traffic_sum(subscription_id)
-
-            # Берём эффективный лимит через репозиторий, чтобы логика совпадала с админкой
-            traffic_limit_bytes = self.repository.get_subscription_traffic_limit(subscription_id)
-
-        with get_db_cursor(commit=True) as cursor:
-            # Тариф сейчас нужен только для отображения имени тарифа в метаданных
-            cursor.execute(
-                """
-                SELECT t.name
-                FROM subscriptions s
-                LEFT JOIN tariffs t ON s.tariff_id = t.id
-                WHERE s.id = ?
-                """,
-                (subscription_id,),
-            )
-            limits_row = cursor.fetchone()
-            if limits_row:
-                tariff_name = limits_row[0]
-
-            # Для VIP подписок пропускаем проверку превышения лимита трафика
-            if not is_vip and traffic_limit_bytes and traffic_usage_bytes > traffic_limit_bytes:
-                cursor.execute(
-                    """
-                    SELECT traffic_over_limit_at
-                    FROM subscriptions
-                    WHERE id = ?
-                    """,
-                    (subscription_id,),
-                )
-                over_limit_row = cursor.fetchone()
-                if over_limit_row and over_limit_row[0]:
-                    grace_end = over_limit_row[0] + 86400  # 24 часа
+            # Used = max(0, S - B), лимит — та же логика, что в get_subscription_traffic_limit (админка)
+            traffic_usage_bytes = data.traffic_usage_bytes
+            traffic_limit_bytes = data.traffic_limit_bytes
+
+            if traffic_limit_bytes and traffic_usage_bytes > traffic_limit_bytes:
+                over_limit_at = data.traffic_over_limit_at
+                if over_limit_at:
+                    grace_end = over_limit_at + 86400  # 24 часа
                     if now > grace_end:
                         logger.warning(
                             "Subscription %s disabled due to traffic limit (%s > %s)",
@@ -463,15 +503,18 @@ class SubscriptionService:
                         )
                         return None
 
-        # Получение ключей подписки
-        keys = await self.repository.get_subscription_keys_async(subscription_id, user_id, now)
+        # Ключи подписки
+        keys = data.keys
         if not keys:
             logger.warning(f"No active keys found for subscription {subscription_id}")
             return None
 
+        # Недостающие конфигурации получаем через API — параллельно по всем ключам, с общим дедлайном
+        missing_keys = [key for key in keys if not (key[1] and 'vless://' in key[1])]
+        fetched_configs = await self._fetch_missing_configs(missing_keys, user_id) if missing_keys else {}
+
         # Сбор VLESS URL
         vless_urls = []
-        keys_to_update = []
         first_server_name: Optional[str] = None
 
         for (
@@ -483,75 +526,18 @@ class SubscriptionService:
             country,
             server_name,
         ) in keys:
-            config = None
-
-            # Используем сохраненную конфигурацию, если она есть и содержит vless://
             if client_config and 'vless://' in client_config:
-                # Нормализуем сохраненную конфигурацию
-                config = normalize_vless_host(
-                    client_config,
-                    domain,
-                    api_url or ''
-                )
-                # Удаляем фрагмент (email) из сохраненной конфигурации, если он есть
-                # Название сервера будет добавлено динамически
-                config = remove_fragment_from_vless(config)
+                config = client_config
             else:
-                # Получаем конфигурацию через API
-                try:
-                    server_config = {
-                        'api_url': api_url,
-                        'api_key': api_key,
-                        'domain': domain,
-                    }
-                    protocol_client = ProtocolFactory.create_protocol('v2ray', server_config)
-                    fetched_config = await protocol_client.get_user_config(
-                        v2ray_uuid,
-                        {
-                            'domain': domain,
-                            'port': 443,
-                            'email': f"user_{user_id}@veilbot.com",
-                        },
-                    )
-
-                    # Извлекаем VLESS URL из конфигурации и нормализуем
-                    if 'vless://' in fetched_config:
-                        lines = fetched_config.split('\n')
-                        for line in lines:
-                            if line.strip().startswith('vless://'):
-                                config = normalize_vless_host(
-                                    line.strip(),
-                                    domain,
-                                    api_url or ''
-                                )
-                                break
-                        else:
-                            config = normalize_vless_host(
-                                fetched_config.strip(),
-                                domain,
-                                api_url or ''
-                            )
-                    else:
-                        config = fetched_config.strip()
-
-                    # Удаляем фрагмент (email) из конфигурации, полученной из API
-                    # V2Ray API может возвращать конфигурацию с email в фрагменте
-                    if config:
-                        config = remove_fragment_from_vless(config)
-                        # Сохраняем конфигурацию без фрагмента в БД
-                        config_for_db = config
-                        keys_to_update.append((config_for_db, v2ray_uuid))
-
-                except Exception as e:
-                    logger.error(
-                        f"Failed to get config for key {v2ray_uuid[:8]}...: {e}",
-                        exc_info=True,
-                    )
+                config = fetched_configs.get(v2ray_uuid)
+                if not config:
+                    # Ошибка или не успели к дедлайну (тогда ключ дозаполнится в фоне)
                     continue
 
-            # Добавляем название сервера из админки в фрагмент VLESS URL
-            # Это делается для всех конфигураций (и сохраненных, и полученных из API)
-            if config and config.startswith('vless://'):
+            # client_config хранится в канонической форме (без фрагмента): хост сервера и его
+            # название из админки подставляются срезами строки, без разбора URL на каждый ключ
+            config = render_vless_link(config, vless_host_override(domain, api_url), vless_fragment(server_name))
+            if config.startswith('vless://'):
                 if not first_server_name and server_name:
                     first_server_name = server_name
                 if not server_name:
@@ -559,27 +545,8 @@ class SubscriptionService:
                         f"Server name is empty for server_id (uuid={v2ray_uuid[:8]}...), "
                         f"country={country}, domain={domain}"
                     )
-                else:
-                    logger.debug(
-                        f"Adding server name '{server_name}' to config for UUID {v2ray_uuid[:8]}..."
-                    )
-                config_before = config
-                config = add_server_name_to_vless(config, server_name)
-                if config != config_before:
-                    logger.debug(
-                        f"Updated config fragment: '{config_before.split('#')[-1] if '#' in config_before else 'none'}' -> '{config.split('#')[-1] if '#' in config else 'none'}'"
-                    )
                 vless_urls.append(config)
 
-        # Обновление конфигураций в БД
-        if keys_to_update:
-            with get_db_cursor(commit=True) as cursor:
-                for config, v2ray_uuid in keys_to_update:
-                    cursor.execute(
-                        "UPDATE v2ray_keys SET client_config = ? WHERE v2ray_uuid = ?",
-                        (config, v2ray_uuid),
-                    )
-
         if not vless_urls:
             logger.warning(f"No valid VLESS URLs found for subscription {subscription_id}")
             return None
@@ -689,9 +656,6 @@ class SubscriptionService:
         }
         _subscription_cache.set(cache_key, package, ttl=CACHE_TTL)
 
-        # Обновление last_updated_at
-        await self.repository.update_subscription_last_updated_async(subscription_id)
-
         logger.info(
             f"Generated subscription content for subscription {subscription_id} "
             f"with {len(vless_urls)} servers"
@@ -699,6 +663,119 @@ class SubscriptionService:
 
         return package
 
+    async def _fetch_missing_configs(self, keys: List[Tuple], user_id: int) -> Dict[str, str]:
+        """Получить client_config ключей без сохранённой конфигурации через API панелей.
+
+        Запросы идут параллельно; ждём не дольше CONFIG_FETCH_DEADLINE секунд и возвращаем то,
+        что успело. Запрос ключа, который уже выполняется для другой генерации, не повторяется —
+        ждём его результат, а сохраняет его та генерация, что начала запрос. Полученные
+        конфигурации сохраняются одной пачкой (ошибка записи не мешает отдать их в подписку),
+        неуспевшие запросы продолжаются в фоне и дозаписывают результат сами.
+
+        Returns:
+            {v2ray_uuid: vless_url без фрагмента}
+        """
+        loop = asyncio.get_running_loop()
+        tasks: Dict[asyncio.Future, str] = {}
+        owned: Set[asyncio.Future] = set()
+        for key in keys:
+            fetch_key = (loop, key[0])
+            task = _config_fetches.get(fetch_key)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch_key_config(key, user_id))
+                _config_fetches[fetch_key] = task
+                task.add_done_callback(functools.partial(_forget_config_fetch, fetch_key))
+                owned.add(task)
+            tasks[task] = key[0]
+        done, pending = await asyncio.wait(tasks, timeout=CONFIG_FETCH_DEADLINE)
+        configs = _collect_fetched_configs(done, tasks)
+        own_configs = _collect_fetched_configs(done & owned, tasks)
+        if own_configs:
+            try:
+                await self.repository.update_keys_client_config_async(
+                    [(config, v2ray_uuid) for v2ray_uuid, config in own_configs.items()]
+                )
+            except Exception as e:
+                logger.error(f"Failed to store client_config for {len(own_configs)} keys: {e}", exc_info=True)
+        own_pending = pending & owned
+        if pending:
+            logger.warning(
+                f"{len(pending)} of {len(tasks)} key configs not fetched within {CONFIG_FETCH_DEADLINE}s, "
+                "continuing in background"
+            )
+        if own_pending:
+            backfill = asyncio.ensure_future(
+                self._backfill_configs({task: tasks[task] for task in own_pending})
+            )
+            _config_backfills.add(backfill)
+            backfill.add_done_callback(_config_backfills.discard)
+        return configs
+
+    async def _backfill_configs(self, tasks: Dict[asyncio.Future, str]) -> None:
+        """Дождаться запросов, не успевших к дедлайну генерации, и сохранить результат пачкой"""
+        done, _ = await asyncio.wait(tasks)
+        configs = _collect_fetched_configs(done, tasks)
+        if not configs:
+            return
+        try:
+            await self.repository.update_keys_client_config_async(
+                [(config, v2ray_uuid) for v2ray_uuid, config in configs.items()]
+            )
+            logger.info(f"Backfilled client_config for {len(configs)} keys")
+        except Exception as e:
+            logger.error(f"Failed to backfill client_config for {len(configs)} keys: {e}", exc_info=True)
+
+    async def _fetch_key_config(self, key: Tuple, user_id: int) -> Optional[str]:
+        """Получить VLESS URL ключа через API панели (нормализованный, без фрагмента)"""
+        v2ray_uuid, _, domain, api_url, api_key, _, _ = key
+        try:
+            server_config = {
+                'api_url': api_url,
+                'api_key': api_key,
+                'domain': domain,
+            }
+            protocol_client = ProtocolFactory.create_protocol('v2ray', server_config)
+            fetched_config = await protocol_client.get_user_config(
+                v2ray_uuid,
+                {
+                    'domain': domain,
+                    'port': 443,
+                    'email': f"user_{user_id}@veilbot.com",
+                },
+            )
+
+            # Извлекаем VLESS URL из конфигурации и нормализуем
+            config = None
+            if 'vless://' in fetched_config:
+                lines = fetched_config.split('\n')
+                for line in lines:
+                    if line.strip().startswith('vless://'):
+                        config = normalize_vless_host(
+                            line.strip(),
+                            domain,
+                            api_url or ''
+                        )
+                        break
+                else:
+                    config = normalize_vless_host(
+                        fetched_config.strip(),
+                        domain,
+                        api_url or ''
+                    )
+            else:
+                config = fetched_config.strip()
+
+            # Удаляем фрагмент (email) из конфигурации, полученной из API
+            # V2Ray API может возвращать конфигурацию с email в фрагменте
+            return remove_fragment_from_vless(config) if config else None
+
+        except Exception as e:
+            logger.error(
+                f"Failed to get config for key {v2ray_uuid[:8]}...: {e}",
+                exc_info=True,
+            )
+            return None
+
     async def create_subscription(
         self,
         user_id: int,
@@ -908,13 +985,8 @@ class SubscriptionService:
                                 },
                             )
 
-                        # Извлекаем VLESS URL из конфигурации
-                        if client_config and 'vless://' in client_config:
-                            lines = client_config.split('\n')
-                            for line in lines:
-                                if line.strip().startswith('vless://'):
-                                    client_config = line.strip()
-                                    break
+                        # Ключ подписки хранится в канонической форме: строка vless:// без фрагмента
+                        client_config = canonical_vless_config(client_config)
 
                         # Сохранение V2Ray ключа в БД
                         with get_db_cursor(commit=True) as cursor:
@@ -923,8 +995,9 @@ class SubscriptionService:
                                 cursor.execute(
                                     """
                                     INSERT INTO v2ray_keys 
-                                    (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, subscription_id)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                    (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config,
+                                     subscription_id, panel_key_id)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                                     """,
                                     (
                                         server_id,
@@ -935,6 +1008,7 @@ class SubscriptionService:
                                         tariff_id,
                                         client_config,
                                         existing_id,
+                                        panel_key_id_from_user_data(user_data),
                                     ),
                                 )
                             finally:
@@ -1048,19 +1122,15 @@ class SubscriptionService:
                                 },
                             )
 
-                        # Извлекаем VLESS URL из конфигурации
-                        if client_config and 'vless://' in client_config:
-                            lines = client_config.split('\n')
-                            for line in lines:
-                                if line.strip().startswith('vless://'):
-                                    client_config = line.strip()
-                                    break
+                        # Ключ подписки хранится в канонической форме: строка vless:// без фрагмента
+                        client_config = canonical_vless_config(client_config)
 
                         # Сохранение ключа в БД (с retry при database is locked)
                         retry_db_operation(
                             lambda: _insert_v2ray_key_for_subscription(
                                 server_id, user_id, v2ray_uuid, key_email, now,
                                 tariff_id, client_config, subscription_id,
+                                panel_key_id_from_user_data(user_data),
                             ),
                             max_attempts=5,
                             initial_delay=0.15,
@@ -0,0 +1,217 @@
+"""
+Индекс существующих токенов подписок для /api/subscription/{token}.
+
+Эндпоинт публичный: сканеры и старые ссылки удалённых подписок присылают корректные по формату,
+но несуществующие токены, и каждый такой запрос стоил выборки из SQLite. Индекс держит в памяти
+множество 64-битных отпечатков всех subscription_token (≈10 байт полезных данных на токен
+против 36 символов строки) и отвечает «точно нет» без обращения к БД.
+
+Актуальность:
+- новые подписки (их создают и бот, и админка, и платёжный сервис) подтягиваются инкрементально
+  по id > последнего виденного — не чаще раза в VEILBOT_SUBSCRIPTION_TOKEN_REFRESH_INTERVAL
+  секунд (по умолчанию 1); id у subscriptions AUTOINCREMENT, поэтому пропусков нет. Промах
+  в пределах интервала решает БД: токен мог появиться после последней выборки;
+- удалённые подписки отсеиваются полной перестройкой раз в VEILBOT_SUBSCRIPTION_TOKEN_REBUILD_INTERVAL
+  секунд (по умолчанию 600), а до неё — mark_missing() после промаха в БД;
+- токены, которых нет в БД, дополнительно живут в отрицательном кэше
+  VEILBOT_SUBSCRIPTION_TOKEN_NEGATIVE_TTL секунд (по умолчанию 60).
+
+Пока индекс не загружен или загрузка не удалась, might_exist() отвечает True — решает БД.
+Отключается VEILBOT_SUBSCRIPTION_TOKEN_INDEX=0.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from app.infra.sqlite_utils import open_async_connection
+
+logger = logging.getLogger(__name__)
+
+_NEGATIVE_CACHE_MAX = 100_000
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def _fingerprint(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class SubscriptionTokenIndex:
+    """Множество отпечатков токенов подписок плюс отрицательный кэш."""
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        *,
+        refresh_interval_sec: Optional[float] = None,
+        rebuild_interval_sec: Optional[float] = None,
+        negative_ttl_sec: Optional[float] = None,
+        enabled: Optional[bool] = None,
+    ):
+        self.db_path = db_path
+        self.refresh_interval_sec = (
+            refresh_interval_sec if refresh_interval_sec is not None
+            else _env_float("VEILBOT_SUBSCRIPTION_TOKEN_REFRESH_INTERVAL", 1.0)
+        )
+        self.rebuild_interval_sec = (
+            rebuild_interval_sec if rebuild_interval_sec is not None
+            else _env_float("VEILBOT_SUBSCRIPTION_TOKEN_REBUILD_INTERVAL", 600)
+        )
+        self.negative_ttl_sec = (
+            negative_ttl_sec if negative_ttl_sec is not None
+            else _env_float("VEILBOT_SUBSCRIPTION_TOKEN_NEGATIVE_TTL", 60)
+        )
+        if enabled is None:
+            enabled = os.getenv("VEILBOT_SUBSCRIPTION_TOKEN_INDEX", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = enabled
+        self._tokens: Set[int] = set()
+        self._negative: Dict[int, float] = {}
+        self._loaded = False
+        self._busy = False
+        self._last_id = 0
+        self._next_refresh = 0.0
+        self._next_rebuild = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0, "rejected": 0, "negative_hits": 0, "deferred": 0, "refreshes": 0, "rebuilds": 0, "errors": 0,
+        }
+
+    async def might_exist(self, token: str) -> bool:
+        """False — токена точно нет (без запроса к БД для известных промахов); True — проверить в БД."""
+        if not self.enabled:
+            return True
+        fingerprint = _fingerprint(token)
+        now = time.monotonic()
+        with self._lock:
+            if self._loaded and fingerprint in self._tokens and now < self._next_rebuild:
+                self._stats["hits"] += 1
+                return True
+            expires = self._negative.get(fingerprint)
+            if expires is not None:
+                if expires > now:
+                    self._stats["negative_hits"] += 1
+                    return False
+                del self._negative[fingerprint]
+
+        if not await self._refresh(now):
+            # Индекс недоступен, его обновляет другой запрос или он обновлялся меньше
+            # refresh_interval назад (токен мог быть создан после выборки) — решает БД
+            with self._lock:
+                self._stats["deferred"] += 1
+            return True
+        with self._lock:
+            if fingerprint in self._tokens:
+                self._stats["hits"] += 1
+                return True
+            self._stats["rejected"] += 1
+            # Выборка свежая: токена нет в БД на момент запроса
+            self._remember_missing(fingerprint, now)
+        return False
+
+    async def warm(self) -> bool:
+        """Загрузить индекс заранее (прогрев после старта); False — индекс недоступен."""
+        if not self.enabled:
+            return False
+        refreshed = await self._refresh(time.monotonic())
+        with self._lock:
+            return refreshed or self._loaded
+
+    def add(self, token: str) -> None:
+        fingerprint = _fingerprint(token)
+        with self._lock:
+            self._tokens.add(fingerprint)
+            self._negative.pop(fingerprint, None)
+
+    def mark_missing(self, token: str) -> None:
+        """Токена нет в БД (подписка удалена) — убрать из индекса и запомнить промах."""
+        fingerprint = _fingerprint(token)
+        with self._lock:
+            self._tokens.discard(fingerprint)
+            self._remember_missing(fingerprint, time.monotonic())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, tokens=len(self._tokens), negative=len(self._negative), loaded=int(self._loaded))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._tokens = set()
+            self._negative.clear()
+            self._loaded = False
+            self._last_id = 0
+            self._next_refresh = 0.0
+            self._next_rebuild = 0.0
+
+    def _remember_missing(self, fingerprint: int, now: float) -> None:
+        if self.negative_ttl_sec <= 0:
+            return
+        if len(self._negative) >= _NEGATIVE_CACHE_MAX:
+            self._negative = {key: exp for key, exp in self._negative.items() if exp > now}
+            if len(self._negative) >= _NEGATIVE_CACHE_MAX:
+                self._negative.clear()
+        self._negative[fingerprint] = now + self.negative_ttl_sec
+
+    async def _refresh(self, now: float) -> bool:
+        """Подтянуть новые токены (или перестроить индекс).
+
+        True — выборка выполнена сейчас; False — индекс недоступен, его обновляет другой запрос
+        или он обновлялся меньше refresh_interval назад.
+        """
+        with self._lock:
+            rebuild = not self._loaded or now >= self._next_rebuild
+            if now < self._next_refresh:
+                if not self._loaded or not rebuild:
+                    # Пауза после ошибки загрузки или недавняя выборка
+                    return False
+            if self._busy:
+                return False
+            self._busy = True
+            last_id = 0 if rebuild else self._last_id
+        try:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
+                async with conn.execute(
+                    "SELECT id, subscription_token FROM subscriptions WHERE id > ? ORDER BY id",
+                    (last_id,),
+                ) as cursor:
+                    rows = await cursor.fetchall()
+        except Exception as e:
+            with self._lock:
+                self._busy = False
+                self._stats["errors"] += 1
+                self._next_refresh = now + max(self.refresh_interval_sec, 30.0)
+            logger.warning(f"[SUBSCRIPTION_TOKENS] Failed to refresh token index: {e}")
+            return False
+
+        fingerprints = {_fingerprint(token) for _, token in rows if token}
+        with self._lock:
+            if rebuild:
+                self._tokens = fingerprints
+                self._loaded = True
+                self._next_rebuild = now + self.rebuild_interval_sec
+                self._stats["rebuilds"] += 1
+            else:
+                self._tokens |= fingerprints
+                self._stats["refreshes"] += 1
+            for fingerprint in fingerprints:
+                self._negative.pop(fingerprint, None)
+            if rows:
+                self._last_id = max(self._last_id if not rebuild else 0, int(rows[-1][0]))
+            self._next_refresh = now + self.refresh_interval_sec
+            self._busy = False
+        if rebuild:
+            logger.info(f"[SUBSCRIPTION_TOKENS] Token index rebuilt: {len(fingerprints)} tokens")
+        return True
+
+
+# Global subscription token index instance
+subscription_tokens = SubscriptionTokenIndex()
@@ -1716,6 +1716,214 @@ def migrate_set_max_keys_v2ray_servers_24_25():
         conn.close()
 
 
+def migrate_add_panel_key_id_to_v2ray_keys():
+    """Добавление поля panel_key_id (числовой key_id панели) в v2ray_keys.
+
+    Позволяет запрашивать трафик/сброс по id без предварительного GET /keys/{uuid}.
+    Заполняется при создании ключа и лениво — монитором трафика.
+    """
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("ALTER TABLE v2ray_keys ADD COLUMN panel_key_id TEXT DEFAULT NULL")
+        conn.commit()
+        logging.info("Поле panel_key_id добавлено в v2ray_keys")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name: panel_key_id" in str(e):
+            logging.info("Поле panel_key_id уже существует в v2ray_keys")
+        else:
+            raise
+    finally:
+        conn.close()
+
+
+def migrate_create_panel_health_state_table():
+    """Создание таблицы снимков здоровья панелей V2Ray (circuit breaker, см. app.infra.panel_health)"""
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS panel_health_state (
+                panel TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                error_rate REAL,
+                latency_ewma_ms REAL,
+                consecutive_failures INTEGER,
+                last_error TEXT,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        conn.commit()
+        logging.info("Таблица panel_health_state создана/проверена")
+    except Exception as e:
+        logging.error(f"Ошибка создания таблицы panel_health_state: {e}")
+    finally:
+        conn.close()
+
+
+def migrate_create_panel_metrics_snapshots_table():
+    """Создание таблицы снимков метрик запросов к панелям V2Ray (см. app.infra.panel_metrics)"""
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS panel_metrics_snapshots (
+                process TEXT PRIMARY KEY,
+                snapshot TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        conn.commit()
+        logging.info("Таблица panel_metrics_snapshots создана/проверена")
+    except Exception as e:
+        logging.error(f"Ошибка создания таблицы panel_metrics_snapshots: {e}")
+    finally:
+        conn.close()
+
+
+def migrate_create_subscription_payloads_table():
+    """Создание таблицы материализованных ответов подписок (см. bot.services.subscription_payloads)"""
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS subscription_payloads (
+                subscription_id INTEGER PRIMARY KEY,
+                inputs_hash TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                built_at INTEGER NOT NULL
+            )
+        """)
+        conn.commit()
+        logging.info("Таблица subscription_payloads создана/проверена")
+    except Exception as e:
+        logging.error(f"Ошибка создания таблицы subscription_payloads: {e}")
+    finally:
+        conn.close()
+
+
+def migrate_create_cache_invalidations_table():
+    """Создание таблицы межпроцессной инвалидации кэшей (см. app.infra.cache_invalidation)"""
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                namespace TEXT NOT NULL,
+                key TEXT,
+                origin TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created_at ON cache_invalidations(created_at)"
+        )
+        conn.commit()
+        logging.info("Таблица cache_invalidations создана/проверена")
+    except Exception as e:
+        logging.error(f"Ошибка создания таблицы cache_invalidations: {e}")
+    finally:
+        conn.close()
+
+
+def migrate_canonicalize_subscription_vless_configs():
+    """Приведение client_config ключей подписок к канонической форме (строка vless:// без фрагмента).
+
+    Хост и название сервера подставляются при выдаче подписки (vpn_protocols.render_vless_link).
+    Выбираются только ещё не приведённые записи, повторный запуск ничего не меняет.
+    """
+    from vpn_protocols import canonical_vless_config
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT id, client_config FROM v2ray_keys
+            WHERE subscription_id IS NOT NULL
+              AND client_config LIKE '%vless://%'
+              AND (
+                client_config NOT LIKE 'vless://%'
+                OR instr(client_config, '#') > 0
+                OR instr(client_config, char(10)) > 0
+                OR instr(client_config, char(13)) > 0
+                OR client_config != trim(client_config)
+              )
+        """)
+        updates = []
+        for key_id, client_config in cursor.fetchall():
+            canonical = canonical_vless_config(client_config)
+            if canonical and canonical != client_config:
+                updates.append((canonical, key_id))
+        if updates:
+            cursor.executemany("UPDATE v2ray_keys SET client_config = ? WHERE id = ?", updates)
+            conn.commit()
+            logging.info(f"client_config ключей подписок приведены к канонической форме: {len(updates)}")
+    except Exception as e:
+        logging.error(f"Ошибка приведения client_config ключей подписок: {e}")
+    finally:
+        conn.close()
+
+
+def migrate_add_composite_indexes():
+    """Составные индексы под горячие запросы репозиториев и фоновых задач.
+
+    Набор подобран по EXPLAIN QUERY PLAN (tests/test_query_plans.py): каждый индекс убирает
+    полный проход или сортировку во временном B-дереве у конкретных запросов.
+    """
+    indexes = (
+        # Ключи сервера по подписке (удаление сервера, досоздание ключей подписки)
+        "CREATE INDEX IF NOT EXISTS idx_v2ray_keys_server_subscription ON v2ray_keys(server_id, subscription_id)",
+        # Ключи подписки с лимитом трафика
+        "CREATE INDEX IF NOT EXISTS idx_v2ray_keys_subscription_traffic_limit ON v2ray_keys(subscription_id, traffic_limit_mb)",
+        # Активные подписки по сроку (истечение, уведомления, мониторинг трафика)
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_active_expires ON subscriptions(is_active, expires_at)",
+        # Активная подписка пользователя
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active_expires ON subscriptions(user_id, is_active, expires_at)",
+        # Подписки без уведомления о покупке
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_purchase_notification ON subscriptions(purchase_notification_sent, is_active)",
+        # Оплаченные платежи подписки по времени (пересчёт срока, продления)
+        "CREATE INDEX IF NOT EXISTS idx_payments_subscription_status_created ON payments(subscription_id, status, created_at)",
+        # Платежи по статусу и времени (фолбэк выдачи ключей, админка)
+        "CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments(status, created_at)",
+        # История платежей пользователя
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(user_id, created_at)",
+        # Список рефералов пользователя
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referrer_created ON referrals(referrer_id, created_at DESC, referred_id)",
+    )
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        for ddl in indexes:
+            cursor.execute(ddl)
+        conn.commit()
+        logging.info("Составные индексы созданы")
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Ошибка при создании составных индексов: {e}")
+    finally:
+        conn.close()
+
+
+def migrate_create_search_index():
+    """FTS5-индекс поиска админки (app/infra/search_index.py): таблица, триггеры, первичное заполнение."""
+    from app.infra.search_index import create_search_index
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        if create_search_index(conn):
+            logging.info("Индекс поиска search_index создан и заполнен")
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        # Без FTS5 (trigram) админка ищет прежним LIKE
+        logging.warning(f"Индекс поиска search_index не создан: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
 def migrate_remove_outline_support():
     """Удаление legacy Outline: очистка данных и таблицы keys, нормализация protocol."""
     conn = sqlite3.connect(DATABASE_PATH)
@@ -1798,6 +2006,14 @@ def _run_all_migrations():
     migrate_subscription_level_traffic_accounting()
     migrate_set_max_keys_v2ray_servers_24_25()
     migrate_remove_outline_support()
+    migrate_add_panel_key_id_to_v2ray_keys()
+    migrate_create_panel_health_state_table()
+    migrate_create_panel_metrics_snapshots_table()
+    migrate_create_subscription_payloads_table()
+    migrate_create_cache_invalidations_table()
+    migrate_canonicalize_subscription_vless_configs()
+    migrate_add_composite_indexes()
+    migrate_create_search_index()
 
 # Выполняем миграции после определения всех функций
 # Это нужно для того, чтобы init_db() могла вызывать миграции
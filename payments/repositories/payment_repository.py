@@ -397,7 +397,7 @@ class PaymentRepository:
     async def get_by_id(self, payment_id: int) -> Optional[Payment]:
         """Получение платежа по ID"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT * FROM payments WHERE id = ?", 
                     (payment_id,)
@@ -414,7 +414,7 @@ class PaymentRepository:
     async def get_by_payment_id(self, payment_id: str) -> Optional[Payment]:
         """Получение платежа по payment_id"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT * FROM payments WHERE payment_id = ?", 
                     (payment_id,)
@@ -750,7 +750,7 @@ class PaymentRepository:
     async def list(self, limit: int = 100, offset: int = 0) -> List[Payment]:
         """Получение списка платежей"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT * FROM payments ORDER BY created_at DESC LIMIT ? OFFSET ?",
                     (limit, offset)
@@ -780,7 +780,7 @@ class PaymentRepository:
 
             params.extend([filter_obj.limit, filter_obj.offset])
             
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     f"SELECT * FROM payments WHERE {where_clause} ORDER BY {order_col} {order_dir} LIMIT ? OFFSET ?",
                     params
@@ -797,7 +797,7 @@ class PaymentRepository:
         try:
             where_clause, params = self._build_filter_conditions(filter_obj)
 
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     f"SELECT COUNT(*) FROM payments WHERE {where_clause}",
                     params,
@@ -811,7 +811,7 @@ class PaymentRepository:
     async def get_user_payments(self, user_id: int, limit: int = 100) -> List[Payment]:
         """Получение платежей пользователя"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT * FROM payments WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
                     (user_id, limit)
@@ -826,7 +826,7 @@ class PaymentRepository:
     async def get_pending_payments(self) -> List[Payment]:
         """Получение ожидающих платежей"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT * FROM payments WHERE status = 'pending' ORDER BY created_at ASC"
                 ) as cursor:
@@ -841,7 +841,7 @@ class PaymentRepository:
         """Получение оплаченных платежей без ключей (исключая закрытые платежи)"""
         try:
             now_ts = int(datetime.now(timezone.utc).timestamp())
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 # Запрос теперь исключает:
                 # 1. Для платежей подписки: НЕ исключаем по наличию активной подписки (нужно продлевать)
                 # 2. Для обычных платежей: исключаем если есть активные ключи или подписки
@@ -858,7 +858,7 @@ class PaymentRepository:
                              SELECT k.user_id FROM v2ray_keys k
                              JOIN subscriptions s ON k.subscription_id = s.id
                              WHERE s.expires_at > ?
-                             UNION
+                             UNION ALL
                              SELECT user_id FROM subscriptions WHERE expires_at > ? AND is_active = 1
                          ))
                     )
@@ -874,7 +874,7 @@ class PaymentRepository:
     async def count(self) -> int:
         """Получение количества платежей"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute("SELECT COUNT(*) FROM payments") as cursor:
                     row = await cursor.fetchone()
                     return row[0] if row else 0
@@ -886,7 +886,7 @@ class PaymentRepository:
     async def exists(self, payment_id: str) -> bool:
         """Проверка существования платежа"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT 1 FROM payments WHERE payment_id = ?", 
                     (payment_id,)
@@ -901,7 +901,7 @@ class PaymentRepository:
     async def get_statistics(self) -> Dict[str, Any]:
         """Получение статистики по платежам"""
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 # Общее количество платежей
                 async with conn.execute("SELECT COUNT(*) FROM payments") as cursor:
                     total_count = (await cursor.fetchone())[0] or 0
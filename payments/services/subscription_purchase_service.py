@@ -14,9 +14,10 @@ from ..repositories.payment_repository import PaymentRepository
 from app.repositories.subscription_repository import SubscriptionRepository
 from app.repositories.tariff_repository import TariffRepository
 from app.repositories.user_repository import UserRepository
+from app.infra.panel_health import panel_health
 from app.infra.sqlite_utils import open_async_connection, open_connection
 from app.settings import settings as app_settings
-from vpn_protocols import ProtocolFactory, format_duration
+from vpn_protocols import ProtocolFactory, canonical_vless_config, format_duration, panel_key_id_from_user_data
 from bot.core import get_bot_instance
 from bot.utils import safe_send_message
 from bot.keyboards import get_main_menu
@@ -34,14 +35,18 @@ logger = logging.getLogger(__name__)
 
 
 class ServerClientPool:
-    """Упрощенный пул клиентов для переиспользования соединений к серверам"""
+    """Пул клиентов по server_id поверх общего реестра клиентов панелей.
+
+    Клиенты берутся из ProtocolFactory (реестр v2ray_clients), поэтому соединения
+    к панелям переиспользуются и между покупками, а не только внутри одной.
+    """
     
     def __init__(self):
         self._clients: Dict[int, Any] = {}
     
     async def get_client(self, server_id: int, protocol: str, api_url: str, api_key: Optional[str] = None, 
                         domain: Optional[str] = None, cert_sha256: Optional[str] = None) -> Optional[Any]:
-        """Получить или создать клиент для сервера"""
+        """Получить клиент для сервера из общего реестра"""
         if server_id not in self._clients:
             try:
                 if protocol == "v2ray":
@@ -60,7 +65,7 @@ class ServerClientPool:
         return self._clients.get(server_id)
     
     async def close_all(self):
-        """Закрыть все клиенты"""
+        """Освободить клиенты (общие клиенты реестра не закрывают пул соединений)"""
         for server_id, client in self._clients.items():
             try:
                 if hasattr(client, 'close'):
@@ -445,7 +450,7 @@ class SubscriptionPurchaseService:
                 subscription_id_retry = payment.subscription_id
                 
                 # Проверяем, есть ли ключи для этой подписки
-                async with open_async_connection(self.db_path) as conn:
+                async with open_async_connection(self.db_path, readonly=True) as conn:
                     async with conn.execute(
                         "SELECT COUNT(*) FROM v2ray_keys WHERE subscription_id = ?",
                         (subscription_id_retry,),
@@ -602,7 +607,7 @@ class SubscriptionPurchaseService:
             
             # Получаем все completed платежи для подписки (включая текущий)
             # Используем PaymentRepository для получения платежей
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT * FROM payments
@@ -780,7 +785,7 @@ class SubscriptionPurchaseService:
             # Ключи уже должны быть созданы в _get_or_create_subscription при was_created = True
             # Но на всякий случай проверяем, есть ли ключи, и создаем их, если их нет
             # (защита от race condition или если была ошибка при создании)
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT COUNT(*) FROM v2ray_keys WHERE subscription_id = ?",
                     (subscription_id,),
@@ -913,20 +918,21 @@ class SubscriptionPurchaseService:
                 ) as update_cursor:
                     await conn.commit()
                     notification_already_sent = update_cursor.rowcount == 0
-                
-                if notification_already_sent:
-                    # Уведомление уже отправлено другим процессом
-                    logger.info(f"[SUBSCRIPTION] Purchase notification already sent for subscription {subscription_id} by another process, skipping")
-                    # Помечаем платеж как completed
-                    await self._mark_payment_completed(payment)
-                    await self._send_admin_purchase_notification(
-                        payment,
-                        subscription_id,
-                        tariff,
-                        existing_subscription[4],
-                        is_new=True
-                    )
-                    return True, None
+            
+            # Соединение отпущено до запросов к Telegram: они не держат пишущее соединение пула
+            if notification_already_sent:
+                # Уведомление уже отправлено другим процессом
+                logger.info(f"[SUBSCRIPTION] Purchase notification already sent for subscription {subscription_id} by another process, skipping")
+                # Помечаем платеж как completed
+                await self._mark_payment_completed(payment)
+                await self._send_admin_purchase_notification(
+                    payment,
+                    subscription_id,
+                    tariff,
+                    existing_subscription[4],
+                    is_new=True
+                )
+                return True, None
             
             # Шаг 1.5: Обновляем лимит трафика подписки из тарифа
             # ВАЖНО: Это нужно делать всегда, даже если уведомление уже отправлено
@@ -1007,7 +1013,7 @@ class SubscriptionPurchaseService:
             # Используем grace_period для определения активной подписки
             grace_threshold = grace_threshold_ts(now, DEFAULT_GRACE_PERIOD)
             
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT id, user_id, subscription_token, created_at, expires_at, tariff_id, is_active, last_updated_at, notified
@@ -1042,7 +1048,7 @@ class SubscriptionPurchaseService:
                 )
                 
                 # Проверяем, было ли отправлено уведомление
-                async with open_async_connection(self.db_path) as conn:
+                async with open_async_connection(self.db_path, readonly=True) as conn:
                     async with conn.execute(
                         "SELECT purchase_notification_sent FROM subscriptions WHERE id = ?",
                         (subscription_id,)
@@ -1241,20 +1247,21 @@ class SubscriptionPurchaseService:
                 ) as update_cursor:
                     await conn.commit()
                     notification_already_sent = update_cursor.rowcount == 0
-                
-                if notification_already_sent:
-                    # Уведомление уже отправлено другим процессом
-                    logger.info(f"[SUBSCRIPTION] Purchase notification already sent for subscription {subscription_id} by another process, skipping")
-                    # Помечаем платеж как completed
-                    await self._mark_payment_completed(payment)
-                    await self._send_admin_purchase_notification(
-                        payment,
-                        subscription_id,
-                        tariff,
-                        expires_at,
-                        is_new=True
-                    )
-                    return True, None
+            
+            # Соединение отпущено до запросов к Telegram: они не держат пишущее соединение пула
+            if notification_already_sent:
+                # Уведомление уже отправлено другим процессом
+                logger.info(f"[SUBSCRIPTION] Purchase notification already sent for subscription {subscription_id} by another process, skipping")
+                # Помечаем платеж как completed
+                await self._mark_payment_completed(payment)
+                await self._send_admin_purchase_notification(
+                    payment,
+                    subscription_id,
+                    tariff,
+                    expires_at,
+                    is_new=True
+                )
+                return True, None
             
             # Шаг 5: МОМЕНТАЛЬНО отправляем уведомление о покупке (как в ключах)
             # Флаг purchase_notification_sent уже установлен атомарно выше
@@ -1491,7 +1498,7 @@ class SubscriptionPurchaseService:
             bool: True если это покупка (1 completed платеж), False если продление (>1 completed платежей)
         """
         try:
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT COUNT(*) FROM payments
@@ -1527,7 +1534,7 @@ class SubscriptionPurchaseService:
         """
         try:
             # Проверка 1: Есть ли ключи у подписки?
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT COUNT(*) FROM v2ray_keys WHERE subscription_id = ?",
                     (subscription_id,),
@@ -1549,7 +1556,7 @@ class SubscriptionPurchaseService:
             
             # Проверка 3: Отправлено ли уведомление?
             sub_expires_at: int | None = None
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT purchase_notification_sent, expires_at FROM subscriptions WHERE id = ?
@@ -1758,7 +1765,7 @@ class SubscriptionPurchaseService:
         grace_threshold = grace_threshold_ts(now, DEFAULT_GRACE_PERIOD)
         
         # Проверяем наличие активной подписки
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT id, user_id, subscription_token, created_at, expires_at, tariff_id, is_active, last_updated_at, notified
@@ -1846,7 +1853,7 @@ class SubscriptionPurchaseService:
                 raise e
         
         # Получаем созданную подписку
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 """
                 SELECT id, user_id, subscription_token, created_at, expires_at, tariff_id, is_active, last_updated_at, notified
@@ -1933,22 +1940,19 @@ class SubscriptionPurchaseService:
                 v2ray_uuid = user_data['uuid']
                 
                 # Получение client_config
-                client_config = await protocol_client.get_user_config(
-                    v2ray_uuid,
-                    {
-                        'domain': domain,
-                        'port': 443,
-                        'email': key_email,
-                    },
-                )
+                client_config = user_data.get('client_config')
+                if not client_config:
+                    client_config = await protocol_client.get_user_config(
+                        v2ray_uuid,
+                        {
+                            'domain': domain,
+                            'port': 443,
+                            'email': key_email,
+                        },
+                    )
                 
-                # Извлекаем VLESS URL из конфигурации
-                if 'vless://' in client_config:
-                    lines = client_config.split('\n')
-                    for line in lines:
-                        if line.strip().startswith('vless://'):
-                            client_config = line.strip()
-                            break
+                # Ключ подписки хранится в канонической форме: строка vless:// без фрагмента
+                client_config = canonical_vless_config(client_config)
                 
                 # Сохранение V2Ray ключа в БД с защитой от race condition
                 async with open_async_connection(self.db_path) as conn:
@@ -1964,53 +1968,59 @@ class SubscriptionPurchaseService:
                             LIMIT 1
                             """
                         , (server_id, subscription_id)) as check_cursor:
-                            if await check_cursor.fetchone():
-                                logger.warning(
-                                    f"[SUBSCRIPTION] Key for subscription {subscription_id} on server {server_id} "
-                                    f"already exists (race condition), deleting duplicate from server"
-                                )
-                                # Удаляем дубликат с сервера
-                                if protocol_client:
-                                    try:
-                                        await protocol_client.delete_user(v2ray_uuid)
-                                    except Exception as e:
-                                        logger.warning(f"[SUBSCRIPTION] Failed to delete duplicate key from server: {e}")
-                                await conn.commit()
-                                return True, None  # Ключ уже существует, считаем успехом
+                            duplicate = await check_cursor.fetchone() is not None
                         
-                        # Вставляем ключ только если его еще нет
-                        await conn.execute(
-                            """
-                            INSERT INTO v2ray_keys 
-                            (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config, subscription_id)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            (
-                                server_id,
-                                user_id,
-                                v2ray_uuid,
-                                key_email,
-                                now,
-                                tariff['id'],
-                                client_config,
-                                subscription_id,
-                            ),
-                        )
-                        await conn.commit()
+                        if duplicate:
+                            await conn.commit()
+                        else:
+                            # Вставляем ключ только если его еще нет
+                            await conn.execute(
+                                """
+                                INSERT INTO v2ray_keys 
+                                (server_id, user_id, v2ray_uuid, email, created_at, tariff_id, client_config,
+                                 subscription_id, panel_key_id)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                """,
+                                (
+                                    server_id,
+                                    user_id,
+                                    v2ray_uuid,
+                                    key_email,
+                                    now,
+                                    tariff['id'],
+                                    client_config,
+                                    subscription_id,
+                                    panel_key_id_from_user_data(user_data),
+                                ),
+                            )
+                            await conn.commit()
                         
-                        # Проверяем, что ключ действительно сохранен
-                        async with conn.execute(
-                            "SELECT id FROM v2ray_keys WHERE server_id = ? AND user_id = ? AND subscription_id = ? AND v2ray_uuid = ?",
-                            (server_id, user_id, subscription_id, v2ray_uuid)
-                        ) as verify_cursor:
-                            if not await verify_cursor.fetchone():
-                                raise Exception(f"Key was not saved to database for server {server_id}")
+                            # Проверяем, что ключ действительно сохранен
+                            async with conn.execute(
+                                "SELECT id FROM v2ray_keys WHERE server_id = ? AND user_id = ? AND subscription_id = ? AND v2ray_uuid = ?",
+                                (server_id, user_id, subscription_id, v2ray_uuid)
+                            ) as verify_cursor:
+                                if not await verify_cursor.fetchone():
+                                    raise Exception(f"Key was not saved to database for server {server_id}")
                     except Exception as db_error:
                         await conn.rollback()
                         raise db_error
                     finally:
                         await conn.execute("PRAGMA foreign_keys = ON")
                 
+                if duplicate:
+                    # Соединение-писатель уже отпущено: запрос к панели не держит его
+                    logger.warning(
+                        f"[SUBSCRIPTION] Key for subscription {subscription_id} on server {server_id} "
+                        f"already exists (race condition), deleting duplicate from server"
+                    )
+                    if protocol_client:
+                        try:
+                            await protocol_client.delete_user(v2ray_uuid)
+                        except Exception as e:
+                            logger.warning(f"[SUBSCRIPTION] Failed to delete duplicate key from server: {e}")
+                    return True, None  # Ключ уже существует, считаем успехом
+                
                 if attempt > 1:
                     logger.info(
                         f"[SUBSCRIPTION] Successfully created v2ray key for subscription {subscription_id} "
@@ -2042,7 +2052,8 @@ class SubscriptionPurchaseService:
                         f"on server {server_id} ({server_name}), attempt {attempt}/{max_retries}. "
                         f"Retrying in {retry_delay}s..."
                     )
-                    # При retry закрываем клиент (даже из пула), чтобы создать новый
+                    # При retry сбрасываем клиент; для общих клиентов реестра close() не трогает
+                    # пул соединений — оборванное по таймауту соединение коннектор отбросит сам
                     if protocol_client:
                         try:
                             await protocol_client.close()
@@ -2104,9 +2115,10 @@ class SubscriptionPurchaseService:
             created_keys_count: Количество успешно созданных ключей
             failed_servers_list: Список ID серверов, на которых не удалось создать ключи
         """
+        failed_servers: List[int] = []
         try:
             # Получаем все V2Ray серверы: access_level, max_keys, subscription_group_id (группы дедупликации)
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT id, name, api_url, api_key, domain, v2ray_path, protocol, cert_sha256,
@@ -2126,7 +2138,7 @@ class SubscriptionPurchaseService:
             
             # Платный статус: подписка с тарифом price_rub > 0; для subscription_id учитываем
             # граничный случай expires_at (OR id = subscription_id), как раньше.
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT COUNT(*) FROM subscriptions s
@@ -2143,14 +2155,24 @@ class SubscriptionPurchaseService:
                 is_vip=is_vip,
                 has_active_paid_subscription=has_active_paid_subscription,
             )
+
+            # Серверы с открытым breaker'ом панели не ждём: в группе выбирается другой сервер,
+            # недостающие ключи досоздаст sync_subscription_keys_with_active_servers
+            unavailable_servers = [row[0] for row in filtered_rows if not panel_health.is_available(row[2])]
+            if unavailable_servers:
+                logger.warning(
+                    f"[SUBSCRIPTION] Skipping servers with open panel circuit for subscription "
+                    f"{subscription_id}: {unavailable_servers}"
+                )
+            available_rows = [row for row in filtered_rows if row[0] not in unavailable_servers]
             
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     "SELECT server_id, COUNT(*) FROM v2ray_keys GROUP BY server_id"
                 ) as cursor:
                     key_counts = {row[0]: row[1] for row in await cursor.fetchall()}
             
-            async with open_async_connection(self.db_path) as conn:
+            async with open_async_connection(self.db_path, readonly=True) as conn:
                 async with conn.execute(
                     """
                     SELECT k.server_id, COALESCE(NULLIF(TRIM(s.subscription_group_id), ''), '') as gid
@@ -2162,15 +2184,35 @@ class SubscriptionPurchaseService:
                 ) as cursor:
                     existing_key_rows = await cursor.fetchall()
             
+            apply_group_dedup = subscription_group_dedup_applies(is_vip=is_vip)
             v2ray_servers = compute_targets_purchase_sql_rows(
-                filtered_rows,
+                available_rows,
                 existing_key_rows=existing_key_rows,
                 key_counts=key_counts,
-                apply_group_dedup=subscription_group_dedup_applies(is_vip=is_vip),
+                apply_group_dedup=apply_group_dedup,
             )
             
             created_keys = 0
-            failed_servers = []
+            if unavailable_servers:
+                # Неудача — только группа (или сервер вне групп), которой ключ был нужен, но без
+                # серверов с закрытым breaker'ом не достался; сервер, заменённый другим сервером группы, — нет
+                server_groups = {row[0]: (row[10] or "").strip() for row in filtered_rows}
+
+                def target_unit(server_id: int) -> Tuple[str, Any]:
+                    gid = server_groups.get(server_id, "")
+                    return ("group", gid) if apply_group_dedup and gid else ("server", server_id)
+
+                covered_units = {target_unit(target[0]) for target in v2ray_servers}
+                failed_servers = [
+                    target[0]
+                    for target in compute_targets_purchase_sql_rows(
+                        filtered_rows,
+                        existing_key_rows=existing_key_rows,
+                        key_counts=key_counts,
+                        apply_group_dedup=apply_group_dedup,
+                    )
+                    if target_unit(target[0]) not in covered_units
+                ]
             
             # ОПТИМИЗАЦИЯ: Создаем пул клиентов для переиспользования соединений
             client_pool = ServerClientPool()
@@ -2288,7 +2330,7 @@ class SubscriptionPurchaseService:
         Если текущий лимит больше лимита тарифа, это может быть реферальный бонус - сохраняем его.
         """
         # Получаем текущий лимит подписки
-        async with open_async_connection(self.db_path) as conn:
+        async with open_async_connection(self.db_path, readonly=True) as conn:
             async with conn.execute(
                 "SELECT traffic_limit_mb FROM subscriptions WHERE id = ?",
                 (subscription_id,)
@@ -48,7 +48,7 @@ sys.path.insert(0, _root_dir)
 
 from app.infra.sqlite_utils import open_connection
 from app.settings import settings
-from vpn_protocols import ProtocolFactory
+from vpn_protocols import ProtocolFactory, close_v2ray_clients
 
 
 logger = logging.getLogger("audit_traffic_reset")
@@ -79,6 +79,7 @@ class ProbeKey:
     subscription_id: Optional[int]
     is_active: Optional[int]
     traffic_usage_bytes: int
+    panel_key_id: Optional[str] = None
 
 
 @dataclass
@@ -148,7 +149,8 @@ def _pick_probe_key(db_path: str, server_id: int) -> Optional[ProbeKey]:
                    k.v2ray_uuid,
                    k.subscription_id,
                    COALESCE(s.is_active, 1) AS is_active,
-                   COALESCE(k.traffic_usage_bytes, 0) AS usage_bytes
+                   COALESCE(k.traffic_usage_bytes, 0) AS usage_bytes,
+                   k.panel_key_id
             FROM v2ray_keys k
             LEFT JOIN subscriptions s ON s.id = k.subscription_id
             WHERE k.server_id = ?
@@ -170,6 +172,7 @@ def _pick_probe_key(db_path: str, server_id: int) -> Optional[ProbeKey]:
         subscription_id=int(row[2]) if row[2] is not None else None,
         is_active=int(row[3]) if row[3] is not None else None,
         traffic_usage_bytes=int(row[4] or 0),
+        panel_key_id=str(row[5]) if row[5] else None,
     )
 
 
@@ -203,7 +206,9 @@ async def _audit_server(
     verdict: str
     api_id_str: Optional[str] = None
     try:
-        api_id, stats_before = await protocol.get_v2ray_key_traffic_resolved(probe.v2ray_uuid)
+        api_id, stats_before = await protocol.get_v2ray_key_traffic_resolved(
+            probe.v2ray_uuid, panel_key_id=probe.panel_key_id
+        )
         if api_id is None or not stats_before:
             return ServerAuditResult(
                 server=srv,
@@ -428,7 +433,13 @@ def main() -> None:
         format="%(asctime)s %(levelname)s %(name)s: %(message)s",
     )
 
-    rc = asyncio.run(_run(args))
+    async def _run_and_close() -> int:
+        try:
+            return await _run(args)
+        finally:
+            await close_v2ray_clients()
+
+    rc = asyncio.run(_run_and_close())
     sys.exit(rc)
 
 
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+"""Бенчмарк публичного эндпоинта /api/subscription/{token}.
+
+Строит временную SQLite-базу с N пользователями/подписками и ключами на M серверах (серверы —
+фейковые панели scripts/fake_v2ray_panel.py в том же процессе), поднимает FastAPI-приложение
+админки in-process через httpx.ASGITransport и прогоняет сценарии обновления подписок:
+
+- steady — равномерный поток `--rate` запросов/с в течение `--duration` секунд, популярность
+  токенов по Ципфу, доля клиентов с If-None-Match (`--conditional-share`);
+- storm — «деплой»: холодные кэши процесса, пустая subscription_payloads, каждый токен
+  запрашивается `--storm-repeat` раз при параллелизме `--concurrency`;
+- flood — поток несуществующих токенов (`--flood-requests`) с примесью настоящих.
+
+По каждому сценарию: RPS, p50/p95/p99/max задержки, среднее время в SQLite (вызовы aiosqlite,
+замер в потоке соединения) и остальное «время Python» (включая ожидание панелей), задержка event
+loop. Результат дописывается JSON-строкой в `--results` (коммит, параметры, метрики) и сравнивается
+с последним прогоном с теми же параметрами (или `--baseline <commit|label>`).
+
+Примеры:
+    python scripts/bench_subscription_endpoint.py
+    python scripts/bench_subscription_endpoint.py --users 2000 --servers 10 --rate 300 --label before-fix
+    python scripts/bench_subscription_endpoint.py --scenarios storm --missing-config-share 0.2 --panel-latency lognormal:40:0.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid as uuid_lib
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+_root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root_dir)
+
+logger = logging.getLogger("bench_subscription_endpoint")
+
+SCENARIOS = ("steady", "storm", "flood")
+DEFAULT_RESULTS_PATH = os.path.join(_root_dir, "bench_results", "subscription_endpoint.jsonl")
+
+# Время SQLite текущего запроса: список длительностей вызовов aiosqlite (секунды)
+_db_samples: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar("bench_db_samples", default=None)
+
+
+@dataclass
+class BenchConfig:
+    """Параметры набора данных и сценариев."""
+
+    users: int = 200
+    servers: int = 5
+    keys_per_subscription: int = 0  # 0 — ключ на каждом сервере
+    missing_config_share: float = 0.0
+    vip_share: float = 0.05
+    panel_latency: str = "fixed:0"
+    rate: float = 100.0
+    duration: float = 5.0
+    conditional_share: float = 0.5
+    zipf_exponent: float = 1.0
+    storm_repeat: int = 2
+    concurrency: int = 50
+    flood_requests: int = 1000
+    flood_valid_share: float = 0.1
+    seed: int = 1
+
+
+class DbTimer:
+    """Подмена aiosqlite.Connection._execute: время каждого вызова в потоке соединения
+    записывается в _db_samples запроса, в рамках которого он сделан."""
+
+    def __init__(self) -> None:
+        self._original = None
+
+    def install(self) -> None:
+        import aiosqlite.core
+
+        if self._original is not None:
+            return
+        original = aiosqlite.core.Connection._execute
+
+        async def _execute(conn, fn, *args, **kwargs):
+            samples = _db_samples.get()
+            if samples is None:
+                return await original(conn, fn, *args, **kwargs)
+
+            def timed():
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - started)
+
+            return await original(conn, timed)
+
+        self._original = original
+        aiosqlite.core.Connection._execute = _execute
+
+    def uninstall(self) -> None:
+        import aiosqlite.core
+
+        if self._original is not None:
+            aiosqlite.core.Connection._execute = self._original
+            self._original = None
+
+
+class LoopLagProbe:
+    """Фоновая задача: насколько позже запрошенного просыпается sleep(interval)."""
+
+    def __init__(self, interval_sec: float = 0.001) -> None:
+        self.interval_sec = interval_sec
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.samples = []
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> List[float]:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        return self.samples
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval_sec)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval_sec) * 1000)
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(samples: List[Dict[str, Any]], elapsed_sec: float, loop_lag_ms: Sequence[float]) -> Dict[str, Any]:
+    """Сводка по сценарию: samples — {latency_ms, db_ms, status}."""
+    latencies = [s["latency_ms"] for s in samples]
+    db_times = [s["db_ms"] for s in samples]
+    statuses: Dict[str, int] = {}
+    for sample in samples:
+        statuses[str(sample["status"])] = statuses.get(str(sample["status"]), 0) + 1
+    count = len(samples)
+    total_latency = sum(latencies)
+    total_db = sum(db_times)
+    return {
+        "requests": count,
+        "elapsed_sec": round(elapsed_sec, 3),
+        "rps": round(count / elapsed_sec, 1) if elapsed_sec > 0 else 0.0,
+        "statuses": statuses,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies), 2) if latencies else 0.0,
+        "db_ms_mean": round(total_db / count, 3) if count else 0.0,
+        "python_ms_mean": round((total_latency - total_db) / count, 3) if count else 0.0,
+        "db_share": round(total_db / total_latency, 3) if total_latency > 0 else 0.0,
+        "loop_lag_p99_ms": round(percentile(loop_lag_ms, 99), 2),
+        "loop_lag_max_ms": round(max(loop_lag_ms), 2) if loop_lag_ms else 0.0,
+    }
+
+
+def seed_database(db_path: str, config: BenchConfig, panels: List[Dict[str, Any]]) -> List[str]:
+    """Создать схему миграциями и заполнить её; вернуть токены подписок."""
+    import db
+
+    previous = db.DATABASE_PATH
+    db.DATABASE_PATH = db_path
+    try:
+        db.init_db_with_migrations()
+    finally:
+        db.DATABASE_PATH = previous
+
+    rng = random.Random(config.seed)
+    now = int(time.time())
+    per_subscription = config.keys_per_subscription or len(panels)
+    tokens: List[str] = []
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            "INSERT INTO tariffs (id, name, duration_sec, traffic_limit_mb, price_rub) VALUES (1, 'Месяц', 2592000, 102400, 299)"
+        )
+        for index, panel in enumerate(panels, start=1):
+            conn.execute(
+                "INSERT INTO servers (id, name, api_url, api_key, domain, country, protocol, active) "
+                "VALUES (?, ?, ?, ?, '127.0.0.1', 'NL', 'v2ray', 1)",
+                (index, f"Bench-{index}", panel["api_url"], panel["api_key"] or ""),
+            )
+        for user_id in range(1, config.users + 1):
+            token = str(uuid_lib.UUID(int=rng.getrandbits(128), version=4))
+            tokens.append(token)
+            conn.execute(
+                "INSERT INTO users (user_id, created_at, is_vip) VALUES (?, ?, ?)",
+                (user_id, now, int(rng.random() < config.vip_share)),
+            )
+            conn.execute(
+                "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, tariff_id, "
+                "is_active, traffic_usage_bytes) VALUES (?, ?, ?, ?, ?, 1, 1, ?)",
+                (user_id, user_id, token, now - 86400, now + 30 * 86400, rng.randrange(0, 10 * 1024 ** 3)),
+            )
+            for server_index in rng.sample(range(len(panels)), min(per_subscription, len(panels))):
+                panel_state = panels[server_index]["app"]["state"]
+                key = panel_state.create_key(f"user-{user_id}")
+                client_config = None
+                if rng.random() >= config.missing_config_share:
+                    client_config = panel_state.vless_link(key, "127.0.0.1").split("#", 1)[0]
+                conn.execute(
+                    "INSERT INTO v2ray_keys (server_id, user_id, v2ray_uuid, email, created_at, subscription_id, "
+                    "client_config, panel_key_id, panel_total_bytes_observed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        server_index + 1, user_id, key["uuid"], f"user-{user_id}@bench", now, user_id,
+                        client_config, key["key_id"], rng.randrange(0, 1024 ** 3),
+                    ),
+                )
+        conn.commit()
+    finally:
+        conn.close()
+    return tokens
+
+
+class _Runner:
+    """Запросы к приложению с замером задержки и времени SQLite."""
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self.etags: Dict[str, str] = {}
+
+    async def request(self, token: str, samples: List[Dict[str, Any]], conditional: bool = False) -> None:
+        headers = {}
+        if conditional and token in self.etags:
+            headers["If-None-Match"] = self.etags[token]
+        db_samples: List[float] = []
+        marker = _db_samples.set(db_samples)
+        started = time.perf_counter()
+        try:
+            response = await self.client.get(f"/api/subscription/{token}", headers=headers)
+            status = response.status_code
+            etag = response.headers.get("etag")
+            if etag:
+                self.etags[token] = etag
+        except Exception as e:
+            logger.warning(f"[BENCH] Request failed: {e}")
+            status = "error"
+        finally:
+            latency_ms = (time.perf_counter() - started) * 1000
+            _db_samples.reset(marker)
+        samples.append({"latency_ms": latency_ms, "db_ms": sum(db_samples) * 1000, "status": status})
+
+    async def request_all(self, tokens: List[str], samples: List[Dict[str, Any]], limit: int) -> None:
+        """Закрытая модель нагрузки: не больше limit запросов одновременно."""
+        semaphore = asyncio.Semaphore(max(1, limit))
+
+        async def bounded(token: str) -> None:
+            async with semaphore:
+                await self.request(token, samples)
+
+        await asyncio.gather(*(bounded(token) for token in tokens))
+
+
+async def _run_steady(runner: _Runner, tokens: List[str], config: BenchConfig, rng: random.Random) -> List[Dict[str, Any]]:
+    samples: List[Dict[str, Any]] = []
+    weights = [1.0 / (rank + 1) ** config.zipf_exponent for rank in range(len(tokens))]
+    total = max(1, int(config.rate * config.duration))
+    chosen = rng.choices(tokens, weights=weights, k=total)
+    started = time.perf_counter()
+    tasks = []
+    for index, token in enumerate(chosen):
+        # Открытая модель нагрузки: запросы уходят по расписанию, не дожидаясь предыдущих
+        delay = started + index / config.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        conditional = rng.random() < config.conditional_share
+        tasks.append(asyncio.create_task(runner.request(token, samples, conditional)))
+    await asyncio.gather(*tasks)
+    return samples
+
+
+async def _run_storm(runner: _Runner, tokens: List[str], config: BenchConfig, rng: random.Random) -> List[Dict[str, Any]]:
+    from bot.services.subscription_service import _subscription_cache
+    from bot.services.subscription_token_index import subscription_tokens
+    from app.infra.sqlite_utils import open_connection
+
+    # Холодный старт после деплоя: пустые кэши процесса и материализованные ответы
+    _subscription_cache.clear()
+    subscription_tokens.reset()
+    conn = open_connection(None)
+    try:
+        conn.execute("DELETE FROM subscription_payloads")
+        conn.commit()
+    finally:
+        conn.close()
+
+    samples: List[Dict[str, Any]] = []
+    requests = [token for token in tokens for _ in range(max(1, config.storm_repeat))]
+    rng.shuffle(requests)
+    await runner.request_all(requests, samples, config.concurrency)
+    return samples
+
+
+async def _run_flood(runner: _Runner, tokens: List[str], config: BenchConfig, rng: random.Random) -> List[Dict[str, Any]]:
+    samples: List[Dict[str, Any]] = []
+    requests = []
+    for _ in range(config.flood_requests):
+        if tokens and rng.random() < config.flood_valid_share:
+            requests.append(rng.choice(tokens))
+        else:
+            requests.append(str(uuid_lib.UUID(int=rng.getrandbits(128), version=4)))
+    await runner.request_all(requests, samples, config.concurrency)
+    return samples
+
+
+_SCENARIO_RUNNERS = {"steady": _run_steady, "storm": _run_storm, "flood": _run_flood}
+
+
+async def run_benchmark(config: BenchConfig, scenarios: Sequence[str] = SCENARIOS) -> Dict[str, Any]:
+    """Прогнать сценарии на свежей базе; вернуть запись результата (без сохранения)."""
+    from scripts.fake_v2ray_panel import FakePanelConfig, LatencyModel, start_fake_panels, stop_fake_panels
+
+    tmp_dir = tempfile.mkdtemp(prefix="veilbot-bench-")
+    db_path = os.path.join(tmp_dir, "bench.db")
+    previous_env = os.environ.get("DATABASE_PATH")
+    os.environ["DATABASE_PATH"] = db_path
+
+    latency = LatencyModel.parse(config.panel_latency)
+    panels = await start_fake_panels(
+        config.servers,
+        config_factory=lambda index: FakePanelConfig(api_key="bench", latency=latency, seed=config.seed + index),
+    )
+    db_timer = DbTimer()
+    restore: List[Any] = []
+    try:
+        tokens = seed_database(db_path, config, panels)
+
+        import httpx
+        from admin.main import app
+        from admin.routes import subscriptions as subscriptions_routes
+        from app.infra.cache_invalidation import cache_invalidation_bus
+        from app.infra.write_behind import flush_write_behind_buffers
+        from app.settings import settings
+        from bot.services.subscription_service import _subscription_cache
+        from bot.services.subscription_token_index import subscription_tokens
+        from vpn_protocols import close_v2ray_clients
+
+        # Настройки уже могли быть прочитаны с другим DATABASE_PATH (импорт до запуска бенчмарка)
+        restore.append((settings, "DATABASE_PATH", settings.DATABASE_PATH))
+        settings.DATABASE_PATH = db_path
+        # Лимит 60/мин на токен отсёк бы популярные токены в steady/storm
+        restore.append((subscriptions_routes.limiter, "enabled", subscriptions_routes.limiter.enabled))
+        subscriptions_routes.limiter.enabled = False
+        cache_invalidation_bus.close()
+        _subscription_cache.clear()
+        subscription_tokens.reset()
+        db_timer.install()
+
+        rng = random.Random(config.seed)
+        results: Dict[str, Any] = {}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            runner = _Runner(client)
+            for name in scenarios:
+                probe = LoopLagProbe()
+                probe.start()
+                started = time.perf_counter()
+                samples = await _SCENARIO_RUNNERS[name](runner, tokens, config, rng)
+                elapsed = time.perf_counter() - started
+                lag = await probe.stop()
+                results[name] = summarize(samples, elapsed, lag)
+                logger.info(f"[BENCH] {name}: {format_summary(results[name])}")
+            await flush_write_behind_buffers()
+        await close_v2ray_clients()
+    finally:
+        db_timer.uninstall()
+        for target, attr, value in restore:
+            setattr(target, attr, value)
+        try:
+            from app.infra.cache_invalidation import cache_invalidation_bus
+            from bot.services.subscription_service import _subscription_cache
+            from bot.services.subscription_token_index import subscription_tokens
+
+            cache_invalidation_bus.close()
+            _subscription_cache.clear()
+            subscription_tokens.reset()
+        except Exception:
+            pass
+        if previous_env is None:
+            os.environ.pop("DATABASE_PATH", None)
+        else:
+            os.environ["DATABASE_PATH"] = previous_env
+        await stop_fake_panels(panels)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    commit, dirty = _git_revision()
+    return {
+        "timestamp": int(time.time()),
+        "commit": commit,
+        "dirty": dirty,
+        "config": asdict(config),
+        "scenarios": results,
+    }
+
+
+def _git_revision() -> tuple:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_root_dir, capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=_root_dir, capture_output=True, text=True, timeout=30,
+        ).stdout.strip())
+        return commit or None, dirty
+    except Exception:
+        return None, False
+
+
+def append_result(path: str, record: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+
+
+def load_results(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"[BENCH] Skipping malformed result line in {path}")
+    return records
+
+
+def find_baseline(records: List[Dict[str, Any]], record: Dict[str, Any], ref: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Последний прогон с коммитом/меткой ref, иначе — последний прогон с теми же параметрами."""
+    for candidate in reversed(records):
+        if candidate is record:
+            continue
+        if ref:
+            if candidate.get("label") == ref or (candidate.get("commit") or "").startswith(ref):
+                return candidate
+        elif candidate.get("config") == record.get("config"):
+            return candidate
+    return None
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    statuses = ",".join(f"{status}:{count}" for status, count in sorted(summary["statuses"].items()))
+    return (
+        f"n={summary['requests']} rps={summary['rps']} p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms "
+        f"p99={summary['p99_ms']}ms max={summary['max_ms']}ms db={summary['db_ms_mean']}ms "
+        f"py={summary['python_ms_mean']}ms db_share={summary['db_share']:.0%} "
+        f"lag_p99={summary['loop_lag_p99_ms']}ms [{statuses}]"
+    )
+
+
+def format_report(record: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> str:
+    lines = [f"commit {record.get('commit') or '?'}{' (dirty)' if record.get('dirty') else ''}"]
+    if baseline:
+        lines[0] += f" vs {baseline.get('label') or baseline.get('commit') or '?'}"
+    for name, summary in record["scenarios"].items():
+        lines.append(f"  {name:<7} {format_summary(summary)}")
+        previous = (baseline or {}).get("scenarios", {}).get(name)
+        if previous:
+            deltas = []
+            for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "db_ms_mean", "python_ms_mean"):
+                before, after = previous.get(metric), summary.get(metric)
+                if before:
+                    deltas.append(f"{metric} {before}->{after} ({(after - before) / before:+.0%})")
+            lines.append("          " + "; ".join(deltas))
+    return "\n".join(lines)
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    defaults = BenchConfig()
+    parser = argparse.ArgumentParser(description="Benchmark /api/subscription/{token} in-process")
+    parser.add_argument("--users", type=int, default=defaults.users, help="Users, one subscription each")
+    parser.add_argument("--servers", type=int, default=defaults.servers, help="Fake panels / servers")
+    parser.add_argument("--keys-per-subscription", type=int, default=defaults.keys_per_subscription,
+                        help="Keys per subscription (0 = one per server)")
+    parser.add_argument("--missing-config-share", type=float, default=defaults.missing_config_share,
+                        help="Share of keys without client_config (fetched from panels)")
+    parser.add_argument("--panel-latency", default=defaults.panel_latency,
+                        help="fixed:<ms> | uniform:<min>:<max> | lognormal:<median>:<sigma>")
+    parser.add_argument("--rate", type=float, default=defaults.rate, help="steady: requests per second")
+    parser.add_argument("--duration", type=float, default=defaults.duration, help="steady: seconds")
+    parser.add_argument("--conditional-share", type=float, default=defaults.conditional_share,
+                        help="steady: share of requests with If-None-Match")
+    parser.add_argument("--storm-repeat", type=int, default=defaults.storm_repeat,
+                        help="storm: requests per token")
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency,
+                        help="storm/flood: requests in flight")
+    parser.add_argument("--flood-requests", type=int, default=defaults.flood_requests)
+    parser.add_argument("--flood-valid-share", type=float, default=defaults.flood_valid_share)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated: steady,storm,flood")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_PATH, help="JSONL file with stored runs")
+    parser.add_argument("--label", default=None, help="Name of this run for --baseline")
+    parser.add_argument("--baseline", default=None, help="Compare with run by commit prefix or label")
+    parser.add_argument("--no-save", action="store_true", help="Do not append the run to --results")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+    # Импорт админки перенастраивает логирование; строка на каждый запрос httpx исказила бы замеры
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    args = _parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    config = BenchConfig(
+        users=args.users,
+        servers=args.servers,
+        keys_per_subscription=args.keys_per_subscription,
+        missing_config_share=args.missing_config_share,
+        panel_latency=args.panel_latency,
+        rate=args.rate,
+        duration=args.duration,
+        conditional_share=args.conditional_share,
+        storm_repeat=args.storm_repeat,
+        concurrency=args.concurrency,
+        flood_requests=args.flood_requests,
+        flood_valid_share=args.flood_valid_share,
+        seed=args.seed,
+    )
+    record = asyncio.run(run_benchmark(config, scenarios))
+    if args.label:
+        record["label"] = args.label
+    records = load_results(args.results)
+    baseline = find_baseline(records, record, args.baseline)
+    if not args.no_save:
+        append_result(args.results, record)
+    print(format_report(record, baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
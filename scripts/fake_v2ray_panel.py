@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""Local fake V2Ray panel for load testing V2RayProtocol without real servers.
+
+Реализует эндпоинты панели, которые использует клиент (`/api/keys`, `/api/keys/{id}`,
+`/api/keys/{id}/link` и `/config`, `/api/keys/{id}/traffic`, `/api/keys/{id}/traffic/reset`,
+`/api/traffic`, `/api/traffic/reset`, `/api/system/xray/sync-config`), хранит ключи и трафик в памяти
+и умеет вносить задержки, ошибки и таймауты. Ключи ищутся и по числовому key_id, и по UUID.
+
+Примеры:
+    # 20 панелей на 127.0.0.1:18000..18019, по 500 ключей, задержка ~лог-нормальная 40 мс, 2% ошибок 5xx
+    python scripts/fake_v2ray_panel.py --panels 20 --keys 500 --latency lognormal:40:0.5 --error-rate 0.02
+
+    # список api_url/api_key запущенных панелей — в JSON (для сидирования таблицы servers)
+    python scripts/fake_v2ray_panel.py --panels 10 --print-json
+
+Параметры меняются на лету: POST /_fake/config (JSON с полями FakePanelConfig),
+статистика запросов — GET /_fake/stats.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid as uuid_lib
+from dataclasses import asdict, dataclass, field, fields
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+FAULT_STATUSES = (500, 502, 503, 504)
+
+
+@dataclass
+class LatencyModel:
+    """Распределение задержки ответа: fixed:<ms>, uniform:<min>:<max>, lognormal:<median>:<sigma>."""
+
+    kind: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        parts = (spec or "fixed:0").split(":")
+        kind = parts[0].strip().lower()
+        values = [float(p) for p in parts[1:]]
+        if kind == "fixed" and len(values) == 1:
+            return cls(kind, values[0])
+        if kind in ("uniform", "lognormal") and len(values) == 2:
+            return cls(kind, values[0], values[1])
+        raise ValueError(f"Invalid latency spec: {spec!r}")
+
+    def sample_ms(self, rng: random.Random) -> float:
+        if self.kind == "uniform":
+            return rng.uniform(self.a, self.b)
+        if self.kind == "lognormal":
+            return rng.lognormvariate(0.0, self.b) * self.a if self.a > 0 else 0.0
+        return self.a
+
+
+@dataclass
+class FakePanelConfig:
+    """Параметры поведения фейковой панели."""
+
+    api_key: Optional[str] = None
+    initial_keys: int = 0
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    error_rate: float = 0.0
+    timeout_rate: float = 0.0
+    timeout_sec: float = 30.0
+    traffic_bytes_per_sec: int = 0
+    support_bulk_traffic: bool = True
+    seed: Optional[int] = None
+
+    def update(self, values: Dict[str, Any]) -> None:
+        known = {f.name for f in fields(self)}
+        for name, value in values.items():
+            if name not in known:
+                raise ValueError(f"Unknown config field: {name}")
+            if name == "latency":
+                value = LatencyModel.parse(value) if isinstance(value, str) else LatencyModel(**value)
+            setattr(self, name, value)
+
+
+class FakePanelState:
+    """In-memory ключи панели и их трафик."""
+
+    def __init__(self, config: FakePanelConfig, port: int = 443):
+        self.config = config
+        self.port = port
+        self.keys: Dict[str, Dict[str, Any]] = {}
+        self._by_uuid: Dict[str, str] = {}
+        self._ids = itertools.count(1)
+        self.requests: Dict[str, int] = {}
+        self.faults = {"errors": 0, "timeouts": 0}
+        for index in range(config.initial_keys):
+            self.create_key(f"seed-{index}")
+
+    def create_key(self, name: str) -> Dict[str, Any]:
+        key_id = str(next(self._ids))
+        key_uuid = str(uuid_lib.uuid4())
+        key = {
+            "key_id": int(key_id),
+            "id": key_id,
+            "uuid": key_uuid,
+            "name": name,
+            "short_id": key_uuid.replace("-", "")[:8],
+            "sni": "www.microsoft.com",
+            "port": self.port,
+            "created_at": int(time.time()),
+            "is_active": True,
+            "_traffic_base": 0,
+            "_traffic_since": time.monotonic(),
+        }
+        self.keys[key_id] = key
+        self._by_uuid[key_uuid] = key_id
+        return key
+
+    def find(self, key_ref: str) -> Optional[Dict[str, Any]]:
+        key_id = key_ref if key_ref in self.keys else self._by_uuid.get(key_ref)
+        return self.keys.get(key_id) if key_id else None
+
+    def delete(self, key: Dict[str, Any]) -> None:
+        self.keys.pop(key["id"], None)
+        self._by_uuid.pop(key["uuid"], None)
+
+    def traffic(self, key: Dict[str, Any]) -> Dict[str, int]:
+        elapsed = time.monotonic() - key["_traffic_since"]
+        total = key["_traffic_base"] + int(elapsed * self.config.traffic_bytes_per_sec)
+        uplink = total // 3
+        return {"upload": uplink, "download": total - uplink, "total": total}
+
+    def reset_traffic(self, key: Dict[str, Any]) -> int:
+        previous = self.traffic(key)["total"]
+        key["_traffic_base"] = 0
+        key["_traffic_since"] = time.monotonic()
+        return previous
+
+    def vless_link(self, key: Dict[str, Any], host: str) -> str:
+        return (
+            f"vless://{key['uuid']}@{host}:{self.port}?encryption=none&security=reality"
+            f"&sni={key['sni']}&fp=chrome&pbk=fakepublickey&sid={key['short_id']}&type=tcp#{key['name']}"
+        )
+
+
+def _public(key: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: value for name, value in key.items() if not name.startswith("_")}
+
+
+def create_app(config: Optional[FakePanelConfig] = None, *, port: int = 443) -> web.Application:
+    """aiohttp-приложение одной фейковой панели."""
+    config = config or FakePanelConfig()
+    state = FakePanelState(config, port=port)
+    rng = random.Random(config.seed)
+
+    @web.middleware
+    async def faults_middleware(request: web.Request, handler):
+        if request.path.startswith("/_fake/"):
+            return await handler(request)
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        state.requests[f"{request.method} {route}"] = state.requests.get(f"{request.method} {route}", 0) + 1
+
+        delay_ms = config.latency.sample_ms(rng)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        if config.timeout_rate and rng.random() < config.timeout_rate:
+            state.faults["timeouts"] += 1
+            await asyncio.sleep(config.timeout_sec)
+            return web.json_response({"detail": "Gateway Timeout"}, status=504)
+        if config.error_rate and rng.random() < config.error_rate:
+            state.faults["errors"] += 1
+            return web.json_response({"detail": "Injected fault"}, status=rng.choice(FAULT_STATUSES))
+        if config.api_key and request.headers.get("Authorization") != f"Bearer {config.api_key}":
+            return web.json_response({"detail": "Unauthorized"}, status=401)
+        return await handler(request)
+
+    def _key_or_404(request: web.Request) -> Dict[str, Any]:
+        key = state.find(request.match_info["key_id"])
+        if key is None:
+            raise web.HTTPNotFound(text=json.dumps({"detail": "Key not found"}), content_type="application/json")
+        return key
+
+    async def api_status(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "keys": len(state.keys)})
+
+    async def list_keys(request: web.Request) -> web.Response:
+        keys = [_public(key) for key in state.keys.values()]
+        return web.json_response({"keys": keys, "total": len(keys)})
+
+    async def create_key(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+        except json.JSONDecodeError:
+            payload = {}
+        key = state.create_key(str(payload.get("name") or payload.get("email") or "key"))
+        return web.json_response(_public(key), status=201)
+
+    async def get_key(request: web.Request) -> web.Response:
+        return web.json_response(_public(_key_or_404(request)))
+
+    async def delete_key(request: web.Request) -> web.Response:
+        key = _key_or_404(request)
+        state.delete(key)
+        return web.json_response({"message": f"Key {key['id']} deleted successfully"})
+
+    async def key_link(request: web.Request) -> web.Response:
+        key = _key_or_404(request)
+        link = state.vless_link(key, request.host.rsplit(":", 1)[0] or "127.0.0.1")
+        return web.json_response({"key_id": key["key_id"], "vless_link": link, "client_config": link})
+
+    async def key_traffic(request: web.Request) -> web.Response:
+        key = _key_or_404(request)
+        traffic = state.traffic(key)
+        return web.json_response({
+            "key_id": key["key_id"],
+            "key_uuid": key["uuid"],
+            "key_name": key["name"],
+            **traffic,
+            "last_updated": int(time.time()),
+        })
+
+    async def key_traffic_reset(request: web.Request) -> web.Response:
+        key = _key_or_404(request)
+        previous = state.reset_traffic(key)
+        return web.json_response({
+            "success": True,
+            "message": f"Traffic for key {key['id']} reset successfully",
+            "previous_total": previous,
+        })
+
+    async def all_traffic(request: web.Request) -> web.Response:
+        if not config.support_bulk_traffic:
+            return web.json_response({"detail": "Not Found"}, status=404)
+        ports = {}
+        for key in state.keys.values():
+            traffic = state.traffic(key)
+            ports[key["id"]] = {
+                "uuid": key["uuid"],
+                "port": key["port"],
+                "key_name": key["name"],
+                "rx_bytes": traffic["upload"],
+                "tx_bytes": traffic["download"],
+                "total_bytes": traffic["total"],
+            }
+        return web.json_response({"data": {"ports": ports, "timestamp": int(time.time())}})
+
+    async def all_traffic_reset(request: web.Request) -> web.Response:
+        for key in state.keys.values():
+            state.reset_traffic(key)
+        return web.json_response({"success": True, "message": "Traffic reset successfully"})
+
+    async def xray_sync(request: web.Request) -> web.Response:
+        return web.json_response({"message": "Config synchronized successfully"})
+
+    async def fake_config(request: web.Request) -> web.Response:
+        try:
+            config.update(await request.json())
+        except (ValueError, TypeError) as e:
+            return web.json_response({"detail": str(e)}, status=400)
+        return web.json_response(_config_view(config))
+
+    async def fake_stats(request: web.Request) -> web.Response:
+        return web.json_response({
+            "keys": len(state.keys),
+            "requests": state.requests,
+            "faults": state.faults,
+            "config": _config_view(config),
+        })
+
+    app = web.Application(middlewares=[faults_middleware])
+    app["state"] = state
+    app.router.add_get("/api/", api_status)
+    app.router.add_get("/api/keys", list_keys)
+    app.router.add_post("/api/keys", create_key)
+    app.router.add_get("/api/keys/{key_id}", get_key)
+    app.router.add_delete("/api/keys/{key_id}", delete_key)
+    app.router.add_get("/api/keys/{key_id}/link", key_link)
+    app.router.add_get("/api/keys/{key_id}/config", key_link)
+    app.router.add_get("/api/keys/{key_id}/traffic", key_traffic)
+    app.router.add_post("/api/keys/{key_id}/traffic/reset", key_traffic_reset)
+    app.router.add_get("/api/traffic", all_traffic)
+    app.router.add_post("/api/traffic/reset", all_traffic_reset)
+    app.router.add_post("/api/system/xray/sync-config", xray_sync)
+    app.router.add_post("/_fake/config", fake_config)
+    app.router.add_get("/_fake/stats", fake_stats)
+    return app
+
+
+def _config_view(config: FakePanelConfig) -> Dict[str, Any]:
+    view = asdict(config)
+    view.pop("api_key", None)
+    return view
+
+
+async def start_fake_panels(
+    count: int,
+    *,
+    host: str = "127.0.0.1",
+    base_port: int = 0,
+    config_factory=None,
+) -> List[Dict[str, Any]]:
+    """Запустить count панелей в текущем event loop.
+
+    base_port=0 — свободные порты от ОС. Возвращает список {api_url, api_key, port, app, runner};
+    останавливать через stop_fake_panels().
+    """
+    panels = []
+    for index in range(count):
+        config = config_factory(index) if config_factory else FakePanelConfig()
+        port = base_port + index if base_port else 0
+        app = create_app(config, port=port)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        # При base_port=0 порт известен только после bind — ссылки vless должны указывать на него
+        app["state"].port = bound_port
+        panels.append({
+            "api_url": f"http://{host}:{bound_port}/api",
+            "api_key": config.api_key,
+            "port": bound_port,
+            "app": app,
+            "runner": runner,
+        })
+    return panels
+
+
+async def stop_fake_panels(panels: List[Dict[str, Any]]) -> None:
+    for panel in panels:
+        await panel["runner"].cleanup()
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run local fake V2Ray panels for load testing")
+    parser.add_argument("--panels", type=int, default=1, help="Number of simulated servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=18000, help="First port (0 = random free ports)")
+    parser.add_argument("--keys", type=int, default=0, help="Keys pre-created on every panel")
+    parser.add_argument("--api-key", default=None, help="Bearer token required by the panels")
+    parser.add_argument("--latency", default="fixed:0", help="fixed:<ms> | uniform:<min>:<max> | lognormal:<median>:<sigma>")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 5xx")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Share of requests that hang")
+    parser.add_argument("--timeout-sec", type=float, default=30.0, help="How long a hanging request sleeps")
+    parser.add_argument("--traffic-rate", type=int, default=0, help="Traffic growth per key, bytes/sec")
+    parser.add_argument("--no-bulk-traffic", action="store_true", help="GET /api/traffic answers 404")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--print-json", action="store_true", help="Print started panels as JSON")
+    return parser.parse_args(argv)
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    latency = LatencyModel.parse(args.latency)
+
+    def config_factory(index: int) -> FakePanelConfig:
+        return FakePanelConfig(
+            api_key=args.api_key,
+            initial_keys=args.keys,
+            latency=latency,
+            error_rate=args.error_rate,
+            timeout_rate=args.timeout_rate,
+            timeout_sec=args.timeout_sec,
+            traffic_bytes_per_sec=args.traffic_rate,
+            support_bulk_traffic=not args.no_bulk_traffic,
+            seed=None if args.seed is None else args.seed + index,
+        )
+
+    panels = await start_fake_panels(
+        args.panels, host=args.host, base_port=args.base_port, config_factory=config_factory
+    )
+    if args.print_json:
+        print(json.dumps([{"api_url": p["api_url"], "api_key": p["api_key"]} for p in panels], indent=2))
+    else:
+        for panel in panels:
+            print(panel["api_url"])
+    sys.stdout.flush()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_fake_panels(panels)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+    args = _parse_args(argv)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,7 +21,7 @@ sys.path.insert(0, _root)
 
 from app.repositories.subscription_repository import SubscriptionRepository
 from app.settings import settings
-from vpn_protocols import ProtocolFactory
+from vpn_protocols import ProtocolFactory, close_v2ray_clients
 
 
 def _human_bytes(n: int) -> str:
@@ -215,5 +215,12 @@ async def main() -> int:
     return 0
 
 
+async def _run() -> int:
+    try:
+        return await main()
+    finally:
+        await close_v2ray_clients()
+
+
 if __name__ == "__main__":
-    raise SystemExit(asyncio.run(main()))
+    raise SystemExit(asyncio.run(_run()))
@@ -15,7 +15,13 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.infra.sqlite_utils import get_db_cursor
 from app.infra.foreign_keys import safe_foreign_keys_off
-from vpn_protocols import ProtocolFactory, normalize_vless_host, remove_fragment_from_vless
+from vpn_protocols import (
+    ProtocolFactory,
+    close_v2ray_clients,
+    normalize_vless_host,
+    panel_key_id_from_user_data,
+    remove_fragment_from_vless,
+)
 from bot.services.subscription_service import invalidate_subscription_cache
 from bot.services.subscription_server_groups import iter_sync_work_items, pick_best_server_by_free_slots
 
@@ -857,8 +863,8 @@ async def sync_all_keys_with_servers(
                                                         cursor.execute("""
                                                             INSERT INTO v2ray_keys
                                                             (server_id, user_id, v2ray_uuid, email, created_at,
-                                                             tariff_id, client_config, subscription_id)
-                                                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                                             tariff_id, client_config, subscription_id, panel_key_id)
+                                                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                                                         """, (
                                                             server_id,
                                                             user_id,
@@ -868,6 +874,7 @@ async def sync_all_keys_with_servers(
                                                             tariff_id,
                                                             client_config,
                                                             sub_id,
+                                                            panel_key_id_from_user_data(user_data),
                                                         ))
                                                     cursor.execute("COMMIT")
                                                 except Exception:
@@ -1308,6 +1315,8 @@ async def sync_all_keys_with_servers(
     finally:
         # ОПТИМИЗАЦИЯ: Закрываем все клиенты из пула (гарантированно)
         await client_pool.close_all()
+        # Общая сессия панелей привязана к event loop этого запуска (asyncio.run в отдельном потоке)
+        await close_v2ray_clients()
     
     # ========== ИТОГОВАЯ СТАТИСТИКА ==========
     stats["duration_seconds"] = time.time() - start_time
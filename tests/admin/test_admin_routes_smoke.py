@@ -17,3 +17,11 @@ def test_login_page_renders_template():
     assert response.status_code == 200
     assert "VeilBot Admin - Login" in response.text
 
+
+
+def test_metrics_requires_token_or_session(monkeypatch):
+    monkeypatch.setenv("VEILBOT_METRICS_TOKEN", "metrics-secret")
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer metrics-secret"})
+    assert response.status_code == 200
+    assert "# TYPE veilbot_panel_request_duration_ms histogram" in response.text
@@ -317,3 +317,55 @@ async def test_extend_subscription_by_duration_uses_max_now_expires_at_async(rep
     new_expires = await repo.extend_subscription_by_duration_async(sub_id, duration_sec=86400)
     assert new_expires >= before + 86400 - 2
 
+
+
+@pytest.mark.asyncio
+async def test_load_subscription_generation_data_async_matches_sync_helpers(tmp_path, monkeypatch):
+    import db
+
+    db_path = str(tmp_path / "generation.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", db_path, raising=False)
+    db.init_db_with_migrations()
+
+    now = int(time.time())
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (user_id, is_vip) VALUES (1, 1)")
+    conn.execute("INSERT INTO tariffs (id, name, duration_sec, price_rub, traffic_limit_mb) VALUES (1, 'Месяц', 2592000, 100, 0)")
+    conn.execute(
+        "INSERT INTO servers (id, name, api_url, api_key, domain, country, protocol, active) "
+        "VALUES (1, 'NL-1', 'https://nl.example.com/api', 'k', 'nl.example.com', 'NL', 'v2ray', 1), "
+        "(2, 'DE-1', 'https://de.example.com/api', 'k', 'de.example.com', 'DE', 'v2ray', 0)"
+    )
+    conn.execute(
+        "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, tariff_id, is_active, "
+        "traffic_limit_mb, traffic_baseline_bytes, traffic_over_limit_at) "
+        "VALUES (1, 1, 'token-gen', ?, ?, 1, 1, NULL, 100, 12345)",
+        (now - 10, now + 3600),
+    )
+    conn.execute(
+        "INSERT INTO v2ray_keys (server_id, user_id, v2ray_uuid, created_at, email, subscription_id, "
+        "client_config, traffic_limit_mb, panel_total_bytes_observed) "
+        "VALUES (1, 1, 'uuid-nl', ?, 'a', 1, 'vless://nl', 2048, 700), "
+        "(2, 1, 'uuid-de', ?, 'b', 1, NULL, 2048, 600)",
+        (now, now),
+    )
+    conn.commit()
+    conn.close()
+
+    repo = SubscriptionRepository(db_path=db_path)
+    data = await repo.load_subscription_generation_data_async("token-gen", now)
+
+    assert data.subscription == await repo.get_subscription_by_token_async("token-gen")
+    assert data.is_vip is True
+    assert data.tariff_name == "Месяц"
+    assert data.traffic_usage_bytes == repo.get_subscription_traffic_sum(1) == 1200
+    # Лимит не задан ни подпиской, ни тарифом — берётся единый лимит ключей
+    assert data.traffic_limit_bytes == repo.get_subscription_traffic_limit(1) == 2048 * 1024 * 1024
+    assert data.traffic_over_limit_at == 12345
+    assert data.keys == await repo.get_subscription_keys_async(1, 1, now)
+    assert await repo.load_subscription_generation_data_async("missing", now) is None
+
+    await repo.update_keys_client_config_async([("vless://de", "uuid-de")])
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT client_config FROM v2ray_keys WHERE v2ray_uuid = 'uuid-de'").fetchone()[0] == "vless://de"
+    conn.close()
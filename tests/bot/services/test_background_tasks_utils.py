@@ -16,3 +16,24 @@ def test_format_bytes_short_formats_gigabytes():
     bytes_value = 5 * 1024 * 1024 * 1024
     assert tasks._format_bytes_short(bytes_value) == "5.00 ГБ"
 
+
+
+def test_split_keys_by_bulk_traffic_maps_uuid_and_collects_fallback():
+    active_keys = [
+        (1, "uuid-a", 10, 100, "https://a", "k", 0),
+        (2, "uuid-b", 10, 100, "https://a", "k", 0),
+        (3, "uuid-c", 20, 101, "https://b", "k", 0),
+    ]
+    bulk_by_server = {10: {"uuid-a": 500}, 20: None}
+
+    usage_map, fallback = tasks._split_keys_by_bulk_traffic(active_keys, bulk_by_server)
+
+    assert usage_map == {1: 500}
+    assert [row[0] for row in fallback] == [2, 3]
+
+
+def test_traffic_bulk_mode_can_be_disabled(monkeypatch):
+    monkeypatch.setenv("VEILBOT_TRAFFIC_BULK_MODE", "0")
+    assert tasks._traffic_bulk_enabled() is False
+    monkeypatch.delenv("VEILBOT_TRAFFIC_BULK_MODE")
+    assert tasks._traffic_bulk_enabled() is True
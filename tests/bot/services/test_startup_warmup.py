@@ -0,0 +1,148 @@
+"""
+Тесты прогрева кэшей после старта (bot/services/startup_warmup.py)
+"""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import db
+from bot.services import subscription_payloads as payloads_module
+from bot.services.startup_warmup import StartupWarmup, startup_warmup
+from bot.services.subscription_service import SubscriptionService
+from bot.services.subscription_token_index import subscription_tokens
+
+TOKEN = "3c1e9a52-7d4b-4f0e-8b6a-1f2e3d4c5b6a"
+
+
+@pytest.fixture
+def warmup_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "warmup.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", db_path, raising=False)
+    monkeypatch.setenv("DATABASE_PATH", db_path)
+    db.init_db_with_migrations()
+
+    now = int(time.time())
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (user_id, created_at) VALUES (1, ?)", (now,))
+    conn.execute(
+        "INSERT INTO servers (id, name, api_url, api_key, domain, country, protocol, active) "
+        "VALUES (1, 'NL-1', 'https://nl.example.com/api', 'k', 'nl.example.com', 'NL', 'v2ray', 1)"
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, is_active, last_updated_at) "
+        "VALUES (?, 1, ?, ?, ?, ?, ?)",
+        [
+            (1, TOKEN, now - 3600, now + 86400, 1, now - 60),
+            (2, "expired-token-0000000000000000000000", now - 3600, now - 10, 1, now - 30),
+        ],
+    )
+    conn.execute(
+        "INSERT INTO v2ray_keys (server_id, user_id, v2ray_uuid, created_at, email, subscription_id, client_config) "
+        "VALUES (1, 1, 'uuid-1', ?, 'u1', 1, 'vless://uuid-1@nl.example.com:443?security=reality')",
+        (now,),
+    )
+    conn.commit()
+    conn.close()
+    subscription_tokens.reset()
+    startup_warmup.reset()
+    monkeypatch.setattr(payloads_module.subscription_payloads, "enabled", True)
+    yield db_path
+    startup_warmup.reset()
+    subscription_tokens.reset()
+
+
+@pytest.fixture
+def generations(monkeypatch):
+    calls = []
+
+    async def fake_generate(self, token):
+        calls.append(token)
+        return {"content": f"payload-{len(calls)}", "metadata": {"expires_at": 1}}
+
+    monkeypatch.setattr(SubscriptionService, "generate_subscription_package", fake_generate)
+    return calls
+
+
+def _rename_server(db_path, name):
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE servers SET name = ?", (name,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_warmup_rebuilds_only_stale_active_payloads(warmup_db, generations):
+    warmup = StartupWarmup(warmup_db, enabled=True, concurrency=2)
+    assert warmup.ready
+    await warmup.run(("token_index", "payloads"))
+
+    status = warmup.status()
+    assert status["ready"] and status["steps"] == {"token_index": "done", "payloads": "done"}
+    assert status["subscriptions_checked"] == 1 and status["payloads_rebuilt"] == 1
+    assert generations == [TOKEN]
+    assert subscription_tokens.stats()["loaded"] == 1
+
+    # Повторный прогрев: payload свежий, генерации нет
+    await warmup.run(("payloads",))
+    assert generations == [TOKEN]
+
+
+def test_stale_payload_is_served_while_warming_up(warmup_db, generations, monkeypatch):
+    from admin.main import app
+
+    client = TestClient(app)
+    url = f"/api/subscription/{TOKEN}"
+    first = client.get(url)
+    assert first.status_code == 200 and generations == [TOKEN]
+
+    _rename_server(warmup_db, "NL-2")
+    refreshed = []
+    monkeypatch.setattr(startup_warmup, "refresh_in_background", lambda token, state: refreshed.append(token))
+    startup_warmup._mark_started(("payloads",))
+
+    stale = client.get(url)
+    assert stale.status_code == 200 and stale.text == first.text
+    assert refreshed == [TOKEN] and generations == [TOKEN]
+    assert client.get(url, headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+    # После прогрева устаревший payload пересобирается синхронно
+    startup_warmup._payloads_pending = False
+    rebuilt = client.get(url)
+    assert rebuilt.status_code == 200 and rebuilt.text != first.text
+    assert generations == [TOKEN, TOKEN]
+
+
+async def test_background_refresh_task_is_referenced_until_done(monkeypatch):
+    warmup = StartupWarmup(enabled=True)
+    release = asyncio.Event()
+
+    async def refresh(token, state):
+        await release.wait()
+
+    monkeypatch.setattr(warmup, "_refresh_payload", refresh)
+    warmup.refresh_in_background(TOKEN, None)
+    warmup.refresh_in_background(TOKEN, None)
+    assert len(warmup._tasks) == 1
+
+    (task,) = warmup._tasks
+    release.set()
+    await task
+    await asyncio.sleep(0)
+    assert not warmup._tasks and not warmup._refreshing
+    assert warmup.status()["stale_served"] == 2
+
+
+@pytest.mark.asyncio
+async def test_panel_warmup_skips_clients_without_api_status(warmup_db, monkeypatch):
+    from vpn_protocols import ProtocolFactory
+
+    class _NoStatusClient:
+        pass
+
+    monkeypatch.setattr(ProtocolFactory, "create_protocol", lambda *args, **kwargs: _NoStatusClient())
+    warmup = StartupWarmup(warmup_db)
+    await warmup._warm_panels()
+    assert warmup._stats["panels_failed"] == 1 and warmup._stats["panels_warmed"] == 0
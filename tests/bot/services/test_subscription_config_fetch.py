@@ -0,0 +1,136 @@
+"""
+Тесты параллельного получения недостающих client_config при генерации подписки
+"""
+import asyncio
+import base64
+import sqlite3
+import time
+
+import pytest
+
+import db
+from bot.services import subscription_service
+from bot.services.subscription_service import SubscriptionService
+
+TOKEN = "7b1f0c7e-2f55-4b8e-9a51-3c4d5e6f7a80"
+
+
+@pytest.fixture
+def generation_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "generation.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", db_path, raising=False)
+    db.init_db_with_migrations()
+
+    now = int(time.time())
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (user_id, is_vip) VALUES (1, 1)")
+    for server_id in (1, 2, 3):
+        conn.execute(
+            "INSERT INTO servers (id, name, api_url, api_key, domain, country, protocol, active) "
+            "VALUES (?, ?, ?, 'k', ?, 'NL', 'v2ray', 1)",
+            (server_id, f"S{server_id}", f"https://s{server_id}.example.com/api", f"s{server_id}.example.com"),
+        )
+        conn.execute(
+            "INSERT INTO v2ray_keys (server_id, user_id, v2ray_uuid, created_at, email, subscription_id) "
+            "VALUES (?, 1, ?, ?, 'e', 1)",
+            (server_id, f"uuid-{server_id}", now),
+        )
+    conn.execute(
+        "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, is_active) "
+        "VALUES (1, 1, ?, ?, ?, 1)",
+        (TOKEN, now - 10, now + 86400),
+    )
+    conn.commit()
+    conn.close()
+    subscription_service._subscription_cache.clear()
+    return db_path
+
+
+class _SlowPanel:
+    delays = {"uuid-1": 0.05, "uuid-2": 0.05, "uuid-3": 0.5}
+    active = 0
+    peak = 0
+
+    async def get_user_config(self, uuid, server_info):
+        type(self).active += 1
+        type(self).peak = max(type(self).peak, type(self).active)
+        try:
+            await asyncio.sleep(self.delays[uuid])
+        finally:
+            type(self).active -= 1
+        return f"vless://{uuid}@{server_info['domain']}:443?security=reality#user@example.com"
+
+
+def _client_configs(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = dict(conn.execute("SELECT v2ray_uuid, client_config FROM v2ray_keys").fetchall())
+    conn.close()
+    return rows
+
+
+@pytest.mark.asyncio
+async def test_missing_configs_are_fetched_concurrently_with_deadline(generation_db, monkeypatch):
+    monkeypatch.setattr(subscription_service, "CONFIG_FETCH_DEADLINE", 0.2)
+    monkeypatch.setattr(subscription_service.ProtocolFactory, "create_protocol", lambda *args, **kwargs: _SlowPanel())
+
+    started = time.perf_counter()
+    package = await SubscriptionService(generation_db).generate_subscription_package(TOKEN)
+    elapsed = time.perf_counter() - started
+
+    content = base64.b64decode(package["content"]).decode("utf-8")
+    assert "vless://uuid-1@" in content and "vless://uuid-2@" in content
+    assert "uuid-3" not in content
+    assert elapsed < 0.45
+    assert _SlowPanel.peak == 3
+
+    configs = _client_configs(generation_db)
+    assert configs["uuid-1"].startswith("vless://uuid-1@") and "#" not in configs["uuid-1"]
+    assert configs["uuid-3"] is None
+
+    # Запрос, не успевший к дедлайну, дописывает конфигурацию в фоне
+    await asyncio.gather(*subscription_service._config_backfills)
+    assert _client_configs(generation_db)["uuid-3"].startswith("vless://uuid-3@")
+
+    from app.infra.write_behind import flush_write_behind_buffers
+
+    await flush_write_behind_buffers()
+
+
+def _missing_keys():
+    return [
+        (f"uuid-{i}", None, f"s{i}.example.com", f"https://s{i}.example.com/api", "k", "NL", f"S{i}")
+        for i in (1, 2)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_fetched_configs_are_returned_when_storing_them_fails(generation_db, monkeypatch):
+    monkeypatch.setattr(subscription_service.ProtocolFactory, "create_protocol", lambda *args, **kwargs: _SlowPanel())
+    service = SubscriptionService(generation_db)
+
+    async def locked(rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(service.repository, "update_keys_client_config_async", locked)
+    configs = await service._fetch_missing_configs(_missing_keys(), 1)
+    assert sorted(configs) == ["uuid-1", "uuid-2"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_generations_share_in_flight_config_fetches(generation_db, monkeypatch):
+    calls = []
+
+    class _CountingPanel(_SlowPanel):
+        async def get_user_config(self, uuid, server_info):
+            calls.append(uuid)
+            return await super().get_user_config(uuid, server_info)
+
+    monkeypatch.setattr(subscription_service.ProtocolFactory, "create_protocol", lambda *args, **kwargs: _CountingPanel())
+    first, second = await asyncio.gather(
+        SubscriptionService(generation_db)._fetch_missing_configs(_missing_keys(), 1),
+        SubscriptionService(generation_db)._fetch_missing_configs(_missing_keys(), 1),
+    )
+    assert first == second and sorted(first) == ["uuid-1", "uuid-2"]
+    assert sorted(calls) == ["uuid-1", "uuid-2"]
+    assert not subscription_service._config_fetches
+    assert _client_configs(generation_db)["uuid-1"].startswith("vless://uuid-1@")
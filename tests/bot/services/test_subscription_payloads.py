@@ -0,0 +1,188 @@
+"""
+Тесты материализованных payload'ов подписки (bot/services/subscription_payloads.py)
+"""
+import sqlite3
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import db
+from bot.services import subscription_payloads as payloads_module
+from bot.services.subscription_payloads import SubscriptionPayloadStore, compute_etag, etag_matches
+from bot.services.subscription_service import SubscriptionService
+from bot.services.subscription_token_index import subscription_tokens
+
+TOKEN = "0f7c6a4e-6b1d-4c55-9c3f-2a9d8e1b7c01"
+
+
+@pytest.fixture
+def subscription_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "payloads.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", db_path, raising=False)
+    monkeypatch.setenv("DATABASE_PATH", db_path)
+    db.init_db_with_migrations()
+
+    now = int(time.time())
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (user_id, created_at) VALUES (1, ?)", (now,))
+    conn.execute(
+        "INSERT INTO servers (id, name, api_url, api_key, domain, country, protocol, active) "
+        "VALUES (1, 'NL-1', 'https://nl.example.com/api', 'k', 'nl.example.com', 'NL', 'v2ray', 1)"
+    )
+    conn.execute(
+        "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, is_active) "
+        "VALUES (1, 1, ?, ?, ?, 1)",
+        (TOKEN, now - 3600, now + 30 * 86400),
+    )
+    conn.execute(
+        "INSERT INTO v2ray_keys (server_id, user_id, v2ray_uuid, created_at, email, subscription_id, client_config) "
+        "VALUES (1, 1, 'uuid-1', ?, 'u1', 1, 'vless://uuid-1@nl.example.com:443?security=reality')",
+        (now,),
+    )
+    conn.commit()
+    conn.close()
+    subscription_tokens.reset()
+    return db_path
+
+
+def _execute(db_path, sql, params=()):
+    conn = sqlite3.connect(db_path)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_etag_matches_handles_lists_and_weak_validators():
+    etag = compute_etag("content")
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches(None, etag)
+
+
+@pytest.mark.asyncio
+async def test_payload_is_fresh_until_inputs_change(subscription_db):
+    store = SubscriptionPayloadStore(subscription_db, enabled=True, traffic_bucket_mb=100, max_age_sec=3600)
+
+    state = await store.load_state(TOKEN)
+    assert state.servable and not state.is_fresh
+    saved = await store.save(state, {"content": "Y29udGVudA==", "metadata": {"expires_at": 1}})
+    assert saved.version == 1
+
+    # Повторная пересборка с тем же отпечатком и содержимым версию не меняет
+    assert (await store.save(state, {"content": "Y29udGVudA==", "metadata": {"expires_at": 1}})).version == 1
+
+    state = await store.load_state(TOKEN)
+    assert state.is_fresh and state.stored_etag == saved.etag
+    stored = await store.get(state.subscription_id)
+    assert stored.content == "Y29udGVudA==" and stored.metadata == {"expires_at": 1}
+
+    # Трафик в пределах корзины — payload остаётся актуальным
+    _execute(subscription_db, "UPDATE v2ray_keys SET panel_total_bytes_observed = ?", (10 * 1024 * 1024,))
+    assert (await store.load_state(TOKEN)).is_fresh
+
+    # Переименование сервера и выход за корзину трафика требуют пересборки
+    _execute(subscription_db, "UPDATE servers SET name = 'NL-2'")
+    state = await store.load_state(TOKEN)
+    assert not state.is_fresh
+    assert (await store.save(state, {"content": "bmV3", "metadata": {}})).version == 2
+
+    _execute(subscription_db, "UPDATE v2ray_keys SET panel_total_bytes_observed = ?", (150 * 1024 * 1024,))
+    assert not (await store.load_state(TOKEN)).is_fresh
+
+
+@pytest.mark.asyncio
+async def test_expired_subscription_is_not_servable(subscription_db):
+    store = SubscriptionPayloadStore(subscription_db, enabled=True)
+    _execute(subscription_db, "UPDATE subscriptions SET expires_at = ?", (int(time.time()) - 10,))
+    assert not (await store.load_state(TOKEN)).servable
+    assert await store.load_state("f" * 36) is None
+
+
+@pytest.mark.asyncio
+async def test_subscription_over_traffic_limit_after_grace_is_not_servable(subscription_db):
+    store = SubscriptionPayloadStore(subscription_db, enabled=True)
+    now = int(time.time())
+    _execute(subscription_db, "UPDATE subscriptions SET traffic_limit_mb = 100, traffic_over_limit_at = ?", (now - 3600,))
+    _execute(subscription_db, "UPDATE v2ray_keys SET panel_total_bytes_observed = ?", (150 * 1024 * 1024,))
+    # В пределах суток после превышения подписка ещё выдаётся
+    assert (await store.load_state(TOKEN)).servable
+
+    _execute(subscription_db, "UPDATE subscriptions SET traffic_over_limit_at = ?", (now - 2 * 86400,))
+    assert not (await store.load_state(TOKEN)).servable
+
+    _execute(subscription_db, "UPDATE users SET is_vip = 1")
+    assert (await store.load_state(TOKEN)).servable
+
+
+def test_endpoint_serves_stored_payload_and_304(subscription_db, monkeypatch):
+    from admin.main import app
+
+    monkeypatch.setattr(payloads_module.subscription_payloads, "enabled", True)
+    calls = []
+
+    async def fake_generate(self, token):
+        calls.append(token)
+        return {
+            "content": "dmxlc3M6Ly91dWlkLTE=",
+            "metadata": {"traffic_usage_bytes": 5, "traffic_limit_bytes": 0, "expires_at": 42},
+        }
+
+    monkeypatch.setattr(SubscriptionService, "generate_subscription_package", fake_generate)
+    client = TestClient(app)
+    url = f"/api/subscription/{TOKEN}"
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert first.headers["subscription-userinfo"] == "upload=0; download=5; total=0; expire=42"
+
+    second = client.get(url)
+    assert second.status_code == 200 and second.text == first.text
+    assert second.headers["etag"] == etag
+    assert second.headers["subscription-userinfo"] == first.headers["subscription-userinfo"]
+
+    not_modified = client.get(url, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert calls == [TOKEN]
+
+    _execute(subscription_db, "UPDATE servers SET name = 'NL-2'")
+    rebuilt = client.get(url, headers={"If-None-Match": etag})
+    assert rebuilt.status_code == 304
+    assert calls == [TOKEN, TOKEN]
+
+
+def test_endpoint_touches_last_updated_for_stored_payload_and_304(subscription_db, monkeypatch):
+    from admin.main import app
+    from app.repositories.subscription_repository import subscription_last_seen_buffer
+
+    monkeypatch.setattr(payloads_module.subscription_payloads, "enabled", True)
+
+    async def fake_generate(self, token):
+        return {"content": "dmxlc3M6Ly91dWlkLTE=", "metadata": {}}
+
+    monkeypatch.setattr(SubscriptionService, "generate_subscription_package", fake_generate)
+    buffer = subscription_last_seen_buffer(payloads_module.subscription_payloads.db_path)
+    client = TestClient(app)
+    url = f"/api/subscription/{TOKEN}"
+
+    def last_seen_after(response):
+        buffer.flush_sync()
+        conn = sqlite3.connect(subscription_db)
+        value = conn.execute("SELECT last_updated_at FROM subscriptions WHERE id = 1").fetchone()[0]
+        conn.execute("UPDATE subscriptions SET last_updated_at = NULL WHERE id = 1")
+        conn.commit()
+        conn.close()
+        return response.status_code, value
+
+    first = client.get(url)
+    etag = first.headers["etag"]
+    assert last_seen_after(first)[1] is not None
+
+    status, value = last_seen_after(client.get(url))
+    assert status == 200 and value is not None
+
+    status, value = last_seen_after(client.get(url, headers={"If-None-Match": etag}))
+    assert status == 304 and value is not None
@@ -0,0 +1,80 @@
+"""
+Тесты single-flight генерации подписки по токену
+"""
+import asyncio
+
+import pytest
+
+from bot.services import subscription_service
+from bot.services.subscription_service import SubscriptionService
+
+
+class _Generator:
+    def __init__(self, delay=0.05, fail_first=False):
+        self.delay = delay
+        self.fail_first = fail_first
+        self.calls = 0
+
+    def bind(self):
+        generator = self
+
+        async def _generate_subscription_package(service, token):
+            return await generator(token)
+
+        return _generate_subscription_package
+
+    async def __call__(self, token):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(self.delay)
+        if self.fail_first and call == 1:
+            raise RuntimeError("panel exploded")
+        return {"content": f"{token}:{call}", "metadata": {"call": call}}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_generation(monkeypatch):
+    generator = _Generator()
+    monkeypatch.setattr(SubscriptionService, "_generate_subscription_package", generator.bind())
+    service = SubscriptionService()
+
+    results = await asyncio.gather(*(service.generate_subscription_package("tok") for _ in range(5)))
+
+    assert generator.calls == 1
+    assert all(result == {"content": "tok:1", "metadata": {"call": 1}} for result in results)
+    # Ожидающие получают копии: правка одного результата не видна остальным
+    results[1]["metadata"]["call"] = 99
+    assert results[2]["metadata"]["call"] == 1
+    assert not subscription_service._generation_inflight
+
+    await service.generate_subscription_package("tok")
+    assert generator.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_waiters_fail_open_when_shared_generation_fails(monkeypatch):
+    generator = _Generator(fail_first=True)
+    monkeypatch.setattr(SubscriptionService, "_generate_subscription_package", generator.bind())
+    service = SubscriptionService()
+
+    leader, follower = await asyncio.gather(
+        service.generate_subscription_package("tok"),
+        service.generate_subscription_package("tok"),
+        return_exceptions=True,
+    )
+    assert isinstance(leader, RuntimeError)
+    assert follower["content"] == "tok:2"
+
+
+@pytest.mark.asyncio
+async def test_waiters_fall_back_after_bounded_wait(monkeypatch):
+    generator = _Generator(delay=0.3)
+    monkeypatch.setattr(SubscriptionService, "_generate_subscription_package", generator.bind())
+    monkeypatch.setattr(subscription_service, "GENERATION_WAIT_TIMEOUT", 0.1)
+    service = SubscriptionService()
+
+    leader = asyncio.create_task(service.generate_subscription_package("tok"))
+    await asyncio.sleep(0)
+    follower = await service.generate_subscription_package("tok")
+    assert follower["content"] == "tok:2"
+    assert (await leader)["content"] == "tok:1"
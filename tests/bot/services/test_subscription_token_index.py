@@ -0,0 +1,79 @@
+"""
+Тесты индекса токенов подписок (bot/services/subscription_token_index.py)
+"""
+import sqlite3
+
+import pytest
+
+from bot.services.subscription_token_index import SubscriptionTokenIndex
+
+
+@pytest.fixture
+def tokens_db(tmp_path):
+    db_path = str(tmp_path / "tokens.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE subscriptions (id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_token TEXT UNIQUE NOT NULL)"
+    )
+    conn.execute("INSERT INTO subscriptions (subscription_token) VALUES ('known-token')")
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def _insert(db_path, token):
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO subscriptions (subscription_token) VALUES (?)", (token,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_unknown_tokens_are_rejected_without_queries(tokens_db):
+    index = SubscriptionTokenIndex(tokens_db, refresh_interval_sec=0, enabled=True)
+    assert await index.might_exist("known-token")
+    assert not await index.might_exist("scanner-token")
+    assert not await index.might_exist("scanner-token")
+    assert not await index.might_exist("another-scanner-token")
+
+    # Повторный промах отвечается из отрицательного кэша, без выборки
+    stats = index.stats()
+    assert stats["rebuilds"] == 1 and stats["refreshes"] == 2
+    assert stats["rejected"] == 2 and stats["negative_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_token_created_after_load_is_not_rejected(tokens_db):
+    index = SubscriptionTokenIndex(tokens_db, refresh_interval_sec=60, enabled=True)
+    assert await index.might_exist("known-token")
+
+    _insert(tokens_db, "fresh-token")
+    # Индекс обновлялся только что: промах не отвергается, решает БД
+    assert await index.might_exist("fresh-token")
+    assert index.stats()["deferred"] == 1
+
+
+@pytest.mark.asyncio
+async def test_new_subscriptions_are_picked_up_incrementally(tokens_db):
+    index = SubscriptionTokenIndex(tokens_db, refresh_interval_sec=0, enabled=True)
+    assert await index.might_exist("known-token")
+
+    _insert(tokens_db, "fresh-token")
+    assert await index.might_exist("fresh-token")
+    assert index.stats()["refreshes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_mark_missing_drops_deleted_token(tokens_db):
+    index = SubscriptionTokenIndex(tokens_db, refresh_interval_sec=60, enabled=True)
+    assert await index.might_exist("known-token")
+    index.mark_missing("known-token")
+    assert not await index.might_exist("known-token")
+
+
+@pytest.mark.asyncio
+async def test_unavailable_index_defers_to_database(tmp_path):
+    index = SubscriptionTokenIndex(str(tmp_path / "empty.db"), enabled=True)
+    assert await index.might_exist("any-token")
+    assert await index.might_exist("any-token")
+    assert index.stats()["errors"] == 1
@@ -135,6 +135,7 @@ def temp_db() -> Generator[sqlite3.Connection, None, None]:
             traffic_over_limit_notified INTEGER DEFAULT 0,
             subscription_id INTEGER,
             panel_total_bytes_observed INTEGER NOT NULL DEFAULT 0,
+            panel_key_id TEXT DEFAULT NULL,
             FOREIGN KEY (server_id) REFERENCES servers(id) ON DELETE CASCADE,
             FOREIGN KEY (user_id) REFERENCES users(user_id),
             FOREIGN KEY (tariff_id) REFERENCES tariffs(id),
@@ -210,3 +211,14 @@ def mock_bot() -> MagicMock:
     bot.send_message = AsyncMock(return_value=None)
     return bot
 
+
+
+@pytest.fixture(autouse=True)
+async def close_panel_sessions():
+    """
+    Закрывает общую сессию пула панелей V2Ray после теста,
+    чтобы она не пережила event loop теста
+    """
+    yield
+    from vpn_protocols import close_v2ray_clients
+    await close_v2ray_clients()
@@ -1,6 +1,11 @@
 
+import sqlite3
+
 import pytest
 
+import db
+from app.infra import sqlite_utils
+from app.infra.panel_health import panel_health
 from payments.models.payment import Payment, PaymentStatus
 from payments.services.subscription_purchase_service import SubscriptionPurchaseService
 
@@ -93,3 +98,49 @@ async def test_process_subscription_purchase_completed_payment_skips(monkeypatch
     assert success is True
     assert error is None
 
+
+
+@pytest.mark.asyncio
+async def test_breaker_skipped_server_counts_as_failed_only_when_its_group_gets_no_key(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "purchase.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", db_path)
+    monkeypatch.setenv("DATABASE_PATH", db_path)
+    db.init_db_with_migrations()
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (user_id, created_at) VALUES (1, 0)")
+    conn.execute(
+        "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, is_active) "
+        "VALUES (1, 1, 'token', 0, 4102434000, 1)"
+    )
+    # eu: 1 недоступен, 2 доступен; us: только недоступный 3; 4 (недоступен) и 5 — вне групп
+    conn.executemany(
+        "INSERT INTO servers (id, name, api_url, api_key, domain, protocol, active, subscription_group_id) "
+        "VALUES (?, ?, ?, 'k', 'example.com', 'v2ray', 1, ?)",
+        [
+            (1, "eu-1", "https://down-1.example.com/api", "eu"),
+            (2, "eu-2", "https://up-2.example.com/api", "eu"),
+            (3, "us-1", "https://down-3.example.com/api", "us"),
+            (4, "solo-4", "https://down-4.example.com/api", None),
+            (5, "solo-5", "https://up-5.example.com/api", None),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(panel_health, "is_available", lambda api_url: "down-" not in api_url)
+    service = SubscriptionPurchaseService(db_path=db_path)
+    attempted = []
+
+    async def create_key(server_info, *args):
+        attempted.append(server_info[0])
+        return True, None
+
+    monkeypatch.setattr(service, "_create_single_v2ray_key", create_key)
+    try:
+        created, failed = await service._create_keys_for_subscription(1, 1, None, {"id": 1}, 0)
+    finally:
+        sqlite_utils.close_connection_pools()
+
+    assert sorted(attempted) == [2, 5]
+    assert created == 2
+    assert sorted(failed) == [3, 4]
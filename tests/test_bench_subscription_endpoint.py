@@ -0,0 +1,42 @@
+"""
+Тесты бенчмарка /api/subscription/{token} (scripts/bench_subscription_endpoint.py)
+"""
+import pytest
+
+from scripts.bench_subscription_endpoint import (
+    BenchConfig,
+    append_result,
+    find_baseline,
+    format_report,
+    load_results,
+    percentile,
+    run_benchmark,
+)
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 51
+    assert percentile(values, 99) == 99
+    assert percentile([], 99) == 0.0
+
+
+@pytest.mark.asyncio
+async def test_small_benchmark_run_is_stored_and_compared(tmp_path):
+    config = BenchConfig(users=8, servers=2, rate=100, duration=0.2, storm_repeat=2, concurrency=4, flood_requests=20)
+    record = await run_benchmark(config)
+
+    steady, storm, flood = (record["scenarios"][name] for name in ("steady", "storm", "flood"))
+    assert steady["requests"] == 20
+    assert set(steady["statuses"]) <= {"200", "304"}
+    assert storm["statuses"] == {"200": 16}
+    assert storm["db_ms_mean"] > 0 and storm["p99_ms"] >= storm["p50_ms"]
+    assert flood["statuses"].get("404", 0) >= 10
+
+    results = str(tmp_path / "results.jsonl")
+    append_result(results, dict(record, label="before"))
+    append_result(results, record)
+    records = load_results(results)
+    assert find_baseline(records, records[-1])["label"] == "before"
+    assert find_baseline(records, records[-1], "before") is records[0]
+    assert "p99_ms" in format_report(records[-1], records[0])
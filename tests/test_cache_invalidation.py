@@ -0,0 +1,139 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import db
+from app.infra.cache_invalidation import CacheInvalidationBus, SharedCache
+from app.infra.sqlite_writer import close_sqlite_writers
+
+
+@pytest.fixture
+def bus_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "bus.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", db_path, raising=False)
+    db.migrate_create_cache_invalidations_table()
+    return db_path
+
+
+def _bus(db_path, **kwargs):
+    return CacheInvalidationBus(db_path, poll_interval_sec=0, enabled=True, **kwargs)
+
+
+def test_invalidation_reaches_other_process(bus_db):
+    admin_bus, bot_bus = _bus(bus_db), _bus(bus_db)
+    admin_cache = SharedCache("subscription", admin_bus)
+    bot_cache = SharedCache("subscription", bot_bus)
+    menu_cache = SharedCache("menu", bot_bus)
+    bot_bus.poll()
+
+    for cache in (admin_cache, bot_cache):
+        cache.set("subscription:a", 1)
+        cache.set("subscription:b", 2)
+    menu_cache.set("tariff_menu", 3)
+
+    admin_cache.invalidate("subscription:a")
+    bot_bus.poll()
+    assert admin_cache.get("subscription:a") is None
+    assert bot_cache.get("subscription:a") is None
+    assert bot_cache.get("subscription:b") == 2
+    assert menu_cache.get("tariff_menu") == 3
+
+    admin_bus.publish("menu")
+    bot_bus.poll()
+    assert menu_cache.get("tariff_menu") is None
+    assert bot_bus.stats()["received"] == 2
+
+
+def test_get_polls_in_background_thread(bus_db):
+    admin_bus, bot_bus = _bus(bus_db), _bus(bus_db)
+    cache = SharedCache("subscription", bot_bus)
+    bot_bus.poll()
+    cache.set("subscription:a", 1)
+    admin_bus.publish("subscription", "subscription:a")
+
+    threads = []
+    release = threading.Event()
+    real_poll = bot_bus.poll
+
+    def slow_poll(force=False):
+        threads.append(threading.get_ident())
+        release.wait(5)
+        return real_poll(force)
+
+    bot_bus.poll = slow_poll
+    # Чтение не ждёт БД: значение из памяти, опрос уходит в фоновый поток
+    assert cache.get("subscription:a") == 1
+    pending = bot_bus.poll_soon()
+    release.set()
+    pending.result(timeout=5)
+    assert threads and threading.get_ident() not in threads
+    assert cache.get("subscription:a") is None
+    bot_bus.close()
+
+
+def test_own_events_are_not_applied_twice(bus_db):
+    bus = _bus(bus_db)
+    seen = []
+    bus.subscribe("menu", seen.append)
+    bus.poll()
+    bus.publish("menu", "k")
+    assert bus.poll() == 0
+    assert seen == ["k"]
+
+
+def test_lagging_process_resyncs_whole_namespaces(bus_db):
+    admin_bus, bot_bus = _bus(bus_db), _bus(bus_db, retention_sec=60)
+    cache = SharedCache("menu", bot_bus)
+    bot_bus.poll()
+    cache.set("protocol_selection_menu", "menu")
+
+    admin_bus.publish("subscription", "subscription:x")
+    conn = sqlite3.connect(bus_db)
+    conn.execute("DELETE FROM cache_invalidations")
+    conn.commit()
+    conn.close()
+    bot_bus._last_poll_wall -= 120
+
+    bot_bus.poll()
+    assert cache.get("protocol_selection_menu") is None
+    assert bot_bus.stats()["resyncs"] == 1
+
+
+def test_missing_table_keeps_local_invalidation(tmp_path):
+    bus = _bus(str(tmp_path / "empty.db"))
+    cache = SharedCache("menu", bus)
+    cache.set("k", 1)
+    cache.invalidate("k")
+    assert cache.get("k") is None
+    assert bus.stats()["errors"] == 1
+
+
+async def test_publish_on_event_loop_does_not_wait_for_callers_transaction(bus_db):
+    admin_bus, bot_bus = _bus(bus_db), _bus(bus_db)
+    cache = SharedCache("subscription", bot_bus)
+    bot_bus.poll()
+    cache.set("subscription:a", 1)
+    cache.set("subscription:b", 2)
+
+    # Вызывающий ещё держит свою транзакцию (как get_db_cursor(commit=True) в фоновых задачах)
+    holder = sqlite3.connect(bus_db)
+    holder.execute("BEGIN IMMEDIATE")
+    started = time.monotonic()
+    admin_bus.publish_many("subscription", ["subscription:a", "subscription:b"])
+    admin_bus.publish("menu")
+    assert time.monotonic() - started < 0.5
+    assert admin_bus.stats()["pending"] == 3
+
+    await asyncio.sleep(0)
+    holder.commit()
+    holder.close()
+    await asyncio.gather(*admin_bus._flushes)
+
+    assert admin_bus.stats()["published"] == 3
+    bot_bus.poll()
+    assert cache.get("subscription:a") is None and cache.get("subscription:b") is None
+    assert bot_bus.stats()["received"] == 3
+    close_sqlite_writers()
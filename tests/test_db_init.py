@@ -16,3 +16,34 @@ def test_init_db_with_migrations_creates_core_tables(tmp_path, monkeypatch):
 
     assert {"servers", "tariffs", "subscriptions", "dashboard_metrics"}.issubset(tables)
 
+
+
+def test_subscription_vless_configs_are_canonicalized(tmp_path, monkeypatch):
+    db_path = tmp_path / "veilbot_test.db"
+    monkeypatch.setattr(db, "DATABASE_PATH", str(db_path), raising=False)
+    db.init_db_with_migrations()
+
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    conn.executemany(
+        "INSERT INTO v2ray_keys (id, v2ray_uuid, subscription_id, client_config) VALUES (?, ?, ?, ?)",
+        [
+            (1, "a", 1, "vless://a@host:443?sid=1#user%40mail"),
+            (2, "b", 1, "config:\nvless://b@host:443?sid=2\n"),
+            (3, "c", None, "vless://c@host:443?sid=3#standalone"),
+            (4, "d", 1, "vless://d@host:443?sid=4"),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    db.migrate_canonicalize_subscription_vless_configs()
+
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    configs = dict(conn.execute("SELECT id, client_config FROM v2ray_keys").fetchall())
+    conn.close()
+    assert configs == {
+        1: "vless://a@host:443?sid=1",
+        2: "vless://b@host:443?sid=2",
+        3: "vless://c@host:443?sid=3#standalone",
+        4: "vless://d@host:443?sid=4",
+    }
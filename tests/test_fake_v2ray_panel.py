@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from app.infra.panel_concurrency import panel_concurrency
+from app.infra.panel_health import panel_health
+from app.infra.panel_singleflight import panel_singleflight
+from scripts.fake_v2ray_panel import FakePanelConfig, LatencyModel, start_fake_panels, stop_fake_panels
+from vpn_protocols import get_v2ray_client, remove_fragment_from_vless, vless_link_templates
+
+
+@pytest.fixture
+async def fake_panel(monkeypatch):
+    monkeypatch.setattr(panel_health, "_persist", lambda state: None)
+    panels = await start_fake_panels(1, config_factory=lambda i: FakePanelConfig(api_key="secret", initial_keys=3))
+    try:
+        yield panels[0]
+    finally:
+        await stop_fake_panels(panels)
+        panel_health.reset()
+        panel_concurrency.reset()
+        panel_singleflight.reset()
+        vless_link_templates.invalidate()
+
+
+def test_latency_model_parse():
+    assert LatencyModel.parse("fixed:25").a == 25
+    model = LatencyModel.parse("uniform:10:20")
+    assert (model.kind, model.a, model.b) == ("uniform", 10, 20)
+    with pytest.raises(ValueError):
+        LatencyModel.parse("gauss:1")
+
+
+@pytest.mark.asyncio
+async def test_v2ray_client_round_trip_against_fake_panel(fake_panel):
+    client = get_v2ray_client(fake_panel["api_url"], "secret")
+    assert len(await client.get_all_keys()) == 3
+
+    created = await client.create_user("user@example.com", name="bench")
+    assert created["client_config"].startswith(f"vless://{created['uuid']}@127.0.0.1:")
+    assert (await client.get_key_info(created["uuid"]))["id"] == created["id"]
+
+    totals = await client.get_traffic_totals_by_uuid()
+    assert created["uuid"] in totals
+    panel_id, stats = await client.get_v2ray_key_traffic_resolved(created["uuid"])
+    assert panel_id == str(created["id"]) and stats["total_bytes"] == 0
+    assert await client.reset_key_traffic(str(created["id"]))
+
+    assert await client.delete_user(str(created["id"]))
+    assert len(await client.get_all_keys()) == 3
+
+
+@pytest.mark.asyncio
+async def test_fake_panel_fault_injection(fake_panel):
+    fake_panel["app"]["state"].config.update({"error_rate": 1.0})
+    client = get_v2ray_client(fake_panel["api_url"], "secret")
+    assert await client.get_all_keys() == []
+    assert fake_panel["app"]["state"].faults["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_iter_all_keys_streams_panel_listing(fake_panel):
+    client = get_v2ray_client(fake_panel["api_url"], "secret")
+    streamed = [key async for key in client.iter_all_keys(chunk_size=64)]
+    assert [key["uuid"] for key in streamed] == [key["uuid"] for key in await client.get_all_keys()]
+
+    fake_panel["app"]["state"].config.update({"error_rate": 1.0})
+    with pytest.raises(Exception):
+        async for _ in client.iter_all_keys():
+            pass
+
+
+@pytest.mark.asyncio
+async def test_create_user_renders_link_from_learned_template(fake_panel):
+    client = get_v2ray_client(fake_panel["api_url"], "secret")
+    requests = fake_panel["app"]["state"].requests
+    await client.create_user("first@example.com", name="first")
+    assert requests.get("GET /api/keys/{key_id}/link") == 1
+
+    second = await client.create_user("second@example.com", name="second")
+    assert requests.get("GET /api/keys/{key_id}/link") == 1
+    panel_link = await client.get_user_config(second["uuid"], {}, max_retries=1)
+    assert remove_fragment_from_vless(second["client_config"]) == remove_fragment_from_vless(panel_link)
+
+
+
+@pytest.mark.asyncio
+async def test_get_user_config_releases_panel_slot_between_retries(fake_panel, monkeypatch):
+    client = get_v2ray_client(fake_panel["api_url"], "secret")
+    real_sleep = asyncio.sleep
+    in_flight_during_sleep = []
+
+    async def recording_sleep(delay, *args, **kwargs):
+        stats = panel_concurrency.stats()
+        in_flight_during_sleep.append(sum(panel["in_flight"] for panel in stats.values()))
+        return await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", recording_sleep)
+    with pytest.raises(Exception):
+        await client.get_user_config("00000000-0000-0000-0000-000000000000", {}, max_retries=3, retry_delay=5)
+
+    assert in_flight_during_sleep and set(in_flight_during_sleep) == {0}
+
+
+@pytest.mark.asyncio
+async def test_iter_all_keys_does_not_hold_panel_slot_while_consumer_runs(fake_panel):
+    client = get_v2ray_client(fake_panel["api_url"], "secret")
+    in_flight = []
+    async for _ in client.iter_all_keys(chunk_size=64):
+        stats = panel_concurrency.stats()
+        in_flight.append(sum(panel["in_flight"] for panel in stats.values()))
+    assert in_flight and set(in_flight) == {0}
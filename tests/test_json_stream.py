@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from app.infra.json_stream import iter_json_array
+
+
+async def _chunks(payload: bytes, size: int):
+    for offset in range(0, len(payload), size):
+        yield payload[offset:offset + size]
+
+
+async def _collect(payload, size=7, field="keys"):
+    return [item async for item in iter_json_array(_chunks(payload, size), field=field)]
+
+
+KEYS = [
+    {"id": 1, "uuid": "u-1", "name": 'ключ, "первый" \\ [a]'},
+    {"id": 22, "uuid": "u-2", "name": "b}", "port": 12345},
+    {"id": 333, "uuid": "u-3", "nested": {"list": [1, 2.5, None, True]}},
+]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [1, 3, 64, 4096])
+async def test_object_with_keys_field_any_chunking(size):
+    payload = json.dumps({"total": 12345, "meta": {"keys": []}, "keys": KEYS, "after": [1]}, ensure_ascii=False)
+    assert await _collect(payload.encode("utf-8"), size) == KEYS
+
+
+@pytest.mark.asyncio
+async def test_top_level_array_and_empty_documents():
+    assert await _collect(json.dumps(KEYS).encode(), 5) == KEYS
+    assert await _collect(b" [ ] ") == []
+    assert await _collect(b'{"total": 0}') == []
+    assert await _collect(b'{"keys": []}') == []
+
+
+@pytest.mark.asyncio
+async def test_truncated_stream_raises_after_yielding_complete_items():
+    payload = json.dumps({"keys": KEYS}).encode()[:-20]
+    received = []
+    with pytest.raises(ValueError):
+        async for item in iter_json_array(_chunks(payload, 16), field="keys"):
+            received.append(item)
+    assert received == KEYS[:2]
+
+
+async def _from_list(parts):
+    for part in parts:
+        yield part
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "parts, expected",
+    [
+        ([b"[1.", b"5]"], [1.5]),
+        ([b"[-2e", b"3]"], [-2000.0]),
+        ([b"[1", b"2, tr", b"ue, nu", b"ll]"], [12, True, None]),
+        ([b'{"keys": [7', b'0], "total": 1', b"0}"], [70]),
+    ],
+)
+async def test_numbers_and_literals_split_across_chunks(parts, expected):
+    assert [item async for item in iter_json_array(_from_list(parts), field="keys")] == expected
@@ -0,0 +1,125 @@
+import pytest
+
+from app.infra.panel_http import PanelSessionPool, panel_session_pool
+from vpn_protocols import ProtocolFactory, V2RayClientRegistry, V2RayProtocol, close_v2ray_clients
+
+
+def test_registry_reuses_client_per_api_url_and_key():
+    registry = V2RayClientRegistry()
+    first = registry.get("https://panel.example.com", "key-1")
+    assert registry.get("https://panel.example.com", "key-1") is first
+    assert registry.get("https://panel.example.com", "key-2") is not first
+    assert registry.size() == 2
+
+
+def test_protocol_factory_returns_shared_client():
+    config = {"api_url": "https://factory.example.com", "api_key": "k"}
+    client = ProtocolFactory.create_protocol("v2ray", config)
+    assert isinstance(client, V2RayProtocol)
+    assert ProtocolFactory.create_protocol("v2ray", config) is client
+
+
+@pytest.mark.asyncio
+async def test_pool_returns_one_session_per_loop_and_closes_it():
+    pool = PanelSessionPool(limit=10, limit_per_host=2)
+    session = pool.get_session()
+    assert pool.get_session() is session
+    assert session.connector.limit_per_host == 2
+    await pool.close()
+    assert session.closed
+    assert pool.get_session() is not session
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_client_close_keeps_pool_session_open():
+    client = ProtocolFactory.create_protocol("v2ray", {"api_url": "https://shared.example.com", "api_key": "k"})
+    session = client._session
+    await client.close()
+    assert not session.closed
+    assert ProtocolFactory.create_protocol("v2ray", {"api_url": "https://other.example.com"})._session is session
+    await close_v2ray_clients()
+    assert session.closed
+    assert panel_session_pool.stats()["sessions"] == 0
+
+
+@pytest.mark.asyncio
+async def test_standalone_client_owns_its_session():
+    client = V2RayProtocol("https://standalone.example.com", "k")
+    session = client._session
+    assert client._session is session
+    await client.close()
+    assert session.closed
+
+
+def _stub_traffic_client(monkeypatch, responses):
+    """Клиент, у которого GET /keys/{id}/traffic и GET /keys/{uuid} отвечают из словарей."""
+    client = V2RayProtocol("https://stub.example.com", "k")
+    calls = []
+
+    async def fake_request_stats(key_id):
+        calls.append(("traffic", key_id))
+        return responses.get(key_id, (404, {}))
+
+    async def fake_get_key_info(key_id):
+        calls.append(("info", key_id))
+        return {"id": 7} if key_id == "uuid-1" else {}
+
+    monkeypatch.setattr(client, "_request_key_traffic_stats", fake_request_stats)
+    monkeypatch.setattr(client, "get_key_info", fake_get_key_info)
+    return client, calls
+
+
+@pytest.mark.asyncio
+async def test_traffic_resolved_uses_stored_panel_key_id(monkeypatch):
+    client, calls = _stub_traffic_client(monkeypatch, {"7": (200, {"uuid": "uuid-1", "total_bytes": 10})})
+    panel_id, stats = await client.get_v2ray_key_traffic_resolved("uuid-1", panel_key_id="7")
+    assert (panel_id, stats["total_bytes"]) == ("7", 10)
+    assert calls == [("traffic", "7")]
+
+
+@pytest.mark.asyncio
+async def test_traffic_resolved_re_resolves_after_404(monkeypatch):
+    client, calls = _stub_traffic_client(monkeypatch, {"7": (200, {"uuid": "uuid-1", "total_bytes": 10})})
+    panel_id, stats = await client.get_v2ray_key_traffic_resolved("uuid-1", panel_key_id="3")
+    assert (panel_id, stats["total_bytes"]) == ("7", 10)
+    assert calls == [("traffic", "3"), ("info", "uuid-1"), ("traffic", "7")]
+
+
+@pytest.mark.asyncio
+async def test_traffic_resolved_does_not_re_resolve_on_server_error(monkeypatch):
+    client, calls = _stub_traffic_client(monkeypatch, {"7": (502, {})})
+    assert await client.get_v2ray_key_traffic_resolved("uuid-1", panel_key_id="7") == (None, {})
+    assert calls == [("traffic", "7")]
+
+
+def _stub_reset_client(monkeypatch, responses):
+    client, calls = _stub_traffic_client(monkeypatch, responses)
+
+    async def fake_request_reset(key_id):
+        calls.append(("reset", key_id))
+        return 200, True
+
+    monkeypatch.setattr(client, "_request_key_traffic_reset", fake_request_reset)
+    return client, calls
+
+
+@pytest.mark.asyncio
+async def test_reset_resolved_checks_owner_of_stored_panel_key_id(monkeypatch):
+    client, calls = _stub_reset_client(monkeypatch, {"7": (200, {"uuid": "uuid-1", "total_bytes": 10})})
+    assert await client.reset_v2ray_key_traffic_resolved("uuid-1", panel_key_id="7") == ("7", True)
+    assert calls == [("traffic", "7"), ("reset", "7")]
+
+
+@pytest.mark.asyncio
+async def test_reset_resolved_does_not_reset_reassigned_panel_key_id(monkeypatch):
+    client, calls = _stub_reset_client(monkeypatch, {"3": (200, {"uuid": "uuid-other", "total_bytes": 10})})
+    assert await client.reset_v2ray_key_traffic_resolved("uuid-1", panel_key_id="3") == ("7", True)
+    assert calls == [("traffic", "3"), ("info", "uuid-1"), ("reset", "7")]
+
+
+@pytest.mark.asyncio
+async def test_reset_resolved_skips_unconfirmed_panel_key_id_on_server_error(monkeypatch):
+    client, calls = _stub_reset_client(monkeypatch, {"7": (502, {})})
+    assert await client.reset_v2ray_key_traffic_resolved("uuid-1", panel_key_id="7") == ("7", False)
+    assert calls == [("traffic", "7")]
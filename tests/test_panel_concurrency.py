@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from app.infra.panel_concurrency import PanelConcurrencyController
+
+
+async def _max_concurrency(controller, urls):
+    active = 0
+    peak = 0
+
+    async def call(url):
+        nonlocal active, peak
+        async with controller.slot(url):
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    await asyncio.gather(*(call(url) for url in urls))
+    return peak
+
+
+@pytest.mark.asyncio
+async def test_slot_limits_concurrency_per_panel():
+    controller = PanelConcurrencyController(initial_limit=2, max_limit=8, global_limit=100)
+    assert await _max_concurrency(controller, ["https://a.example.com"] * 6) == 2
+
+
+@pytest.mark.asyncio
+async def test_global_cap_applies_across_panels():
+    controller = PanelConcurrencyController(initial_limit=4, max_limit=8, global_limit=3)
+    urls = ["https://a.example.com", "https://b.example.com"] * 4
+    assert await _max_concurrency(controller, urls) == 3
+
+
+@pytest.mark.asyncio
+async def test_nested_slot_for_same_panel_is_reentrant():
+    controller = PanelConcurrencyController(initial_limit=1, max_limit=1, global_limit=1)
+    async with controller.slot("https://a.example.com"):
+        async with controller.slot("https://a.example.com/api/keys"):
+            pass
+    assert controller.stats()["a.example.com:443"]["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_exited_from_another_context_is_released():
+    controller = PanelConcurrencyController(initial_limit=1, max_limit=1, global_limit=1)
+    slot = controller.slot("https://a.example.com")
+    await slot.__aenter__()
+    # Брошенный генератор закрывается, например, при сборке мусора — уже в другом контексте
+    await asyncio.create_task(slot.__aexit__(None, None, None))
+    assert controller.stats()["a.example.com:443"]["in_flight"] == 0
+    assert controller._global.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_leak_slot():
+    controller = PanelConcurrencyController(initial_limit=1, max_limit=1, global_limit=10)
+    url = "https://a.example.com"
+    released = asyncio.Event()
+
+    async def holder():
+        async with controller.slot(url):
+            await released.wait()
+
+    async def waiter():
+        async with controller.slot(url):
+            pass
+
+    holder_task = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+    waiter_task = asyncio.create_task(waiter())
+    await asyncio.sleep(0)
+    waiter_task.cancel()
+    released.set()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter_task
+    await holder_task
+    async with controller.slot(url):
+        pass
+    assert controller.stats()["a.example.com:443"]["in_flight"] == 0
+
+
+def test_aimd_decreases_on_error_and_grows_when_saturated():
+    controller = PanelConcurrencyController(
+        initial_limit=8, min_limit=1, max_limit=16, global_limit=100, decrease_cooldown_sec=0
+    )
+    url = "https://a.example.com/api/keys/1/traffic"
+    controller.on_result(url, False)
+    assert controller.limit_for(url) == 4
+
+    panel = controller._get("a.example.com:443")
+    panel.gate.in_flight = 4
+    for _ in range(8):
+        controller.on_result(url, True, 50.0)
+    assert controller.limit_for(url) == 5
+
+
+def test_aimd_decreases_when_latency_rises_above_baseline():
+    controller = PanelConcurrencyController(
+        initial_limit=10, max_limit=16, global_limit=100, decrease_cooldown_sec=0, ewma_alpha=1.0
+    )
+    url = "https://a.example.com"
+    controller.on_result(url, True, 20.0)
+    controller.on_result(url, True, 200.0)
+    assert controller.limit_for(url) == 8
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from app.infra.panel_health import (
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    PanelCircuitOpenError,
+    PanelHealthRegistry,
+    panel_health,
+    panel_key,
+)
+from vpn_protocols import V2RayProtocol
+
+
+def _registry(**overrides):
+    params = dict(failure_threshold=3, min_requests=4, cooldown_sec=60, persist_interval_sec=0)
+    params.update(overrides)
+    registry = PanelHealthRegistry(**params)
+    registry._persist = lambda state: None
+    return registry
+
+
+def test_panel_key_normalizes_scheme_and_port():
+    assert panel_key("https://Panel.example.com/api") == "panel.example.com:443"
+    assert panel_key("panel.example.com:8443") == "panel.example.com:8443"
+    assert panel_key("http://panel.example.com") == "panel.example.com:80"
+    assert panel_key("") == ""
+
+
+def test_breaker_opens_after_consecutive_failures_and_fails_fast():
+    registry = _registry()
+    url = "https://panel.example.com/api"
+    for _ in range(3):
+        registry.check(url)
+        registry.record(f"{url}/keys", False, 100.0, "HTTP 502")
+
+    assert registry.get_state(url)["state"] == STATE_OPEN
+    assert not registry.is_available(url)
+    with pytest.raises(PanelCircuitOpenError):
+        registry.check(url)
+
+
+def test_breaker_opens_on_error_rate():
+    registry = _registry(failure_threshold=100, error_rate_threshold=0.5)
+    url = "https://panel.example.com/api"
+    for ok in (True, False, True, False):
+        registry.record(url, ok, 10.0)
+    assert registry.get_state(url)["state"] == STATE_OPEN
+
+
+def test_half_open_allows_single_probe_and_success_closes():
+    registry = _registry(cooldown_sec=0)
+    url = "https://panel.example.com/api"
+    for _ in range(3):
+        registry.record(url, False)
+
+    assert registry.get_state(url)["state"] == STATE_HALF_OPEN
+    registry.check(url)
+    with pytest.raises(PanelCircuitOpenError):
+        registry.check(url)
+
+    registry.record(url, True, 50.0)
+    state = registry.get_state(url)
+    assert state["state"] == STATE_CLOSED
+    assert state["consecutive_failures"] == 0
+    registry.check(url)
+
+
+def test_latency_ewma_is_tracked():
+    registry = _registry()
+    url = "https://panel.example.com/api"
+    registry.record(url, True, 100.0)
+    registry.record(url, True, 200.0)
+    assert registry.get_state(url)["latency_ewma_ms"] == pytest.approx(120.0)
+
+
+@pytest.mark.asyncio
+async def test_v2ray_client_fails_fast_when_circuit_open(monkeypatch):
+    monkeypatch.setattr(panel_health, "_persist", lambda state: None)
+    url = "https://dead-panel.example.com"
+    try:
+        for _ in range(panel_health.failure_threshold):
+            panel_health.record(url, False)
+        client = V2RayProtocol(url, "k")
+        assert await client.get_key_info("uuid-1") == {}
+        assert client._own_session is None
+    finally:
+        panel_health.reset()
+
+
+async def test_record_on_event_loop_persists_in_background_thread():
+    registry = PanelHealthRegistry(failure_threshold=1, persist_interval_sec=0)
+    persisted = []
+    release = threading.Event()
+
+    def slow_persist(state):
+        release.wait(5)
+        persisted.append((state["state"], threading.current_thread() is threading.main_thread()))
+
+    registry._persist = slow_persist
+    started = time.monotonic()
+    registry.record("https://panel.example.com/api/keys", False, 100.0, "HTTP 502")
+    assert time.monotonic() - started < 0.5
+    assert persisted == []
+
+    release.set()
+    registry._persist_executor.shutdown(wait=True)
+    assert persisted == [(STATE_OPEN, False)]
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from app.infra.panel_metrics import (
+    PanelMetricsRegistry,
+    endpoint_template,
+    merge_series,
+    panel_metrics,
+    quantile_ms,
+    render_prometheus,
+    status_class,
+    summarize_by_panel,
+)
+
+
+def _registry():
+    registry = PanelMetricsRegistry(persist_interval_sec=0, process_name="test")
+    registry.load_persisted = lambda max_age_sec=3600: {}
+    return registry
+
+
+def test_endpoint_template_replaces_ids():
+    assert endpoint_template("get", "https://p.example.com/api/keys/123/traffic") == "GET /keys/{id}/traffic"
+    assert (
+        endpoint_template("GET", "https://p.example.com/api/keys/52b598fa-34dc-4753-bef0-bcd52728e9cc")
+        == "GET /keys/{id}"
+    )
+    assert endpoint_template("GET", "https://p.example.com/api/traffic/daily/2026-01-05") == "GET /traffic/daily/{id}"
+    assert endpoint_template("POST", "https://p.example.com/api/keys") == "POST /keys"
+
+
+def test_status_class():
+    assert status_class(200) == "2xx"
+    assert status_class(404) == "4xx"
+    assert status_class(exception=TimeoutError()) == "timeout"
+    assert status_class(exception=OSError()) == "error"
+
+
+def test_histogram_summary_and_prometheus():
+    registry = _registry()
+    url = "https://p.example.com/api/keys/1/traffic"
+    for duration in (5, 40, 40, 90):
+        registry.observe(url, "GET", "2xx", duration)
+    registry.observe(url, "GET", "5xx", 3000)
+
+    summary = summarize_by_panel(registry.collect())["p.example.com:443"]
+    assert (summary["requests"], summary["errors"]) == (5, 1)
+    assert summary["slowest_endpoint"] == "GET /keys/{id}/traffic"
+    assert 25 <= summary["p50_ms"] <= 50
+
+    text = render_prometheus(registry.collect(), {"p.example.com:443": 7})
+    assert (
+        'veilbot_panel_request_duration_ms_bucket{server_id="7",panel="p.example.com:443",'
+        'endpoint="GET /keys/{id}/traffic",status="2xx",le="50"} 3'
+    ) in text
+    assert 'veilbot_panel_requests_total{server_id="7",panel="p.example.com:443",' in text
+
+
+def test_merge_series_sums_processes():
+    registry = _registry()
+    registry.observe("https://p.example.com/api/traffic", "GET", "2xx", 20)
+    merged = merge_series([registry.snapshot(), registry.snapshot()])
+    assert merged[0]["count"] == 2
+    assert quantile_ms(merged[0]["buckets"], 0.5) <= 25
+
+
+@pytest.mark.asyncio
+async def test_panel_requests_are_recorded_by_trace_config(monkeypatch):
+    from app.infra.panel_health import panel_health
+    from scripts.fake_v2ray_panel import FakePanelConfig, start_fake_panels, stop_fake_panels
+    from vpn_protocols import get_v2ray_client
+
+    monkeypatch.setattr(panel_health, "_persist", lambda state: None)
+    monkeypatch.setattr(panel_metrics, "persist_interval_sec", 0)
+    panels = await start_fake_panels(1, config_factory=lambda i: FakePanelConfig(initial_keys=1))
+    try:
+        client = get_v2ray_client(panels[0]["api_url"], "k")
+        await client.get_all_keys()
+        await client.get_key_info("does-not-exist-0000")
+        endpoints = {
+            (s["endpoint"], s["status"]): s["count"]
+            for s in panel_metrics.snapshot()
+            if s["panel"] == f"127.0.0.1:{panels[0]['port']}"
+        }
+        assert endpoints == {("GET /keys", "2xx"): 1, ("GET /keys/{id}", "4xx"): 1}
+    finally:
+        await stop_fake_panels(panels)
+        panel_health.reset()
+        panel_metrics.reset()
+
+
+async def test_observe_on_event_loop_persists_in_background_thread():
+    registry = PanelMetricsRegistry(persist_interval_sec=0.001, process_name="test")
+    persisted = []
+    release = threading.Event()
+
+    def slow_persist():
+        release.wait(5)
+        persisted.append(threading.current_thread() is threading.main_thread())
+
+    registry._persist = slow_persist
+    time.sleep(0.01)
+    started = time.monotonic()
+    registry.observe("https://p.example.com/api/keys", "GET", "2xx", 12.0)
+    assert time.monotonic() - started < 0.5
+    assert persisted == []
+
+    release.set()
+    registry._persist_executor.shutdown(wait=True)
+    assert persisted == [False]
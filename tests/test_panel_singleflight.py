@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from app.infra.panel_singleflight import PanelSingleFlight, panel_singleflight
+from vpn_protocols import V2RayProtocol
+
+
+def _counting_fetch(result, delay=0.01):
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return result
+
+    return fetch, calls
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_request_and_get_copies():
+    flight = PanelSingleFlight(ttl_sec=0)
+    fetch, calls = _counting_fetch([{"uuid": "u-1"}])
+    results = await asyncio.gather(*(flight.do(("panel", "keys"), fetch) for _ in range(5)))
+
+    assert len(calls) == 1
+    assert all(result == [{"uuid": "u-1"}] for result in results)
+    results[1][0]["uuid"] = "changed"
+    assert results[2][0]["uuid"] == "u-1"
+    assert flight.stats()["coalesced"] == 4
+    assert flight.stats()["inflight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_absorbs_burst_and_invalidate_clears_it():
+    flight = PanelSingleFlight(ttl_sec=60)
+    fetch, calls = _counting_fetch({"id": 7})
+    await flight.do(("panel", "info"), fetch)
+    await flight.do(("panel", "info"), fetch)
+    assert len(calls) == 1
+
+    flight.invalidate("panel")
+    await flight.do(("panel", "info"), fetch)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_empty_result_is_not_cached():
+    flight = PanelSingleFlight(ttl_sec=60)
+    fetch, calls = _counting_fetch({})
+    await flight.do(("panel", "info"), fetch)
+    await flight.do(("panel", "info"), fetch)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_cancel_shared_request():
+    flight = PanelSingleFlight(ttl_sec=0)
+    fetch, calls = _counting_fetch({"id": 1}, delay=0.02)
+    first = asyncio.create_task(flight.do(("panel", "info"), fetch))
+    second = asyncio.create_task(flight.do(("panel", "info"), fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == {"id": 1}
+    assert len(calls) == 1
+
+
+class _FakeResponse:
+    status = 200
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    async def json(self):
+        return self._payload
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _FakeSession:
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, headers=None):
+        self.calls.append(url)
+        return _FakeResponse({"keys": [{"id": "1", "uuid": "u-1"}]})
+
+
+@pytest.mark.asyncio
+async def test_v2ray_get_all_keys_is_coalesced(monkeypatch):
+    client = V2RayProtocol("https://coalesce.example.com", "k")
+    session = _FakeSession()
+    monkeypatch.setattr(V2RayProtocol, "_session", property(lambda self: session))
+
+    first, second = await asyncio.gather(client.get_all_keys(), client.get_all_keys())
+    assert first == second == [{"id": "1", "uuid": "u-1"}]
+    assert session.calls == ["https://coalesce.example.com/api/keys"]
+    panel_singleflight.reset()
@@ -0,0 +1,182 @@
+"""
+Регрессия планов запросов: SQL репозиториев и фоновых задач не должен делать полный проход
+по таблице или сортировку во временном B-дереве без причины.
+
+Выражения собираются из исходников (строковые константы, начинающиеся с SELECT/UPDATE/DELETE/WITH),
+для каждого снимается EXPLAIN QUERY PLAN на схеме после всех миграций. Шаблоны с подстановками
+{...} проверяются с пустыми подстановками (условие целиком — «1»), f-строки и фрагменты
+запросов пропускаются.
+Допустимые исключения перечислены в ALLOWED с причиной.
+"""
+import ast
+import re
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+import db
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SOURCES = (
+    "app/repositories/key_repository.py",
+    "app/repositories/server_repository.py",
+    "app/repositories/subscription_repository.py",
+    "app/repositories/tariff_repository.py",
+    "app/repositories/user_repository.py",
+    "payments/repositories/payment_repository.py",
+    "payments/services/subscription_purchase_service.py",
+    "bot/services/background_tasks.py",
+    "bot/services/subscription_payloads.py",
+    "bot/services/subscription_token_index.py",
+    "admin/routes/dashboard.py",
+)
+
+# Небольшие справочники: полный проход дешевле индекса
+SMALL_TABLES = ("servers", "tariffs", "dashboard_metrics")
+
+# (файл, функция) -> причина
+ALLOWED = {
+    ("app/repositories/key_repository.py", "list_v2ray_keys_with_server"): "полный список ключей для админки",
+    ("app/repositories/key_repository.py", "add_v2ray"): "полный список ключей для админки (list_keys_unified)",
+    ("app/repositories/subscription_repository.py", "list_subscriptions"): "постраничный список подписок админки с поиском",
+    ("app/repositories/subscription_repository.py", "count_subscriptions"): "счётчик для списка подписок админки",
+    ("app/repositories/subscription_repository.py", "get_active_subscription"): "сортировка подписок одного пользователя",
+    ("app/repositories/subscription_repository.py", "get_active_subscription_async"): "сортировка подписок одного пользователя",
+    ("app/repositories/subscription_repository.py", "get_subscriptions_without_purchase_notification"): "сортировка по COALESCE среди неуведомлённых подписок",
+    ("app/repositories/subscription_repository.py", "get_subscription_keys"): "сортировка ключей одной подписки",
+    ("app/repositories/subscription_repository.py", "get_subscription_keys_async"): "сортировка ключей одной подписки",
+    ("app/repositories/subscription_repository.py", "get_subscription_keys_list"): "сортировка ключей одной подписки",
+    ("app/repositories/subscription_repository.py", "load_subscription_generation_data_async"): "ключи и count(DISTINCT) одной подписки",
+    ("app/repositories/user_repository.py", "_resolve_user_email"): "сортировка нескольких строк одного пользователя",
+    ("app/repositories/user_repository.py", "count_active_users"): "count(DISTINCT) для статистики админки",
+    ("payments/repositories/payment_repository.py", "get_statistics"): "GROUP BY currency для статистики админки",
+    ("payments/services/subscription_purchase_service.py", "_create_subscription"): "сортировка подписок одного пользователя",
+    ("payments/services/subscription_purchase_service.py", "_get_or_create_subscription"): "сортировка подписок одного пользователя",
+    ("bot/services/background_tasks.py", "job"): "периодические задачи: очистка истёкших ключей, подписки одного пользователя",
+    ("bot/services/subscription_payloads.py", "load_state"): "сортировка ключей одной подписки",
+}
+
+_SQL_START = re.compile(r"^\s*(SELECT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"\{\w*\}")
+# Подстановка на месте условия целиком (WHERE {search_condition}) — истинное условие
+_PREDICATE_PLACEHOLDER = re.compile(r"\b(WHERE|AND|OR)(\s+)\{\w*\}", re.IGNORECASE)
+_PARAM_COUNT = re.compile(r"uses (\d+)")
+
+
+def _collect_statements():
+    statements = []
+    for source in SOURCES:
+        tree = ast.parse((ROOT / source).read_text(encoding="utf-8"))
+        skipped = {
+            id(value)
+            for node in ast.walk(tree) if isinstance(node, ast.JoinedStr)
+            for value in node.values
+        }
+        functions = [
+            node for node in ast.walk(tree) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        ]
+        for node in ast.walk(tree):
+            if not (isinstance(node, ast.Constant) and isinstance(node.value, str)):
+                continue
+            if id(node) in skipped or not _SQL_START.match(node.value):
+                continue
+            owner = min(
+                (f for f in functions if f.lineno <= node.lineno <= f.end_lineno),
+                key=lambda f: f.end_lineno - f.lineno,
+                default=None,
+            )
+            statements.append((source, owner.name if owner else "<module>", node.lineno, node.value))
+    return statements
+
+
+def _explain(conn, sql):
+    sql = _PLACEHOLDER.sub("", _PREDICATE_PLACEHOLDER.sub(r"\1\g<2>1", sql))
+    try:
+        return conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")).fetchall()
+    except sqlite3.ProgrammingError as e:
+        match = _PARAM_COUNT.search(str(e))
+        if not match:
+            raise
+        return conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * int(match.group(1))).fetchall()
+
+
+def _problems(plan):
+    problems = []
+    for _, _, _, detail in plan:
+        if "TEMP B-TREE" in detail:
+            problems.append(detail)
+        elif (
+            detail.startswith("SCAN")
+            and "INDEX" not in detail
+            and "(subquery" not in detail
+            and "CONSTANT ROW" not in detail
+            and not any(re.search(rf"\b{table}\b", detail) for table in SMALL_TABLES)
+        ):
+            problems.append(detail)
+    return problems
+
+
+@pytest.fixture(scope="module")
+def schema(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("plans") / "plans.db")
+    patch = pytest.MonkeyPatch()
+    patch.setattr(db, "DATABASE_PATH", path)
+    patch.setenv("DATABASE_PATH", path)
+    try:
+        db.init_db_with_migrations()
+    finally:
+        patch.undo()
+    conn = sqlite3.connect(path)
+    yield conn
+    conn.close()
+
+
+def test_statements_are_collected():
+    statements = _collect_statements()
+    assert len(statements) > 100
+    assert {source for source, *_ in statements} == set(SOURCES)
+
+
+def test_hot_queries_do_not_scan_or_sort(schema):
+    failures = []
+    checked = 0
+    for source, function, lineno, sql in _collect_statements():
+        try:
+            plan = _explain(schema, sql)
+        except sqlite3.OperationalError as e:
+            if "incomplete input" in str(e):
+                continue  # фрагмент, который склеивается с другими строками
+            failures.append(f"{source}:{lineno} {function}: {e}")
+            continue
+        checked += 1
+        problems = _problems(plan)
+        if problems and (source, function) not in ALLOWED:
+            failures.append(f"{source}:{lineno} {function}: {problems}")
+    assert checked > 100
+    assert not failures, "\n".join(failures)
+
+
+@pytest.mark.parametrize(
+    "sql, index",
+    [
+        ("SELECT id FROM v2ray_keys WHERE server_id = ? AND subscription_id = ?", "idx_v2ray_keys_server_subscription"),
+        ("SELECT id FROM subscriptions WHERE is_active = 1 AND expires_at > ?", "idx_subscriptions_active_expires"),
+        (
+            "SELECT id FROM subscriptions WHERE user_id = ? AND is_active = 1 AND expires_at > ?",
+            "idx_subscriptions_user_active_expires",
+        ),
+        (
+            "SELECT created_at FROM payments WHERE subscription_id = ? AND status = 'completed' ORDER BY created_at",
+            "idx_payments_subscription_status_created",
+        ),
+        (
+            "SELECT referred_id FROM referrals WHERE referrer_id = ? ORDER BY created_at DESC, referred_id ASC",
+            "idx_referrals_referrer_created",
+        ),
+    ],
+)
+def test_composite_indexes_are_used(schema, sql, index):
+    details = " ".join(row[3] for row in _explain(schema, sql))
+    assert index in details and "TEMP B-TREE" not in details
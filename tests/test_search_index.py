@@ -0,0 +1,142 @@
+"""
+Тесты FTS5-индекса поиска админки (app/infra/search_index.py)
+"""
+import sqlite3
+
+import pytest
+
+import db
+from app.infra import search_index, sqlite_utils
+from app.infra.search_index import rebuild_search_index
+from app.repositories.key_repository import KeyRepository
+from app.repositories.subscription_repository import SubscriptionRepository
+from app.repositories.user_repository import UserRepository
+
+TOKEN = "3c1e9a52-7d4b-4f0e-8b6a-1f2e3d4c5b6a"
+
+
+@pytest.fixture
+def search_db(tmp_path, monkeypatch):
+    path = str(tmp_path / "search.db")
+    monkeypatch.setattr(db, "DATABASE_PATH", path)
+    monkeypatch.setenv("DATABASE_PATH", path)
+    db.init_db_with_migrations()
+
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, created_at) VALUES (?, ?, ?, 0)",
+        [(1001, "alice_vpn", "Alice"), (1002, "bob", "Bob"), (1003, None, "Carol")],
+    )
+    conn.execute("INSERT INTO tariffs (id, name, duration_sec, price_rub) VALUES (1, 'Годовой', 31536000, 990)")
+    conn.execute(
+        "INSERT INTO servers (id, name, api_url, api_key, domain, country, protocol, active) "
+        "VALUES (1, 'Amsterdam-1', 'https://nl.example.com/api', 'k', 'nl.example.com', 'NL', 'v2ray', 1)"
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (id, user_id, subscription_token, created_at, expires_at, tariff_id, is_active) "
+        "VALUES (?, ?, ?, 0, 4102434000, ?, 1)",
+        [(1, 1001, TOKEN, 1), (2, 1002, "ffffffff-0000-4000-8000-000000000000", None)],
+    )
+    conn.executemany(
+        "INSERT INTO v2ray_keys (id, server_id, user_id, v2ray_uuid, email, created_at, subscription_id) "
+        "VALUES (?, 1, ?, ?, ?, 0, ?)",
+        [
+            (206, 1001, "aaaa1111-uuid", "alice@example.com", 1),
+            (207, 1002, "bbbb2222-uuid", "user_1002@veilbot.com", 2),
+        ],
+    )
+    conn.execute(
+        "INSERT INTO payments (user_id, tariff_id, payment_id, amount, email, status, subscription_id) "
+        "VALUES (1003, 1, 'pay-778899', 990, 'carol@example.com', 'completed', 2)"
+    )
+    conn.commit()
+    conn.close()
+    yield path
+    sqlite_utils.close_connection_pools()
+
+
+def _index_rows(path, kind):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(conn.execute(
+            "SELECT entity_id, field, value FROM search_index WHERE kind = ?", (kind,)
+        ).fetchall())
+    finally:
+        conn.close()
+
+
+def _user_ids(path, query):
+    return [row[0] for row in UserRepository(path).list_users(query=query)]
+
+
+def _subscription_ids(path, query):
+    return [row[0] for row in SubscriptionRepository(path).list_subscriptions(query=query)]
+
+
+def _key_ids(path, query):
+    return [row[0] for row in KeyRepository(path).list_keys_unified(search_query=query)]
+
+
+def test_triggers_keep_index_in_sync(search_db):
+    assert (206, "id", "206_v2ray") in _index_rows(search_db, "key")
+    assert (206, "email", "alice@example.com") in _index_rows(search_db, "key")
+
+    conn = sqlite3.connect(search_db)
+    conn.execute("UPDATE v2ray_keys SET email = 'new@example.com', client_config = 'x' WHERE id = 206")
+    conn.execute("UPDATE users SET username = NULL WHERE user_id = 1001")
+    conn.execute("DELETE FROM subscriptions WHERE id = 2")
+    conn.commit()
+    conn.close()
+
+    keys = _index_rows(search_db, "key")
+    assert (206, "email", "new@example.com") in keys and (206, "email", "alice@example.com") not in keys
+    assert (1001, "username", "alice_vpn") not in _index_rows(search_db, "user")
+    assert [row[0] for row in _index_rows(search_db, "subscription")] == [1, 1, 1]
+
+    # Триггеры дают то же, что полное перезаполнение; строки сущностей с тем же id не задеты
+    conn = sqlite3.connect(search_db)
+    before = conn.execute("SELECT COUNT(*) FROM search_index").fetchone()[0]
+    assert rebuild_search_index(conn) == before
+    conn.close()
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_admin_search_matches_legacy_fields(search_db, monkeypatch, indexed):
+    monkeypatch.setattr(search_index, "SEARCH_INDEX_ENABLED", indexed)
+
+    assert _user_ids(search_db, "ALICE_v") == [1001]
+    assert _user_ids(search_db, "alice@example") == [1001]
+    assert _user_ids(search_db, "veilbot.com") == []  # служебные email не ищутся
+    assert UserRepository(search_db).count_users(query="100") == 3
+
+    assert _subscription_ids(search_db, TOKEN[4:12]) == [1]
+    assert _subscription_ids(search_db, "Годов") == [1]
+    assert _subscription_ids(search_db, "example.com") == [1]
+    assert SubscriptionRepository(search_db).count_subscriptions(query="1002") == 1
+
+    assert _key_ids(search_db, "206_v") == ["206_v2ray"]
+    assert _key_ids(search_db, "bbbb2222") == ["207_v2ray"]
+    assert sorted(_key_ids(search_db, "amsterdam")) == ["206_v2ray", "207_v2ray"]
+    assert KeyRepository(search_db).count_keys_unified(search_query="veilbot.com") == 1
+
+
+def test_payment_ids_resolve_users_and_subscriptions(search_db):
+    assert _user_ids(search_db, "pay-7788") == [1003]
+    assert _subscription_ids(search_db, "pay-7788") == [2]
+    assert _subscription_ids(search_db, "carol@") == []  # email ищется по владельцу подписки
+
+
+def test_search_reads_index_instead_of_scanning(search_db):
+    conn = sqlite3.connect(search_db)
+    try:
+        for build, table in (
+            (search_index.user_search_condition, "users u"),
+            (search_index.subscription_search_condition, "subscriptions s LEFT JOIN tariffs t ON s.tariff_id = t.id"),
+            (search_index.key_search_condition, "v2ray_keys k"),
+        ):
+            condition, params = build(conn, "example")
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN SELECT COUNT(*) FROM {table} WHERE {condition}", params)]
+            assert any("search_index VIRTUAL TABLE INDEX" in detail for detail in plan), plan
+            assert not any(detail.split()[:2] in (["SCAN", "u"], ["SCAN", "s"], ["SCAN", "k"]) for detail in plan), plan
+    finally:
+        conn.close()
@@ -0,0 +1,219 @@
+"""
+Тесты пулов соединений SQLite (app/infra/sqlite_utils.py)
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app.infra import sqlite_utils
+from app.infra.sqlite_utils import SQLiteConnectionPool, get_db_cursor, pooled_connection
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "pool.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(sqlite_utils, "SQLITE_POOL_ENABLED", True)
+    yield path
+    sqlite_utils.close_connection_pools()
+
+
+def _count(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_connection_is_reused_and_reset_between_leases(db_path):
+    with pooled_connection(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute("INSERT INTO items (name) VALUES ('a')")
+        first = conn
+
+    with pooled_connection(db_path) as conn:
+        assert conn is first
+        assert conn.row_factory is None
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    stats = sqlite_utils.get_connection_pool(db_path).stats()
+    assert stats["created"] == 1 and stats["reused"] == 1 and stats["idle"] == 1
+    assert _count(db_path) == 1
+
+
+def test_uncommitted_changes_are_rolled_back(db_path):
+    with get_db_cursor(db_path=db_path) as cursor:
+        cursor.execute("INSERT INTO items (name) VALUES ('lost')")
+    assert _count(db_path) == 0
+
+    with get_db_cursor(commit=True, db_path=db_path) as cursor:
+        cursor.execute("INSERT INTO items (name) VALUES ('kept')")
+        assert isinstance(cursor.execute("SELECT 1 AS one").fetchone(), sqlite3.Row)
+
+    with pytest.raises(RuntimeError):
+        with pooled_connection(db_path) as conn:
+            conn.execute("INSERT INTO items (name) VALUES ('failed')")
+            raise RuntimeError("boom")
+    assert _count(db_path) == 1
+
+
+def test_exhausted_pool_falls_back_to_temporary_connection(db_path):
+    pool = SQLiteConnectionPool(db_path, max_size=1, timeout=0.05)
+    held = pool.acquire()
+    overflow = pool.acquire()
+    assert not overflow.pooled and overflow.conn is not held.conn
+    pool.release(overflow)
+    pool.release(held)
+    assert pool.stats()["overflow"] == 1 and pool.stats()["size"] == 1
+    pool.close()
+
+
+def test_broken_connection_is_replaced(db_path):
+    pool = SQLiteConnectionPool(db_path, max_size=2)
+    entry = pool.acquire()
+    entry.conn.close()
+    pool.release(entry)
+    assert pool.stats()["discarded"] == 1 and pool.stats()["size"] == 0
+
+    fresh = pool.acquire()
+    assert fresh.conn.execute("SELECT 1").fetchone() == (1,)
+    pool.release(fresh)
+    pool.close()
+
+
+def test_threads_share_bounded_number_of_connections(db_path):
+    pool = SQLiteConnectionPool(db_path, max_size=3, timeout=5)
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(20):
+                entry = pool.acquire()
+                try:
+                    entry.conn.execute("SELECT COUNT(*) FROM items").fetchone()
+                finally:
+                    pool.release(entry)
+        except Exception as e:  # pragma: no cover - сообщение в assert ниже
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = pool.stats()
+    assert not errors
+    assert stats["created"] <= 3 and stats["overflow"] == 0
+    pool.close()
+
+
+async def test_exhausted_pool_does_not_block_event_loop(db_path, monkeypatch):
+    pool = SQLiteConnectionPool(db_path, max_size=2, timeout=5)
+    monkeypatch.setattr(sqlite_utils, "get_connection_pool", lambda db_path=None: pool)
+    release = asyncio.Event()
+
+    async def holder():
+        with get_db_cursor(db_path=db_path) as cursor:
+            cursor.execute("SELECT 1")
+            await release.wait()
+
+    holders = [asyncio.ensure_future(holder()) for _ in range(2)]
+    await asyncio.sleep(0)
+    started = time.monotonic()
+    with get_db_cursor(commit=True, db_path=db_path) as cursor:
+        cursor.execute("INSERT INTO items (name) VALUES ('on loop')")
+    assert time.monotonic() - started < 1
+    release.set()
+    await asyncio.gather(*holders)
+
+    stats = pool.stats()
+    assert stats["loop_overflow"] == 1 and stats["waits"] == 0 and stats["size"] == 2
+    assert _count(db_path) == 1
+    pool.close()
+
+
+@pytest.fixture
+async def async_pool(db_path):
+    pool = sqlite_utils.AsyncSQLiteConnectionPool(db_path, readers=2, writers=1, timeout=0.2)
+    yield pool
+    await pool.close()
+
+
+async def test_async_pool_reuses_reader_and_writer_connections(async_pool):
+    writer = await async_pool.acquire()
+    await writer.conn.execute("INSERT INTO items (name) VALUES ('a')")
+    await writer.conn.commit()
+    await writer.conn.execute("INSERT INTO items (name) VALUES ('rolled back')")
+    await async_pool.release(writer)
+    assert (await async_pool.acquire()).conn is writer.conn
+    await async_pool.release(writer)
+
+    reader = await async_pool.acquire(readonly=True)
+    async with reader.conn.execute("SELECT COUNT(*) FROM items") as cursor:
+        assert (await cursor.fetchone())[0] == 1
+    with pytest.raises(sqlite3.OperationalError):
+        await reader.conn.execute("INSERT INTO items (name) VALUES ('b')")
+    await async_pool.release(reader)
+
+    stats = async_pool.stats()
+    assert stats["write"]["created"] == 1 and stats["write"]["checkouts"] == 2
+    assert stats["read"]["created"] == 1 and stats["read"]["idle"] == 1
+
+
+async def test_async_pool_restores_foreign_keys_left_off_in_transaction(async_pool):
+    writer = await async_pool.acquire()
+    await writer.conn.execute("PRAGMA foreign_keys=OFF")
+    await writer.conn.execute("INSERT INTO items (name) VALUES ('failed')")
+    # Как в репозитории при ошибке: восстановление внутри транзакции ничего не меняет
+    await writer.conn.execute("PRAGMA foreign_keys=ON")
+    await async_pool.release(writer)
+
+    again = await async_pool.acquire()
+    assert again.conn is writer.conn
+    async with again.conn.execute("PRAGMA foreign_keys") as cursor:
+        assert (await cursor.fetchone())[0] == 1
+    await async_pool.release(again)
+    assert _count(async_pool.path) == 0
+
+
+async def test_async_pool_hands_writer_to_waiter_or_times_out(async_pool):
+    held = await async_pool.acquire()
+    waiter = asyncio.ensure_future(async_pool.acquire())
+    await asyncio.sleep(0.05)
+    assert async_pool.stats()["write"]["waiting"] == 1
+    await async_pool.release(held)
+    handed = await waiter
+    assert handed.conn is held.conn and handed.pooled
+
+    overflow = await async_pool.acquire()
+    assert not overflow.pooled
+    await async_pool.release(overflow)
+    await async_pool.release(handed)
+    stats = async_pool.stats()["write"]
+    assert stats["waits"] == 2 and stats["timeouts"] == 1 and stats["size"] == 1
+
+
+async def test_nested_async_connection_does_not_wait_for_itself(db_path, monkeypatch):
+    monkeypatch.setattr(sqlite_utils, "SQLITE_ASYNC_POOL_ENABLED", True)
+    async with sqlite_utils.open_async_connection(db_path) as outer:
+        await outer.execute("INSERT INTO items (name) VALUES ('outer')")
+        async with sqlite_utils.open_async_connection(db_path, readonly=True) as reader:
+            async with reader.execute("SELECT COUNT(*) FROM items") as cursor:
+                assert (await cursor.fetchone())[0] == 0
+        async with sqlite_utils.open_async_connection(db_path) as inner:
+            assert inner is not outer
+        await outer.commit()
+
+    stats = sqlite_utils.get_async_connection_pool(db_path).stats()
+    assert stats["write"]["nested"] == 1 and stats["write"]["waits"] == 0
+    await sqlite_utils.close_async_connection_pools()
+    assert _count(db_path) == 1
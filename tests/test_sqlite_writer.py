@@ -0,0 +1,96 @@
+"""
+Тесты писателя SQLite с групповым коммитом (app/infra/sqlite_writer.py)
+"""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from app.infra.sqlite_writer import SQLiteWriter
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "writer.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def _names(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT name FROM items ORDER BY id")]
+    finally:
+        conn.close()
+
+
+def _hold_write_lock(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("BEGIN IMMEDIATE")
+    return conn
+
+
+def test_batches_queued_behind_lock_commit_as_one_group(db_path):
+    writer = SQLiteWriter(db_path, lock_wait_sec=5)
+    blocker = _hold_write_lock(db_path)
+    futures = [writer.submit([("INSERT INTO items (name) VALUES (?)", (f"n{i}",), False)]) for i in range(10)]
+    time.sleep(0.2)
+    blocker.execute("COMMIT")
+    blocker.close()
+
+    assert [future.result(timeout=5) for future in futures] == [1] * 10
+    stats = writer.stats()
+    assert stats["batches"] == 10 and stats["groups"] <= 2 and stats["lock_waits"] >= 1
+    assert len(_names(db_path)) == 10
+    writer.close()
+
+
+def test_failing_batch_is_rolled_back_alone(db_path):
+    writer = SQLiteWriter(db_path)
+    blocker = _hold_write_lock(db_path)
+    ok = writer.submit([("INSERT INTO items (name) VALUES (?)", ("a",), False)])
+    bad = writer.submit([
+        ("INSERT INTO items (name) VALUES (?)", ("b",), False),
+        ("INSERT INTO items (name) VALUES (?)", ("a",), False),
+    ])
+    many = writer.submit([("INSERT INTO items (name) VALUES (?)", [("c",), ("d",)], True)])
+    blocker.execute("ROLLBACK")
+    blocker.close()
+
+    assert ok.result(timeout=5) == 1 and many.result(timeout=5) == 2
+    with pytest.raises(sqlite3.IntegrityError):
+        bad.result(timeout=5)
+    assert _names(db_path) == ["a", "c", "d"]
+    assert writer.stats()["failed_batches"] == 1
+    writer.close()
+
+
+def test_lock_wait_is_bounded(db_path):
+    writer = SQLiteWriter(db_path, lock_wait_sec=0.2)
+    blocker = _hold_write_lock(db_path)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            writer.execute("INSERT INTO items (name) VALUES ('late')")
+    finally:
+        blocker.execute("ROLLBACK")
+        blocker.close()
+    assert writer.stats()["lock_timeouts"] == 1
+
+    assert writer.execute("INSERT INTO items (name) VALUES ('late')") == 1
+    writer.close()
+
+
+async def test_async_writes_from_many_tasks(db_path):
+    writer = SQLiteWriter(db_path)
+    results = await asyncio.gather(*(
+        writer.execute_async("INSERT INTO items (name) VALUES (?)", (f"t{i}",)) for i in range(50)
+    ))
+    assert sum(results) == 50
+    assert await writer.executemany_async("UPDATE items SET name = name || '!' WHERE id = ?", [(1,), (2,)]) == 2
+    assert len(_names(db_path)) == 50
+    writer.close()
@@ -1,7 +1,13 @@
 from vpn_protocols import (
+    VlessLinkTemplate,
+    VlessLinkTemplateCache,
     normalize_vless_host,
     remove_fragment_from_vless,
     add_server_name_to_vless,
+    canonical_vless_config,
+    render_vless_link,
+    vless_fragment,
+    vless_host_override,
 )
 
 
@@ -33,3 +39,69 @@ def test_add_server_name_to_vless_no_server_name_returns_original():
     config = "vless://uuid@example.com:443"
     assert add_server_name_to_vless(config, None) == config
 
+
+PANEL_LINK = (
+    "vless://52b598fa-34dc-4753-bef0-bcd52728e9cc@38.180.192.10:443?type=tcp&security=reality"
+    "&sni=microsoft.com&fp=chrome&pbk=qbvVtmwqpAhF9VzaDuqFoylWGj4b-V1s_vbqsMzUeks&sid=7bb45050&spx=/#old%40mail"
+)
+
+
+def test_vless_link_template_renders_new_key_with_panel_params():
+    template = VlessLinkTemplate.from_link(PANEL_LINK)
+    rendered = template.render("11111111-2222-3333-4444-555555555555", "abcd0001", name="Мой ключ")
+    assert rendered == (
+        "vless://11111111-2222-3333-4444-555555555555@38.180.192.10:443?type=tcp&security=reality"
+        "&sni=microsoft.com&fp=chrome&pbk=qbvVtmwqpAhF9VzaDuqFoylWGj4b-V1s_vbqsMzUeks&sid=abcd0001&spx=/"
+        "#%D0%9C%D0%BE%D0%B9%20%D0%BA%D0%BB%D1%8E%D1%87"
+    )
+    assert template.render("u", "s", port=10001, sni="www.apple.com").startswith(
+        "vless://u@38.180.192.10:10001?type=tcp&security=reality&sni=www.apple.com&"
+    )
+
+
+def test_vless_link_template_rejects_links_without_short_id():
+    assert VlessLinkTemplate.from_link("vless://uuid@example.com:443?encryption=none#Node") is None
+    assert VlessLinkTemplate.from_link("not a link") is None
+
+
+def test_vless_link_template_cache_needs_short_id_and_expires():
+    cache = VlessLinkTemplateCache(ttl_sec=3600, enabled=True)
+    api_url = "https://panel.example.com/api"
+    assert cache.render(api_url, {"uuid": "u", "short_id": "s"}) is None
+
+    cache.learn(api_url, PANEL_LINK)
+    assert cache.render(api_url, {"uuid": "u"}) is None
+    assert "sid=s&" in cache.render(api_url, {"uuid": "u", "short_id": "s"})
+
+    cache.ttl_sec = -1
+    assert cache.get(api_url) is None
+
+
+
+def test_canonical_vless_config_keeps_single_line_without_fragment():
+    config = "Your config:\n  vless://uuid@example.com:443?security=reality#user%40mail  \n"
+    assert canonical_vless_config(config) == "vless://uuid@example.com:443?security=reality"
+    assert canonical_vless_config("ss://abc#x") == "ss://abc#x"
+    assert canonical_vless_config(None) is None
+
+
+def test_render_vless_link_matches_url_parsing_pipeline():
+    links = [
+        PANEL_LINK,
+        "vless://uuid@example.com:443?encryption=none#Node",
+        "vless://uuid@example.com?encryption=none",
+        "vless://uuid@[2001:db8::1]:8443/?type=ws&path=%2Fws",
+        "vless://uuid@example.com:443",
+        "vless://example.com:443?security=reality",
+    ]
+    servers = [("nl.example.com", "https://api.old", "NL 🇳🇱 #1"), (None, "https://api.server.dev:8080", None), ("", "", "DE")]
+    for link in links:
+        for domain, api_url, name in servers:
+            expected = add_server_name_to_vless(
+                remove_fragment_from_vless(normalize_vless_host(link, domain, api_url)), name
+            )
+            rendered = render_vless_link(link, vless_host_override(domain, api_url), vless_fragment(name))
+            assert rendered == expected, (link, domain, api_url, name)
+            # Каноническая форма даёт тот же результат
+            canonical = canonical_vless_config(link)
+            assert render_vless_link(canonical, vless_host_override(domain, api_url), vless_fragment(name)) == expected
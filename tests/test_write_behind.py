@@ -0,0 +1,84 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from app.infra.write_behind import WriteBehindBuffer
+from app.repositories.subscription_repository import SubscriptionRepository, subscription_last_seen_buffer
+
+SQL = "UPDATE items SET seen_at = MAX(COALESCE(seen_at, 0), ?) WHERE id = ?"
+
+
+@pytest.fixture
+def items_db(tmp_path):
+    db_path = str(tmp_path / "items.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, seen_at INTEGER)")
+    conn.executemany("INSERT INTO items (id, seen_at) VALUES (?, NULL)", [(1,), (2,), (3,)])
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def _seen(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = dict(conn.execute("SELECT id, seen_at FROM items").fetchall())
+    conn.close()
+    return rows
+
+
+@pytest.mark.asyncio
+async def test_touches_are_coalesced_and_flushed_by_timer(items_db):
+    buffer = WriteBehindBuffer("items", SQL, db_path=items_db, interval_sec=0.05)
+    buffer.touch(1, 100)
+    buffer.touch(1, 300)
+    buffer.touch(1, 200)
+    buffer.touch(2, 50)
+    assert _seen(items_db) == {1: None, 2: None, 3: None}
+
+    await asyncio.sleep(0.2)
+    assert _seen(items_db) == {1: 300, 2: 50, 3: None}
+    stats = buffer.stats()
+    assert stats["touches"] == 4 and stats["rows"] == 2 and stats["flushes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_values(tmp_path, items_db):
+    buffer = WriteBehindBuffer("items", SQL, db_path=str(tmp_path / "missing" / "x.db"), interval_sec=60)
+    buffer.touch(1, 10)
+    assert await buffer.flush() == 0
+    assert buffer.pending() == 1
+
+    buffer.db_path = items_db
+    assert await buffer.flush() == 1
+    assert _seen(items_db)[1] == 10
+
+
+def test_sync_touch_flushes_on_overflow(items_db):
+    buffer = WriteBehindBuffer("items", SQL, db_path=items_db, interval_sec=60, max_pending=2)
+    buffer.touch(1, 5)
+    assert buffer.pending() == 1
+    buffer.touch(2, 6)
+    assert buffer.pending() == 0
+    assert _seen(items_db) == {1: 5, 2: 6, 3: None}
+
+
+@pytest.mark.asyncio
+async def test_subscription_last_updated_never_moves_backwards(tmp_path):
+    db_path = str(tmp_path / "subs.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE subscriptions (id INTEGER PRIMARY KEY, last_updated_at INTEGER)")
+    conn.execute("INSERT INTO subscriptions (id, last_updated_at) VALUES (1, 500), (2, NULL)")
+    conn.commit()
+    conn.close()
+
+    repo = SubscriptionRepository(db_path=db_path)
+    buffer = subscription_last_seen_buffer(db_path)
+    buffer.touch(1, 400)
+    repo.touch_subscription_last_updated(2)
+    assert await buffer.flush() == 2
+
+    conn = sqlite3.connect(db_path)
+    rows = dict(conn.execute("SELECT id, last_updated_at FROM subscriptions").fetchall())
+    conn.close()
+    assert rows[1] == 500 and rows[2] > 0
@@ -1,12 +1,66 @@
 import asyncio
 import aiohttp
+import functools
+import json
 import logging
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Tuple
-from urllib.parse import urlparse, urlunparse
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlparse, urlunparse
+
+from app.infra.json_stream import iter_json_array
+from app.infra.panel_concurrency import panel_concurrency
+from app.infra.panel_health import PanelCircuitOpenError, panel_health
+from app.infra.panel_http import panel_session_pool
+from app.infra.panel_singleflight import panel_singleflight
 
 logger = logging.getLogger(__name__)
 
+# Ответы панели, после которых сохранённый числовой key_id считается устаревшим
+_PANEL_KEY_ID_STALE_STATUSES = frozenset({404, 422})
+
+
+def _panel_slot(method):
+    """Выполнять метод V2RayProtocol в слоте panel_concurrency (адаптивный лимит запросов на панель)."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        async with panel_concurrency.slot(self.api_url):
+            return await method(self, *args, **kwargs)
+    return wrapper
+
+
+def _single_flight(cache_if=None):
+    """Объединять одинаковые одновременные GET-вызовы метода V2RayProtocol (panel_singleflight)."""
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args):
+            key = (self.api_url, self.headers.get("Authorization"), method.__name__, args)
+            return await panel_singleflight.do(key, lambda: method(self, *args), cache_if=cache_if)
+        return wrapper
+    return decorator
+
+
+def _invalidates_panel_cache(method):
+    """После изменяющего запроса сбросить TTL-кэш GET-ответов панели."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            panel_singleflight.invalidate(self.api_url)
+    return wrapper
+
+
+def panel_key_id_from_user_data(user_data: Optional[Dict]) -> Optional[str]:
+    """Числовой key_id панели из ответа create_user (для v2ray_keys.panel_key_id)."""
+    if not user_data:
+        return None
+    key_id = user_data.get('key_id') or user_data.get('id')
+    return str(key_id) if key_id not in (None, '') else None
+
 
 def normalize_vless_host(config: Optional[str], domain: Optional[str], api_url: str) -> str:
     """
@@ -115,6 +169,209 @@ def add_server_name_to_vless(config: Optional[str], server_name: Optional[str])
         return config or ""
 
 
+def extract_vless_line(config: Optional[str]) -> Optional[str]:
+    """Строка vless://... из (возможно многострочной) конфигурации панели."""
+    if not config or 'vless://' not in config:
+        return config
+    for line in config.split('\n'):
+        if line.strip().startswith('vless://'):
+            return line.strip()
+    return config
+
+
+def canonical_vless_config(config: Optional[str]) -> Optional[str]:
+    """
+    Каноническая форма client_config ключа подписки: одна строка vless:// без фрагмента.
+
+    Хост и название сервера подставляются при выдаче подписки (render_vless_link), поэтому
+    в БД они не нужны. Конфигурации без vless:// возвращаются как есть.
+    """
+    line = extract_vless_line(config)
+    if not line or not line.startswith('vless://'):
+        return config
+    return line.split('#', 1)[0]
+
+
+@functools.lru_cache(maxsize=1024)
+def vless_host_override(domain: Optional[str], api_url: Optional[str]) -> str:
+    """Хост для VLESS-ссылок сервера: домен из админки или host из API URL (как в normalize_vless_host)."""
+    host = (domain or "").strip()
+    if host:
+        return host
+    try:
+        return urlparse(api_url or "").hostname or ""
+    except Exception:
+        return ""
+
+
+@functools.lru_cache(maxsize=1024)
+def vless_fragment(server_name: Optional[str]) -> str:
+    """Фрагмент '#<название сервера>' (URL-кодированный), пустая строка без названия."""
+    return f"#{quote(server_name, safe='')}" if server_name else ""
+
+
+def render_vless_link(config: Optional[str], host: str, fragment: str) -> str:
+    """
+    VLESS-ссылка для подписки из сохранённого client_config.
+
+    Эквивалент normalize_vless_host + remove_fragment_from_vless + add_server_name_to_vless, но для
+    канонической формы (canonical_vless_config) обходится срезами строки без разбора URL; host и
+    fragment считаются один раз на сервер (vless_host_override, vless_fragment).
+    Записи не в канонической форме сначала приводятся к ней.
+    """
+    if not config:
+        return ""
+    if not config.startswith('vless://') or '#' in config or '\n' in config:
+        config = canonical_vless_config(config.strip()) or ""
+        if not config.startswith('vless://'):
+            return config
+    if host:
+        end = len(config)
+        for separator in ('/', '?'):
+            index = config.find(separator, 8)
+            if index != -1 and index < end:
+                end = index
+        at = config.find('@', 8, end)
+        # Без userinfo normalize_vless_host хост не подменяет
+        if at > 8:
+            host_port = config[at + 1:end]
+            if host_port.startswith('['):
+                closing = host_port.find(']')
+                host_port = f"[{host}]{host_port[closing + 1:]}" if closing != -1 else host
+            elif ':' in host_port:
+                host_port = f"{host}:{host_port.rsplit(':', 1)[1]}"
+            else:
+                host_port = host
+            config = f"{config[:at + 1]}{host_port}{config[end:]}"
+    return config + fragment
+
+
+@dataclass(frozen=True)
+class VlessLinkTemplate:
+    """Параметры Reality-ссылки сервера, общие для всех его ключей.
+
+    Ссылки панели для разных ключей отличаются только UUID, short_id (sid), а также
+    портом и SNI, если панель выдаёт их на ключ. Остальные параметры (pbk, fp, flow,
+    security, type, ...) хранятся как есть, в исходном порядке и кодировке.
+    """
+
+    host: str
+    port: str
+    params: Tuple[Tuple[str, Optional[str]], ...]
+    learned_at: float
+
+    @classmethod
+    def from_link(cls, link: Optional[str]) -> Optional["VlessLinkTemplate"]:
+        """Шаблон из готовой ссылки панели; None, если ссылка не похожа на VLESS Reality с sid."""
+        link = extract_vless_line(link)
+        if not link or not link.startswith('vless://'):
+            return None
+        body = link[len('vless://'):].split('#', 1)[0]
+        if '?' not in body:
+            return None
+        authority, query = body.split('?', 1)
+        if '@' not in authority:
+            return None
+        user, host_port = authority.rsplit('@', 1)
+        if not user or ':' not in host_port or host_port.endswith(']'):
+            return None
+        host, port = host_port.rsplit(':', 1)
+        params = tuple(
+            (name, value) if sep else (name, None)
+            for name, sep, value in (part.partition('=') for part in query.split('&') if part)
+        )
+        if not host or not port.isdigit() or not any(name == 'sid' for name, _ in params):
+            return None
+        return cls(host=host, port=port, params=params, learned_at=time.monotonic())
+
+    def render(
+        self,
+        uuid: str,
+        short_id: str,
+        *,
+        port: Optional[int] = None,
+        sni: Optional[str] = None,
+        name: Optional[str] = None,
+    ) -> str:
+        overrides = {'sid': quote(str(short_id), safe='')}
+        if sni:
+            overrides['sni'] = quote(str(sni), safe='')
+        query = '&'.join(
+            name_ if value is None else f"{name_}={overrides.get(name_, value)}"
+            for name_, value in self.params
+        )
+        link = f"vless://{uuid}@{self.host}:{port or self.port}?{query}"
+        if name:
+            link += f"#{quote(name, safe='')}"
+        return link
+
+
+class VlessLinkTemplateCache:
+    """Шаблоны VLESS-ссылок по панели (api_url): ссылка нового ключа собирается локально
+    из ответа create_user без GET /keys/{id}/link и повторов get_user_config.
+
+    Шаблон запоминается из любой ссылки, полученной от панели, сбрасывается после
+    sync_xray_config и устаревает через VEILBOT_VLESS_TEMPLATE_TTL секунд.
+    Отключается VEILBOT_VLESS_LOCAL_LINKS=0.
+    """
+
+    def __init__(self, ttl_sec: Optional[float] = None, enabled: Optional[bool] = None):
+        if ttl_sec is None:
+            try:
+                ttl_sec = float(os.getenv("VEILBOT_VLESS_TEMPLATE_TTL", "3600"))
+            except ValueError:
+                ttl_sec = 3600.0
+        if enabled is None:
+            enabled = os.getenv("VEILBOT_VLESS_LOCAL_LINKS", "1").strip().lower() not in ("0", "false", "no", "off")
+        self.ttl_sec = ttl_sec
+        self.enabled = enabled
+        self._templates: Dict[str, VlessLinkTemplate] = {}
+        self._lock = threading.Lock()
+
+    def learn(self, api_url: str, link: Optional[str]) -> Optional[VlessLinkTemplate]:
+        template = VlessLinkTemplate.from_link(link)
+        if template is not None:
+            with self._lock:
+                self._templates[api_url] = template
+        return template
+
+    def get(self, api_url: str) -> Optional[VlessLinkTemplate]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            template = self._templates.get(api_url)
+            if template is not None and time.monotonic() - template.learned_at > self.ttl_sec:
+                del self._templates[api_url]
+                return None
+            return template
+
+    def render(self, api_url: str, user_data: Dict, name: Optional[str] = None) -> Optional[str]:
+        """Ссылка для ключа из ответа create_user; None — шаблона нет или в ответе нет uuid/short_id."""
+        template = self.get(api_url)
+        uuid_value = user_data.get('uuid')
+        short_id = user_data.get('short_id')
+        if template is None or not uuid_value or not short_id:
+            return None
+        return template.render(
+            uuid_value,
+            short_id,
+            port=user_data.get('port'),
+            sni=user_data.get('sni'),
+            name=name,
+        )
+
+    def invalidate(self, api_url: Optional[str] = None) -> None:
+        with self._lock:
+            if api_url is None:
+                self._templates.clear()
+            else:
+                self._templates.pop(api_url, None)
+
+
+# Global link template cache
+vless_link_templates = VlessLinkTemplateCache()
+
+
 class VPNProtocol(ABC):
     """Абстрактный класс для VPN протоколов"""
     
@@ -141,7 +398,14 @@ class VPNProtocol(ABC):
 class V2RayProtocol(VPNProtocol):
     """Реализация для V2Ray VLESS с новым API"""
     
-    def __init__(self, api_url: str, api_key: str = None):
+    def __init__(self, api_url: str, api_key: str = None, *, shared: bool = False):
+        """
+        Args:
+            api_url: URL API панели
+            api_key: Bearer-токен панели
+            shared: клиент из реестра (v2ray_clients) — использует общую сессию пула
+                и не закрывает её в close(); иначе клиент владеет собственной сессией
+        """
         base_url = api_url.strip()
         logger.debug(f"[V2RayProtocol.__init__] Input api_url: {api_url!r}")
         parsed = urlparse(base_url)
@@ -182,18 +446,26 @@ class V2RayProtocol(VPNProtocol):
         if api_key:
             self.headers['Authorization'] = f'Bearer {api_key}'
         
-        # Настройка SSL контекста для самоподписанных сертификатов
-        import ssl
-        self.ssl_context = ssl.create_default_context()
-        self.ssl_context.check_hostname = False
-        self.ssl_context.verify_mode = ssl.CERT_NONE
-
-        # Общая сессия aiohttp с таймаутами
-        # Медленные/перегруженные панели: больше connect (TLS), total и sock_read для крупных ответов
-        self._timeout = aiohttp.ClientTimeout(total=120, connect=20, sock_connect=20, sock_read=100)
-        self._connector = aiohttp.TCPConnector(ssl=self.ssl_context, force_close=False, enable_cleanup_closed=True)
-        self._session = aiohttp.ClientSession(connector=self._connector, timeout=self._timeout)
+        # Сессия создаётся лениво внутри event loop (см. app.infra.panel_http)
+        self._shared = shared
+        self._own_session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def _session(self) -> aiohttp.ClientSession:
+        """Сессия aiohttp для запросов к панели.
+
+        Общие клиенты берут сессию пула для текущего event loop (keep-alive, DNS-кэш,
+        лимиты соединений на хост); самостоятельные клиенты создают свою при первом запросе.
+        Если breaker панели открыт, сразу бросает PanelCircuitOpenError (см. app.infra.panel_health).
+        """
+        panel_health.check(self.api_url)
+        if self._shared:
+            return panel_session_pool.get_session()
+        if self._own_session is None or self._own_session.closed:
+            self._own_session = panel_session_pool.create_session()
+        return self._own_session
     
+    @_invalidates_panel_cache
     async def create_user(self, email: str, level: int = 0, name: Optional[str] = None) -> Dict:
         """Создать пользователя V2Ray через новый API
         
@@ -217,244 +489,254 @@ class V2RayProtocol(VPNProtocol):
             logger.debug(f"V2Ray key data: {key_data}")
 
             for attempt in range(3):
-                retry_after = False
-                async with session.post(
+                async with panel_concurrency.slot(self.api_url), session.post(
                     f"{self.api_url}/keys",
                     headers=self.headers,
                     json=key_data
                 ) as response:
+                    status = response.status
                     response_text = await response.text()
-                    logger.debug(f"V2Ray create response status: {response.status}")
-                    logger.debug(f"V2Ray create response text: {response_text}")
+                logger.debug(f"V2Ray create response status: {status}")
+                logger.debug(f"V2Ray create response text: {response_text}")
 
-                    if response.status in (200, 201):
-                        try:
-                            result = await response.json()
+                if status in (502, 503, 504) and attempt < 2:
+                    logger.warning(f"V2Ray API returned {status}, retry {attempt + 1}/3 in 2s")
+                    # Слот панели на время паузы не держим
+                    await asyncio.sleep(2)
+                    continue
+                if status not in (200, 201):
+                    raise Exception(f"V2Ray API error: {status} - {response_text}")
+                break
+
+            try:
+                result = json.loads(response_text)
+
+                # Проверяем, что результат - это словарь, а не список
+                if isinstance(result, list):
+                    if len(result) > 0:
+                        # Если это список с одним элементом, берем первый
+                        result = result[0]
+                    else:
+                        # Если API возвращает пустой список, попробуем альтернативный подход
+                        print(f"V2Ray API returned empty list, trying alternative approach...")
+                        # Попробуем создать ключ с другими параметрами
+                        alternative_key_data = {
+                            "name": email,
+                            "email": email
+                        }
+                    
+                        async with panel_concurrency.slot(self.api_url), session.post(
+                            f"{self.api_url}/keys",
+                            headers=self.headers,
+                            json=alternative_key_data
+                        ) as alt_response:
+                            alt_response_text = await alt_response.text()
+                            logger.debug(f"Alternative V2Ray create response status: {alt_response.status}")
+                            logger.debug(f"Alternative V2Ray create response text: {alt_response_text}")
                         
-                            # Проверяем, что результат - это словарь, а не список
-                            if isinstance(result, list):
-                                if len(result) > 0:
-                                    # Если это список с одним элементом, берем первый
-                                    result = result[0]
+                            if alt_response.status in (200, 201):
+                                alt_result = await alt_response.json()
+                                if isinstance(alt_result, list) and len(alt_result) > 0:
+                                    result = alt_result[0]
+                                elif isinstance(alt_result, dict):
+                                    result = alt_result
                                 else:
-                                    # Если API возвращает пустой список, попробуем альтернативный подход
-                                    print(f"V2Ray API returned empty list, trying alternative approach...")
-                                    # Попробуем создать ключ с другими параметрами
-                                    alternative_key_data = {
-                                        "name": email,
-                                        "email": email
-                                    }
-                                
-                                    async with session.post(
-                                        f"{self.api_url}/keys",
-                                        headers=self.headers,
-                                        json=alternative_key_data
-                                    ) as alt_response:
-                                        alt_response_text = await alt_response.text()
-                                        logger.debug(f"Alternative V2Ray create response status: {alt_response.status}")
-                                        logger.debug(f"Alternative V2Ray create response text: {alt_response_text}")
-                                    
-                                        if alt_response.status in (200, 201):
-                                            alt_result = await alt_response.json()
-                                            if isinstance(alt_result, list) and len(alt_result) > 0:
-                                                result = alt_result[0]
-                                            elif isinstance(alt_result, dict):
-                                                result = alt_result
-                                            else:
-                                                raise Exception(f"V2Ray API still returned empty response - {alt_response_text}")
-                                        else:
-                                            raise Exception(f"V2Ray API alternative request failed: {alt_response.status} - {alt_response_text}")
-                        
-                            # Валидация ответа сервера
-                            # API возвращает key_id (integer) или id (string) для обратной совместимости
-                            key_id = result.get('key_id') or result.get('id')
-                            if not key_id:
-                                raise Exception(f"V2Ray API did not return key_id or id - {response_text}")
-                        
-                            uuid_value = result.get('uuid')
-                        
-                            logger.info(f"Successfully created V2Ray key {key_id} with UUID {uuid_value}")
-                        
-                            # Извлекаем все параметры из ответа API (API версия 2.3.7)
-                            # ВАЖНО: Сохраняем все параметры из ответа, не генерируем самостоятельно!
-                            short_id = result.get('short_id')
-                            sni = result.get('sni')
-                            port = result.get('port')
-                        
-                            if short_id:
-                                logger.info(f"Key {key_id} has short_id from API: {short_id}")
-                            if sni:
-                                logger.info(f"Key {key_id} has SNI from API: {sni}")
-                            if port:
-                                logger.info(f"Key {key_id} has port from API: {port}")
-                        
-                            # РЕКОМЕНДУЕТСЯ: Получить готовый VLESS URL через /api/keys/{key_id}/link
-                            # Согласно API документации, это лучший способ, так как:
-                            # - Все параметры гарантированно правильные
-                            # - Short ID совпадает с БД
-                            # - Public key правильный
-                            # - SNI правильный
-                            client_config = None
-                        
-                            # Сначала пробуем получить готовый URL через эндпоинт link
-                            try:
-                                logger.info(f"Fetching ready VLESS URL via GET /api/keys/{key_id}/link")
-                                config_url = f"{self.api_url}/keys/{key_id}/link"
-                            
-                                async with session.get(
-                                        config_url,
-                                        headers=self.headers
-                                    ) as config_response:
-                                    if config_response.status == 200:
-                                        config_result = await config_response.json()
-                                    
-                                        # Извлекаем vless_link из ответа API
-                                        client_config = config_result.get('vless_link') or config_result.get('client_config') or config_result.get('vless_url')
-                                    
-                                        if client_config:
-                                            # Извлекаем VLESS URL из многострочного формата, если нужно
-                                            if 'vless://' in client_config:
-                                                lines = client_config.split('\n')
-                                                for line in lines:
-                                                    if line.strip().startswith('vless://'):
-                                                        client_config = line.strip()
-                                                        break
-
-                                            # Проверяем наличие ключевых параметров
-                                            if 'sni=' in client_config and 'sid=' in client_config:
-                                                logger.info(f"✅ Got ready VLESS URL with SNI and short_id from /api/keys/{key_id}/link")
-                                            else:
-                                                logger.warning(f"⚠️  VLESS URL from /api/keys/{key_id}/link missing SNI or short_id")
-
-                                            logger.info(f"✅ Successfully obtained ready VLESS URL via /api/keys/{key_id}/link")
-                                        else:
-                                            logger.warning(f"⚠️  /api/keys/{key_id}/link returned empty vless_link")
-                                    else:
-                                        logger.warning(f"⚠️  Failed to get link via /api/keys/{key_id}/link: status {config_response.status}")
-                            except Exception as config_error:
-                                logger.warning(f"⚠️  Error getting link via /api/keys/{key_id}/link: {config_error}")
+                                    raise Exception(f"V2Ray API still returned empty response - {alt_response_text}")
+                            else:
+                                raise Exception(f"V2Ray API alternative request failed: {alt_response.status} - {alt_response_text}")
+            
+                # Валидация ответа сервера
+                # API возвращает key_id (integer) или id (string) для обратной совместимости
+                key_id = result.get('key_id') or result.get('id')
+                if not key_id:
+                    raise Exception(f"V2Ray API did not return key_id or id - {response_text}")
+            
+                uuid_value = result.get('uuid')
+            
+                logger.info(f"Successfully created V2Ray key {key_id} with UUID {uuid_value}")
+            
+                # Извлекаем все параметры из ответа API (API версия 2.3.7)
+                # ВАЖНО: Сохраняем все параметры из ответа, не генерируем самостоятельно!
+                short_id = result.get('short_id')
+                sni = result.get('sni')
+                port = result.get('port')
+            
+                if short_id:
+                    logger.info(f"Key {key_id} has short_id from API: {short_id}")
+                if sni:
+                    logger.info(f"Key {key_id} has SNI from API: {sni}")
+                if port:
+                    logger.info(f"Key {key_id} has port from API: {port}")
+            
+                # РЕКОМЕНДУЕТСЯ: Получить готовый VLESS URL через /api/keys/{key_id}/link
+                # Согласно API документации, это лучший способ, так как:
+                # - Все параметры гарантированно правильные
+                # - Short ID совпадает с БД
+                # - Public key правильный
+                # - SNI правильный
+                # Ссылка из локального шаблона сервера (Reality-параметры из прошлых ссылок панели):
+                # без GET /keys/{id}/link и без повторов get_user_config
+                client_config = vless_link_templates.render(
+                    self.api_url,
+                    {'uuid': uuid_value, 'short_id': short_id, 'port': port, 'sni': sni},
+                    name=key_name,
+                )
+                rendered_locally = bool(client_config)
+                if rendered_locally:
+                    logger.info(f"✅ Built VLESS URL for key {key_id} from cached link template")
+            
+                # Иначе получаем готовый URL через эндпоинт link
+                if not client_config:
+                    try:
+                        logger.info(f"Fetching ready VLESS URL via GET /api/keys/{key_id}/link")
+                        config_url = f"{self.api_url}/keys/{key_id}/link"
+                
+                        async with panel_concurrency.slot(self.api_url), session.get(
+                                config_url,
+                                headers=self.headers
+                            ) as config_response:
+                            if config_response.status == 200:
+                                config_result = await config_response.json()
                         
-                            # Если не получилось получить через config эндпоинт, пробуем синхронизацию и повтор
-                            if not client_config:
-                                logger.info(f"Config not obtained, trying sync and retry...")
-                                try:
-                                    sync_success = await self.sync_xray_config(timeout=5.0)
-                                    if sync_success:
-                                        logger.info(f"Sync successful, retrying link fetch...")
-                                        # Повторная попытка после синхронизации
-                                        async with session.get(
-                                                f"{self.api_url}/keys/{key_id}/link",
-                                                headers=self.headers
-                                            ) as retry_response:
-                                            if retry_response.status == 200:
-                                                retry_result = await retry_response.json()
-                                                client_config = retry_result.get('vless_link') or retry_result.get('client_config') or retry_result.get('vless_url')
-                                            
-                                                if client_config and 'vless://' in client_config:
-                                                    lines = client_config.split('\n')
-                                                    for line in lines:
-                                                        if line.strip().startswith('vless://'):
-                                                            client_config = line.strip()
-                                                            if 'sni=' in client_config and 'sid=' in client_config:
-                                                                logger.info(f"✅ Got ready VLESS URL after sync and retry")
-                                                            break
-                                except Exception as retry_error:
-                                    logger.warning(f"Error during sync and retry: {retry_error}")
+                                # Извлекаем vless_link из ответа API
+                                client_config = config_result.get('vless_link') or config_result.get('client_config') or config_result.get('vless_url')
                         
-                            # Если все еще нет client_config, пробуем извлечь из ответа создания (fallback)
-                            if not client_config:
-                                logger.warning(f"No vless_link obtained via /api/keys/{key_id}/link, trying fallback from create response")
-                                vless_url = result.get('vless_url')
-                                if not vless_url and isinstance(result.get('key'), dict):
-                                    vless_url = result['key'].get('vless_url')
-                                if isinstance(vless_url, str) and vless_url.strip():
-                                    client_config = vless_url.strip()
-                            
-                                if result.get('client_config'):
-                                    client_config = result['client_config']
+                                if client_config:
+                                    # Извлекаем VLESS URL из многострочного формата, если нужно
                                     if 'vless://' in client_config:
                                         lines = client_config.split('\n')
                                         for line in lines:
                                             if line.strip().startswith('vless://'):
                                                 client_config = line.strip()
                                                 break
-                                elif result.get('key') and isinstance(result.get('key'), dict) and result['key'].get('client_config'):
-                                    client_config = result['key']['client_config']
-                                    if 'vless://' in client_config:
+
+                                    # Проверяем наличие ключевых параметров
+                                    if 'sni=' in client_config and 'sid=' in client_config:
+                                        logger.info(f"✅ Got ready VLESS URL with SNI and short_id from /api/keys/{key_id}/link")
+                                    else:
+                                        logger.warning(f"⚠️  VLESS URL from /api/keys/{key_id}/link missing SNI or short_id")
+
+                                    logger.info(f"✅ Successfully obtained ready VLESS URL via /api/keys/{key_id}/link")
+                                else:
+                                    logger.warning(f"⚠️  /api/keys/{key_id}/link returned empty vless_link")
+                            else:
+                                logger.warning(f"⚠️  Failed to get link via /api/keys/{key_id}/link: status {config_response.status}")
+                    except Exception as config_error:
+                        logger.warning(f"⚠️  Error getting link via /api/keys/{key_id}/link: {config_error}")
+            
+                # Если не получилось получить через config эндпоинт, пробуем синхронизацию и повтор
+                if not client_config:
+                    logger.info(f"Config not obtained, trying sync and retry...")
+                    try:
+                        sync_success = await self.sync_xray_config(timeout=5.0)
+                        if sync_success:
+                            logger.info(f"Sync successful, retrying link fetch...")
+                            # Повторная попытка после синхронизации
+                            async with panel_concurrency.slot(self.api_url), session.get(
+                                    f"{self.api_url}/keys/{key_id}/link",
+                                    headers=self.headers
+                                ) as retry_response:
+                                if retry_response.status == 200:
+                                    retry_result = await retry_response.json()
+                                    client_config = retry_result.get('vless_link') or retry_result.get('client_config') or retry_result.get('vless_url')
+                                
+                                    if client_config and 'vless://' in client_config:
                                         lines = client_config.split('\n')
                                         for line in lines:
                                             if line.strip().startswith('vless://'):
                                                 client_config = line.strip()
+                                                if 'sni=' in client_config and 'sid=' in client_config:
+                                                    logger.info(f"✅ Got ready VLESS URL after sync and retry")
                                                 break
-                        
-                            # Если все еще нет, используем get_user_config как последний fallback
-                            if not client_config:
-                                logger.warning(f"No client_config found anywhere, using get_user_config as last resort")
-                                try:
-                                    # Используем get_user_config с параметрами из ответа API
-                                    server_config = {
-                                        'domain': None,  # Будет получен из конфигурации
-                                        'port': port,
-                                        'email': email
-                                    }
-                                    client_config = await self.get_user_config(uuid_value, server_config, max_retries=3, retry_delay=1.0)
-                                except Exception as fallback_error:
-                                    logger.error(f"Failed to get config via get_user_config fallback: {fallback_error}")
-                                    # Не прерываем выполнение - ключ создан, просто нет конфигурации
-                        
-                            if client_config and isinstance(client_config, str):
-                                client_config = client_config.strip()
-                        
-                            # Вызываем синхронизацию для гарантии применения ключа
-                            # Согласно документации API, ключ автоматически применяется при создании,
-                            # но дополнительная синхронизация гарантирует применение
-                            # Запускаем синхронизацию в фоне, чтобы не блокировать создание ключа
-                            async def sync_in_background():
-                                try:
-                                    sync_success = await self.sync_xray_config(timeout=5.0)
-                                    if sync_success:
-                                        logger.debug(f"Successfully synchronized Xray config via HandlerService API after creating key {key_id} (UUID: {uuid_value})")
-                                    # Не логируем предупреждения для неудачной синхронизации, так как это не критично
-                                except Exception as sync_error:
-                                    # Не прерываем выполнение, если синхронизация не удалась
-                                    logger.debug(f"Xray config sync failed for key {key_id}: {sync_error} (non-critical)")
-                        
-                            # Запускаем синхронизацию в фоне без ожидания
-                            import asyncio
-                            asyncio.create_task(sync_in_background())
-                        
-                            # API возвращает key_id (integer) согласно документации
-                            # Сохраняем для обратной совместимости и как id, и как key_id
-                            return {
-                                'id': key_id,
-                                'key_id': key_id,  # Добавляем key_id для соответствия документации
-                                'uuid': uuid_value,
-                                'name': email,
-                                'created_at': result.get('created_at'),
-                                'is_active': result.get('is_active', True),
-                                'port': port,  # Порт из ответа API
-                                'short_id': short_id,  # Short ID из ответа API (НЕ генерируем самостоятельно!)
-                                'sni': sni,  # SNI из ответа API
-                                'client_config': client_config  # Готовый VLESS URL из /api/keys/{key_id}/link (РЕКОМЕНДУЕТСЯ)
-                            }
-                        except Exception as parse_error:
-                            raise Exception(f"Failed to parse V2Ray API response: {parse_error} - Response: {response_text}")
-                    elif response.status in (502, 503, 504) and attempt < 2:
-                        logger.warning(
-                            f"V2Ray API returned {response.status}, retry {attempt + 1}/3 in 2s"
-                        )
-                        retry_after = True
-                    else:
-                        raise Exception(f"V2Ray API error: {response.status} - {response_text}")
-                if retry_after:
-                    await asyncio.sleep(2)
-                    continue
-                break
+                    except Exception as retry_error:
+                        logger.warning(f"Error during sync and retry: {retry_error}")
+            
+                # Если все еще нет client_config, пробуем извлечь из ответа создания (fallback)
+                if not client_config:
+                    logger.warning(f"No vless_link obtained via /api/keys/{key_id}/link, trying fallback from create response")
+                    vless_url = result.get('vless_url')
+                    if not vless_url and isinstance(result.get('key'), dict):
+                        vless_url = result['key'].get('vless_url')
+                    if isinstance(vless_url, str) and vless_url.strip():
+                        client_config = vless_url.strip()
+                
+                    if result.get('client_config'):
+                        client_config = result['client_config']
+                        if 'vless://' in client_config:
+                            lines = client_config.split('\n')
+                            for line in lines:
+                                if line.strip().startswith('vless://'):
+                                    client_config = line.strip()
+                                    break
+                    elif result.get('key') and isinstance(result.get('key'), dict) and result['key'].get('client_config'):
+                        client_config = result['key']['client_config']
+                        if 'vless://' in client_config:
+                            lines = client_config.split('\n')
+                            for line in lines:
+                                if line.strip().startswith('vless://'):
+                                    client_config = line.strip()
+                                    break
+            
+                # Если все еще нет, используем get_user_config как последний fallback
+                if not client_config:
+                    logger.warning(f"No client_config found anywhere, using get_user_config as last resort")
+                    try:
+                        # Используем get_user_config с параметрами из ответа API
+                        server_config = {
+                            'domain': None,  # Будет получен из конфигурации
+                            'port': port,
+                            'email': email
+                        }
+                        client_config = await self.get_user_config(uuid_value, server_config, max_retries=3, retry_delay=1.0)
+                    except Exception as fallback_error:
+                        logger.error(f"Failed to get config via get_user_config fallback: {fallback_error}")
+                        # Не прерываем выполнение - ключ создан, просто нет конфигурации
+            
+                if client_config and isinstance(client_config, str):
+                    client_config = client_config.strip()
+                    if not rendered_locally:
+                        vless_link_templates.learn(self.api_url, client_config)
+            
+                # Вызываем синхронизацию для гарантии применения ключа
+                # Согласно документации API, ключ автоматически применяется при создании,
+                # но дополнительная синхронизация гарантирует применение
+                # Запускаем синхронизацию в фоне, чтобы не блокировать создание ключа
+                async def sync_in_background():
+                    try:
+                        sync_success = await self.sync_xray_config(timeout=5.0, refresh_link_template=False)
+                        if sync_success:
+                            logger.debug(f"Successfully synchronized Xray config via HandlerService API after creating key {key_id} (UUID: {uuid_value})")
+                        # Не логируем предупреждения для неудачной синхронизации, так как это не критично
+                    except Exception as sync_error:
+                        # Не прерываем выполнение, если синхронизация не удалась
+                        logger.debug(f"Xray config sync failed for key {key_id}: {sync_error} (non-critical)")
+            
+                # Запускаем синхронизацию в фоне без ожидания
+                asyncio.create_task(sync_in_background())
+            
+                # API возвращает key_id (integer) согласно документации
+                # Сохраняем для обратной совместимости и как id, и как key_id
+                return {
+                    'id': key_id,
+                    'key_id': key_id,  # Добавляем key_id для соответствия документации
+                    'uuid': uuid_value,
+                    'name': email,
+                    'created_at': result.get('created_at'),
+                    'is_active': result.get('is_active', True),
+                    'port': port,  # Порт из ответа API
+                    'short_id': short_id,  # Short ID из ответа API (НЕ генерируем самостоятельно!)
+                    'sni': sni,  # SNI из ответа API
+                    'client_config': client_config  # Готовый VLESS URL из /api/keys/{key_id}/link (РЕКОМЕНДУЕТСЯ)
+                }
+            except Exception as parse_error:
+                raise Exception(f"Failed to parse V2Ray API response: {parse_error} - Response: {response_text}")
 
         except Exception as e:
             logger.error(f"Error creating V2Ray user: {e}")
             raise
     
+    @_invalidates_panel_cache
+    @_panel_slot
     async def delete_user(self, user_id: str) -> bool:
         """Удалить пользователя V2Ray через новый API"""
         try:
@@ -510,80 +792,88 @@ class V2RayProtocol(VPNProtocol):
                     logger.error(error_msg)
                     raise ValueError(error_msg)
                 
-                async with session.get(
+                async with panel_concurrency.slot(self.api_url), session.get(
                         config_url,
                         headers=self.headers
                     ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            logger.debug(f"[GET_CONFIG] API response status 200. Keys: {list(result.keys()) if isinstance(result, dict) else 'not a dict'}")
-                            
-                            # API возвращает vless_link в поле vless_link
-                            vless_url = None
-                            if isinstance(result, dict):
-                                vless_url = result.get('vless_link') or result.get('vless_url')
-                                if not vless_url and isinstance(result.get('key'), dict):
-                                    vless_url = result['key'].get('vless_link') or result['key'].get('vless_url')
-                            if isinstance(vless_url, str) and vless_url.strip():
-                                logger.info(f"[GET_CONFIG] Using vless_link from API response on attempt {attempt + 1}")
-                                return vless_url.strip()
-                            
-                            # Проверяем альтернативную структуру ответа (для обратной совместимости)
-                            if result.get('client_config'):
-                                # Извлекаем только VLESS URL из client_config
-                                client_config = result['client_config']
-                                logger.info(f"[GET_CONFIG] Found client_config in API response on attempt {attempt + 1}")
-                                # Ищем VLESS URL в конфигурации
-                                if 'vless://' in client_config:
-                                    # Извлекаем строку, начинающуюся с vless://
-                                    lines = client_config.split('\n')
-                                    for line in lines:
-                                        if line.strip().startswith('vless://'):
-                                            config_line = line.strip()
-                                            # Проверяем наличие SNI и shortid
-                                            if 'sni=' in config_line and 'sid=' in config_line:
-                                                logger.info(f"[GET_CONFIG] Successfully retrieved client_config with SNI and shortid on attempt {attempt + 1}")
-                                            else:
-                                                logger.warning(f"[GET_CONFIG] WARNING: Retrieved client_config without SNI or shortid on attempt {attempt + 1}")
-                                            return config_line
-                                # Если не нашли VLESS URL, возвращаем всю конфигурацию
-                                logger.debug(f"[GET_CONFIG] Successfully retrieved client_config (non-VLESS format) on attempt {attempt + 1}")
-                                return client_config
-                            
-                            # Если client_config не найден, проверяем альтернативную структуру
-                            if result.get('key') and result.get('client_config'):
-                                client_config = result['client_config']
-                                if 'vless://' in client_config:
-                                    lines = client_config.split('\n')
-                                    for line in lines:
-                                        if line.strip().startswith('vless://'):
-                                            logger.debug(f"Successfully retrieved client_config from key.client_config on attempt {attempt + 1}")
-                                            return line.strip()
-                                logger.debug(f"Successfully retrieved client_config from key.client_config (non-VLESS format) on attempt {attempt + 1}")
-                                return client_config
-                            
-                            # Если client_config не найден вообще, пробуем снова или выбрасываем исключение
-                            if attempt < max_retries - 1:
-                                logger.debug(f"API did not return client_config, retrying in {retry_delay}s (attempt {attempt + 1}/{max_retries})")
-                                await asyncio.sleep(retry_delay)
-                                continue
-                            else:
-                                # Если все попытки исчерпаны и client_config не получен, выбрасываем исключение
-                                # Не используем fallback с хардкодом short id, так как каждый сервер генерирует уникальные short id
-                                logger.error(f"API did not return client_config after {max_retries} attempts for user {user_id}")
-                                raise Exception(f"Failed to get client_config from V2Ray API after {max_retries} attempts. Server may be generating unique short IDs that must be retrieved from API.")
-                        
-                        # Если статус не 200, пробуем снова или выбрасываем исключение
-                        if attempt < max_retries - 1:
-                            logger.debug(f"API returned status {response.status}, retrying in {retry_delay}s (attempt {attempt + 1}/{max_retries})")
-                            await asyncio.sleep(retry_delay)
-                            continue
-                        else:
-                            # Если все попытки исчерпаны, выбрасываем исключение
-                            # Не используем fallback с хардкодом short id
-                            logger.error(f"API returned status {response.status} after {max_retries} attempts for user {user_id}")
-                            raise Exception(f"V2Ray API returned status {response.status} after {max_retries} attempts. Cannot use fallback with hardcoded short ID as servers generate unique short IDs.")
-                    
+                    status = response.status
+                    result = await response.json() if status == 200 else None
+
+                # Слот панели занят только на время запроса, паузы между повторами — без него
+                if status == 200:
+                    logger.debug(f"[GET_CONFIG] API response status 200. Keys: {list(result.keys()) if isinstance(result, dict) else 'not a dict'}")
+
+                    # API возвращает vless_link в поле vless_link
+                    vless_url = None
+                    if isinstance(result, dict):
+                        vless_url = result.get('vless_link') or result.get('vless_url')
+                        if not vless_url and isinstance(result.get('key'), dict):
+                            vless_url = result['key'].get('vless_link') or result['key'].get('vless_url')
+                    if isinstance(vless_url, str) and vless_url.strip():
+                        logger.info(f"[GET_CONFIG] Using vless_link from API response on attempt {attempt + 1}")
+                        vless_link_templates.learn(self.api_url, vless_url.strip())
+                        return vless_url.strip()
+
+                    # Проверяем альтернативную структуру ответа (для обратной совместимости)
+                    if result.get('client_config'):
+                        # Извлекаем только VLESS URL из client_config
+                        client_config = result['client_config']
+                        logger.info(f"[GET_CONFIG] Found client_config in API response on attempt {attempt + 1}")
+                        # Ищем VLESS URL в конфигурации
+                        if 'vless://' in client_config:
+                            # Извлекаем строку, начинающуюся с vless://
+                            lines = client_config.split('\n')
+                            for line in lines:
+                                if line.strip().startswith('vless://'):
+                                    config_line = line.strip()
+                                    # Проверяем наличие SNI и shortid
+                                    if 'sni=' in config_line and 'sid=' in config_line:
+                                        logger.info(f"[GET_CONFIG] Successfully retrieved client_config with SNI and shortid on attempt {attempt + 1}")
+                                    else:
+                                        logger.warning(f"[GET_CONFIG] WARNING: Retrieved client_config without SNI or shortid on attempt {attempt + 1}")
+                                    vless_link_templates.learn(self.api_url, config_line)
+                                    return config_line
+                        # Если не нашли VLESS URL, возвращаем всю конфигурацию
+                        logger.debug(f"[GET_CONFIG] Successfully retrieved client_config (non-VLESS format) on attempt {attempt + 1}")
+                        return client_config
+
+                    # Если client_config не найден, проверяем альтернативную структуру
+                    if result.get('key') and result.get('client_config'):
+                        client_config = result['client_config']
+                        if 'vless://' in client_config:
+                            lines = client_config.split('\n')
+                            for line in lines:
+                                if line.strip().startswith('vless://'):
+                                    logger.debug(f"Successfully retrieved client_config from key.client_config on attempt {attempt + 1}")
+                                    return line.strip()
+                        logger.debug(f"Successfully retrieved client_config from key.client_config (non-VLESS format) on attempt {attempt + 1}")
+                        return client_config
+
+                    # Если client_config не найден вообще, пробуем снова или выбрасываем исключение
+                    if attempt < max_retries - 1:
+                        logger.debug(f"API did not return client_config, retrying in {retry_delay}s (attempt {attempt + 1}/{max_retries})")
+                        await asyncio.sleep(retry_delay)
+                        continue
+                    else:
+                        # Если все попытки исчерпаны и client_config не получен, выбрасываем исключение
+                        # Не используем fallback с хардкодом short id, так как каждый сервер генерирует уникальные short id
+                        logger.error(f"API did not return client_config after {max_retries} attempts for user {user_id}")
+                        raise Exception(f"Failed to get client_config from V2Ray API after {max_retries} attempts. Server may be generating unique short IDs that must be retrieved from API.")
+
+                # Если статус не 200, пробуем снова или выбрасываем исключение
+                if attempt < max_retries - 1:
+                    logger.debug(f"API returned status {status}, retrying in {retry_delay}s (attempt {attempt + 1}/{max_retries})")
+                    await asyncio.sleep(retry_delay)
+                    continue
+                else:
+                    # Если все попытки исчерпаны, выбрасываем исключение
+                    # Не используем fallback с хардкодом short id
+                    logger.error(f"API returned status {status} after {max_retries} attempts for user {user_id}")
+                    raise Exception(f"V2Ray API returned status {status} after {max_retries} attempts. Cannot use fallback with hardcoded short ID as servers generate unique short IDs.")
+
+            except PanelCircuitOpenError:
+                # Панель помечена недоступной: повторы с задержкой ничего не дадут
+                raise
             except Exception as e:
                 import traceback
                 error_details = str(e)
@@ -602,6 +892,7 @@ class V2RayProtocol(VPNProtocol):
         # Если цикл не вернул значение, выбрасываем исключение
         raise Exception(f"Failed to get client_config from V2Ray API for user {user_id}. No valid response received after {max_retries} attempts.")
     
+    @_panel_slot
     async def get_traffic_stats(self) -> List[Dict]:
         """Получить статистику трафика V2Ray через новый API"""
         try:
@@ -669,6 +960,55 @@ class V2RayProtocol(VPNProtocol):
             logger.error(f"Error getting V2Ray traffic stats: {e}")
             return []
     
+    @_panel_slot
+    async def get_traffic_totals_by_uuid(self) -> Optional[Dict[str, int]]:
+        """Получить накопленный трафик всех ключей сервера одним запросом GET /traffic.
+
+        Returns:
+            Словарь {uuid: total_bytes} или None, если панель не ответила/формат неизвестен
+            (вызывающий код тогда переходит на поштучные запросы по ключам).
+        """
+        try:
+            session = self._session
+            async with session.get(
+                    f"{self.api_url}/traffic",
+                    headers=self.headers
+                ) as response:
+                    if response.status != 200:
+                        logger.warning(f"Failed to get bulk traffic from {self.api_url}: {response.status}")
+                        return None
+                    result = await response.json()
+        except Exception as e:
+            logger.warning(f"Error getting bulk V2Ray traffic from {self.api_url}: {e}")
+            return None
+
+        if not isinstance(result, dict):
+            return None
+        data = result.get('data') if isinstance(result.get('data'), dict) else result
+        ports = data.get('ports')
+        if isinstance(ports, dict):
+            entries = ports.values()
+        elif isinstance(ports, list):
+            entries = ports
+        else:
+            return None
+
+        totals: Dict[str, int] = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            uuid_value = entry.get('uuid') or entry.get('key_uuid')
+            if not isinstance(uuid_value, str) or not uuid_value.strip():
+                continue
+            total = entry.get('total_bytes')
+            if total is None:
+                total = entry.get('total')
+            if total is None and ('rx_bytes' in entry or 'tx_bytes' in entry):
+                total = (entry.get('rx_bytes') or 0) + (entry.get('tx_bytes') or 0)
+            if isinstance(total, (int, float)) and total >= 0:
+                totals[uuid_value.strip()] = int(total)
+        return totals
+
     async def get_key_traffic_stats(self, key_id: str) -> Dict:
         """Получить статистику трафика конкретного ключа через новый API
         
@@ -681,6 +1021,13 @@ class V2RayProtocol(VPNProtocol):
             "last_updated": 1703520000
         }
         """
+        _status, stats = await self._request_key_traffic_stats(key_id)
+        return stats
+
+    @_single_flight(cache_if=lambda result: result[0] == 200)
+    @_panel_slot
+    async def _request_key_traffic_stats(self, key_id: str) -> Tuple[Optional[int], Dict]:
+        """GET /keys/{key_id}/traffic: (HTTP-статус или None при сетевой ошибке, статистика или {})."""
         try:
             session = self._session
             async with session.get(
@@ -712,7 +1059,7 @@ class V2RayProtocol(VPNProtocol):
                         download_bytes_int = int(download_bytes) if download_bytes else 0
                         total_bytes_int = int(total_bytes) if total_bytes else 0
                         
-                        return {
+                        return response.status, {
                             'uuid': result.get('key_uuid') or result.get('uuid'),
                             'key_id': key_id_from_api or key_id,
                             'key_name': result.get('key_name', 'Unknown'),
@@ -738,10 +1085,10 @@ class V2RayProtocol(VPNProtocol):
                         logger.error(f"Failed to get key traffic stats: {response.status}")
                         response_text = await response.text()
                         logger.error(f"Response: {response_text}")
-                        return {}
+                        return response.status, {}
         except Exception as e:
             logger.error(f"Error getting V2Ray key traffic stats: {e}")
-            return {}
+            return None, {}
     
     def _format_bytes(self, num_bytes: int) -> str:
         """Форматировать байты в человекочитаемый формат"""
@@ -766,6 +1113,13 @@ class V2RayProtocol(VPNProtocol):
             "previous_total": 3072000
         }
         """
+        _status, ok = await self._request_key_traffic_reset(key_id)
+        return ok
+
+    @_invalidates_panel_cache
+    @_panel_slot
+    async def _request_key_traffic_reset(self, key_id: str) -> Tuple[Optional[int], bool]:
+        """POST /keys/{key_id}/traffic/reset: (HTTP-статус или None при сетевой ошибке, успех)."""
         try:
             session = self._session
             async with session.post(
@@ -784,18 +1138,18 @@ class V2RayProtocol(VPNProtocol):
                             if 'previous_total' in result:
                                 prev_total = result.get('previous_total', 0)
                                 logger.debug(f"Previous traffic for key {key_id}: {prev_total} bytes ({prev_total / (1024*1024):.2f} MB)")
-                            return True
+                            return response.status, True
                         else:
                             logger.warning(f"Unexpected reset response: {message}")
-                            return False
+                            return response.status, False
                     else:
                         logger.error(f"Failed to reset traffic stats: {response.status}")
                         response_text = await response.text()
                         logger.error(f"Response: {response_text}")
-                        return False
+                        return response.status, False
         except Exception as e:
             logger.error(f"Error resetting V2Ray key traffic: {e}")
-            return False
+            return None, False
     
     async def get_traffic_status(self) -> Dict:
         """Получить статус системы мониторинга трафика"""
@@ -1048,7 +1402,7 @@ class V2RayProtocol(VPNProtocol):
             logger.error(f"Error getting V2Ray Xray config status: {e}")
             return {}
     
-    async def sync_xray_config(self, timeout: float = 5.0) -> bool:
+    async def sync_xray_config(self, timeout: float = 5.0, refresh_link_template: bool = True) -> bool:
         """Синхронизировать конфигурацию Xray через HandlerService API
         
         Согласно документации API, этот метод применяет изменения через Xray HandlerService API
@@ -1056,6 +1410,9 @@ class V2RayProtocol(VPNProtocol):
         
         Args:
             timeout: Таймаут для запроса в секундах (по умолчанию 5 секунд)
+            refresh_link_template: после успешной синхронизации сбросить шаблон VLESS-ссылок
+                сервера (параметры Reality могли измениться); фоновая синхронизация после
+                create_user шаблон не трогает
         
         Returns:
             True если синхронизация успешна, False в противном случае
@@ -1074,6 +1431,8 @@ class V2RayProtocol(VPNProtocol):
                         message = result.get('message', '')
                         if 'synchronized successfully' in message.lower():
                             logger.info("Successfully synchronized Xray config via HandlerService API")
+                            if refresh_link_template:
+                                vless_link_templates.invalidate(self.api_url)
                             return True
                         else:
                             logger.warning(f"Unexpected Xray sync response: {message}")
@@ -1126,6 +1485,8 @@ class V2RayProtocol(VPNProtocol):
             logger.error(f"Error validating V2Ray Xray sync: {e}")
             return {}
     
+    @_single_flight()
+    @_panel_slot
     async def get_all_keys(self) -> List[Dict]:
         """Получить список всех ключей
         
@@ -1158,6 +1519,41 @@ class V2RayProtocol(VPNProtocol):
             logger.error(f"Error getting V2Ray all keys: {e}")
             return []
     
+    async def iter_all_keys(self, chunk_size: int = 64 * 1024) -> AsyncIterator[Dict]:
+        """Потоково перебрать ключи панели (GET /keys) без загрузки всего ответа в память.
+
+        Элементы разбираются по мере чтения тела ответа; формат — как у get_all_keys()
+        (список или объект с полем 'keys'). В отличие от get_all_keys(), ошибки не глотаются:
+        при HTTP-ошибке или обрыве ответа бросается исключение, и вызывающий код может
+        отличить «ключей нет» от «список не получен».
+
+        Слот панели берётся только на запрос и на чтение каждого куска тела, но не на время
+        обработки элементов потребителем.
+        """
+        async with panel_concurrency.slot(self.api_url):
+            response = await self._session.get(f"{self.api_url}/keys", headers=self.headers)
+        try:
+            if response.status != 200:
+                raise Exception(f"Failed to get all keys: {response.status}")
+            async for entry in iter_json_array(self._iter_body_chunks(response, chunk_size), field="keys"):
+                if isinstance(entry, dict):
+                    yield entry
+        finally:
+            response.release()
+
+    async def _iter_body_chunks(self, response: aiohttp.ClientResponse, chunk_size: int) -> AsyncIterator[bytes]:
+        """Куски тела ответа; каждый читается в слоте панели, отдаётся — вне его."""
+        chunks = response.content.iter_chunked(chunk_size).__aiter__()
+        while True:
+            async with panel_concurrency.slot(self.api_url):
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield chunk
+
+    @_single_flight()
+    @_panel_slot
     async def get_key_info(self, key_id: str) -> Dict:
         """Получить информацию о конкретном ключе
         
@@ -1194,21 +1590,48 @@ class V2RayProtocol(VPNProtocol):
             logger.error(f"Error getting V2Ray key info: {e}")
             return {}
 
-    async def get_v2ray_key_traffic_resolved(self, v2ray_uuid: str) -> Tuple[Optional[str], Dict]:
+    async def resolve_panel_key_id(self, v2ray_uuid: str) -> Optional[str]:
+        """Числовой key_id панели по UUID (GET /keys/{uuid}); None, если ключ не найден."""
+        key_info = await self.get_key_info(v2ray_uuid)
+        api_key_id = key_info.get("id") or key_info.get("uuid")
+        return str(api_key_id) if api_key_id else None
+
+    async def get_v2ray_key_traffic_resolved(
+        self, v2ray_uuid: str, panel_key_id: Optional[str] = None
+    ) -> Tuple[Optional[str], Dict]:
         """
         Получить статистику трафика ключа, корректно резолвя идентификатор панели.
 
         В некоторых версиях панели эндпоинт GET /keys/{key_id}/traffic принимает только числовой key_id,
-        а UUID в path приводит к 422 (int_parsing). Поэтому сначала получаем key_id через GET /keys/{uuid},
-        затем запрашиваем трафик по числовому id.
+        а UUID в path приводит к 422 (int_parsing). Если key_id уже известен (v2ray_keys.panel_key_id),
+        трафик запрашивается сразу по нему; резолв через GET /keys/{uuid} выполняется только когда
+        id не сохранён или панель ответила 404/422 (ключ пересоздан под другим id).
+
+        Returns:
+            (key_id панели, статистика) — key_id стоит сохранить в БД, если он отличается от переданного.
         """
         try:
-            key_info = await self.get_key_info(v2ray_uuid)
-            api_key_id = key_info.get("id") or key_info.get("uuid")
-            if not api_key_id:
+            if panel_key_id:
+                status, stats = await self._request_key_traffic_stats(str(panel_key_id))
+                stats_uuid = (stats.get("uuid") or "").strip() if stats else ""
+                if stats and (not stats_uuid or stats_uuid == v2ray_uuid.strip()):
+                    total_bytes = stats.get("total_bytes")
+                    if isinstance(total_bytes, (int, float)) and total_bytes >= 0:
+                        return str(panel_key_id), stats
+                    return None, {}
+                if stats or status in _PANEL_KEY_ID_STALE_STATUSES:
+                    logger.info(
+                        "[V2RAY TRAFFIC] Stored panel key_id %s is stale for %s (status=%s), re-resolving",
+                        panel_key_id, v2ray_uuid, status,
+                    )
+                else:
+                    # Сетевая ошибка/5xx: повторный резолв не поможет, только удвоит нагрузку на панель
+                    return None, {}
+
+            sid = await self.resolve_panel_key_id(v2ray_uuid)
+            if not sid:
                 return None, {}
 
-            sid = str(api_key_id)
             stats2 = await self.get_key_traffic_stats(sid)
             if not stats2:
                 return None, {}
@@ -1221,6 +1644,48 @@ class V2RayProtocol(VPNProtocol):
             logger.error("Error in get_v2ray_key_traffic_resolved for %s: %s", v2ray_uuid, e)
             return None, {}
 
+    async def reset_v2ray_key_traffic_resolved(
+        self, v2ray_uuid: str, panel_key_id: Optional[str] = None
+    ) -> Tuple[Optional[str], bool]:
+        """
+        Сбросить трафик ключа по сохранённому key_id панели, с резолвом по UUID только после 404/422.
+
+        Сброс — разрушающая запись, поэтому сохранённый key_id сначала сверяется с v2ray_uuid
+        (uuid из статистики трафика, при его отсутствии — GET /keys/{key_id}): id мог достаться
+        другому ключу после пересоздания. При несовпадении key_id резолвится заново по UUID.
+
+        Returns:
+            (key_id панели, успех сброса)
+        """
+        try:
+            if panel_key_id:
+                status, stats = await self._request_key_traffic_stats(str(panel_key_id))
+                owner_uuid = (stats.get("uuid") or "").strip() if stats else ""
+                if stats and not owner_uuid:
+                    owner_uuid = ((await self.get_key_info(str(panel_key_id))).get("uuid") or "").strip()
+                if stats and owner_uuid == v2ray_uuid.strip():
+                    status, ok = await self._request_key_traffic_reset(str(panel_key_id))
+                    if ok:
+                        return str(panel_key_id), True
+                    if status not in _PANEL_KEY_ID_STALE_STATUSES:
+                        return str(panel_key_id), False
+                elif stats or status in _PANEL_KEY_ID_STALE_STATUSES:
+                    logger.info(
+                        "[V2RAY TRAFFIC] Stored panel key_id %s does not belong to %s (status=%s), re-resolving",
+                        panel_key_id, v2ray_uuid, status,
+                    )
+                else:
+                    # Сетевая ошибка/5xx: владельца id не подтвердить, чужой ключ не сбрасываем
+                    return str(panel_key_id), False
+
+            sid = await self.resolve_panel_key_id(v2ray_uuid)
+            if not sid:
+                return None, False
+            return sid, await self.reset_key_traffic(sid)
+        except Exception as e:
+            logger.error("Error in reset_v2ray_key_traffic_resolved for %s: %s", v2ray_uuid, e)
+            return None, False
+
     async def get_traffic_history(self) -> Dict:
         """Получить общий объем трафика для всех ключей с момента создания"""
         try:
@@ -1318,6 +1783,7 @@ class V2RayProtocol(VPNProtocol):
             logger.error(f"Error getting V2Ray daily traffic stats: {e}")
             return {}
 
+    @_invalidates_panel_cache
     async def reset_key_traffic_history(self, key_id: str) -> bool:
         """Сбросить историю трафика для конкретного ключа"""
         try:
@@ -1401,18 +1867,76 @@ class V2RayProtocol(VPNProtocol):
             return {}
     
     async def close(self):
-        """Закрыть сессию"""
-        if hasattr(self, '_session') and not self._session.closed:
-            await self._session.close()
+        """Закрыть сессию.
+
+        Для общих клиентов из реестра ничего не делает: сессией владеет пул,
+        её закрывает close_v2ray_clients() при остановке процесса.
+        """
+        if self._shared:
+            return
+        if self._own_session is not None and not self._own_session.closed:
+            await self._own_session.close()
+
+
+class V2RayClientRegistry:
+    """Реестр долгоживущих клиентов панелей V2Ray по ключу (api_url, api_key).
+
+    Все клиенты работают поверх общего пула сессий (panel_session_pool), поэтому
+    повторные запросы к одной панели переиспользуют keep-alive соединения.
+    """
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, str], V2RayProtocol] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_url: str, api_key: Optional[str] = None) -> V2RayProtocol:
+        """Вернуть общий клиент для панели (создаётся при первом обращении)."""
+        registry_key = ((api_url or "").strip(), (api_key or "").strip())
+        with self._lock:
+            client = self._clients.get(registry_key)
+            if client is None:
+                client = V2RayProtocol(api_url, api_key, shared=True)
+                self._clients[registry_key] = client
+            return client
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+    async def close(self) -> None:
+        """Закрыть общую сессию текущего event loop (shutdown-хук бота и админки)."""
+        await panel_session_pool.close()
+
+
+# Global registry instance
+v2ray_clients = V2RayClientRegistry()
+
+
+def get_v2ray_client(api_url: str, api_key: Optional[str] = None) -> V2RayProtocol:
+    """Получить общий клиент панели из реестра."""
+    return v2ray_clients.get(api_url, api_key)
+
+
+async def close_v2ray_clients() -> None:
+    """Закрыть пул соединений к панелям (вызывать при остановке процесса)."""
+    try:
+        await v2ray_clients.close()
+    except Exception as e:
+        logger.warning(f"Error closing V2Ray panel sessions: {e}")
+
 
 class ProtocolFactory:
     """Фабрика для создания протоколов"""
     
     @staticmethod
     def create_protocol(protocol_type: str, server_config: Dict) -> VPNProtocol:
-        """Создать экземпляр протокола по типу"""
+        """Получить клиент протокола по типу (общий клиент из реестра)"""
         if protocol_type == 'v2ray':
-            return V2RayProtocol(
+            return v2ray_clients.get(
                 server_config['api_url'], 
                 server_config.get('api_key')
             )